@@ -0,0 +1,637 @@
+from __main__ import vtk, qt, ctk, slicer
+from slicer.ScriptedLoadableModule import *
+from vtk.util import numpy_support
+import json
+import logging
+import numpy
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+#
+# CathNavBenchmark
+#
+
+class CathNavBenchmark(ScriptedLoadableModule):
+  def __init__(self, parent):
+    parent.title = "CathNavBenchmark"
+    parent.categories = ["IGT"]
+    parent.dependencies = ["MarkupsToModel", "PivotCalibration"]
+    parent.contributors = ["Thomas Vaughan (Queen's)", "Gabor Fichtinger (Queen's)"]
+    parent.helpText = """
+    Time the CathNav hot paths and write the results to a JSON file. The benchmarks clear the scene.
+    To run without a display or GPU:
+    Slicer --no-main-window --no-splash --python-code "import CathNavBenchmark; CathNavBenchmark.CathNavBenchmarkLogic().runBenchmarks('CathNavBenchmark.json'); slicer.app.quit()"
+    """
+    parent.acknowledgementText = """
+	This work is funded as a project in the Laboratory for Percutaneous Surgery, Queen's University, Kingston, Ontario. Thomas Vaughan is funded by an NSERC Postgraduate award. Gabor Fichtinger is funded as a Cancer Care Ontario (CCO) Chair.
+	""" # replace with organization, grant and thanks.
+    self.parent = parent
+
+#
+# CathNavBenchmarkWidget
+#
+
+class CathNavBenchmarkWidget(ScriptedLoadableModuleWidget):
+
+  def setup(self):
+    ScriptedLoadableModuleWidget.setup(self)
+
+    self.logic = CathNavBenchmarkLogic()
+
+    # Collapsible buttons
+    self.parametersCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.parametersCollapsibleButton.text = "CathNavBenchmark"
+    self.layout.addWidget(self.parametersCollapsibleButton)
+
+    # Layout within the collapsible button
+    self.parametersFormLayout = qt.QFormLayout(self.parametersCollapsibleButton)
+
+    self.outputFilePathLabel = qt.QLabel()
+    self.outputFilePathLabel.setText("Results file: ")
+    self.outputFilePathEdit = ctk.ctkPathLineEdit()
+    self.outputFilePathEdit.filters = ctk.ctkPathLineEdit.Files | ctk.ctkPathLineEdit.Writable
+    self.outputFilePathEdit.nameFilters = ["JSON (*.json)"]
+    self.outputFilePathEdit.currentPath = os.path.join(tempfile.gettempdir(), 'CathNavBenchmark.json')
+    self.parametersFormLayout.addRow(self.outputFilePathLabel, self.outputFilePathEdit)
+
+    self.quickCheckBox = qt.QCheckBox("Quick (small sizes, few repeats)")
+    self.parametersFormLayout.addRow(self.quickCheckBox)
+
+    self.runButton = qt.QPushButton()
+    self.runButton.text = "Run Benchmarks"
+    self.runButton.setToolTip("Run all benchmarks. This clears the scene.")
+    self.parametersFormLayout.addRow(self.runButton)
+
+    self.runButton.connect('clicked()', self.runButtonClicked)
+
+    # Add vertical spacer
+    self.layout.addStretch(1)
+
+  def runButtonClicked(self):
+    logging.debug('runButtonClicked')
+    # the benchmarks need the application scene, so they clear it, including a case open in CathNav
+    if (not slicer.util.confirmOkCancelDisplay("Running the benchmarks clears the scene. Unsaved data, e.g. of a CathNav case, is lost.\n\nRun the benchmarks?")):
+      return
+    qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+    try:
+      self.logic.runBenchmarks(self.outputFilePathEdit.currentPath, self.quickCheckBox.checked)
+    finally:
+      qt.QApplication.restoreOverrideCursor()
+
+#
+# CathNavBenchmarkLogic
+#
+
+class CathNavBenchmarkLogic(ScriptedLoadableModuleLogic):
+  """
+  Each benchmark returns a list of dictionaries, one per problem size, with the timings in seconds.
+  Geometry comes from the shipped scenes where they have it, the rest is synthetic with a fixed seed
+  so that runs on different commits time the same work.
+  """
+  # constants - DO NOT CHANGE THESE
+  resultsFormatVersion = 1
+  randomSeed = 0
+
+  def __init__(self):
+    sourceDirectoryPath = os.path.dirname(os.path.abspath(__file__))
+    self.savedSceneFilePath = os.path.join(sourceDirectoryPath, 'slicelet', 'SavedScenes', 'CathNav-20151126-131041', 'CathNav-20151126-131041.mrml')
+    self.tumorModelFilePath = os.path.join(sourceDirectoryPath, 'slicelet', 'SavedScenes', 'CathNav-20151126-131041', 'Data', 'TumorModel.vtk')
+    self.demoSceneFilePath = os.path.join(sourceDirectoryPath, '..', 'doc', 'DemoScene', 'Demo-2015_02_27c', '2015-02-12-Scene.mrml')
+    self.numberOfRepeats = 5
+    self.seromaRadiusMm = 20.0
+
+  def runBenchmarks(self, outputFilePath, quick=False):
+    """
+    Run every benchmark, write the results with the environment they were measured in to outputFilePath
+    and return them. quick uses small problem sizes and few repeats, for smoke tests.
+    """
+    logging.info('Running CathNav benchmarks')
+    self.numberOfRepeats = 2 if quick else 5
+    benchmarks = [
+      ('sceneLoad', lambda: self.benchmarkSceneLoad()),
+      ('gridGeneration', lambda: self.benchmarkGridGeneration([5,10] if quick else [5,10,20,40,80])),
+      ('fixedPointCalibration', lambda: self.benchmarkFixedPointCalibration([100] if quick else [250,1000,4000])),
+      ('pivotCalibration', lambda: self.benchmarkPivotCalibration([100] if quick else [250,750,2000])),
+      ('pointCollection', lambda: self.benchmarkPointCollection([50,200], 1 if quick else 10)),
+      ('closedSurfaceRebuild', lambda: self.benchmarkClosedSurfaceRebuild([20] if quick else [10,20,50,100,200])),
+      ('catheterReconstruction', lambda: self.benchmarkCatheterReconstruction([50] if quick else [50,100,200,400,800])),
+      ('tipToSurfaceDistance', lambda: self.benchmarkTipToSurfaceDistance([20] if quick else [20,50,100])),
+      ('catheterAnalysis', lambda: self.benchmarkCatheterAnalysis([10] if quick else [10,20,50])),
+      ('transformQueries', lambda: self.benchmarkTransformQueries(50 if quick else 1000)),
+      ('trackingReplay', lambda: self.benchmarkTrackingReplay(1 if quick else 10)),
+      ]
+    results = { 'formatVersion' : self.resultsFormatVersion,
+                'environment' : self.getEnvironment(),
+                'quick' : quick,
+                'benchmarks' : {} }
+    for benchmarkName, benchmark in benchmarks:
+      slicer.mrmlScene.Clear(0)
+      startTimeSec = time.time()
+      results['benchmarks'][benchmarkName] = benchmark()
+      logging.info("Benchmark {0} done in {1:.1f} s".format(benchmarkName, time.time() - startTimeSec))
+    slicer.mrmlScene.Clear(0)
+    with open(outputFilePath, 'w') as outputFile:
+      json.dump(results, outputFile, indent=2, sort_keys=True)
+    logging.info("Benchmark results written to {0}".format(outputFilePath))
+    return results
+
+  def getEnvironment(self):
+    try:
+      gitCommit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+      gitCommit = None # not running from a git checkout
+    return { 'gitCommit' : gitCommit,
+             'timestamp' : time.strftime("%Y-%m-%dT%H:%M:%S"),
+             'platform' : platform.platform(),
+             'processor' : platform.processor(),
+             'python' : platform.python_version(),
+             'numpy' : numpy.__version__,
+             'vtk' : vtk.vtkVersion.GetVTKVersion(),
+             'slicer' : slicer.app.applicationVersion }
+
+  def timeRepeated(self, function, numberOfRepeats=None):
+    # the minimum is the most stable figure across runs, the median shows how noisy the machine was
+    numberOfRepeats = numberOfRepeats or self.numberOfRepeats
+    durationsSec = []
+    for repeatIndex in xrange(numberOfRepeats):
+      startTimeSec = time.time()
+      function()
+      durationsSec.append(time.time() - startTimeSec)
+    return { 'minimumSec' : min(durationsSec), 'medianSec' : float(numpy.median(durationsSec)), 'numberOfRepeats' : numberOfRepeats }
+
+  def addMarkupsFromArray(self, markupsNode, pointsMm):
+    wasModifying = markupsNode.StartModify()
+    for pointMm in pointsMm:
+      markupsNode.AddFiducialFromArray(pointMm.tolist())
+    markupsNode.EndModify(wasModifying)
+
+  def benchmarkSceneLoad(self):
+    results = []
+    for sceneFilePath in [self.savedSceneFilePath, self.demoSceneFilePath]:
+      def loadScene():
+        slicer.mrmlScene.Clear(0)
+        slicer.util.loadScene(sceneFilePath)
+      result = { 'scene' : os.path.basename(sceneFilePath) }
+      result.update(self.timeRepeated(loadScene))
+      results.append(result)
+    return results
+
+  def benchmarkGridGeneration(self, gridSizesMm):
+    import InsertionGridPlanner
+    return InsertionGridPlanner.InsertionGridPlannerLogic().benchmarkGridGeneration(gridSizesMm)
+
+  def benchmarkFixedPointCalibration(self, numbersOfPoints):
+    import CathNav
+    import ToolCalibration
+    cathNavLogic = CathNav.CathNavLogic()
+    toolCalibrationLogic = ToolCalibration.ToolCalibrationLogic()
+    randomState = numpy.random.RandomState(self.randomSeed)
+    toolPointMm = numpy.array([10,20,30.0])
+    results = []
+    for numberOfPoints in numbersOfPoints:
+      pointsMm = randomState.normal(toolPointMm, 0.5, [numberOfPoints,3])
+      markupsNode = slicer.mrmlScene.AddNode(slicer.vtkMRMLMarkupsFiducialNode())
+      self.addMarkupsFromArray(markupsNode, pointsMm)
+      def calibrate():
+        toolPointMm = cathNavLogic.computeAverageOfMarkups(markupsNode)
+        cathNavLogic.computeRMSEOfPointToMarkups(toolPointMm, markupsNode)
+      result = { 'numberOfPoints' : numberOfPoints }
+      result.update(self.timeRepeated(calibrate))
+      slicer.mrmlScene.RemoveNode(markupsNode)
+      # the streaming calibration, including the per-sample cost, on the same samples with 1% of them glitched
+      glitchIndices = randomState.choice(numberOfPoints, max(1, numberOfPoints / 100), replace=False)
+      pointsMm[glitchIndices] = pointsMm[glitchIndices] + randomState.normal(0, 30, [len(glitchIndices),3])
+      fixedPointCalibration = ToolCalibration.FixedPointCalibration(toolCalibrationLogic)
+      def calibrateStreaming():
+        fixedPointCalibration.reset()
+        for pointMm in pointsMm:
+          fixedPointCalibration.addSample(pointMm)
+        fixedPointCalibration.computeCalibration()
+      result['streaming'] = self.timeRepeated(calibrateStreaming)
+      calibration = fixedPointCalibration.computeCalibration()
+      result['streaming']['numberOfGlitches'] = len(glitchIndices)
+      result['streaming']['meanErrorMm'] = float(numpy.linalg.norm(fixedPointCalibration.getMeanMm() - toolPointMm))
+      result['streaming']['meanRmseMm'] = fixedPointCalibration.getRMSEMm()
+      result['streaming']['robustErrorMm'] = float(numpy.linalg.norm(calibration['pointMm'] - toolPointMm))
+      result['streaming']['robustRmseMm'] = calibration['rmseMm']
+      result['streaming']['numberOfOutliers'] = calibration['numberOfSamples'] - calibration['numberOfInliers']
+      results.append(result)
+    return results
+
+  def getPivotPoseMatrices(self, numberOfPoses, randomState):
+    # tool swivelling up to 30 degrees around a fixed tip 100 mm from the sensor
+    tipToToolMm = numpy.array([0, 0, 100.0])
+    pivotMm = numpy.array([20, -10, 50.0])
+    matrices = []
+    for poseIndex in xrange(numberOfPoses):
+      transform = vtk.vtkTransform()
+      transform.RotateX(randomState.uniform(-30,30))
+      transform.RotateY(randomState.uniform(-30,30))
+      transform.RotateZ(randomState.uniform(-180,180))
+      rotatedTipMm = numpy.array(transform.TransformPoint(tipToToolMm.tolist()))
+      translationMm = pivotMm - rotatedTipMm + randomState.normal(0, 0.2, 3)
+      matrix = vtk.vtkMatrix4x4()
+      matrix.DeepCopy(transform.GetMatrix())
+      for axis in xrange(3):
+        matrix.SetElement(axis, 3, translationMm[axis])
+      matrices.append(matrix)
+    return matrices
+
+  def benchmarkPivotCalibration(self, numbersOfPoses):
+    import ToolCalibration
+    pivotCalibrationLogic = slicer.modules.pivotcalibration.logic()
+    randomState = numpy.random.RandomState(self.randomSeed)
+    results = []
+    for numberOfPoses in numbersOfPoses:
+      matrices = self.getPivotPoseMatrices(numberOfPoses, randomState)
+      def calibrate():
+        pivotCalibrationLogic.ClearToolToReferenceMatrices()
+        for matrix in matrices:
+          pivotCalibrationLogic.AddToolToReferenceMatrix(matrix)
+        pivotCalibrationLogic.ComputePivotCalibration()
+      result = { 'numberOfPoses' : numberOfPoses }
+      result.update(self.timeRepeated(calibrate))
+      result['rmseMm'] = pivotCalibrationLogic.GetPivotRMSE()
+      # the incremental solver, solved once every 25 poses as if it were updated twice a second at 50 Hz
+      poses = [(numpy.array([[matrix.GetElement(row,column) for column in xrange(3)] for row in xrange(3)]),
+                numpy.array([matrix.GetElement(row,3) for row in xrange(3)])) for matrix in matrices]
+      pivotCalibration = ToolCalibration.PivotCalibration()
+      def calibrateIncrementally():
+        pivotCalibration.reset()
+        for poseIndex, (rotation, translationMm) in enumerate(poses):
+          pivotCalibration.addSample(rotation, translationMm)
+          if ((poseIndex + 1) % 25 == 0):
+            pivotCalibration.updateEstimate()
+        pivotCalibration.updateEstimate()
+      result['incremental'] = self.timeRepeated(calibrateIncrementally)
+      result['incremental']['rmseMm'] = pivotCalibration.rmseMm
+      # poses needed before the estimate would have stopped the calibration
+      pivotCalibration.reset()
+      result['incremental']['numberOfPosesToConvergence'] = None
+      for poseIndex, (rotation, translationMm) in enumerate(poses):
+        pivotCalibration.addSample(rotation, translationMm)
+        if ((poseIndex + 1) % 25 == 0 and pivotCalibration.updateEstimate() and pivotCalibration.isConverged()):
+          result['incremental']['numberOfPosesToConvergence'] = poseIndex + 1
+          break
+      results.append(result)
+    pivotCalibrationLogic.ClearToolToReferenceMatrices()
+    return results
+
+  def benchmarkPointCollection(self, sampleRatesHz, durationSec):
+    import CollectFiducialsSupplement
+    return CollectFiducialsSupplement.CollectFiducialsSupplementLogic().benchmarkPointCollection(sampleRatesHz, durationSec)
+
+  def getSeromaPointsMm(self, numberOfPoints, randomState):
+    # directions of the vertices of the saved scene's tumor model, topped up with random directions
+    reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(self.tumorModelFilePath)
+    reader.Update()
+    directions = numpy_support.vtk_to_numpy(reader.GetOutput().GetPoints().GetData()).astype(numpy.float64)
+    directions = directions[numpy.linalg.norm(directions, axis=1) > 0]
+    if (len(directions) < numberOfPoints):
+      directions = numpy.concatenate([directions, randomState.normal(0, 1, [numberOfPoints - len(directions), 3])])
+    directions = directions[:numberOfPoints]
+    directions = directions / numpy.linalg.norm(directions, axis=1)[:,numpy.newaxis]
+    return directions * (self.seromaRadiusMm + randomState.normal(0, 1, [numberOfPoints,1]))
+
+  def getChestWallPointsMm(self, numberOfPoints, randomState):
+    # patch of a 150 mm radius cylinder, like markups placed along the ribs
+    anglesRad = randomState.uniform(-0.5, 0.5, numberOfPoints)
+    lengthsMm = randomState.uniform(-60, 60, numberOfPoints)
+    return numpy.column_stack([150 * numpy.sin(anglesRad), lengthsMm, 150 * numpy.cos(anglesRad) - 150 - 40])
+
+  def createMarkupsToModelNode(self, modelType):
+    # same settings as the CathNav guidelet
+    markupsToModelNode = slicer.vtkMRMLMarkupsToModelNode()
+    markupsToModelNode.SetModelType(modelType)
+    markupsToModelNode.SetCleanMarkups(True)
+    markupsToModelNode.SetAutoUpdateOutput(False)
+    if (modelType == markupsToModelNode.ClosedSurface):
+      markupsToModelNode.SetButterflySubdivision(True)
+      markupsToModelNode.SetConvexHull(True)
+      markupsToModelNode.SetDelaunayAlpha(0.0)
+    else:
+      markupsToModelNode.SetTubeRadius(1.0)
+      markupsToModelNode.SetTubeNumberOfSides(8)
+      markupsToModelNode.SetTubeSamplingFrequency(5)
+      markupsToModelNode.SetInterpolationType(markupsToModelNode.Polynomial)
+      markupsToModelNode.SetPointParameterType(markupsToModelNode.MinimumSpanningTree)
+      markupsToModelNode.SetPolynomialOrder(9)
+    slicer.mrmlScene.AddNode(markupsToModelNode)
+    return markupsToModelNode
+
+  def timeMarkupsToModel(self, markupsToModelNode, pointsMm):
+    markupsNode = slicer.mrmlScene.AddNode(slicer.vtkMRMLMarkupsFiducialNode())
+    self.addMarkupsFromArray(markupsNode, pointsMm)
+    modelNode = slicer.mrmlScene.AddNode(slicer.vtkMRMLModelNode())
+    markupsToModelNode.SetAndObserveMarkupsNodeID(markupsNode.GetID())
+    markupsToModelNode.SetAndObserveModelNodeID(modelNode.GetID())
+    markupsToModelLogic = slicer.modules.markupstomodel.logic()
+    result = self.timeRepeated(lambda: markupsToModelLogic.UpdateOutputModel(markupsToModelNode))
+    result['numberOfModelPoints'] = modelNode.GetPolyData().GetNumberOfPoints() if modelNode.GetPolyData() else 0
+    slicer.mrmlScene.RemoveNode(markupsNode)
+    slicer.mrmlScene.RemoveNode(modelNode)
+    return result
+
+  def benchmarkClosedSurfaceRebuild(self, numbersOfPoints):
+    import ClosedSurfaceModeling
+    surfaceLogic = ClosedSurfaceModeling.ClosedSurfaceModelingLogic()
+    randomState = numpy.random.RandomState(self.randomSeed)
+    markupsToModelNode = self.createMarkupsToModelNode(slicer.vtkMRMLMarkupsToModelNode.ClosedSurface)
+    results = []
+    for surface, getPointsMm in [('seroma', self.getSeromaPointsMm), ('chestWall', self.getChestWallPointsMm)]:
+      for numberOfPoints in numbersOfPoints:
+        pointsMm = getPointsMm(numberOfPoints, randomState)
+        result = { 'surface' : surface, 'numberOfPoints' : numberOfPoints }
+        result.update(self.timeMarkupsToModel(markupsToModelNode, pointsMm))
+        # the same surface computed off the scene, as the surface pipelines do in their worker thread
+        result['closedSurfaceModeling'] = self.timeRepeated(lambda: surfaceLogic.createClosedSurfacePolyData(pointsMm))
+        result['pointsHash'] = self.timeRepeated(lambda: surfaceLogic.getPointsHash(pointsMm))
+        if (surface == 'seroma'):
+          result['incrementalConvexHullPerPoint'] = self.timeIncrementalConvexHull(pointsMm)
+        results.append(result)
+    return results
+
+  def timeIncrementalConvexHull(self, pointsMm):
+    # what the seroma pipeline pays for each point the operator adds, including the display surface update
+    import ClosedSurfaceModeling
+    convexHull = ClosedSurfaceModeling.IncrementalConvexHull()
+    hullSurface = ClosedSurfaceModeling.SmoothHullSurface(convexHull)
+    def addPoints():
+      convexHull.removeAllPoints()
+      hullSurface.reset()
+      for pointMm in pointsMm:
+        convexHull.addPoint(pointMm)
+        hullSurface.update()
+    result = self.timeRepeated(addPoints)
+    result['minimumSec'] = result['minimumSec'] / len(pointsMm)
+    result['medianSec'] = result['medianSec'] / len(pointsMm)
+    return result
+
+  def benchmarkTipToSurfaceDistance(self, numbersOfPoints):
+    import ClosedSurfaceModeling
+    import TipToSurfaceDistance
+    surfaceLogic = ClosedSurfaceModeling.ClosedSurfaceModelingLogic()
+    distanceLogic = TipToSurfaceDistance.TipToSurfaceDistanceLogic()
+    randomState = numpy.random.RandomState(self.randomSeed)
+    results = []
+    for numberOfPoints in numbersOfPoints:
+      surfacePolyData = surfaceLogic.createClosedSurfacePolyData(self.getSeromaPointsMm(numberOfPoints, randomState))
+      result = { 'numberOfPoints' : numberOfPoints, 'numberOfTriangles' : surfacePolyData.GetNumberOfPolys() }
+      result['distanceField'] = self.timeRepeated(lambda: distanceLogic.computeSignedDistanceField(surfacePolyData))
+      distanceField = distanceLogic.computeSignedDistanceField(surfacePolyData)
+      # tip positions between 1.5 and 2.5 seroma radii from the centre, where lookups are interpolated
+      directions = randomState.normal(0, 1, [1000, 3])
+      directions = directions / numpy.linalg.norm(directions, axis=1)[:, numpy.newaxis]
+      tipPositionsMm = (directions * randomState.uniform(1.5, 2.5, [1000, 1]) * self.seromaRadiusMm).tolist()
+      result['lookupPerFrame'] = self.timePerTipPosition(lambda tipMm: distanceField.getDistanceMm(tipMm), tipPositionsMm)
+      result['exactQueryPerFrame'] = self.timePerTipPosition(lambda tipMm: distanceField.getExactDistanceMm(tipMm, False), tipPositionsMm)
+      result['numberOfInterpolatedLookups'] = distanceField.numberOfInterpolatedLookups
+      result['numberOfExactQueries'] = distanceField.numberOfExactQueries
+      result.update(self.timeSurfaceRayCasting(surfacePolyData, tipPositionsMm))
+      results.append(result)
+    return results
+
+  def timeSurfaceRayCasting(self, surfacePolyData, tipPositionsMm):
+    import TipToSurfaceDistance
+    result = {}
+    result['rayCasterBuild'] = self.timeRepeated(lambda: TipToSurfaceDistance.SurfaceRayCaster(surfacePolyData))
+    rayCaster = TipToSurfaceDistance.SurfaceRayCaster(surfacePolyData)
+    # 32x32 planning grid of parallel needle paths through the seroma
+    gridCoordinatesMm = numpy.linspace(-1.5, 1.5, 32) * self.seromaRadiusMm
+    gridXMm, gridYMm = numpy.meshgrid(gridCoordinatesMm, gridCoordinatesMm)
+    gridOriginsMm = numpy.column_stack([gridXMm.ravel(), gridYMm.ravel(), numpy.ones(gridXMm.size) * -3 * self.seromaRadiusMm])
+    gridDirections = numpy.tile([0.0, 0.0, 1.0], [len(gridOriginsMm), 1])
+    result['planningGridRays'] = self.timeRepeated(lambda: rayCaster.castRays(gridOriginsMm, gridDirections, 6 * self.seromaRadiusMm))
+    # live needle axis, one ray per frame aimed at the seroma centre
+    castNeedleRay = lambda tipMm: rayCaster.castRays([tipMm], [[-coordinateMm for coordinateMm in tipMm]], 200.0)
+    result['needleRayPerFrame'] = self.timePerTipPosition(castNeedleRay, tipPositionsMm)
+    return result
+
+  def timePerTipPosition(self, getDistance, tipPositionsMm):
+    def getDistances():
+      for tipMm in tipPositionsMm:
+        getDistance(tipMm)
+    result = self.timeRepeated(getDistances)
+    result['minimumSec'] = result['minimumSec'] / len(tipPositionsMm)
+    result['medianSec'] = result['medianSec'] / len(tipPositionsMm)
+    return result
+
+  def benchmarkCatheterAnalysis(self, numbersOfCatheters):
+    import CatheterAnalysis
+    import CatheterReconstruction
+    import InsertionGridPlanner
+    analysisLogic = CatheterAnalysis.CatheterAnalysisLogic()
+    # 5 mm triangular grid over 80x80 mm
+    gridLogic = InsertionGridPlanner.InsertionGridPlannerLogic()
+    gridLogic.setGridPatternToTriangular()
+    for setGridSizeMm in [gridLogic.setGridSizeLeftMm, gridLogic.setGridSizeRightMm, gridLogic.setGridSizeUpMm, gridLogic.setGridSizeDownMm]:
+      setGridSizeMm(40)
+    gridLogic.setGridSpacingHorizontalMm(5)
+    gridLogic.setGridSpacingVerticalMm(5)
+    gridLogic.holeLatticeIndices = gridLogic.computeHoleLatticeIndices()
+    holeStartsMm, holeDirections = analysisLogic.computeHoleAxesMm(gridLogic, vtk.vtkMatrix4x4())
+    randomState = numpy.random.RandomState(self.randomSeed)
+    results = []
+    for numberOfCatheters in numbersOfCatheters:
+      # catheters along random holes, 400 points each
+      pathStore = CatheterReconstruction.CatheterPathStore(3)
+      for pathNumber in xrange(numberOfCatheters):
+        holeIndex = randomState.randint(len(holeStartsMm))
+        depthsMm = numpy.linspace(0, 80, 400)
+        pointsMm = holeStartsMm[holeIndex] + depthsMm[:, numpy.newaxis] * holeDirections[holeIndex] + randomState.normal(0, 0.5, [400, 3])
+        pathStore.addPath(pathNumber, pointsMm, depthsMm, numpy.zeros([4, 3]), 400)
+      result = { 'numberOfCatheters' : numberOfCatheters, 'numberOfHoles' : len(holeStartsMm) }
+      result.update(self.timeRepeated(lambda: analysisLogic.computeDeviations(pathStore, gridLogic.holeLatticeIndices, holeStartsMm, holeDirections)))
+      # 16 dwell positions 4 mm apart along each catheter, labelled by catheter
+      pointsMm, pointPathIndices = pathStore.getAllPathPointsMm()
+      dwellPointIndices = (numpy.arange(numberOfCatheters)[:, numpy.newaxis] * 400 + numpy.arange(40, 360, 20)).ravel()
+      dwellPositionsMm = pointsMm[dwellPointIndices] + randomState.normal(0, 1.0, [len(dwellPointIndices), 3])
+      dwellChannels = pointPathIndices[dwellPointIndices]
+      result['pathComparisonIndex'] = self.timeRepeated(lambda: CatheterAnalysis.CatheterPathComparison(pathStore))
+      pathComparison = CatheterAnalysis.CatheterPathComparison(pathStore)
+      result['pathComparison'] = self.timeRepeated(lambda: pathComparison.compare(dwellPositionsMm, dwellChannels))
+      results.append(result)
+    return results
+
+  def getCatheterPointsMm(self, numberOfPoints, randomState):
+    # 120 mm catheter bending through a quarter turn, sampled with tracker noise
+    anglesRad = numpy.linspace(0, numpy.pi / 2, numberOfPoints)
+    pointsMm = numpy.column_stack([76 * numpy.sin(anglesRad), 76 * (1 - numpy.cos(anglesRad)), numpy.linspace(0, 20, numberOfPoints)])
+    return pointsMm + randomState.normal(0, 0.3, pointsMm.shape)
+
+  def benchmarkCatheterReconstruction(self, numbersOfPoints):
+    randomState = numpy.random.RandomState(self.randomSeed)
+    markupsToModelNode = self.createMarkupsToModelNode(slicer.vtkMRMLMarkupsToModelNode.Curve)
+    results = []
+    for numberOfPoints in numbersOfPoints:
+      result = { 'numberOfPoints' : numberOfPoints }
+      pointsMm = self.getCatheterPointsMm(numberOfPoints, randomState)
+      result.update(self.timeMarkupsToModel(markupsToModelNode, pointsMm))
+      result['incrementalFitPerPoint'] = self.timeIncrementalCurveFit(pointsMm)
+      result['qualityProfiles'] = self.timeCatheterQualityProfiles(pointsMm)
+      results.append(result)
+    return results
+
+  def timeCatheterQualityProfiles(self, pointsMm):
+    # tube build alone, on the curve the live reconstruction would sample, to tune the live profile to the tracker rate
+    import CatheterReconstruction
+    reconstructionLogic = CatheterReconstruction.CatheterReconstructionLogic()
+    curveFit = CatheterReconstruction.IncrementalCatheterCurveFit(reconstructionLogic)
+    curveFit.onPointsReset(pointsMm)
+    results = {}
+    for profileName in [reconstructionLogic.liveProfileName, reconstructionLogic.finalProfileName]:
+      curvePointsMm = curveFit.getCurvePointsMm(reconstructionLogic.getNumberOfCurveSamples(profileName, len(pointsMm)))
+      result = self.timeRepeated(lambda: reconstructionLogic.createTubePolyData(curvePointsMm, profileName))
+      result['numberOfTriangles'] = reconstructionLogic.getRebuildStatistics(profileName)['lastNumberOfTriangles']
+      results[profileName] = result
+    return results
+
+  def timeIncrementalCurveFit(self, pointsMm):
+    # what the live reconstruction pays on each collected point, the points are fed in collection order
+    import CatheterReconstruction
+    curveFit = CatheterReconstruction.IncrementalCatheterCurveFit(CatheterReconstruction.CatheterReconstructionLogic())
+    def fitPoints():
+      curveFit.onPointsReset(numpy.zeros([0,3]))
+      for pointMm in pointsMm:
+        curveFit.onPointAdded(pointMm)
+    result = self.timeRepeated(fitPoints)
+    result['minimumSec'] = result['minimumSec'] / len(pointsMm)
+    result['medianSec'] = result['medianSec'] / len(pointsMm)
+    return result
+
+  def benchmarkTransformQueries(self, numberOfFrames):
+    """
+    Time one tracker frame on the CathNav transform tree, with its matrix queries through GetMatrixTransformToNode and
+    through a TransformGraph.CachedTransformGraph. Each frame moves the needle and the wire, the guide stays still.
+    The frame time includes the transform updates, as the graph's observers run then.
+    """
+    import TransformGraph
+    transformParentNames = [ ('ChestToRas', None),
+                             ('GuideToChest', 'ChestToRas'), ('GuideTipToGuide', 'GuideToChest'),
+                             ('GuideModelToGuideTip', 'GuideTipToGuide'), ('GuideCameraToGuideModel', 'GuideModelToGuideTip'),
+                             ('NeedleToChest', 'ChestToRas'), ('NeedleTipToNeedle', 'NeedleToChest'),
+                             ('NeedleModelToNeedleTip', 'NeedleTipToNeedle'), ('PlanToNeedle', 'NeedleToChest'),
+                             ('GridToPlan', 'PlanToNeedle'), ('WireToChest', 'ChestToRas') ]
+    transformNodes = {}
+    for (transformName, parentName) in transformParentNames:
+      transformNode = slicer.mrmlScene.AddNode(slicer.vtkMRMLLinearTransformNode())
+      transformNode.SetName(transformName)
+      if (parentName):
+        transformNode.SetAndObserveTransformNodeID(transformNodes[parentName].GetID())
+      transformNodes[transformName] = transformNode
+    # wire collection, both tip to surface monitors (with trajectories) and the guide camera
+    nodePairs = [ ('WireToChest', 'NeedleToChest'),
+                  ('NeedleTipToNeedle', 'NeedleToChest'), ('NeedleToChest', None), ('NeedleModelToNeedleTip', 'NeedleToChest'),
+                  ('NeedleTipToNeedle', 'ChestToRas'), ('ChestToRas', None), ('NeedleModelToNeedleTip', 'ChestToRas'),
+                  ('GuideCameraToGuideModel', None) ]
+    nodePairs = [(transformNodes[sourceName], transformNodes[targetName] if targetName else None) for (sourceName, targetName) in nodePairs]
+    randomState = numpy.random.RandomState(self.randomSeed)
+    translationsMm = randomState.normal(0, 50, [numberOfFrames,2,3])
+    matrix = vtk.vtkMatrix4x4()
+    queryMatrix = vtk.vtkMatrix4x4()
+    transformGraph = TransformGraph.CachedTransformGraph()
+    result = { 'numberOfFrames' : numberOfFrames, 'numberOfQueriesPerFrame' : len(nodePairs) }
+    for method in ['getMatrixTransformToNode', 'transformGraph']:
+      elapsedSec = 0
+      for frameIndex in xrange(numberOfFrames):
+        startTimeSec = time.time()
+        for (transformName, translationMm) in zip(['NeedleToChest', 'WireToChest'], translationsMm[frameIndex]):
+          for axis in xrange(3):
+            matrix.SetElement(axis, 3, translationMm[axis])
+          transformNodes[transformName].SetMatrixTransformToParent(matrix)
+        if (method == 'transformGraph'):
+          transformGraph.getMatrices(nodePairs)
+        else:
+          for (sourceNode, targetNode) in nodePairs:
+            if (targetNode):
+              sourceNode.GetMatrixTransformToNode(targetNode, queryMatrix)
+            else:
+              sourceNode.GetMatrixTransformToWorld(queryMatrix)
+        elapsedSec = elapsedSec + time.time() - startTimeSec
+      result[method + 'PerFrameSec'] = elapsedSec / numberOfFrames
+    result.update(transformGraph.getCounters())
+    transformGraph.clear()
+    return result
+
+  def benchmarkTrackingReplay(self, durationSec, sampleRateHz=50):
+    """
+    Replay a synthetic guide, needle and wire recording as fast as possible while wire points are collected,
+    and report the per-frame latency through the observers.
+    """
+    import CollectFiducialsSupplement
+    import TrackingRecorder
+    chestToRas = slicer.mrmlScene.AddNode(slicer.vtkMRMLLinearTransformNode())
+    chestToRas.SetName('ChestToRas')
+    transformNodes = []
+    for transformName in ['GuideToChest', 'NeedleToChest', 'WireToChest']:
+      transformNode = slicer.mrmlScene.AddNode(slicer.vtkMRMLLinearTransformNode())
+      transformNode.SetName(transformName)
+      transformNode.SetAndObserveTransformNodeID(chestToRas.GetID())
+      transformNodes.append(transformNode)
+    (guideToChest, needleToChest, wireToChest) = transformNodes
+
+    recordingFilePath = os.path.join(tempfile.gettempdir(), 'CathNavBenchmark' + TrackingRecorder.TrackingRecorderLogic.recordingFileExtension)
+    recorderLogic = TrackingRecorder.TrackingRecorderLogic()
+    recorderLogic.startRecording(recordingFilePath, transformNodes, durationSec, sampleRateHz, observeTransformNodes=False)
+    matrix = vtk.vtkMatrix4x4()
+    catheterPointsMm = self.getCatheterPointsMm(int(durationSec * sampleRateHz), numpy.random.RandomState(self.randomSeed))
+    for sampleIndex, wirePointMm in enumerate(catheterPointsMm):
+      for axis in xrange(3):
+        matrix.SetElement(axis, 3, wirePointMm[axis])
+      wireToChest.SetMatrixTransformToParent(matrix)
+      for transformNode in transformNodes:
+        recorderLogic.recordSample(transformNode, float(sampleIndex) / sampleRateHz)
+    recorderLogic.stopRecording()
+
+    collectorLogic = CollectFiducialsSupplement.CollectFiducialsSupplementLogic()
+    collectorLogic.setTransformSourceNode(wireToChest)
+    collectorLogic.setTransformTargetNode(needleToChest)
+    collectorLogic.setMarkupsFiducialNode(slicer.mrmlScene.AddNode(slicer.vtkMRMLMarkupsFiducialNode()))
+    collectorLogic.setMinimumAddDistanceMm(1)
+    collectorLogic.setAllowPointRemovalsTrue()
+    collectorLogic.startCollection()
+    replayLogic = TrackingRecorder.TrackingReplayLogic()
+    replayLogic.setRecording(TrackingRecorder.TrackingRecording(recordingFilePath))
+    replayLogic.setReplaySpeed(replayLogic.replaySpeedAsFastAsPossible)
+    startTimeSec = time.time()
+    replayLogic.startReplay()
+    replayLogic.waitForReplay()
+    replaySec = time.time() - startTimeSec
+    collectorLogic.stopCollection()
+
+    result = { 'durationSec' : durationSec, 'sampleRateHz' : sampleRateHz, 'replaySec' : replaySec }
+    result.update(replayLogic.getLatencyStatistics())
+    result.update(collectorLogic.getCollectionCounters())
+    os.remove(recordingFilePath)
+    return [result]
+
+#
+# CathNavBenchmarkTest
+#
+
+class CathNavBenchmarkTest(ScriptedLoadableModuleTest):
+  """
+  Runs the quick benchmarks and checks that every benchmark reported results.
+  The full benchmarks are run with CathNavBenchmarkLogic.runBenchmarks.
+  """
+
+  def setUp(self):
+    slicer.mrmlScene.Clear(0)
+
+  def runTest(self):
+    self.setUp()
+    self.test_CathNavBenchmark1()
+
+  def test_CathNavBenchmark1(self):
+    self.delayDisplay("Starting the test")
+    outputFilePath = os.path.join(tempfile.gettempdir(), 'CathNavBenchmarkTest.json')
+    CathNavBenchmarkLogic().runBenchmarks(outputFilePath, quick=True)
+    with open(outputFilePath) as outputFile:
+      results = json.load(outputFile)
+    for benchmarkName, benchmarkResults in results['benchmarks'].items():
+      self.assertTrue(len(benchmarkResults) > 0, benchmarkName + " reported no results")
+    self.delayDisplay('Test passed!')
@@ -0,0 +1,520 @@
+from __main__ import vtk, qt, ctk, slicer
+from slicer.ScriptedLoadableModule import *
+import csv
+import logging
+import math
+import numpy
+
+#
+# CatheterAnalysis
+#
+
+class CatheterAnalysis(ScriptedLoadableModule):
+  def __init__(self, parent):
+    parent.title = "CatheterAnalysis"
+    parent.categories = ["IGT"]
+    parent.dependencies = ["CatheterReconstruction", "InsertionGridPlanner"]
+    parent.contributors = ["Thomas Vaughan (Queen's)", "Gabor Fichtinger (Queen's)"]
+    parent.helpText = """
+    Compare reconstructed catheter paths with the planned insertion grid. Each catheter is matched to the nearest
+    planned hole and its lateral deviation along depth, angular deviation and tip depth error are reported in a table.
+    The catheters can also be compared with reference paths or dwell positions (nearest path, Hausdorff and mean
+    closest point distances), using k-d trees built once over all the paths.
+    The analysis is run from the CathNav reconstruction panel after every collected catheter.
+    """
+    parent.acknowledgementText = """
+	This work is funded as a project in the Laboratory for Percutaneous Surgery, Queen's University, Kingston, Ontario. Thomas Vaughan is funded by an NSERC Postgraduate award. Gabor Fichtinger is funded as a Cancer Care Ontario (CCO) Chair.
+	""" # replace with organization, grant and thanks.
+    self.parent = parent
+
+#
+# CatheterAnalysisWidget
+#
+
+class CatheterAnalysisWidget(ScriptedLoadableModuleWidget):
+
+  def setup(self):
+    ScriptedLoadableModuleWidget.setup(self)
+
+    # Collapsible buttons
+    self.parametersCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.parametersCollapsibleButton.text = "CatheterAnalysis"
+    self.layout.addWidget(self.parametersCollapsibleButton)
+
+    # Layout within the collapsible button
+    self.parametersFormLayout = qt.QFormLayout(self.parametersCollapsibleButton)
+
+    # the paths and the grid are owned by CathNav, so there is nothing to set up here
+    self.usageLabel = qt.QLabel()
+    self.usageLabel.setText("Catheter deviations are computed by CathNav into the CatheterDeviations table.")
+    self.usageLabel.setWordWrap(True)
+    self.parametersFormLayout.addRow(self.usageLabel)
+
+    # Add vertical spacer
+    self.layout.addStretch(1)
+
+#
+# CatheterAnalysisLogic
+#
+
+class CatheterAnalysisLogic(ScriptedLoadableModuleLogic):
+  """
+  Matches the paths of a CatheterReconstruction.CatheterPathStore to the holes of an
+  InsertionGridPlanner.InsertionGridPlannerLogic grid. Every statistic is computed over the points of all the
+  paths at once, so analysing a whole case takes a few milliseconds.
+  """
+  # constants - DO NOT CHANGE THESE
+  # (result name, column title) of every per-catheter value, in table order
+  resultColumns = [ ('pathNumber', 'Catheter'),
+                    ('holeColumn', 'Hole column'),
+                    ('holeRow', 'Hole row'),
+                    ('meanLateralDeviationMm', 'Mean lateral deviation (mm)'),
+                    ('maximumLateralDeviationMm', 'Max lateral deviation (mm)'),
+                    ('tipLateralDeviationMm', 'Tip lateral deviation (mm)'),
+                    ('angularDeviationDeg', 'Angular deviation (deg)'),
+                    ('tipDepthMm', 'Tip depth (mm)'),
+                    ('plannedTipDepthMm', 'Planned tip depth (mm)'),
+                    ('tipDepthErrorMm', 'Tip depth error (mm)') ]
+  # same for the per-catheter values of CatheterPathComparison.compare
+  comparisonColumns = [ ('pathNumber', 'Catheter'),
+                        ('referenceLabel', 'Reference'),
+                        ('meanClosestPointDistanceMm', 'Mean closest point distance (mm)'),
+                        ('hausdorffDistanceMm', 'Hausdorff distance (mm)') ]
+
+  def __init__(self):
+    self.depthProfileSpacingMm = 10.0 # lateral deviation along depth is averaged over bins of this depth
+
+  def computeHoleAxesMm(self, gridLogic, matrixGridToPaths):
+    """
+    Entry points and unit directions of all the holes of gridLogic, in the order of its output model, in the coordinates
+    the paths are stored in. matrixGridToPaths is a vtkMatrix4x4. Holes point along -z of the grid, see
+    InsertionGridAnatomyLogic.computeHoleIntersections. Returns None if there is no grid.
+    """
+    if gridLogic.holeLatticeIndices is None:
+      return None
+    matrix = numpy.array([[matrixGridToPaths.GetElement(row,column) for column in xrange(4)] for row in xrange(4)])
+    holeCentersMm = gridLogic.computeHoleCentersMm(gridLogic.holeLatticeIndices)
+    holeStartsMm = holeCentersMm.dot(matrix[0:3,0:2].T) + matrix[0:3,3]
+    holeDirection = -matrix[0:3,2] / numpy.linalg.norm(matrix[0:3,2])
+    holeDirections = numpy.tile(holeDirection, (holeStartsMm.shape[0],1))
+    return holeStartsMm, holeDirections
+
+  def computePathMoments(self, pointsMm, pointPathIndices, numberOfPaths):
+    # centroid and covariance of the points of every path, from per-path sums
+    numbersOfPoints = numpy.bincount(pointPathIndices, minlength=numberOfPaths).astype(float)
+    numbersOfPoints[numbersOfPoints == 0] = 1 # empty paths get a zero centroid, they are not analysed
+    centroidsMm = numpy.empty((numberOfPaths,3))
+    for axis in xrange(3):
+      centroidsMm[:,axis] = numpy.bincount(pointPathIndices, weights=pointsMm[:,axis], minlength=numberOfPaths) / numbersOfPoints
+    offsetsMm = pointsMm - centroidsMm[pointPathIndices]
+    covariancesMm2 = numpy.empty((numberOfPaths,3,3))
+    for row in xrange(3):
+      for column in xrange(row,3):
+        covariancesMm2[:,row,column] = numpy.bincount(pointPathIndices, weights=offsetsMm[:,row]*offsetsMm[:,column], minlength=numberOfPaths) / numbersOfPoints
+        covariancesMm2[:,column,row] = covariancesMm2[:,row,column]
+    return centroidsMm, covariancesMm2
+
+  def matchPathsToHoles(self, centroidsMm, covariancesMm2, holeStartsMm, holeDirections):
+    """
+    Index of the hole whose axis has the least mean squared distance to the points of each path.
+    The mean squared distance of a path's points to a line splits into the squared distance of the centroid to the line
+    and the spread of the points across the line, so it is computed for every path and hole pair from the path moments.
+    """
+    centroidOffsetsMm = centroidsMm[:,numpy.newaxis,:] - holeStartsMm[numpy.newaxis,:,:]
+    alongAxisMm = numpy.einsum('phi,hi->ph', centroidOffsetsMm, holeDirections)
+    spreadAlongAxisMm2 = numpy.einsum('hi,pij,hj->ph', holeDirections, covariancesMm2, holeDirections)
+    meanSquaredDistancesMm2 = (centroidOffsetsMm ** 2).sum(axis=2) - alongAxisMm ** 2 - spreadAlongAxisMm2
+    return numpy.argmin(meanSquaredDistancesMm2, axis=1)
+
+  def computeDeviations(self, pathStore, holeLatticeIndices, holeStartsMm, holeDirections, plannedTipDepthsMm=None):
+    """
+    Match every path of pathStore to its nearest hole and return a dictionary of per-path arrays, in the order of
+    pathStore.getPathNumbers(), named as in resultColumns. Depths are measured along the matched hole from its entry point.
+    plannedTipDepthsMm is one depth per hole (e.g. where the hole leaves the seroma), NaN or None if there is no plan.
+    The lateral deviation along depth is in 'lateralDeviationProfilesMm', one row per path and one column per
+    depth bin starting at 'profileDepthsMm'. Empty paths are left out, None is returned if there are no points.
+    """
+    pointsMm, pointPathIndices = pathStore.getAllPathPointsMm()
+    if len(pointsMm) == 0:
+      return None
+    numberOfPaths = pathStore.getNumberOfPaths()
+    pathNumbers = pathStore.getPathNumbers().copy()
+    numbersOfPoints = numpy.bincount(pointPathIndices, minlength=numberOfPaths)
+    centroidsMm, covariancesMm2 = self.computePathMoments(pointsMm, pointPathIndices, numberOfPaths)
+    holeIndices = self.matchPathsToHoles(centroidsMm, covariancesMm2, holeStartsMm, holeDirections)
+
+    # depth along and distance from the matched hole axis of every point
+    pointHoleIndices = holeIndices[pointPathIndices]
+    pointOffsetsMm = pointsMm - holeStartsMm[pointHoleIndices]
+    pointDepthsMm = (pointOffsetsMm * holeDirections[pointHoleIndices]).sum(axis=1)
+    pointLateralOffsetsMm = pointOffsetsMm - pointDepthsMm[:,numpy.newaxis] * holeDirections[pointHoleIndices]
+    pointLateralDeviationsMm = numpy.sqrt((pointLateralOffsetsMm ** 2).sum(axis=1))
+
+    analysedPaths = (numbersOfPoints > 0)
+    safeNumbersOfPoints = numpy.maximum(numbersOfPoints, 1)
+    meanLateralDeviationsMm = numpy.bincount(pointPathIndices, weights=pointLateralDeviationsMm, minlength=numberOfPaths) / safeNumbersOfPoints
+    maximumLateralDeviationsMm = numpy.zeros(numberOfPaths)
+    numpy.maximum.at(maximumLateralDeviationsMm, pointPathIndices, pointLateralDeviationsMm)
+
+    # the tip is the deepest point of each path, the last one of the path after sorting by depth within paths
+    pointOrder = numpy.lexsort((pointDepthsMm, pointPathIndices))
+    tipPointIndices = pointOrder[numpy.maximum(numpy.cumsum(numbersOfPoints) - 1, 0)]
+    tipDepthsMm = pointDepthsMm[tipPointIndices]
+    tipLateralDeviationsMm = pointLateralDeviationsMm[tipPointIndices]
+
+    # principal axis of the points of each path, against the hole direction
+    eigenvalues, eigenvectors = numpy.linalg.eigh(covariancesMm2)
+    pathDirections = eigenvectors[:,:,-1]
+    cosines = numpy.abs((pathDirections * holeDirections[holeIndices]).sum(axis=1))
+    angularDeviationsDeg = numpy.degrees(numpy.arccos(numpy.clip(cosines, 0.0, 1.0)))
+
+    if plannedTipDepthsMm is None:
+      plannedTipDepthsMm = numpy.full(holeStartsMm.shape[0], numpy.nan)
+    pathPlannedTipDepthsMm = numpy.asarray(plannedTipDepthsMm, dtype=float)[holeIndices]
+
+    results = { 'pathNumber' : pathNumbers,
+                'holeColumn' : holeLatticeIndices[holeIndices,0],
+                'holeRow' : holeLatticeIndices[holeIndices,1],
+                'meanLateralDeviationMm' : meanLateralDeviationsMm,
+                'maximumLateralDeviationMm' : maximumLateralDeviationsMm,
+                'tipLateralDeviationMm' : tipLateralDeviationsMm,
+                'angularDeviationDeg' : angularDeviationsDeg,
+                'tipDepthMm' : tipDepthsMm,
+                'plannedTipDepthMm' : pathPlannedTipDepthsMm,
+                'tipDepthErrorMm' : tipDepthsMm - pathPlannedTipDepthsMm }
+    profileDepthsMm, lateralDeviationProfilesMm = self.computeLateralDeviationProfiles(pointPathIndices, pointDepthsMm, pointLateralDeviationsMm, numberOfPaths)
+    results['lateralDeviationProfilesMm'] = lateralDeviationProfilesMm
+    for resultName in results:
+      results[resultName] = results[resultName][analysedPaths]
+    results['profileDepthsMm'] = profileDepthsMm
+    return results
+
+  def computeLateralDeviationProfiles(self, pointPathIndices, pointDepthsMm, pointLateralDeviationsMm, numberOfPaths):
+    # mean lateral deviation of each path in bins along the depth, NaN for bins without points
+    depthBinIndices = numpy.floor(numpy.maximum(pointDepthsMm, 0.0) / self.depthProfileSpacingMm).astype(int)
+    numberOfDepthBins = depthBinIndices.max() + 1
+    binIndices = pointPathIndices * numberOfDepthBins + depthBinIndices
+    numberOfBins = numberOfPaths * numberOfDepthBins
+    binNumbersOfPoints = numpy.bincount(binIndices, minlength=numberOfBins).astype(float)
+    binSumsMm = numpy.bincount(binIndices, weights=pointLateralDeviationsMm, minlength=numberOfBins)
+    binNumbersOfPoints[binNumbersOfPoints == 0] = numpy.nan
+    profileDepthsMm = numpy.arange(numberOfDepthBins) * self.depthProfileSpacingMm
+    return profileDepthsMm, (binSumsMm / binNumbersOfPoints).reshape((numberOfPaths, numberOfDepthBins))
+
+  def getResultRows(self, results, resultColumns=None):
+    # column titles and one row of values per path, the depth profile bins (if any) after the per-path values
+    if resultColumns is None:
+      resultColumns = self.resultColumns
+    titles = [columnTitle for resultName, columnTitle in resultColumns]
+    profileDepthsMm = results.get('profileDepthsMm', [])
+    titles += ['Lateral deviation {0:g}-{1:g} mm (mm)'.format(depthMm, depthMm + self.depthProfileSpacingMm) for depthMm in profileDepthsMm]
+    rows = []
+    for pathIndex in xrange(len(results['pathNumber'])):
+      row = [results[resultName][pathIndex] for resultName, columnTitle in resultColumns]
+      if len(profileDepthsMm) > 0:
+        row += list(results['lateralDeviationProfilesMm'][pathIndex])
+      rows.append(row)
+    return titles, rows
+
+  def formatValue(self, value):
+    if isinstance(value, (int, long, numpy.integer)):
+      return str(value)
+    if numpy.isnan(value):
+      return ''
+    return '{0:.2f}'.format(value)
+
+  def updateTableNode(self, results, tableNode, resultColumns=None):
+    titles, rows = self.getResultRows(results, resultColumns)
+    table = vtk.vtkTable()
+    for columnIndex in xrange(len(titles)):
+      column = vtk.vtkStringArray()
+      column.SetName(titles[columnIndex])
+      for row in rows:
+        column.InsertNextValue(self.formatValue(row[columnIndex]))
+      table.AddColumn(column)
+    tableNode.SetAndObserveTable(table)
+
+  def writeCsv(self, results, filePath, resultColumns=None):
+    titles, rows = self.getResultRows(results, resultColumns)
+    with open(filePath, 'wb') as csvFile:
+      writer = csv.writer(csvFile)
+      writer.writerow(titles)
+      for row in rows:
+        writer.writerow([self.formatValue(value) for value in row])
+
+#
+# PointKdTree
+#
+
+class PointKdTree(object):
+  """
+  Closest points of a batch of query points among a fixed set of points. The points are sorted into balanced
+  k-d trees once, by splitting every node at the median point along its longest axis. The points can be split
+  into several trees (e.g. one per catheter) that share one set of arrays, and each query then searches one tree.
+  The queries first descend to one leaf each for an upper bound, then walk down the tree one level at a time with
+  every (query, node) pair whose box is closer than that bound, so each level is a single vectorized box distance
+  and the leaves a single point test, whatever the number of trees.
+  """
+  # constants - DO NOT CHANGE THESE
+  maximumPointsPerLeaf = 8
+
+  def __init__(self, pointsMm, pointTreeIndices=None):
+    """
+    pointTreeIndices is the tree (0, 1, ...) of every point, all the points are in tree 0 if it is None.
+    """
+    pointsMm = numpy.asarray(pointsMm, dtype=numpy.float64).reshape(-1,3)
+    self.numberOfPoints = pointsMm.shape[0]
+    if pointTreeIndices is None:
+      pointTreeIndices = numpy.zeros(self.numberOfPoints, dtype=numpy.int64)
+    pointTreeIndices = numpy.asarray(pointTreeIndices, dtype=numpy.int64)
+    treeSizes = numpy.bincount(pointTreeIndices, minlength=1)
+    self.numberOfTrees = len(treeSizes)
+    self.depth = 0 # leaves are at this level, the root is level 0, all the trees have the same depth
+    if (treeSizes.max() > self.maximumPointsPerLeaf):
+      self.depth = int(math.ceil(math.log(float(treeSizes.max()) / self.maximumPointsPerLeaf, 2)))
+    self.treeStarts = numpy.cumsum(treeSizes) - treeSizes
+    self.treeSizes = treeSizes
+
+    # sort the points by tree, then level by level, each node's points are a contiguous range split in half for its children
+    self.numberOfTreeNodes = 2 ** (self.depth + 1) - 1
+    nodeSplitAxes = numpy.zeros([self.numberOfTrees, self.numberOfTreeNodes], dtype=numpy.int64)
+    self.pointOrder = numpy.argsort(pointTreeIndices, kind='mergesort')
+    for level in xrange(self.depth):
+      nodeStarts = self.getNodeStarts(level)
+      nodeOfPoint = numpy.repeat(numpy.arange(len(nodeStarts)), numpy.diff(numpy.append(nodeStarts, self.numberOfPoints)))
+      sortedPointsMm = pointsMm[self.pointOrder]
+      nodeExtentsMm = self.reduceNodes(numpy.maximum, sortedPointsMm, nodeStarts, 0.0) - self.reduceNodes(numpy.minimum, sortedPointsMm, nodeStarts, 0.0)
+      levelSplitAxes = numpy.argmax(nodeExtentsMm, axis=1)
+      nodeSplitAxes[:,2 ** level - 1:2 ** (level + 1) - 1] = levelSplitAxes.reshape(self.numberOfTrees, -1)
+      splitKeys = sortedPointsMm[numpy.arange(self.numberOfPoints), levelSplitAxes[nodeOfPoint]]
+      self.pointOrder = self.pointOrder[numpy.lexsort((splitKeys, nodeOfPoint))]
+    sortedPointsMm = pointsMm[self.pointOrder]
+    # one contiguous array per coordinate, gathering from them is much faster than from N x 3 arrays
+    (self.pointsXMm, self.pointsYMm, self.pointsZMm) = sortedPointsMm.T.copy()
+    self.leafStarts = self.getNodeStarts(self.depth)
+    self.leafEnds = numpy.append(self.leafStarts[1:], self.numberOfPoints)
+
+    # node boxes, stored tree after tree and in each tree level after level like in TipToSurfaceDistance.SurfaceRayCaster
+    # empty nodes get inverted boxes, which are infinitely far from every query
+    nodeLowerMm = numpy.zeros([self.numberOfTrees, self.numberOfTreeNodes, 3])
+    nodeUpperMm = numpy.zeros([self.numberOfTrees, self.numberOfTreeNodes, 3])
+    leafOffset = 2 ** self.depth - 1
+    nodeLowerMm[:,leafOffset:] = self.reduceNodes(numpy.minimum, sortedPointsMm, self.leafStarts, numpy.inf).reshape(self.numberOfTrees, -1, 3)
+    nodeUpperMm[:,leafOffset:] = self.reduceNodes(numpy.maximum, sortedPointsMm, self.leafStarts, -numpy.inf).reshape(self.numberOfTrees, -1, 3)
+    for level in xrange(self.depth - 1, -1, -1):
+      levelNodes = slice(2 ** level - 1, 2 ** (level + 1) - 1)
+      firstChildren = slice(2 ** (level + 1) - 1, 2 ** (level + 2) - 1, 2)
+      secondChildren = slice(2 ** (level + 1), 2 ** (level + 2) - 1, 2)
+      nodeLowerMm[:,levelNodes] = numpy.minimum(nodeLowerMm[:,firstChildren], nodeLowerMm[:,secondChildren])
+      nodeUpperMm[:,levelNodes] = numpy.maximum(nodeUpperMm[:,firstChildren], nodeUpperMm[:,secondChildren])
+    self.nodeLowerMm = nodeLowerMm.reshape(-1,3).T.copy() # 3 x nodes of all the trees
+    self.nodeUpperMm = nodeUpperMm.reshape(-1,3).T.copy()
+
+    # queries below the split value of a node are closer to its first child, the value is halfway between the children
+    # -inf and inf send all the queries to the child that is not empty
+    self.nodeSplitAxes = nodeSplitAxes.ravel()
+    self.nodeSplitValuesMm = numpy.zeros(self.numberOfTrees * self.numberOfTreeNodes)
+    if (self.depth > 0):
+      treeInternalNodes = numpy.arange(2 ** self.depth - 1)
+      internalNodes = (numpy.arange(self.numberOfTrees)[:,numpy.newaxis] * self.numberOfTreeNodes + treeInternalNodes).ravel()
+      firstChildren = internalNodes + treeInternalNodes[numpy.newaxis,:].repeat(self.numberOfTrees, axis=0).ravel() + 1
+      splitAxes = self.nodeSplitAxes[internalNodes]
+      with numpy.errstate(invalid='ignore'):
+        splitValuesMm = (self.nodeUpperMm[splitAxes, firstChildren] + self.nodeLowerMm[splitAxes, firstChildren + 1]) / 2.0
+      splitValuesMm[numpy.isinf(self.nodeLowerMm[0, firstChildren])] = -numpy.inf
+      splitValuesMm[numpy.isinf(self.nodeLowerMm[0, firstChildren + 1])] = numpy.inf
+      self.nodeSplitValuesMm[internalNodes] = splitValuesMm
+
+  def getNodeStarts(self, level):
+    # first sorted point of each node of the level, tree after tree, the halves of a node differ in size by at most one
+    # empty nodes start where the next node starts
+    return (self.treeStarts[:,numpy.newaxis] + (numpy.arange(2 ** level) * self.treeSizes[:,numpy.newaxis]) // (2 ** level)).ravel()
+
+  def reduceNodes(self, reduction, sortedPointsMm, nodeStarts, emptyValue):
+    # reduction of the points of each node, emptyValue for empty nodes
+    nodeSizes = numpy.diff(numpy.append(nodeStarts, self.numberOfPoints))
+    reducedMm = numpy.full([len(nodeStarts), 3], emptyValue)
+    isNodeFilled = (nodeSizes > 0)
+    if isNodeFilled.any():
+      reducedMm[isNodeFilled] = reduction.reduceat(sortedPointsMm, nodeStarts[isNodeFilled], axis=0)
+    return reducedMm
+
+  def getBoxDistancesSquaredMm2(self, queryCoordinatesMm, queryIndices, nodeIndices):
+    # squared distance from each query point to its node's box, 0 inside the box
+    distancesSquaredMm2 = numpy.zeros(len(queryIndices))
+    for axis in xrange(3):
+      pairCoordinatesMm = queryCoordinatesMm[axis][queryIndices]
+      outsideMm = numpy.maximum(numpy.maximum(self.nodeLowerMm[axis][nodeIndices] - pairCoordinatesMm, pairCoordinatesMm - self.nodeUpperMm[axis][nodeIndices]), 0.0)
+      distancesSquaredMm2 += outsideMm * outsideMm
+    return distancesSquaredMm2
+
+  def searchLeaves(self, queryCoordinatesMm, queryIndices, leafIndices, closestDistancesSquaredMm2, closestPointIndices):
+    # test every point of every (query, leaf) pair, closer points replace the closest ones found so far
+    # queryIndices must be sorted, so that the pairs of one query are next to each other
+    maximumLeafSize = int((self.leafEnds - self.leafStarts).max())
+    pointIndices = self.leafStarts[leafIndices][:,numpy.newaxis] + numpy.arange(maximumLeafSize)
+    isOutsideLeaf = (pointIndices >= self.leafEnds[leafIndices][:,numpy.newaxis])
+    pointIndices[isOutsideLeaf] = 0
+    distancesSquaredMm2 = numpy.zeros(pointIndices.shape)
+    for (pointCoordinatesMm, coordinatesMm) in [(self.pointsXMm, queryCoordinatesMm[0]), (self.pointsYMm, queryCoordinatesMm[1]), (self.pointsZMm, queryCoordinatesMm[2])]:
+      differencesMm = pointCoordinatesMm[pointIndices] - coordinatesMm[queryIndices][:,numpy.newaxis]
+      distancesSquaredMm2 += differencesMm * differencesMm
+    distancesSquaredMm2[isOutsideLeaf] = numpy.inf
+    pairIndices = numpy.arange(len(queryIndices))
+    pairClosestColumns = numpy.argmin(distancesSquaredMm2, axis=1)
+    pairDistancesSquaredMm2 = distancesSquaredMm2[pairIndices, pairClosestColumns]
+    pairPointIndices = pointIndices[pairIndices, pairClosestColumns]
+    # closest of the pairs of each query
+    queryStarts = numpy.flatnonzero(numpy.concatenate(([True], queryIndices[1:] != queryIndices[:-1])))
+    queryDistancesSquaredMm2 = numpy.minimum.reduceat(pairDistancesSquaredMm2, queryStarts)
+    isQueryClosest = (pairDistancesSquaredMm2 == numpy.repeat(queryDistancesSquaredMm2, numpy.diff(numpy.append(queryStarts, len(queryIndices)))))
+    isQueryClosest &= (pairDistancesSquaredMm2 < closestDistancesSquaredMm2[queryIndices])
+    closestDistancesSquaredMm2[queryIndices[isQueryClosest]] = pairDistancesSquaredMm2[isQueryClosest]
+    closestPointIndices[queryIndices[isQueryClosest]] = pairPointIndices[isQueryClosest]
+
+  def findClosestPoints(self, queryPointsMm, queryTreeIndices=None):
+    """
+    queryPointsMm is an N x 3 array, queryTreeIndices the tree to search for each query point (tree 0 if None).
+    Returns the distance in mm to the closest point and its index in the points the tree was built from,
+    for every query point. NaN and -1 where the searched tree is empty or does not exist.
+    """
+    queryPointsMm = numpy.asarray(queryPointsMm, dtype=numpy.float64).reshape(-1,3)
+    numberOfQueries = queryPointsMm.shape[0]
+    closestDistancesSquaredMm2 = numpy.full(numberOfQueries, numpy.inf)
+    closestPointIndices = numpy.full(numberOfQueries, -1, dtype=numpy.int64)
+    if queryTreeIndices is None:
+      queryTreeIndices = numpy.zeros(numberOfQueries, dtype=numpy.int64)
+    queryTreeIndices = numpy.asarray(queryTreeIndices, dtype=numpy.int64)
+    queryIndices = numpy.flatnonzero((queryTreeIndices >= 0) & (queryTreeIndices < self.numberOfTrees))
+    queryIndices = queryIndices[self.treeSizes[queryTreeIndices[queryIndices]] > 0]
+    if (len(queryIndices) > 0):
+      queryCoordinatesMm = queryPointsMm.T.copy()
+      treeRoots = queryTreeIndices[queryIndices] * self.numberOfTreeNodes
+      leafOffset = 2 ** self.depth - 1
+
+      # upper bound from the leaf reached by taking the child on the query's side of every split
+      nodeIndices = numpy.zeros(len(queryIndices), dtype=numpy.int64)
+      for level in xrange(self.depth):
+        # children of the node at index n of a tree are at 2n+1 and 2n+2
+        splitAxes = self.nodeSplitAxes[treeRoots + nodeIndices]
+        isFirstSide = (queryCoordinatesMm[splitAxes, queryIndices] <= self.nodeSplitValuesMm[treeRoots + nodeIndices])
+        nodeIndices = 2 * nodeIndices + numpy.where(isFirstSide, 1, 2)
+      leafIndices = queryTreeIndices[queryIndices] * (2 ** self.depth) + nodeIndices - leafOffset
+      self.searchLeaves(queryCoordinatesMm, queryIndices, leafIndices, closestDistancesSquaredMm2, closestPointIndices)
+
+      # walk down the tree with every (query, node) pair that may hold a closer point
+      nodeIndices = numpy.zeros(len(queryIndices), dtype=numpy.int64)
+      for level in xrange(self.depth + 1):
+        isCloser = (self.getBoxDistancesSquaredMm2(queryCoordinatesMm, queryIndices, treeRoots + nodeIndices) < closestDistancesSquaredMm2[queryIndices])
+        queryIndices = queryIndices[isCloser]
+        treeRoots = treeRoots[isCloser]
+        nodeIndices = nodeIndices[isCloser]
+        if (level < self.depth):
+          queryIndices = numpy.repeat(queryIndices, 2)
+          treeRoots = numpy.repeat(treeRoots, 2)
+          nodeIndices = numpy.repeat(2 * nodeIndices + 1, 2)
+          nodeIndices[1::2] += 1
+      if (len(queryIndices) > 0):
+        leafIndices = treeRoots // self.numberOfTreeNodes * (2 ** self.depth) + nodeIndices - leafOffset
+        self.searchLeaves(queryCoordinatesMm, queryIndices, leafIndices, closestDistancesSquaredMm2, closestPointIndices)
+
+    isFound = (closestPointIndices >= 0)
+    closestPointIndices[isFound] = self.pointOrder[closestPointIndices[isFound]]
+    closestDistancesSquaredMm2[~isFound] = numpy.nan
+    return (numpy.sqrt(closestDistancesSquaredMm2), closestPointIndices)
+
+#
+# LabelledPointIndex
+#
+
+class LabelledPointIndex(object):
+  """
+  Closest points among all the points, or among the points with a given label only (e.g. the points of one path).
+  Holds a PointKdTree over all the points and one with a tree per label, both built once.
+  """
+
+  def __init__(self, pointsMm, pointLabels):
+    pointsMm = numpy.asarray(pointsMm, dtype=numpy.float64).reshape(-1,3)
+    self.labels, pointLabelIndices = numpy.unique(pointLabels, return_inverse=True)
+    self.allPointsTree = PointKdTree(pointsMm)
+    self.labelTrees = PointKdTree(pointsMm, pointLabelIndices)
+
+  def findClosestPoints(self, queryPointsMm, queryLabels=None):
+    """
+    Distance to and index of the closest point, among the points with the query's label if queryLabels is given.
+    NaN and -1 where there is no point with the query's label.
+    """
+    if queryLabels is None:
+      return self.allPointsTree.findClosestPoints(queryPointsMm)
+    queryLabels = numpy.asarray(queryLabels)
+    queryLabelIndices = numpy.minimum(numpy.searchsorted(self.labels, queryLabels), len(self.labels) - 1)
+    queryLabelIndices[self.labels[queryLabelIndices] != queryLabels] = -1
+    return self.labelTrees.findClosestPoints(queryPointsMm, queryLabelIndices)
+
+#
+# CatheterPathComparison
+#
+
+class CatheterPathComparison(object):
+  """
+  Distances between every catheter path of a CatheterReconstruction.CatheterPathStore and a set of labelled
+  reference points, e.g. dwell positions labelled by channel or the paths of another reconstruction labelled by
+  path number. The store's points are indexed once, then all the catheters are compared in a few batched queries.
+  """
+
+  def __init__(self, pathStore):
+    pointsMm, pointPathIndices = pathStore.getAllPathPointsMm()
+    self.pathNumbers = pathStore.getPathNumbers().copy()
+    self.pointsMm = pointsMm.copy() # the store's arrays are reused when paths are added
+    self.pointPathIndices = pointPathIndices
+    self.pathPointIndex = LabelledPointIndex(self.pointsMm, self.pointPathIndices)
+
+  def compare(self, referencePointsMm, referenceLabels):
+    """
+    Each catheter is matched to the reference label whose points are closest to most of its points.
+    Returns a dictionary of per-catheter arrays, in the order of the store's path numbers:
+    'pathNumber', 'referenceLabel', 'meanClosestPointDistanceMm' (from the catheter points to the matched reference)
+    and 'hausdorffDistanceMm' (between the catheter and the matched reference, both ways),
+    and of per-reference point arrays: 'referenceNearestPathNumber' and 'referenceNearestPathDistanceMm'.
+    Returns None if there are no catheter or no reference points.
+    """
+    referencePointsMm = numpy.asarray(referencePointsMm, dtype=numpy.float64).reshape(-1,3)
+    if (len(self.pointsMm) == 0 or len(referencePointsMm) == 0):
+      return None
+    uniqueReferenceLabels, referenceLabelIndices = numpy.unique(referenceLabels, return_inverse=True)
+    numberOfReferences = len(uniqueReferenceLabels)
+    numberOfPaths = len(self.pathNumbers)
+    referencePointIndex = LabelledPointIndex(referencePointsMm, referenceLabelIndices)
+
+    # nearest reference point of every catheter point, the most frequent reference of a catheter is its match
+    closestDistancesMm, closestReferencePointIndices = referencePointIndex.findClosestPoints(self.pointsMm)
+    closestReferences = referenceLabelIndices[closestReferencePointIndices]
+    votes = numpy.bincount(self.pointPathIndices * numberOfReferences + closestReferences, minlength=numberOfPaths * numberOfReferences)
+    matchedReferences = numpy.argmax(votes.reshape(numberOfPaths, numberOfReferences), axis=1)
+
+    # catheter to matched reference, only the points whose closest reference is another one need a second query
+    pointMatchedReferences = matchedReferences[self.pointPathIndices]
+    isOtherReference = (closestReferences != pointMatchedReferences)
+    if isOtherReference.any():
+      closestDistancesMm[isOtherReference] = referencePointIndex.findClosestPoints(self.pointsMm[isOtherReference], pointMatchedReferences[isOtherReference])[0]
+    numbersOfPoints = numpy.maximum(numpy.bincount(self.pointPathIndices, minlength=numberOfPaths), 1)
+    meanClosestPointDistancesMm = numpy.bincount(self.pointPathIndices, weights=closestDistancesMm, minlength=numberOfPaths) / numbersOfPoints
+    hausdorffDistancesMm = numpy.zeros(numberOfPaths)
+    numpy.maximum.at(hausdorffDistancesMm, self.pointPathIndices, closestDistancesMm)
+
+    # matched reference to catheter, the points of each catheter's reference queried against that catheter only
+    referencePointOrder = numpy.argsort(referenceLabelIndices, kind='mergesort')
+    referenceStarts = numpy.searchsorted(referenceLabelIndices[referencePointOrder], numpy.arange(numberOfReferences + 1))
+    queryPointIndices = numpy.concatenate([referencePointOrder[referenceStarts[reference]:referenceStarts[reference + 1]] for reference in matchedReferences])
+    queryPathIndices = numpy.repeat(numpy.arange(numberOfPaths), numpy.diff(referenceStarts)[matchedReferences])
+    referenceToPathDistancesMm = self.pathPointIndex.findClosestPoints(referencePointsMm[queryPointIndices], queryPathIndices)[0]
+    numpy.maximum.at(hausdorffDistancesMm, queryPathIndices, referenceToPathDistancesMm)
+
+    # nearest catheter of every reference point
+    nearestPathDistancesMm, nearestPathPointIndices = self.pathPointIndex.findClosestPoints(referencePointsMm)
+    return { 'pathNumber' : self.pathNumbers,
+             'referenceLabel' : uniqueReferenceLabels[matchedReferences],
+             'meanClosestPointDistanceMm' : meanClosestPointDistancesMm,
+             'hausdorffDistanceMm' : hausdorffDistancesMm,
+             'referenceNearestPathNumber' : self.pathNumbers[self.pointPathIndices[nearestPathPointIndices]],
+             'referenceNearestPathDistanceMm' : nearestPathDistancesMm }
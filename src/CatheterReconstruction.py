@@ -0,0 +1,737 @@
+from __main__ import vtk, qt, ctk, slicer
+from slicer.ScriptedLoadableModule import *
+from vtk.util import numpy_support
+import logging
+import numpy
+import Queue
+import threading
+import time
+
+#
+# CatheterReconstruction
+#
+
+class CatheterReconstruction(ScriptedLoadableModule):
+  def __init__(self, parent):
+    parent.title = "CatheterReconstruction"
+    parent.categories = ["IGT"]
+    parent.dependencies = []
+    parent.contributors = ["Thomas Vaughan (Queen's)", "Gabor Fichtinger (Queen's)"]
+    parent.helpText = """
+    Fit a smooth curve through the points collected along a catheter and build a tube model around it.
+    The points are ordered along a minimum spanning tree and fitted with a polynomial, like the curve mode of MarkupsToModel.
+    """
+    parent.acknowledgementText = """
+	This work is funded as a project in the Laboratory for Percutaneous Surgery, Queen's University, Kingston, Ontario. Thomas Vaughan is funded by an NSERC Postgraduate award. Gabor Fichtinger is funded as a Cancer Care Ontario (CCO) Chair.
+	""" # replace with organization, grant and thanks.
+    self.parent = parent
+
+#
+# CatheterReconstructionWidget
+#
+
+class CatheterReconstructionWidget(ScriptedLoadableModuleWidget):
+
+  def setup(self):
+    ScriptedLoadableModuleWidget.setup(self)
+
+    self.logic = CatheterReconstructionLogic()
+
+    # Collapsible buttons
+    self.parametersCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.parametersCollapsibleButton.text = "CatheterReconstruction"
+    self.layout.addWidget(self.parametersCollapsibleButton)
+
+    # Layout within the collapsible button
+    self.parametersFormLayout = qt.QFormLayout(self.parametersCollapsibleButton)
+
+    # Point List combobox
+    self.pointListLabel = qt.QLabel()
+    self.pointListLabel.setText("Point list: ")
+    self.pointListSelector = slicer.qMRMLNodeComboBox()
+    self.pointListSelector.nodeTypes = ( ("vtkMRMLMarkupsFiducialNode"), "" )
+    self.pointListSelector.noneEnabled = False
+    self.pointListSelector.addEnabled = False
+    self.pointListSelector.removeEnabled = False
+    self.pointListSelector.setMRMLScene( slicer.mrmlScene )
+    self.pointListSelector.setToolTip("Pick the points collected along the catheter")
+    self.parametersFormLayout.addRow(self.pointListLabel, self.pointListSelector)
+
+    # Model combobox
+    self.modelLabel = qt.QLabel()
+    self.modelLabel.setText("Catheter model: ")
+    self.modelSelector = slicer.qMRMLNodeComboBox()
+    self.modelSelector.nodeTypes = ( ("vtkMRMLModelNode"), "" )
+    self.modelSelector.noneEnabled = False
+    self.modelSelector.addEnabled = True
+    self.modelSelector.removeEnabled = False
+    self.modelSelector.setMRMLScene( slicer.mrmlScene )
+    self.modelSelector.setToolTip("Pick the model to store the catheter tube in")
+    self.parametersFormLayout.addRow(self.modelLabel, self.modelSelector)
+
+    self.reconstructButton = qt.QPushButton()
+    self.reconstructButton.text = "Reconstruct"
+    self.parametersFormLayout.addRow(self.reconstructButton)
+
+    self.reconstructButton.connect('clicked()', self.reconstructButtonClicked)
+
+    # Add vertical spacer
+    self.layout.addStretch(1)
+
+  def reconstructButtonClicked(self):
+    logging.debug('reconstructButtonClicked')
+    markupsNode = self.pointListSelector.currentNode()
+    modelNode = self.modelSelector.currentNode()
+    if (not markupsNode or not modelNode):
+      return
+    pointsMm = self.logic.getPointsFromMarkups(markupsNode)
+    modelNode.SetAndObservePolyData(self.logic.reconstructCatheter(pointsMm))
+    modelNode.SetAndObserveTransformNodeID(markupsNode.GetTransformNodeID())
+
+#
+# CatheterReconstructionLogic
+#
+
+class CatheterReconstructionLogic(ScriptedLoadableModuleLogic):
+  """
+  Everything except getPointsFromMarkups works on NumPy arrays and VTK objects that are not in the scene,
+  so reconstructCatheter can run in a worker thread.
+  """
+  # constants - DO NOT CHANGE THESE
+  minimumNumberOfPoints = 2
+  liveProfileName = 'Live'
+  finalProfileName = 'Final'
+
+  def __init__(self):
+    self.polynomialOrder = 9
+    self.tubeRadiusMm = 1.0
+    self.duplicatePointToleranceMm = 0.01
+    # The live profile is rebuilt on every display update during collection, so it has to fit in a tracker frame.
+    # The final profile is built once when collection stops and is the model kept in the scene.
+    # Fewer than 3 tube sides gives the bare curve as a polyline.
+    self.qualityProfiles = {
+      self.liveProfileName : { 'tubeNumberOfSides' : 4, 'tubeSamplingFrequency' : 1, 'maximumNumberOfCurveSamples' : 100, 'tubeCapping' : False },
+      self.finalProfileName : { 'tubeNumberOfSides' : 24, 'tubeSamplingFrequency' : 5, 'maximumNumberOfCurveSamples' : 1000, 'tubeCapping' : True } }
+    self.rebuildStatisticsLock = threading.Lock() # rebuilds are recorded from the worker thread
+    self.resetRebuildStatistics()
+
+  def getQualityProfile(self, profileName):
+    # returns the profile itself, change its entries to tune it
+    return self.qualityProfiles[profileName]
+
+  def getNumberOfCurveSamples(self, profileName, numberOfPoints):
+    profile = self.qualityProfiles[profileName]
+    return max(2, min(profile['tubeSamplingFrequency'] * numberOfPoints, profile['maximumNumberOfCurveSamples']))
+
+  def resetRebuildStatistics(self):
+    with self.rebuildStatisticsLock:
+      self.rebuildStatistics = {}
+
+  def recordRebuild(self, profileName, durationSec, numberOfTriangles):
+    with self.rebuildStatisticsLock:
+      statistics = self.rebuildStatistics.setdefault(profileName, { 'numberOfRebuilds' : 0, 'totalDurationSec' : 0.0, 'maximumDurationSec' : 0.0, 'maximumNumberOfTriangles' : 0 })
+      statistics['numberOfRebuilds'] = statistics['numberOfRebuilds'] + 1
+      statistics['totalDurationSec'] = statistics['totalDurationSec'] + durationSec
+      statistics['maximumDurationSec'] = max(statistics['maximumDurationSec'], durationSec)
+      statistics['maximumNumberOfTriangles'] = max(statistics['maximumNumberOfTriangles'], numberOfTriangles)
+      statistics['lastDurationSec'] = durationSec
+      statistics['lastNumberOfTriangles'] = numberOfTriangles
+
+  def getRebuildStatistics(self, profileName):
+    # None if the profile has not been built since the last reset
+    with self.rebuildStatisticsLock:
+      if (profileName not in self.rebuildStatistics):
+        return None
+      statistics = dict(self.rebuildStatistics[profileName])
+    statistics['meanDurationSec'] = statistics['totalDurationSec'] / statistics['numberOfRebuilds']
+    return statistics
+
+  def getNumberOfTriangles(self, polyData):
+    # a strip or polygon of n points is n - 2 triangles, and each cell takes n + 1 connectivity entries
+    numberOfTriangles = 0
+    for cells in [polyData.GetStrips(), polyData.GetPolys()]:
+      numberOfTriangles = numberOfTriangles + cells.GetNumberOfConnectivityEntries() - 3 * cells.GetNumberOfCells()
+    return numberOfTriangles
+
+  def getPointsFromMarkups(self, markupsNode):
+    numberOfFiducials = markupsNode.GetNumberOfFiducials()
+    pointsMm = numpy.zeros([numberOfFiducials,3])
+    pointMm = [0,0,0]
+    for pointIndex in xrange(numberOfFiducials):
+      markupsNode.GetNthFiducialPosition(pointIndex, pointMm)
+      pointsMm[pointIndex] = pointMm
+    return pointsMm
+
+  def removeDuplicatePoints(self, pointsMm):
+    # drops points that repeat the previous one, as cleaning the markups does in MarkupsToModel
+    if (len(pointsMm) < 2):
+      return pointsMm
+    stepsMm = numpy.linalg.norm(numpy.diff(pointsMm, axis=0), axis=1)
+    return pointsMm[numpy.concatenate([[True], stepsMm > self.duplicatePointToleranceMm])]
+
+  def computeMinimumSpanningTree(self, pointsMm):
+    # Prim's algorithm over the complete graph, O(N^2) time and O(N) memory. Returns the parent of each point
+    # (-1 for the root) and the length of the edge to it.
+    numberOfPoints = len(pointsMm)
+    parentIndices = numpy.zeros(numberOfPoints, dtype=numpy.int64)
+    parentIndices[0] = -1
+    edgeLengthsMm = numpy.zeros(numberOfPoints)
+    inTree = numpy.zeros(numberOfPoints, dtype=bool)
+    closestDistancesMm = numpy.full(numberOfPoints, numpy.inf)
+    closestTreeIndices = numpy.zeros(numberOfPoints, dtype=numpy.int64)
+    newIndex = 0
+    for step in xrange(numberOfPoints):
+      inTree[newIndex] = True
+      distancesMm = numpy.linalg.norm(pointsMm - pointsMm[newIndex], axis=1)
+      closer = (distancesMm < closestDistancesMm) & ~inTree
+      closestDistancesMm[closer] = distancesMm[closer]
+      closestTreeIndices[closer] = newIndex
+      closestDistancesMm[inTree] = numpy.inf
+      if (step == numberOfPoints - 1):
+        break
+      newIndex = int(numpy.argmin(closestDistancesMm))
+      parentIndices[newIndex] = closestTreeIndices[newIndex]
+      edgeLengthsMm[newIndex] = closestDistancesMm[newIndex]
+    return parentIndices, edgeLengthsMm
+
+  def getTreeDistancesMm(self, parentIndices, edgeLengthsMm, startIndex):
+    # distance along the tree from startIndex to every point, and the previous point on the way
+    numberOfPoints = len(parentIndices)
+    neighbours = [[] for pointIndex in xrange(numberOfPoints)]
+    for pointIndex in xrange(numberOfPoints):
+      if (parentIndices[pointIndex] >= 0):
+        neighbours[pointIndex].append((parentIndices[pointIndex], edgeLengthsMm[pointIndex]))
+        neighbours[parentIndices[pointIndex]].append((pointIndex, edgeLengthsMm[pointIndex]))
+    distancesMm = numpy.full(numberOfPoints, -1.0)
+    previousIndices = numpy.full(numberOfPoints, -1, dtype=numpy.int64)
+    distancesMm[startIndex] = 0
+    stack = [startIndex]
+    while (stack):
+      pointIndex = stack.pop()
+      for neighbourIndex, edgeLengthMm in neighbours[pointIndex]:
+        if (distancesMm[neighbourIndex] < 0):
+          distancesMm[neighbourIndex] = distancesMm[pointIndex] + edgeLengthMm
+          previousIndices[neighbourIndex] = pointIndex
+          stack.append(neighbourIndex)
+    return distancesMm, previousIndices
+
+  def computeMinimumSpanningTreeParameters(self, pointsMm):
+    """
+    Arc length of each point along the longest path through the minimum spanning tree of the points.
+    Points on side branches get the arc length of the point where their branch joins the longest path.
+    Returns the arc lengths in mm and the length of the longest path.
+    """
+    numberOfPoints = len(pointsMm)
+    if (numberOfPoints < 2):
+      return numpy.zeros(numberOfPoints), 0.0
+    parentIndices, edgeLengthsMm = self.computeMinimumSpanningTree(pointsMm)
+    # the longest path runs between the point farthest from any point and the point farthest from that one
+    distancesMm, previousIndices = self.getTreeDistancesMm(parentIndices, edgeLengthsMm, 0)
+    startIndex = int(numpy.argmax(distancesMm))
+    distancesMm, previousIndices = self.getTreeDistancesMm(parentIndices, edgeLengthsMm, startIndex)
+    endIndex = int(numpy.argmax(distancesMm))
+    if (endIndex < startIndex): # keep the collection direction, the first collected point is near the start
+      startIndex, endIndex = endIndex, startIndex
+      distancesMm, previousIndices = self.getTreeDistancesMm(parentIndices, edgeLengthsMm, startIndex)
+    onPath = numpy.zeros(numberOfPoints, dtype=bool)
+    pointIndex = endIndex
+    while (pointIndex >= 0):
+      onPath[pointIndex] = True
+      pointIndex = previousIndices[pointIndex]
+    arcLengthsMm = numpy.array(distancesMm)
+    for pointIndex in numpy.flatnonzero(~onPath):
+      joinIndex = pointIndex
+      while (not onPath[joinIndex]):
+        joinIndex = previousIndices[joinIndex]
+      arcLengthsMm[pointIndex] = distancesMm[joinIndex]
+    return arcLengthsMm, distancesMm[endIndex]
+
+  def fitPolynomialCurve(self, arcLengthsMm, pointsMm, pathLengthMm):
+    # least squares fit in the Legendre basis over the path, which stays well conditioned at order 9
+    order = min(self.polynomialOrder, len(pointsMm) - 1)
+    normalizedParameters = 2 * arcLengthsMm / max(pathLengthMm, 1e-9) - 1
+    basis = numpy.polynomial.legendre.legvander(normalizedParameters, order)
+    coefficients = numpy.linalg.lstsq(basis, pointsMm, rcond=-1)[0]
+    return coefficients
+
+  def sampleCurve(self, coefficients, numberOfSamples):
+    normalizedParameters = numpy.linspace(-1, 1, numberOfSamples)
+    return numpy.polynomial.legendre.legval(normalizedParameters, coefficients).T
+
+  def createTubePolyData(self, curvePointsMm, profileName=finalProfileName):
+    startTimeSec = time.time()
+    profile = self.qualityProfiles[profileName]
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(curvePointsMm), deep=1))
+    lines = vtk.vtkCellArray()
+    lines.InsertNextCell(len(curvePointsMm))
+    for pointIndex in xrange(len(curvePointsMm)):
+      lines.InsertCellPoint(pointIndex)
+    curvePolyData = vtk.vtkPolyData()
+    curvePolyData.SetPoints(points)
+    curvePolyData.SetLines(lines)
+    if (profile['tubeNumberOfSides'] < 3):
+      self.recordRebuild(profileName, time.time() - startTimeSec, 0)
+      return curvePolyData
+    tubeFilter = vtk.vtkTubeFilter()
+    tubeFilter.SetInputData(curvePolyData)
+    tubeFilter.SetRadius(self.tubeRadiusMm)
+    tubeFilter.SetNumberOfSides(profile['tubeNumberOfSides'])
+    tubeFilter.SetCapping(profile['tubeCapping'])
+    tubeFilter.Update()
+    tubePolyData = tubeFilter.GetOutput()
+    self.recordRebuild(profileName, time.time() - startTimeSec, self.getNumberOfTriangles(tubePolyData))
+    return tubePolyData
+
+  def fitCatheterCurve(self, pointsMm):
+    """
+    Curve fitted to pointsMm, an N x 3 array, as Legendre coefficients padded with zeros to polynomialOrder + 1 rows,
+    and the number of distinct points it was fitted to. The coefficients are all zero if there are too few distinct points.
+    """
+    pointsMm = self.removeDuplicatePoints(pointsMm)
+    coefficients = numpy.zeros([self.polynomialOrder + 1,3])
+    if (len(pointsMm) < self.minimumNumberOfPoints):
+      return coefficients, len(pointsMm)
+    arcLengthsMm, pathLengthMm = self.computeMinimumSpanningTreeParameters(pointsMm)
+    fittedCoefficients = self.fitPolynomialCurve(arcLengthsMm, pointsMm, pathLengthMm)
+    coefficients[:len(fittedCoefficients)] = fittedCoefficients
+    return coefficients, len(pointsMm)
+
+  def createCurvePolyData(self, coefficients, numberOfFittedPoints, profileName=finalProfileName):
+    # tube for a curve from fitCatheterCurve, so stored fits can be shown again without refitting
+    if (numberOfFittedPoints < self.minimumNumberOfPoints):
+      return vtk.vtkPolyData()
+    curvePointsMm = self.sampleCurve(coefficients, self.getNumberOfCurveSamples(profileName, numberOfFittedPoints))
+    return self.createTubePolyData(curvePointsMm, profileName)
+
+  def reconstructCatheter(self, pointsMm, profileName=finalProfileName):
+    """
+    Tube polydata along the curve fitted to pointsMm, an N x 3 array, built with the given quality profile.
+    Does not touch the scene. Returns empty polydata if there are too few distinct points.
+    """
+    coefficients, numberOfFittedPoints = self.fitCatheterCurve(pointsMm)
+    return self.createCurvePolyData(coefficients, numberOfFittedPoints, profileName)
+
+#
+# CatheterPathStore
+#
+
+class CatheterPathStore(object):
+  """
+  All the collected catheter paths in a few contiguous arrays. The points and their timestamps are stored one path
+  after another, and each path has its number, where its points start, how many there are, its curve fit
+  (see CatheterReconstructionLogic.fitCatheterCurve) and whether it is shown. Paths are only appended and removed
+  at the end, so removing the last path is O(1). The whole store is saved to and loaded from one NPZ file.
+  """
+  # constants - DO NOT CHANGE THESE
+  fileFormatVersion = 1
+  initialPointCapacity = 16384
+  initialPathCapacity = 32
+
+  def __init__(self, polynomialOrder):
+    self.polynomialOrder = polynomialOrder
+    self.removeAllPaths()
+
+  def removeAllPaths(self):
+    self.pointsMm = numpy.zeros([self.initialPointCapacity,3])
+    self.timestampsSec = numpy.zeros(self.initialPointCapacity)
+    self.numberOfPoints = 0
+    self.pathNumbers = numpy.zeros(self.initialPathCapacity, dtype=numpy.int64)
+    self.pathPointStartIndices = numpy.zeros(self.initialPathCapacity, dtype=numpy.int64)
+    self.pathNumbersOfPoints = numpy.zeros(self.initialPathCapacity, dtype=numpy.int64)
+    self.pathCurveCoefficients = numpy.zeros([self.initialPathCapacity, self.polynomialOrder + 1, 3])
+    self.pathNumbersOfFittedPoints = numpy.zeros(self.initialPathCapacity, dtype=numpy.int64)
+    self.pathVisibilities = numpy.zeros(self.initialPathCapacity, dtype=bool)
+    self.numberOfPaths = 0
+    self.pathIndexByNumber = {}
+
+  def growArray(self, array, minimumLength):
+    # double the capacity, so appends stay O(1) amortized
+    newShape = list(array.shape)
+    newShape[0] = max(minimumLength, 2 * array.shape[0])
+    grownArray = numpy.zeros(newShape, dtype=array.dtype)
+    grownArray[:array.shape[0]] = array
+    return grownArray
+
+  def addPath(self, pathNumber, pointsMm, timestampsSec, curveCoefficients, numberOfFittedPoints, visible=True):
+    if (pathNumber in self.pathIndexByNumber):
+      raise ValueError("Catheter path {0} is already stored".format(pathNumber))
+    numberOfPathPoints = len(pointsMm)
+    if (self.numberOfPoints + numberOfPathPoints > self.pointsMm.shape[0]):
+      self.pointsMm = self.growArray(self.pointsMm, self.numberOfPoints + numberOfPathPoints)
+      self.timestampsSec = self.growArray(self.timestampsSec, self.numberOfPoints + numberOfPathPoints)
+    if (self.numberOfPaths == self.pathNumbers.shape[0]):
+      for arrayName in ['pathNumbers', 'pathPointStartIndices', 'pathNumbersOfPoints', 'pathCurveCoefficients', 'pathNumbersOfFittedPoints', 'pathVisibilities']:
+        setattr(self, arrayName, self.growArray(getattr(self, arrayName), self.numberOfPaths + 1))
+    self.pointsMm[self.numberOfPoints:self.numberOfPoints + numberOfPathPoints] = pointsMm
+    self.timestampsSec[self.numberOfPoints:self.numberOfPoints + numberOfPathPoints] = timestampsSec
+    pathIndex = self.numberOfPaths
+    self.pathNumbers[pathIndex] = pathNumber
+    self.pathPointStartIndices[pathIndex] = self.numberOfPoints
+    self.pathNumbersOfPoints[pathIndex] = numberOfPathPoints
+    self.pathCurveCoefficients[pathIndex] = curveCoefficients
+    self.pathNumbersOfFittedPoints[pathIndex] = numberOfFittedPoints
+    self.pathVisibilities[pathIndex] = visible
+    self.pathIndexByNumber[pathNumber] = pathIndex
+    self.numberOfPaths = self.numberOfPaths + 1
+    self.numberOfPoints = self.numberOfPoints + numberOfPathPoints
+
+  def removeLastPath(self):
+    # returns the number of the removed path, None if the store is empty
+    if (self.numberOfPaths == 0):
+      return None
+    self.numberOfPaths = self.numberOfPaths - 1
+    pathNumber = int(self.pathNumbers[self.numberOfPaths])
+    self.numberOfPoints = int(self.pathPointStartIndices[self.numberOfPaths])
+    del self.pathIndexByNumber[pathNumber]
+    return pathNumber
+
+  def getNumberOfPaths(self):
+    return self.numberOfPaths
+
+  def getPathNumbers(self):
+    return self.pathNumbers[:self.numberOfPaths]
+
+  def hasPath(self, pathNumber):
+    return pathNumber in self.pathIndexByNumber
+
+  def getPathPointsMm(self, pathNumber):
+    # view into the store, valid until the next path is added or removed
+    pathIndex = self.pathIndexByNumber[pathNumber]
+    startIndex = self.pathPointStartIndices[pathIndex]
+    return self.pointsMm[startIndex:startIndex + self.pathNumbersOfPoints[pathIndex]]
+
+  def getAllPathPointsMm(self):
+    # points of all the paths, one path after another, and the index of the path (in getPathNumbers order) of every point
+    pointPathIndices = numpy.repeat(numpy.arange(self.numberOfPaths), self.pathNumbersOfPoints[:self.numberOfPaths])
+    return self.pointsMm[:self.numberOfPoints], pointPathIndices
+
+  def getPathTimestampsSec(self, pathNumber):
+    pathIndex = self.pathIndexByNumber[pathNumber]
+    startIndex = self.pathPointStartIndices[pathIndex]
+    return self.timestampsSec[startIndex:startIndex + self.pathNumbersOfPoints[pathIndex]]
+
+  def getPathCurve(self, pathNumber):
+    # curve coefficients and number of fitted points, as taken by CatheterReconstructionLogic.createCurvePolyData
+    pathIndex = self.pathIndexByNumber[pathNumber]
+    return self.pathCurveCoefficients[pathIndex], int(self.pathNumbersOfFittedPoints[pathIndex])
+
+  def setPathVisible(self, pathNumber, visible):
+    self.pathVisibilities[self.pathIndexByNumber[pathNumber]] = visible
+
+  def isPathVisible(self, pathNumber):
+    return bool(self.pathVisibilities[self.pathIndexByNumber[pathNumber]])
+
+  def getVisiblePathNumbers(self):
+    return self.pathNumbers[:self.numberOfPaths][self.pathVisibilities[:self.numberOfPaths]]
+
+  def save(self, filePath):
+    numpy.savez_compressed(filePath,
+      fileFormatVersion=self.fileFormatVersion,
+      pointsMm=self.pointsMm[:self.numberOfPoints],
+      timestampsSec=self.timestampsSec[:self.numberOfPoints],
+      pathNumbers=self.pathNumbers[:self.numberOfPaths],
+      pathNumbersOfPoints=self.pathNumbersOfPoints[:self.numberOfPaths],
+      pathCurveCoefficients=self.pathCurveCoefficients[:self.numberOfPaths],
+      pathNumbersOfFittedPoints=self.pathNumbersOfFittedPoints[:self.numberOfPaths],
+      pathVisibilities=self.pathVisibilities[:self.numberOfPaths])
+
+  def load(self, filePath):
+    # replaces all the paths in the store
+    with numpy.load(filePath) as pathFile:
+      if (int(pathFile['fileFormatVersion']) > self.fileFormatVersion):
+        raise ValueError("{0} was written by a newer version of CatheterReconstruction".format(filePath))
+      arrays = dict((arrayName, pathFile[arrayName]) for arrayName in pathFile.files)
+    self.polynomialOrder = arrays['pathCurveCoefficients'].shape[1] - 1
+    self.removeAllPaths()
+    pathEndIndices = numpy.cumsum(arrays['pathNumbersOfPoints'])
+    for pathIndex in xrange(len(arrays['pathNumbers'])):
+      startIndex = pathEndIndices[pathIndex] - arrays['pathNumbersOfPoints'][pathIndex]
+      self.addPath(int(arrays['pathNumbers'][pathIndex]),
+                   arrays['pointsMm'][startIndex:pathEndIndices[pathIndex]],
+                   arrays['timestampsSec'][startIndex:pathEndIndices[pathIndex]],
+                   arrays['pathCurveCoefficients'][pathIndex],
+                   arrays['pathNumbersOfFittedPoints'][pathIndex],
+                   bool(arrays['pathVisibilities'][pathIndex]))
+
+#
+# IncrementalCatheterCurveFit
+#
+
+class IncrementalCatheterCurveFit(object):
+  """
+  Polynomial curve fit that follows the points of a CollectFiducialsSupplementLogic while they are collected
+  (register it with addPointListener). The normal equations of the least squares fit are kept up to date, so adding,
+  removing or moving the last point costs O(order^2) however many points there are.
+  Points are parameterized by arc length along the collection order. The minimum spanning tree parameterization
+  is only redone when the new points double back, which is when the collection order stops following the catheter.
+  After that, new points are parameterized by projecting them onto the current fit, since the last point's parameter
+  may lie at the far end of a branch, e.g. while the wire is pulled back.
+  A turn only counts as doubling back once the points have gone back far enough, so that tracking jitter while the
+  wire is held still does not rerun the O(N^2) parameterization during collection.
+  The Legendre basis is defined over a domain slightly longer than the path. The normal equations are rebuilt from
+  all the points only when the path outgrows the domain by a fixed factor, so that cost is constant per point amortized.
+  The domain is kept tight because the fit becomes badly conditioned when the points only cover part of it.
+  """
+
+  def __init__(self, reconstructionLogic):
+    self.reconstructionLogic = reconstructionLogic
+    self.order = reconstructionLogic.polynomialOrder
+    self.minimumDomainLengthMm = 10.0
+    self.domainGrowthFactor = 1.1
+    self.doubleBackCosine = 0.0 # new segments at more than 90 degrees to the previous one may double back
+    self.minimumDoubleBackDistanceMm = 3.0 # how far the points have to go back from the turn
+    self.minimumNumberOfDoubleBackPoints = 3 # and in how many points after the turn
+    self.numberOfProjectionSamples = 100 # along the current fit, for the parameter of points after a reparameterization
+    self.numberOfReparameterizations = 0
+    self.numberOfDomainRebuilds = 0
+    self.onPointsReset(numpy.zeros([0,3]))
+
+  def getNumberOfPoints(self):
+    return self.numberOfPoints
+
+  def getBasis(self, arcLengthsMm):
+    return numpy.polynomial.legendre.legvander(2 * arcLengthsMm / self.domainLengthMm - 1, self.order)
+
+  def getPointBasis(self, arcLengthMm):
+    # Legendre recurrence, legvander has too much overhead for a single point
+    x = 2 * arcLengthMm / self.domainLengthMm - 1
+    basis = [1.0, x]
+    for degree in xrange(1, self.order):
+      basis.append(((2 * degree + 1) * x * basis[degree] - degree * basis[degree - 1]) / (degree + 1))
+    return numpy.array(basis[:self.order + 1])
+
+  def onPointsReset(self, pointsMm):
+    self.turnPointIndex = None # last point before a possible double back, see updateDoubleBack
+    self.turnDirection = None
+    self.isParameterizedByTree = (len(pointsMm) >= 2) # then new points are projected onto the fit, see setLastPoint
+    self.numberOfPoints = len(pointsMm)
+    capacity = max(1024, 2 * self.numberOfPoints)
+    self.pointsMm = numpy.zeros([capacity,3])
+    self.pointsMm[:self.numberOfPoints] = pointsMm
+    self.arcLengthsMm = numpy.zeros(capacity)
+    if (self.numberOfPoints >= 2):
+      self.arcLengthsMm[:self.numberOfPoints] = self.reconstructionLogic.computeMinimumSpanningTreeParameters(self.pointsMm[:self.numberOfPoints])[0]
+      self.numberOfReparameterizations = self.numberOfReparameterizations + 1
+    self.rebuildNormalEquations()
+
+  def rebuildNormalEquations(self):
+    pathLengthMm = self.arcLengthsMm[:self.numberOfPoints].max() if (self.numberOfPoints > 0) else 0
+    self.domainLengthMm = max(self.minimumDomainLengthMm, self.domainGrowthFactor * pathLengthMm)
+    basis = self.getBasis(self.arcLengthsMm[:self.numberOfPoints])
+    self.normalMatrix = basis.T.dot(basis)
+    self.normalRightHandSide = basis.T.dot(self.pointsMm[:self.numberOfPoints])
+
+  def accumulate(self, pointIndex, sign):
+    basis = self.getPointBasis(self.arcLengthsMm[pointIndex])
+    self.normalMatrix += sign * numpy.outer(basis, basis)
+    self.normalRightHandSide += sign * numpy.outer(basis, self.pointsMm[pointIndex])
+
+  def setLastPoint(self, pointMm):
+    # parameterize and accumulate the point at numberOfPoints - 1
+    pointIndex = self.numberOfPoints - 1
+    self.pointsMm[pointIndex] = pointMm
+    if (pointIndex == 0):
+      self.arcLengthsMm[pointIndex] = 0
+    elif (self.isParameterizedByTree and pointIndex > self.order): # enough points before it for a full order fit
+      self.arcLengthsMm[pointIndex] = self.getProjectedArcLengthMm(self.pointsMm[pointIndex])
+    else:
+      stepMm = self.pointsMm[pointIndex] - self.pointsMm[pointIndex - 1]
+      self.arcLengthsMm[pointIndex] = self.arcLengthsMm[pointIndex - 1] + numpy.sqrt(stepMm.dot(stepMm))
+    if (self.arcLengthsMm[pointIndex] > self.domainLengthMm):
+      self.numberOfDomainRebuilds = self.numberOfDomainRebuilds + 1
+      self.rebuildNormalEquations()
+    else:
+      self.accumulate(pointIndex, 1)
+
+  def getProjectedArcLengthMm(self, pointMm):
+    # parameter of the closest point on the fit of the points before the last one, extrapolated past either end
+    arcLengthsMm = self.arcLengthsMm[:self.numberOfPoints - 1]
+    sampleArcLengthsMm = numpy.linspace(arcLengthsMm.min(), arcLengthsMm.max(), self.numberOfProjectionSamples)
+    coefficients = self.getCoefficients()
+    samplesMm = numpy.polynomial.legendre.legval(2 * sampleArcLengthsMm / self.domainLengthMm - 1, coefficients).T
+    segmentsMm = samplesMm[1:] - samplesMm[:-1]
+    segmentLengthsSquared = numpy.sum(segmentsMm * segmentsMm, axis=1)
+    segmentLengthsSquared[segmentLengthsSquared == 0] = 1
+    fractions = numpy.sum((pointMm - samplesMm[:-1]) * segmentsMm, axis=1) / segmentLengthsSquared
+    fractions[1:] = numpy.maximum(fractions[1:], 0)
+    fractions[:-1] = numpy.minimum(fractions[:-1], 1)
+    offsetsMm = samplesMm[:-1] + fractions[:,numpy.newaxis] * segmentsMm - pointMm
+    segmentIndex = numpy.argmin(numpy.sum(offsetsMm * offsetsMm, axis=1))
+    arcLengthMm = sampleArcLengthsMm[segmentIndex] + fractions[segmentIndex] * (sampleArcLengthsMm[1] - sampleArcLengthsMm[0])
+    return max(0.0, arcLengthMm) # the basis domain starts at 0
+
+  def updateDoubleBack(self, pointMm):
+    # True once the points after a sharp turn have gone back at least minimumDoubleBackDistanceMm
+    if (self.turnPointIndex is None):
+      previousStepMm = self.pointsMm[self.numberOfPoints - 1] - self.pointsMm[self.numberOfPoints - 2]
+      newStepMm = pointMm - self.pointsMm[self.numberOfPoints - 1]
+      previousStepLengthMm = numpy.sqrt(previousStepMm.dot(previousStepMm))
+      if (previousStepLengthMm == 0 or previousStepMm.dot(newStepMm) >= self.doubleBackCosine * previousStepLengthMm * numpy.sqrt(newStepMm.dot(newStepMm))):
+        return False
+      self.turnPointIndex = self.numberOfPoints - 1
+      self.turnDirection = previousStepMm / previousStepLengthMm
+    doubleBackDistanceMm = -(pointMm - self.pointsMm[self.turnPointIndex]).dot(self.turnDirection)
+    if (doubleBackDistanceMm <= 0):
+      self.turnPointIndex = None # carried on past the turn, it was jitter
+      self.turnDirection = None
+      return False
+    return (doubleBackDistanceMm >= self.minimumDoubleBackDistanceMm and
+            self.numberOfPoints - self.turnPointIndex >= self.minimumNumberOfDoubleBackPoints)
+
+  def onPointAdded(self, pointMm):
+    if (self.numberOfPoints >= 2 and self.updateDoubleBack(pointMm)):
+      self.onPointsReset(numpy.concatenate([self.pointsMm[:self.numberOfPoints], [pointMm]]))
+      return
+    if (self.numberOfPoints == self.pointsMm.shape[0]):
+      self.pointsMm = numpy.concatenate([self.pointsMm, numpy.zeros(self.pointsMm.shape)])
+      self.arcLengthsMm = numpy.concatenate([self.arcLengthsMm, numpy.zeros(self.arcLengthsMm.shape)])
+    self.numberOfPoints = self.numberOfPoints + 1
+    self.setLastPoint(pointMm)
+
+  def onLastPointRemoved(self):
+    self.accumulate(self.numberOfPoints - 1, -1)
+    self.numberOfPoints = self.numberOfPoints - 1
+    if (self.turnPointIndex is not None and self.turnPointIndex >= self.numberOfPoints - 1):
+      self.turnPointIndex = None # the points after the turn are gone
+      self.turnDirection = None
+    if (self.numberOfPoints > 0 and self.domainGrowthFactor * self.domainGrowthFactor * self.arcLengthsMm[:self.numberOfPoints].max() < self.domainLengthMm):
+      self.numberOfDomainRebuilds = self.numberOfDomainRebuilds + 1
+      self.rebuildNormalEquations()
+
+  def onLastPointMoved(self, pointMm):
+    self.accumulate(self.numberOfPoints - 1, -1)
+    self.setLastPoint(pointMm)
+
+  def getCoefficients(self):
+    # Legendre coefficients over the current domain, None if there are too few points
+    if (self.numberOfPoints < CatheterReconstructionLogic.minimumNumberOfPoints):
+      return None
+    numberOfCoefficients = min(self.order, self.numberOfPoints - 1) + 1
+    normalMatrix = self.normalMatrix[:numberOfCoefficients,:numberOfCoefficients]
+    regularization = 1e-12 * numpy.trace(normalMatrix) * numpy.identity(numberOfCoefficients)
+    return numpy.linalg.solve(normalMatrix + regularization, self.normalRightHandSide[:numberOfCoefficients])
+
+  def getCurvePointsMm(self, numberOfSamples):
+    coefficients = self.getCoefficients()
+    if (coefficients is None):
+      return numpy.zeros([0,3])
+    arcLengthsMm = self.arcLengthsMm[:self.numberOfPoints]
+    normalizedParameters = numpy.linspace(2 * arcLengthsMm.min() / self.domainLengthMm - 1, 2 * arcLengthsMm.max() / self.domainLengthMm - 1, numberOfSamples)
+    return numpy.polynomial.legendre.legval(normalizedParameters, coefficients).T
+
+#
+# CatheterReconstructionWorker
+#
+
+class CatheterReconstructionWorker(object):
+  """
+  Runs jobFunction in a background thread, e.g. CatheterReconstructionLogic.reconstructCatheter on collected points
+  or CatheterReconstructionLogic.createTubePolyData on curve points. Jobs carry a copy of their input (NumPy points,
+  or VTK data that is deep copied), so the collection can go on changing its own points. Only the latest submitted job is kept, older pending jobs
+  are dropped. Results are handed to resultCallback on the main thread by a timer that polls the result queue,
+  since Python code cannot declare new Qt signals.
+  """
+
+  def __init__(self, jobFunction, resultCallback, jobName='Catheter reconstruction'):
+    self.jobFunction = jobFunction # called as jobFunction(jobInput) in the thread, returns e.g. vtkPolyData, None is not passed on
+    self.jobName = jobName # for log messages
+    self.resultCallback = resultCallback # called as resultCallback(result, jobTag) on the main thread
+    self.jobCondition = threading.Condition()
+    self.pendingJob = None
+    self.stopEvent = None # one per thread, so a thread that outlives stop() cannot pick up new jobs
+    self.lastSubmittedJobId = 0
+    self.lastCancelledJobId = 0
+    self.numberOfJobsInFlight = 0
+    self.resultQueue = Queue.Queue()
+    self.thread = None
+    self.resultPollTimer = qt.QTimer()
+    self.resultPollTimer.setInterval(10)
+    self.resultPollTimer.connect('timeout()', self.onResultPollTimeout)
+
+  def submit(self, jobInput, jobTag=None):
+    # jobTag is passed back with the result, e.g. the path number
+    if (not self.thread):
+      self.stopEvent = threading.Event()
+      self.resultQueue = Queue.Queue()
+      self.thread = threading.Thread(target=self.processJobs, args=(self.stopEvent, self.resultQueue))
+      self.thread.daemon = True
+      self.thread.start()
+    with self.jobCondition:
+      self.lastSubmittedJobId = self.lastSubmittedJobId + 1
+      if (self.pendingJob is None):
+        self.numberOfJobsInFlight = self.numberOfJobsInFlight + 1
+      self.pendingJob = (self.lastSubmittedJobId, jobTag, self.copyJobInput(jobInput))
+      self.jobCondition.notify()
+    if (not self.resultPollTimer.isActive()):
+      self.resultPollTimer.start()
+    return self.lastSubmittedJobId
+
+  def copyJobInput(self, jobInput):
+    if (isinstance(jobInput, vtk.vtkDataObject)):
+      jobInputCopy = jobInput.NewInstance()
+      jobInputCopy.DeepCopy(jobInput)
+      return jobInputCopy
+    return numpy.array(jobInput, copy=True)
+
+  def cancel(self):
+    # drop the pending job and ignore the result of the one being processed
+    with self.jobCondition:
+      if (self.pendingJob is not None):
+        self.pendingJob = None
+        self.numberOfJobsInFlight = self.numberOfJobsInFlight - 1
+      self.lastCancelledJobId = self.lastSubmittedJobId
+
+  def stop(self, timeoutSec=1.0):
+    """
+    Cancel everything and end the thread, waiting at most timeoutSec for the job being processed.
+    The thread is a daemon, so if the job takes longer it cannot keep Slicer from exiting.
+    """
+    self.cancel()
+    self.resultPollTimer.stop()
+    if (not self.thread):
+      return
+    with self.jobCondition:
+      self.stopEvent.set()
+      self.jobCondition.notify_all()
+    self.thread.join(timeoutSec)
+    if (self.thread.isAlive()):
+      logging.warning("{0} did not finish within {1} s, its result will be discarded".format(self.jobName, timeoutSec))
+    self.thread = None
+    self.numberOfJobsInFlight = 0
+
+  def isBusy(self):
+    return self.numberOfJobsInFlight > 0
+
+  def processJobs(self, stopEvent, resultQueue):
+    while True:
+      with self.jobCondition:
+        while (self.pendingJob is None and not stopEvent.is_set()):
+          self.jobCondition.wait()
+        if (stopEvent.is_set()):
+          return
+        (jobId, jobTag, jobInput) = self.pendingJob
+        self.pendingJob = None
+      try:
+        result = self.jobFunction(jobInput)
+      except Exception as exception:
+        logging.error("{0} failed: {1}".format(self.jobName, exception))
+        result = None
+      resultQueue.put((jobId, jobTag, result))
+
+  def onResultPollTimeout(self):
+    latestResult = None
+    try:
+      while True:
+        result = self.resultQueue.get_nowait()
+        with self.jobCondition:
+          self.numberOfJobsInFlight = self.numberOfJobsInFlight - 1
+        if (result[0] > self.lastCancelledJobId and result[2] is not None):
+          latestResult = result
+    except Queue.Empty:
+      pass
+    if (not self.isBusy()):
+      self.resultPollTimer.stop()
+    if (latestResult):
+      (jobId, jobTag, result) = latestResult
+      self.resultCallback(result, jobTag)
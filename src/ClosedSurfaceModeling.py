@@ -0,0 +1,536 @@
+from __main__ import vtk, qt, ctk, slicer
+from slicer.ScriptedLoadableModule import *
+from vtk.util import numpy_support
+import hashlib
+import logging
+import numpy
+
+#
+# ClosedSurfaceModeling
+#
+
+class ClosedSurfaceModeling(ScriptedLoadableModule):
+  def __init__(self, parent):
+    parent.title = "ClosedSurfaceModeling"
+    parent.categories = ["IGT"]
+    parent.dependencies = ["CatheterReconstruction"]
+    parent.contributors = ["Thomas Vaughan (Queen's)", "Gabor Fichtinger (Queen's)"]
+    parent.helpText = """
+    Keep a closed surface model (e.g. seroma or chest wall) up to date with the points of a markups node.
+    The surface is the convex hull of the points, smoothed with curved triangle patches, like the butterfly subdivided
+    convex hull of the closed surface mode of MarkupsToModel. Edits are coalesced and the surface is computed in a background
+    thread. A surface whose points are mostly added and deleted at the end can instead keep its convex hull incrementally.
+    """
+    parent.acknowledgementText = """
+	This work is funded as a project in the Laboratory for Percutaneous Surgery, Queen's University, Kingston, Ontario. Thomas Vaughan is funded by an NSERC Postgraduate award. Gabor Fichtinger is funded as a Cancer Care Ontario (CCO) Chair.
+	""" # replace with organization, grant and thanks.
+    self.parent = parent
+
+#
+# ClosedSurfaceModelingWidget
+#
+
+class ClosedSurfaceModelingWidget(ScriptedLoadableModuleWidget):
+
+  def setup(self):
+    ScriptedLoadableModuleWidget.setup(self)
+
+    self.logic = ClosedSurfaceModelingLogic()
+    self.pipeline = ClosedSurfacePipeline(self.logic, 'Closed surface')
+
+    # Collapsible buttons
+    self.parametersCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.parametersCollapsibleButton.text = "ClosedSurfaceModeling"
+    self.layout.addWidget(self.parametersCollapsibleButton)
+
+    # Layout within the collapsible button
+    self.parametersFormLayout = qt.QFormLayout(self.parametersCollapsibleButton)
+
+    # Point List combobox
+    self.pointListLabel = qt.QLabel()
+    self.pointListLabel.setText("Point list: ")
+    self.pointListSelector = slicer.qMRMLNodeComboBox()
+    self.pointListSelector.nodeTypes = ( ("vtkMRMLMarkupsFiducialNode"), "" )
+    self.pointListSelector.noneEnabled = True
+    self.pointListSelector.addEnabled = False
+    self.pointListSelector.removeEnabled = False
+    self.pointListSelector.setMRMLScene( slicer.mrmlScene )
+    self.pointListSelector.setToolTip("Pick the points on the surface")
+    self.parametersFormLayout.addRow(self.pointListLabel, self.pointListSelector)
+
+    # Model combobox
+    self.modelLabel = qt.QLabel()
+    self.modelLabel.setText("Surface model: ")
+    self.modelSelector = slicer.qMRMLNodeComboBox()
+    self.modelSelector.nodeTypes = ( ("vtkMRMLModelNode"), "" )
+    self.modelSelector.noneEnabled = True
+    self.modelSelector.addEnabled = True
+    self.modelSelector.removeEnabled = False
+    self.modelSelector.setMRMLScene( slicer.mrmlScene )
+    self.modelSelector.setToolTip("Pick the model to store the surface in")
+    self.parametersFormLayout.addRow(self.modelLabel, self.modelSelector)
+
+    self.pointListSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onNodesChanged)
+    self.modelSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onNodesChanged)
+
+    # Add vertical spacer
+    self.layout.addStretch(1)
+
+  def cleanup(self):
+    self.pipeline.stop()
+
+  def onNodesChanged(self, node):
+    logging.debug('onNodesChanged')
+    self.pipeline.setNodes(self.pointListSelector.currentNode(), self.modelSelector.currentNode())
+
+#
+# ClosedSurfaceModelingLogic
+#
+
+class ClosedSurfaceModelingLogic(ScriptedLoadableModuleLogic):
+  """
+  Everything except getPointsFromMarkups works on NumPy arrays and VTK objects that are not in the scene,
+  so createClosedSurfacePolyData can run in a worker thread. It is written in NumPy rather than with VTK filters,
+  since those keep the GIL for all of Update() and would stall the main thread for as long as the worker runs.
+  """
+  # constants - DO NOT CHANGE THESE
+  minimumNumberOfPoints = 4 # fewer points cannot enclose a volume
+
+  def __init__(self):
+    self.duplicatePointToleranceMm = 0.01
+    self.smoothSubdivision = True # otherwise the flat hull facets
+    self.numberOfSubdivisions = 3 # each hull facet becomes 4**numberOfSubdivisions triangles
+
+  def getPointsFromMarkups(self, markupsNode):
+    numberOfFiducials = markupsNode.GetNumberOfFiducials()
+    pointsMm = numpy.zeros([numberOfFiducials,3])
+    pointMm = [0,0,0]
+    for pointIndex in xrange(numberOfFiducials):
+      markupsNode.GetNthFiducialPosition(pointIndex, pointMm)
+      pointsMm[pointIndex] = pointMm
+    return pointsMm
+
+  def getPointsHash(self, pointsMm):
+    # identical point sets give identical surfaces, so a matching hash means the rebuild can be skipped
+    return hashlib.sha1(numpy.ascontiguousarray(pointsMm, dtype=numpy.float64).tostring()).hexdigest()
+
+  def removeDuplicatePoints(self, pointsMm):
+    # points closer than duplicatePointToleranceMm, i.e. in the same tolerance cell, are kept once, in their original order
+    if (len(pointsMm) == 0):
+      return pointsMm
+    cellIndices = numpy.round(pointsMm / self.duplicatePointToleranceMm)
+    sortOrder = numpy.lexsort(cellIndices.T)
+    sortedCellIndices = cellIndices[sortOrder]
+    isFirstInCell = numpy.concatenate([[True], numpy.any(numpy.diff(sortedCellIndices, axis=0) != 0, axis=1)])
+    return pointsMm[numpy.sort(sortOrder[isFirstInCell])]
+
+  def createClosedSurfacePolyData(self, pointsMm):
+    """
+    Closed surface around pointsMm, an N x 3 array. Does not touch the scene.
+    Returns empty polydata if the points do not span a volume.
+    """
+    pointsMm = self.removeDuplicatePoints(pointsMm)
+    if (len(pointsMm) < self.minimumNumberOfPoints):
+      return vtk.vtkPolyData()
+    convexHull = IncrementalConvexHull()
+    for pointMm in pointsMm:
+      convexHull.addPoint(pointMm)
+    subdivisionLevel = 2 ** self.numberOfSubdivisions if self.smoothSubdivision else 1
+    return SmoothHullSurface(convexHull, subdivisionLevel).update()
+
+#
+# IncrementalConvexHull
+#
+
+class IncrementalConvexHull(object):
+  """
+  3D convex hull that is updated one point at a time, for point sets that grow while they are collected.
+  Facets are only appended, and a flag marks the ones that are still on the hull. Each insertion records the facets
+  it deleted and where its new facets start, so removing the last point restores the previous hull exactly.
+  The facets a new point can see are found with one vectorized plane test over the live facets. For the few hundred
+  points of a seroma this is faster in NumPy than walking conflict lists in Python.
+  """
+  # constants - DO NOT CHANGE THESE
+  initialCapacity = 256
+  pendingInsertion = 'pending' # there was no hull yet, the point is waiting for enough points to span a volume
+  interiorInsertion = 'interior' # the point was inside the hull, nothing changed
+  initialInsertion = 'initial' # the point was the first to span a volume, the hull was built on it
+  hullInsertion = 'hull' # the point replaced the facets it could see
+
+  def __init__(self, toleranceMm=1e-6):
+    self.toleranceMm = toleranceMm
+    self.removeAllPoints()
+
+  def removeAllPoints(self):
+    self.pointsMm = numpy.zeros([self.initialCapacity,3])
+    self.numberOfPoints = 0
+    self.facetVertexIndices = numpy.zeros([self.initialCapacity,3], dtype=numpy.int64)
+    self.facetNormals = numpy.zeros([self.initialCapacity,3])
+    self.facetOffsetsMm = numpy.zeros(self.initialCapacity)
+    self.facetAlive = numpy.zeros(self.initialCapacity, dtype=bool)
+    self.numberOfFacets = 0 # including the ones no longer on the hull
+    self.insertionRecords = [] # one per point, see removeLastPoint
+    self.interiorPointMm = None # inside every hull built on the current points, used to orient the facets
+
+  def hasHull(self):
+    return self.interiorPointMm is not None
+
+  def getPointsMm(self):
+    return self.pointsMm[:self.numberOfPoints]
+
+  def getNumberOfPoints(self):
+    return self.numberOfPoints
+
+  def getAliveFacetIndices(self):
+    return numpy.flatnonzero(self.facetAlive[:self.numberOfFacets])
+
+  def addPoint(self, pointMm):
+    if (self.numberOfPoints == self.pointsMm.shape[0]): # grow geometrically so appends stay O(1) amortized
+      self.pointsMm = numpy.concatenate([self.pointsMm, numpy.zeros(self.pointsMm.shape)])
+    pointIndex = self.numberOfPoints
+    self.pointsMm[pointIndex] = pointMm
+    self.numberOfPoints = self.numberOfPoints + 1
+    if (self.hasHull()):
+      self.insertionRecords.append(self.insertPoint(pointIndex))
+    elif (self.createInitialHull()):
+      self.insertionRecords.append((self.initialInsertion,))
+    else:
+      self.insertionRecords.append((self.pendingInsertion,))
+
+  def removeLastPoint(self):
+    if (self.numberOfPoints == 0):
+      return
+    insertionRecord = self.insertionRecords.pop()
+    self.numberOfPoints = self.numberOfPoints - 1
+    if (insertionRecord[0] == self.initialInsertion):
+      self.facetAlive[:self.numberOfFacets] = False
+      self.numberOfFacets = 0
+      self.interiorPointMm = None
+    elif (insertionRecord[0] == self.hullInsertion):
+      (insertionType, deletedFacetIndices, firstNewFacetIndex) = insertionRecord
+      self.facetAlive[firstNewFacetIndex:self.numberOfFacets] = False
+      self.numberOfFacets = firstNewFacetIndex
+      self.facetAlive[deletedFacetIndices] = True
+
+  def createInitialHull(self):
+    # a tetrahedron from points that span a volume, then every other point inserted into it
+    pointsMm = self.getPointsMm()
+    if (len(pointsMm) < 4):
+      return False
+    distancesMm = numpy.linalg.norm(pointsMm - pointsMm[0], axis=1)
+    secondIndex = int(numpy.argmax(distancesMm))
+    if (distancesMm[secondIndex] <= self.toleranceMm):
+      return False
+    lineDirection = (pointsMm[secondIndex] - pointsMm[0]) / distancesMm[secondIndex]
+    offsetsFromLineMm = (pointsMm - pointsMm[0]) - numpy.outer((pointsMm - pointsMm[0]).dot(lineDirection), lineDirection)
+    distancesMm = numpy.linalg.norm(offsetsFromLineMm, axis=1)
+    thirdIndex = int(numpy.argmax(distancesMm))
+    if (distancesMm[thirdIndex] <= self.toleranceMm):
+      return False
+    planeNormal = numpy.cross(pointsMm[secondIndex] - pointsMm[0], pointsMm[thirdIndex] - pointsMm[0])
+    planeNormal = planeNormal / numpy.linalg.norm(planeNormal)
+    distancesMm = numpy.abs((pointsMm - pointsMm[0]).dot(planeNormal))
+    fourthIndex = int(numpy.argmax(distancesMm))
+    if (distancesMm[fourthIndex] <= self.toleranceMm):
+      return False
+    simplexIndices = [0, secondIndex, thirdIndex, fourthIndex]
+    self.interiorPointMm = pointsMm[simplexIndices].mean(axis=0)
+    for (firstCorner, secondCorner, thirdCorner) in [(0,1,2), (0,1,3), (0,2,3), (1,2,3)]:
+      self.addFacet(simplexIndices[firstCorner], simplexIndices[secondCorner], simplexIndices[thirdCorner])
+    for pointIndex in xrange(len(pointsMm)):
+      if (pointIndex not in simplexIndices):
+        self.insertPoint(pointIndex)
+    return True
+
+  def addFacet(self, firstIndex, secondIndex, thirdIndex):
+    if (self.numberOfFacets == self.facetVertexIndices.shape[0]):
+      self.facetVertexIndices = numpy.concatenate([self.facetVertexIndices, numpy.zeros(self.facetVertexIndices.shape, dtype=numpy.int64)])
+      self.facetNormals = numpy.concatenate([self.facetNormals, numpy.zeros(self.facetNormals.shape)])
+      self.facetOffsetsMm = numpy.concatenate([self.facetOffsetsMm, numpy.zeros(self.facetOffsetsMm.shape)])
+      self.facetAlive = numpy.concatenate([self.facetAlive, numpy.zeros(self.facetAlive.shape, dtype=bool)])
+    normal = numpy.cross(self.pointsMm[secondIndex] - self.pointsMm[firstIndex], self.pointsMm[thirdIndex] - self.pointsMm[firstIndex])
+    normal = normal / numpy.linalg.norm(normal)
+    if (normal.dot(self.interiorPointMm - self.pointsMm[firstIndex]) > 0): # make it point outwards, with the vertices counterclockwise seen from outside
+      normal = -normal
+      (secondIndex, thirdIndex) = (thirdIndex, secondIndex)
+    self.facetVertexIndices[self.numberOfFacets] = [firstIndex, secondIndex, thirdIndex]
+    self.facetNormals[self.numberOfFacets] = normal
+    self.facetOffsetsMm[self.numberOfFacets] = normal.dot(self.pointsMm[firstIndex])
+    self.facetAlive[self.numberOfFacets] = True
+    self.numberOfFacets = self.numberOfFacets + 1
+
+  def insertPoint(self, pointIndex):
+    aliveFacetIndices = self.getAliveFacetIndices()
+    distancesMm = self.facetNormals[aliveFacetIndices].dot(self.pointsMm[pointIndex]) - self.facetOffsetsMm[aliveFacetIndices]
+    visibleFacetIndices = aliveFacetIndices[distancesMm > self.toleranceMm]
+    if (len(visibleFacetIndices) == 0):
+      return (self.interiorInsertion,)
+    # the horizon is made of the edges of visible facets whose other facet is not visible
+    visibleEdges = set()
+    for (firstIndex, secondIndex, thirdIndex) in self.facetVertexIndices[visibleFacetIndices].tolist():
+      visibleEdges.update([(firstIndex, secondIndex), (secondIndex, thirdIndex), (thirdIndex, firstIndex)])
+    self.facetAlive[visibleFacetIndices] = False
+    firstNewFacetIndex = self.numberOfFacets
+    for (firstIndex, secondIndex) in visibleEdges:
+      if ((secondIndex, firstIndex) not in visibleEdges):
+        self.addFacet(firstIndex, secondIndex, pointIndex)
+    return (self.hullInsertion, visibleFacetIndices, firstNewFacetIndex)
+
+#
+# SmoothHullSurface
+#
+
+class SmoothHullSurface(object):
+  """
+  Smooth display surface for an IncrementalConvexHull. Each hull facet is replaced by a curved point-normal triangle
+  patch, which only depends on the facet's vertices and their normals. So after the hull changes, only facets with
+  a new, moved or re-oriented vertex are evaluated again, and the other patches are reused.
+  Patches meet along their edges because an edge's curve only depends on the two vertices it joins.
+  """
+
+  def __init__(self, convexHull, subdivisionLevel=4):
+    self.convexHull = convexHull
+    self.subdivisionLevel = subdivisionLevel
+    # barycentric coordinates of the patch samples, and the triangles between them
+    patchCoordinates = []
+    sampleIndexByCoordinates = {}
+    for uIndex in xrange(subdivisionLevel + 1):
+      for vIndex in xrange(subdivisionLevel + 1 - uIndex):
+        sampleIndexByCoordinates[(uIndex, vIndex)] = len(patchCoordinates)
+        patchCoordinates.append([uIndex, vIndex])
+    patchCoordinates = numpy.array(patchCoordinates, dtype=numpy.float64) / subdivisionLevel
+    self.patchU = patchCoordinates[:,0]
+    self.patchV = patchCoordinates[:,1]
+    self.patchW = 1 - self.patchU - self.patchV
+    patchTriangles = []
+    for uIndex in xrange(subdivisionLevel):
+      for vIndex in xrange(subdivisionLevel - uIndex):
+        patchTriangles.append([sampleIndexByCoordinates[(uIndex, vIndex)], sampleIndexByCoordinates[(uIndex + 1, vIndex)], sampleIndexByCoordinates[(uIndex, vIndex + 1)]])
+        if (vIndex < subdivisionLevel - uIndex - 1):
+          patchTriangles.append([sampleIndexByCoordinates[(uIndex + 1, vIndex)], sampleIndexByCoordinates[(uIndex + 1, vIndex + 1)], sampleIndexByCoordinates[(uIndex, vIndex + 1)]])
+    self.patchTriangles = numpy.array(patchTriangles, dtype=numpy.int64)
+    self.numberOfPatchSamples = len(patchCoordinates)
+    self.numberOfRegeneratedFacets = 0 # in the last update
+    self.reset()
+
+  def reset(self):
+    self.patchPointsMm = numpy.zeros([0, self.numberOfPatchSamples, 3])
+    self.patchNormals = numpy.zeros([0, self.numberOfPatchSamples, 3])
+    self.patchVertexIndices = numpy.zeros([0,3], dtype=numpy.int64) # the facet vertices each patch was evaluated for
+    self.vertexPointsMm = numpy.zeros([0,3]) # the vertex positions and normals the patches were evaluated with
+    self.vertexNormals = numpy.zeros([0,3])
+
+  def getVertexNormals(self, aliveFacetIndices):
+    # area weighted average of the normals of the facets around each vertex
+    convexHull = self.convexHull
+    facetVertexIndices = convexHull.facetVertexIndices[aliveFacetIndices]
+    pointsMm = convexHull.getPointsMm()
+    facetAreaNormals = numpy.cross(pointsMm[facetVertexIndices[:,1]] - pointsMm[facetVertexIndices[:,0]], pointsMm[facetVertexIndices[:,2]] - pointsMm[facetVertexIndices[:,0]])
+    vertexNormals = numpy.zeros([len(pointsMm),3])
+    for corner in xrange(3):
+      numpy.add.at(vertexNormals, facetVertexIndices[:,corner], facetAreaNormals)
+    lengths = numpy.linalg.norm(vertexNormals, axis=1)
+    lengths[lengths == 0] = 1
+    return vertexNormals / lengths[:,numpy.newaxis]
+
+  def evaluatePatches(self, firstPointsMm, secondPointsMm, thirdPointsMm, firstNormals, secondNormals, thirdNormals):
+    # cubic Bezier triangles with quadratic normals (Vlachos et al., Curved PN Triangles), one row per facet
+    def dot(a, b):
+      return numpy.sum(a * b, axis=1)[:,numpy.newaxis]
+    def edgeControlPoint(startMm, endMm, startNormals):
+      return (2 * startMm + endMm - dot(endMm - startMm, startNormals) * startNormals) / 3
+    def edgeNormal(startMm, endMm, startNormals, endNormals):
+      edgeMm = endMm - startMm
+      edgeLengthsSquared = dot(edgeMm, edgeMm)
+      edgeLengthsSquared[edgeLengthsSquared == 0] = 1
+      normals = startNormals + endNormals - 2 * dot(edgeMm, startNormals + endNormals) / edgeLengthsSquared * edgeMm
+      lengths = numpy.linalg.norm(normals, axis=1)[:,numpy.newaxis]
+      lengths[lengths == 0] = 1
+      return normals / lengths
+    b210 = edgeControlPoint(firstPointsMm, secondPointsMm, firstNormals)
+    b120 = edgeControlPoint(secondPointsMm, firstPointsMm, secondNormals)
+    b021 = edgeControlPoint(secondPointsMm, thirdPointsMm, secondNormals)
+    b012 = edgeControlPoint(thirdPointsMm, secondPointsMm, thirdNormals)
+    b102 = edgeControlPoint(thirdPointsMm, firstPointsMm, thirdNormals)
+    b201 = edgeControlPoint(firstPointsMm, thirdPointsMm, firstNormals)
+    edgeCenter = (b210 + b120 + b021 + b012 + b102 + b201) / 6
+    b111 = edgeCenter + (edgeCenter - (firstPointsMm + secondPointsMm + thirdPointsMm) / 3) / 2
+    n110 = edgeNormal(firstPointsMm, secondPointsMm, firstNormals, secondNormals)
+    n011 = edgeNormal(secondPointsMm, thirdPointsMm, secondNormals, thirdNormals)
+    n101 = edgeNormal(thirdPointsMm, firstPointsMm, thirdNormals, firstNormals)
+    (w, u, v) = (self.patchW[:,numpy.newaxis], self.patchU[:,numpy.newaxis], self.patchV[:,numpy.newaxis])
+    def combine(controlPoints, weights):
+      return sum(weights[index] * controlPoints[index][:,numpy.newaxis,:] for index in xrange(len(weights)))
+    patchPointsMm = combine([firstPointsMm, secondPointsMm, thirdPointsMm, b210, b120, b201, b021, b102, b012, b111],
+                            [w**3, u**3, v**3, 3*w*w*u, 3*w*u*u, 3*w*w*v, 3*u*u*v, 3*w*v*v, 3*u*v*v, 6*w*u*v])
+    patchNormals = combine([firstNormals, secondNormals, thirdNormals, n110, n011, n101], [w*w, u*u, v*v, w*u, u*v, w*v])
+    lengths = numpy.linalg.norm(patchNormals, axis=2)[:,:,numpy.newaxis]
+    lengths[lengths == 0] = 1
+    return patchPointsMm, patchNormals / lengths
+
+  def update(self):
+    """
+    Bring the patches in line with the hull and return the surface as vtkPolyData.
+    Empty polydata while the hull does not exist yet.
+    """
+    convexHull = self.convexHull
+    if (not convexHull.hasHull()):
+      self.reset()
+      self.numberOfRegeneratedFacets = 0
+      return vtk.vtkPolyData()
+    aliveFacetIndices = convexHull.getAliveFacetIndices()
+    pointsMm = convexHull.getPointsMm()
+    vertexNormals = self.getVertexNormals(aliveFacetIndices)
+    # vertices whose position or normal differs from what the existing patches used
+    numberOfKnownVertices = min(len(pointsMm), len(self.vertexPointsMm))
+    vertexChanged = numpy.ones(len(pointsMm), dtype=bool)
+    vertexChanged[:numberOfKnownVertices] = (numpy.any(pointsMm[:numberOfKnownVertices] != self.vertexPointsMm[:numberOfKnownVertices], axis=1)
+                                             | numpy.any(numpy.abs(vertexNormals[:numberOfKnownVertices] - self.vertexNormals[:numberOfKnownVertices]) > 1e-12, axis=1))
+    # facets are only appended and truncated, so a facet index keeps its vertices unless the facet was replaced
+    numberOfFacets = convexHull.numberOfFacets
+    if (len(self.patchPointsMm) < numberOfFacets):
+      numberOfNewPatches = numberOfFacets - len(self.patchPointsMm)
+      self.patchPointsMm = numpy.concatenate([self.patchPointsMm, numpy.zeros([numberOfNewPatches, self.numberOfPatchSamples, 3])])
+      self.patchNormals = numpy.concatenate([self.patchNormals, numpy.zeros([numberOfNewPatches, self.numberOfPatchSamples, 3])])
+      self.patchVertexIndices = numpy.concatenate([self.patchVertexIndices, -numpy.ones([numberOfNewPatches,3], dtype=numpy.int64)])
+    facetVertexIndices = convexHull.facetVertexIndices[aliveFacetIndices]
+    facetChanged = (numpy.any(facetVertexIndices != self.patchVertexIndices[aliveFacetIndices], axis=1)
+                    | numpy.any(vertexChanged[facetVertexIndices], axis=1))
+    changedFacetIndices = aliveFacetIndices[facetChanged]
+    if (len(changedFacetIndices) > 0):
+      changedVertexIndices = convexHull.facetVertexIndices[changedFacetIndices]
+      (patchPointsMm, patchNormals) = self.evaluatePatches(pointsMm[changedVertexIndices[:,0]], pointsMm[changedVertexIndices[:,1]], pointsMm[changedVertexIndices[:,2]],
+                                                           vertexNormals[changedVertexIndices[:,0]], vertexNormals[changedVertexIndices[:,1]], vertexNormals[changedVertexIndices[:,2]])
+      self.patchPointsMm[changedFacetIndices] = patchPointsMm
+      self.patchNormals[changedFacetIndices] = patchNormals
+      self.patchVertexIndices[changedFacetIndices] = changedVertexIndices
+    self.numberOfRegeneratedFacets = len(changedFacetIndices)
+    self.vertexPointsMm = pointsMm.copy()
+    self.vertexNormals = vertexNormals
+    return self.createPolyData(aliveFacetIndices)
+
+  def createPolyData(self, facetIndices):
+    numberOfFacets = len(facetIndices)
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(self.patchPointsMm[facetIndices].reshape(-1,3), deep=1))
+    normals = numpy_support.numpy_to_vtk(self.patchNormals[facetIndices].reshape(-1,3), deep=1)
+    normals.SetName('Normals')
+    triangles = numpy.empty([numberOfFacets * len(self.patchTriangles), 4], dtype=numpy_support.ID_TYPE_CODE)
+    triangles[:,0] = 3
+    triangles[:,1:] = (self.patchTriangles[numpy.newaxis,:,:] + (numpy.arange(numberOfFacets) * self.numberOfPatchSamples)[:,numpy.newaxis,numpy.newaxis]).reshape(-1,3)
+    cells = vtk.vtkCellArray()
+    cells.SetCells(len(triangles), numpy_support.numpy_to_vtkIdTypeArray(triangles.ravel(), deep=1))
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(points)
+    polyData.SetPolys(cells)
+    polyData.GetPointData().SetNormals(normals)
+    return polyData
+
+#
+# ClosedSurfacePipeline
+#
+
+class ClosedSurfacePipeline(object):
+  """
+  Keeps one model node's closed surface up to date with one markups node. Only point additions, removals and moves
+  are observed, not every ModifiedEvent. A burst of them within rebuildIntervalMs results in a single rebuild,
+  which is skipped if the points are the same as for the last one. The surface is computed in a worker thread,
+  or, with setIncrementalConvexHull, updated in place from the points added or removed since the last rebuild.
+  Each surface gets its own pipeline, so they never wait for or retarget each other.
+  """
+
+  def __init__(self, surfaceLogic, surfaceName):
+    import CatheterReconstruction
+    self.surfaceLogic = surfaceLogic
+    self.surfaceName = surfaceName
+    self.markupsNode = None
+    self.modelNode = None
+    self.markupsObserverTags = []
+    self.lastSubmittedPointsHash = None
+    self.numberOfMarkupsEvents = 0
+    self.numberOfRebuilds = 0
+    self.numberOfSkippedRebuilds = 0
+    self.rebuildTimer = qt.QTimer()
+    self.rebuildTimer.setSingleShot(True)
+    self.rebuildTimer.setInterval(33) # about one rebuild per display frame
+    self.rebuildTimer.connect('timeout()', self.onRebuildTimeout)
+    self.worker = CatheterReconstruction.CatheterReconstructionWorker(self.surfaceLogic.createClosedSurfacePolyData, self.onSurfaceComputed,
+                                                                      surfaceName + ' surface modeling')
+    self.convexHull = None
+    self.hullSurface = None
+
+  def setIncrementalConvexHull(self, enabled):
+    # for point sets that are mostly added to and deleted from at the end, e.g. the seroma
+    self.convexHull = IncrementalConvexHull() if enabled else None
+    self.hullSurface = SmoothHullSurface(self.convexHull) if enabled else None
+    self.lastSubmittedPointsHash = None
+
+  def setRebuildIntervalMs(self, intervalMs):
+    self.rebuildTimer.setInterval(intervalMs)
+
+  def setNodes(self, markupsNode, modelNode):
+    # observe markupsNode and write its surface to modelNode, None for either stops the pipeline
+    self.removeObservers()
+    self.worker.cancel()
+    self.markupsNode = markupsNode
+    self.modelNode = modelNode
+    self.lastSubmittedPointsHash = None
+    if (not self.markupsNode or not self.modelNode):
+      return
+    for eventId in [slicer.vtkMRMLMarkupsNode.MarkupAddedEvent, slicer.vtkMRMLMarkupsNode.MarkupRemovedEvent, slicer.vtkMRMLMarkupsNode.PointModifiedEvent]:
+      self.markupsObserverTags.append(self.markupsNode.AddObserver(eventId, self.onMarkupsModified))
+    self.rebuildTimer.start() # the markups may already hold points
+
+  def removeObservers(self):
+    for observerTag in self.markupsObserverTags:
+      self.markupsNode.RemoveObserver(observerTag)
+    self.markupsObserverTags = []
+
+  def stop(self):
+    self.removeObservers()
+    self.rebuildTimer.stop()
+    self.worker.stop()
+
+  def onMarkupsModified(self, observer, eventid):
+    # no logging here, it is called for every drag step
+    self.numberOfMarkupsEvents = self.numberOfMarkupsEvents + 1
+    if (not self.rebuildTimer.isActive()):
+      self.rebuildTimer.start()
+
+  def onRebuildTimeout(self):
+    if (not self.markupsNode or not self.modelNode):
+      return
+    pointsMm = self.surfaceLogic.getPointsFromMarkups(self.markupsNode)
+    pointsHash = self.surfaceLogic.getPointsHash(pointsMm)
+    if (pointsHash == self.lastSubmittedPointsHash):
+      self.numberOfSkippedRebuilds = self.numberOfSkippedRebuilds + 1
+      return
+    self.lastSubmittedPointsHash = pointsHash
+    self.numberOfRebuilds = self.numberOfRebuilds + 1
+    if (self.convexHull):
+      self.updateConvexHull(pointsMm)
+      self.onSurfaceComputed(self.hullSurface.update(), pointsHash)
+      return
+    self.worker.submit(pointsMm, pointsHash)
+
+  def updateConvexHull(self, pointsMm):
+    # roll the hull back to the points it shares with pointsMm, then add the rest
+    hullPointsMm = self.convexHull.getPointsMm()
+    numberOfCommonPoints = min(len(pointsMm), len(hullPointsMm))
+    differentPointIndices = numpy.flatnonzero(numpy.any(pointsMm[:numberOfCommonPoints] != hullPointsMm[:numberOfCommonPoints], axis=1))
+    if (len(differentPointIndices) > 0):
+      numberOfCommonPoints = differentPointIndices[0]
+    while (self.convexHull.getNumberOfPoints() > numberOfCommonPoints):
+      self.convexHull.removeLastPoint()
+    for pointMm in pointsMm[numberOfCommonPoints:]:
+      self.convexHull.addPoint(pointMm)
+
+  def onSurfaceComputed(self, polyData, pointsHash):
+    if (not self.modelNode):
+      return
+    self.modelNode.SetAndObservePolyData(polyData)
+
+  def getCounters(self):
+    return { 'numberOfMarkupsEvents' : self.numberOfMarkupsEvents,
+             'numberOfRebuilds' : self.numberOfRebuilds,
+             'numberOfSkippedRebuilds' : self.numberOfSkippedRebuilds }
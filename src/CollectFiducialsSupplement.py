@@ -1,6 +1,9 @@
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import math
+import numpy
+import time
 
 #
 # CollectFiducialsSupplement
@@ -10,7 +13,7 @@ class CollectFiducialsSupplement(ScriptedLoadableModule):
   def __init__(self, parent):
     parent.title = "CollectFiducialsSupplement"
     parent.categories = ["IGT"]
-    parent.dependencies = []
+    parent.dependencies = ["TransformGraph"]
     parent.contributors = ["Thomas Vaughan (Queen's)", "Gabor Fichtinger (Queen's)"]
     parent.helpText = """
     Collect fiducials at the origin of an observed transform automatically after some amount of movement.
@@ -167,6 +170,9 @@ class CollectFiducialsSupplementWidget(ScriptedLoadableModuleWidget):
 #
 
 class CollectFiducialsSupplementLogic(ScriptedLoadableModuleLogic):
+  # constants - DO NOT CHANGE THESE
+  initialPointCapacity = 1024
+  
   def __init__(self):
     self.transformSourceNode = None
     self.transformTargetNode = None
@@ -175,32 +181,62 @@ class CollectFiducialsSupplementLogic(ScriptedLoadableModuleLogic):
     self.currentlyCollecting = False
     self.allowPointRemovals = False
     self.forceConstantPointDistance = False
-    self.currentPositionMm = [0,0,0]
+    self.currentPositionMm = numpy.zeros(3)
     self.currentDistanceFromPointNMinus2Mm = 0 # Relative to second last point, N refers to the size of the markups list
     self.currentDistanceFromPointNMinus3Mm = 0 # Relative to third last point
     self.transformNodeObserverTags = []
+    # collected points are kept here and pushed to the markups node in batches (see flushPointsToMarkups)
+    self.pointsMm = numpy.zeros([self.initialPointCapacity,3])
+    self.timestampsSec = numpy.zeros(self.initialPointCapacity) # when each point was last moved, 0 for points read from the markups node
+    self.currentTimestampSec = 0
+    self.numberOfPoints = 0
+    self.firstModifiedPointIndex = 0 # points before this index and the markups node agree
+    self.displayUpdateRateHz = 30 # 0 pushes every sample to the markups node
+    self.lastFlushTimeSec = 0
+    import TransformGraph
+    self.transformGraph = TransformGraph.CachedTransformGraph() # see setTransformGraph
+    # objects told about every change to the collected points, see addPointListener
+    self.pointListeners = []
+    # all transform events from one tracker frame are handled by a single deferred collection step
+    self.collectionStepPending = False
+    self.numberOfTransformModifiedEvents = 0
+    self.numberOfCollectionSteps = 0
+    self.pendingNumberOfTransformModifiedEvents = 0
+    self.lastStepNumberOfTransformModifiedEvents = 0 # events coalesced into the most recent step
 
   def addObservers(self): # mostly copied from PositionErrorMapping.py in PLUS
     logging.debug('addObservers')
     transformModifiedEvent = 15000
-    transformSourceNode = self.transformSourceNode
-    while transformSourceNode:
-      print "Add observer to {0}".format(transformSourceNode.GetName())
-      self.transformNodeObserverTags.append([transformSourceNode, transformSourceNode.AddObserver(transformModifiedEvent, self.onTransformModified)])
-      transformSourceNode = transformSourceNode.GetParentTransformNode()
-    transformTargetNode = self.transformTargetNode
-    while transformTargetNode:
-      print "Add observer to {0}".format(transformTargetNode.GetName())
-      self.transformNodeObserverTags.append([transformTargetNode, transformTargetNode.AddObserver(transformModifiedEvent, self.onTransformModified)])
-      transformTargetNode = transformTargetNode.GetParentTransformNode()
-      # TODO: What should it do if a transform node already exists in the list?
-    print "Done adding observers"
+    for transformNode in self.getObservedTransformNodes():
+      logging.debug('Add observer to {0}'.format(transformNode.GetName()))
+      self.transformNodeObserverTags.append([transformNode, transformNode.AddObserver(transformModifiedEvent, self.onTransformModified)])
+    logging.debug('Done adding observers')
+    
+  def getObservedTransformNodes(self):
+    # Only the transforms between the source, the target, and their closest common parent affect the
+    # source-to-target transform. The common parents (e.g. ChestToRas) are shared by both chains and
+    # cancel out, so they are left unobserved, and every node is observed at most once.
+    sourceChain = self.getTransformNodeChain(self.transformSourceNode)
+    targetChain = self.getTransformNodeChain(self.transformTargetNode)
+    sourceChainIDs = [transformNode.GetID() for transformNode in sourceChain]
+    targetChainIDs = [transformNode.GetID() for transformNode in targetChain]
+    observedTransformNodes = [transformNode for transformNode in sourceChain if transformNode.GetID() not in targetChainIDs]
+    observedTransformNodes.extend([transformNode for transformNode in targetChain if transformNode.GetID() not in sourceChainIDs])
+    return observedTransformNodes
+    
+  def getTransformNodeChain(self, transformNode):
+    chain = []
+    while transformNode:
+      chain.append(transformNode)
+      transformNode = transformNode.GetParentTransformNode()
+    return chain
 
   def removeObservers(self):
-    print "Removing observers..."
+    logging.debug('Removing observers...')
     for nodeTagPair in self.transformNodeObserverTags:
       nodeTagPair[0].RemoveObserver(nodeTagPair[1])
-    print "Done removing observers"
+    self.transformNodeObserverTags = []
+    logging.debug('Done removing observers')
 
   def setMinimumAddDistanceMm(self,newValueMm):
     logging.debug('setMinimumAddDistanceMm')
@@ -234,10 +270,21 @@ class CollectFiducialsSupplementLogic(ScriptedLoadableModuleLogic):
     logging.debug('setForceConstantPointDistanceFalse')
     self.forceConstantPointDistance = False
     
+  def setTransformGraph(self, transformGraph):
+    # share the matrix cache of the application, the logic has its own until then
+    self.transformGraph.clear()
+    self.transformGraph = transformGraph
+    
+  def setDisplayUpdateRateHz(self, rateHz):
+    logging.debug('setDisplayUpdateRateHz')
+    self.displayUpdateRateHz = rateHz
+    
   def startCollection(self):
     logging.debug('startCollection')
     if (self.transformSourceNode and self.transformSourceNode and self.markupsFiducialNode):
       self.markupsFiducialNode.SetAndObserveTransformNodeID(self.transformTargetNode.GetID())
+      self.readPointsFromMarkups()
+      self.resetCollectionCounters()
       self.currentlyCollecting = True
       self.addObservers()
     else:
@@ -247,45 +294,73 @@ class CollectFiducialsSupplementLogic(ScriptedLoadableModuleLogic):
     logging.debug('stopCollection')
     self.currentlyCollecting = False
     self.removeObservers();
+    if (self.markupsFiducialNode):
+      self.flushPointsToMarkups()
 
   def onTransformModified(self, observer, eventid):
     # no logging here - it slows Slicer down a *lot*
+    self.numberOfTransformModifiedEvents = self.numberOfTransformModifiedEvents + 1
+    self.pendingNumberOfTransformModifiedEvents = self.pendingNumberOfTransformModifiedEvents + 1
+    if (self.collectionStepPending == False):
+      self.collectionStepPending = True
+      qt.QTimer.singleShot(0, self.onCollectionStep) # runs once the tracker frame has been processed
+    
+  def onCollectionStep(self):
+    self.collectionStepPending = False
+    self.lastStepNumberOfTransformModifiedEvents = self.pendingNumberOfTransformModifiedEvents
+    self.pendingNumberOfTransformModifiedEvents = 0
+    if (self.currentlyCollecting == False):
+      return
+    self.numberOfCollectionSteps = self.numberOfCollectionSteps + 1
+    self.processSample()
+    
+  def resetCollectionCounters(self):
+    self.numberOfTransformModifiedEvents = 0
+    self.numberOfCollectionSteps = 0
+    self.pendingNumberOfTransformModifiedEvents = 0
+    self.lastStepNumberOfTransformModifiedEvents = 0
+    
+  def getCollectionCounters(self):
+    # numberOfCollectionSteps counts tracker frames, each handled by exactly one collection step
+    return { 'numberOfTransformModifiedEvents' : self.numberOfTransformModifiedEvents,
+             'numberOfCollectionSteps' : self.numberOfCollectionSteps,
+             'lastStepNumberOfTransformModifiedEvents' : self.lastStepNumberOfTransformModifiedEvents }
+    
+  def processSample(self, timestampSec=None):
+    # One collection step for the current tracker pose. Only the point buffer is touched here,
+    # the markups node is updated at most displayUpdateRateHz times per second.
+    if (timestampSec is None):
+      timestampSec = time.time()
+    self.currentTimestampSec = timestampSec
     self.updateCurrentPosition()
     if (self.addPointConditions() == True):
       self.addPoint()
     elif (self.removePointConditions() == True):
       self.removePoint()
     self.moveLastPoint()
+    if (self.displayUpdateRateHz <= 0 or timestampSec - self.lastFlushTimeSec >= 1.0 / self.displayUpdateRateHz):
+      self.flushPointsToMarkups()
+      self.lastFlushTimeSec = timestampSec
     
   def updateCurrentPosition(self):
-    matrixSourceToTarget = vtk.vtkMatrix4x4()
-    self.transformSourceNode.GetMatrixTransformToNode(self.transformTargetNode,matrixSourceToTarget)
-    transformSourceToTarget = vtk.vtkTransform()
-    transformSourceToTarget.SetMatrix(matrixSourceToTarget)
-    transformSourceToTarget.GetPosition(self.currentPositionMm)
+    self.currentPositionMm[:] = self.transformGraph.getMatrix(self.transformSourceNode, self.transformTargetNode)[0:3,3]
     
     # determine self.currentDistanceFromPointNMinus2Mm
-    if (self.markupsFiducialNode.GetNumberOfFiducials() >= 2):
-      pointNMinus2Mm = [0,0,0]
-      self.markupsFiducialNode.GetNthFiducialPosition(self.markupsFiducialNode.GetNumberOfFiducials() - 2, pointNMinus2Mm)
-      positionRelativeToPointNMinus2Mm = [0,0,0]
-      vtk.vtkMath.Subtract(self.currentPositionMm,pointNMinus2Mm,positionRelativeToPointNMinus2Mm)
-      self.currentDistanceFromPointNMinus2Mm = vtk.vtkMath.Norm(positionRelativeToPointNMinus2Mm)
+    if (self.numberOfPoints >= 2):
+      positionRelativeToPointNMinus2Mm = self.currentPositionMm - self.pointsMm[self.numberOfPoints - 2]
+      self.currentDistanceFromPointNMinus2Mm = math.sqrt(positionRelativeToPointNMinus2Mm.dot(positionRelativeToPointNMinus2Mm))
     else:
       self.currentDistanceFromPointNMinus2Mm = 0
     
     # determine self.currentDistanceFromPointNMinus3Mm
-    if (self.markupsFiducialNode.GetNumberOfFiducials() >= 3):
-      pointNMinus3Mm = [0,0,0] # second last point
-      self.markupsFiducialNode.GetNthFiducialPosition(self.markupsFiducialNode.GetNumberOfFiducials() - 3, pointNMinus3Mm)
-      positionRelativeToPointNMinus3Mm = [0,0,0]
-      vtk.vtkMath.Subtract(self.currentPositionMm,pointNMinus3Mm,positionRelativeToPointNMinus3Mm)
-      self.currentDistanceFromPointNMinus3Mm = vtk.vtkMath.Norm(positionRelativeToPointNMinus3Mm)
+    if (self.numberOfPoints >= 3):
+      positionRelativeToPointNMinus3Mm = self.currentPositionMm - self.pointsMm[self.numberOfPoints - 3]
+      self.currentDistanceFromPointNMinus3Mm = math.sqrt(positionRelativeToPointNMinus3Mm.dot(positionRelativeToPointNMinus3Mm))
     else:
       self.currentDistanceFromPointNMinus3Mm = 0
 
   def addPointConditions(self):
-    if (self.markupsFiducialNode.GetNumberOfFiducials() < 2): # currentDistanceFromPointNMinus2Mm couldn't be computed
+    if (self.numberOfPoints < 2): # currentDistanceFromPointNMinus2Mm couldn't be computed
       return True
     if (self.currentDistanceFromPointNMinus2Mm >= self.minimumAddDistanceMm):
       return True
@@ -294,7 +369,7 @@ class CollectFiducialsSupplementLogic(ScriptedLoadableModuleLogic):
   def removePointConditions(self):
     if (self.allowPointRemovals == False):
       return False
-    if (self.markupsFiducialNode.GetNumberOfFiducials() < 3): # currentDistanceFromPointNMinus3Mm couldn't be computed
+    if (self.numberOfPoints < 3): # currentDistanceFromPointNMinus3Mm couldn't be computed
       return False
     if (self.currentDistanceFromPointNMinus3Mm < self.minimumAddDistanceMm):
       return True
@@ -303,41 +378,179 @@ class CollectFiducialsSupplementLogic(ScriptedLoadableModuleLogic):
   def addPoint(self):
     # Two tasks: 1. Move the last point to boundary of the sphere around pointNMinus2
     #            2. Add a new point at the current position
-    # print "Add Point"
     # task 1
-    if (self.forceConstantPointDistance == True and self.markupsFiducialNode.GetNumberOfFiducials() >= 2):
-      pointNMinus1Index = self.markupsFiducialNode.GetNumberOfFiducials() - 1
-      pointNMinus1Mm = [0,0,0]
-      self.markupsFiducialNode.GetNthFiducialPosition(pointNMinus1Index, pointNMinus1Mm)
-      
-      pointNMinus2Index = self.markupsFiducialNode.GetNumberOfFiducials() - 2
-      pointNMinus2Mm = [0,0,0]
-      self.markupsFiducialNode.GetNthFiducialPosition(pointNMinus2Index, pointNMinus2Mm)
-      
-      # calculate the vector that moves pointNMinus1Mm from pointNMinus2Mm to the sphere boundary
-      trajectory = [0,0,0]
-      vtk.vtkMath.Subtract(pointNMinus1Mm,pointNMinus2Mm,trajectory)
-      vtk.vtkMath.Normalize(trajectory)
-      vtk.vtkMath.MultiplyScalar(trajectory,self.minimumAddDistanceMm)
-
-      # apply the vector and find the new pointNMinus1Mm
-      newPointNMinus1Mm = [0,0,0]
-      vtk.vtkMath.Add(pointNMinus2Mm,trajectory,newPointNMinus1Mm)
-      self.markupsFiducialNode.SetMarkupPointFromArray(pointNMinus1Index,0,newPointNMinus1Mm)
-      
+    if (self.forceConstantPointDistance == True and self.numberOfPoints >= 2):
+      pointNMinus1Index = self.numberOfPoints - 1
+      trajectory = self.pointsMm[pointNMinus1Index] - self.pointsMm[pointNMinus1Index - 1]
+      trajectoryLengthMm = math.sqrt(trajectory.dot(trajectory))
+      if (trajectoryLengthMm > 0):
+        self.pointsMm[pointNMinus1Index] = self.pointsMm[pointNMinus1Index - 1] + trajectory * (self.minimumAddDistanceMm / trajectoryLengthMm)
+        self.firstModifiedPointIndex = min(self.firstModifiedPointIndex, pointNMinus1Index)
+        for listener in self.pointListeners:
+          listener.onLastPointMoved(self.pointsMm[pointNMinus1Index])
     # task 2
-    self.markupsFiducialNode.AddFiducialFromArray(self.currentPositionMm)
+    self.appendPoint(self.currentPositionMm)
+  
+  def appendPoint(self, pointMm):
+    if (self.numberOfPoints == self.pointsMm.shape[0]): # grow geometrically so appends stay O(1) amortized
+      self.pointsMm = numpy.concatenate([self.pointsMm, numpy.zeros(self.pointsMm.shape)])
+      self.timestampsSec = numpy.concatenate([self.timestampsSec, numpy.zeros(self.timestampsSec.shape)])
+    self.pointsMm[self.numberOfPoints] = pointMm
+    self.timestampsSec[self.numberOfPoints] = self.currentTimestampSec
+    self.firstModifiedPointIndex = min(self.firstModifiedPointIndex, self.numberOfPoints)
+    self.numberOfPoints = self.numberOfPoints + 1
+    for listener in self.pointListeners:
+      listener.onPointAdded(pointMm)
   
   def removePoint(self):
-    self.markupsFiducialNode.RemoveMarkup(self.markupsFiducialNode.GetNumberOfFiducials() - 1)
+    self.numberOfPoints = self.numberOfPoints - 1
+    self.firstModifiedPointIndex = min(self.firstModifiedPointIndex, self.numberOfPoints)
+    for listener in self.pointListeners:
+      listener.onLastPointRemoved()
     
   def moveLastPoint(self):
-    if (self.markupsFiducialNode.GetNumberOfFiducials() >= 1):
-      pointNMinus1Index = self.markupsFiducialNode.GetNumberOfFiducials() - 1
-      self.markupsFiducialNode.SetMarkupPointFromArray(pointNMinus1Index,0,self.currentPositionMm)
+    if (self.numberOfPoints >= 1):
+      pointNMinus1Index = self.numberOfPoints - 1
+      self.pointsMm[pointNMinus1Index] = self.currentPositionMm
+      self.timestampsSec[pointNMinus1Index] = self.currentTimestampSec
+      self.firstModifiedPointIndex = min(self.firstModifiedPointIndex, pointNMinus1Index)
+      for listener in self.pointListeners:
+        listener.onLastPointMoved(self.currentPositionMm)
+      
+  def addPointListener(self, listener):
+    # The listener needs onPointAdded(pointMm), onLastPointRemoved(), onLastPointMoved(pointMm) and onPointsReset(pointsMm).
+    # They are called on every sample, so they have to be cheap.
+    if (listener not in self.pointListeners):
+      self.pointListeners.append(listener)
+      listener.onPointsReset(self.getPointsMm())
+      
+  def removePointListener(self, listener):
+    if (listener in self.pointListeners):
+      self.pointListeners.remove(listener)
+      
+  def getPointsMm(self):
+    # view of the collected points, valid until the next sample
+    return self.pointsMm[:self.numberOfPoints]
+      
+  def getTimestampsSec(self):
+    # view of the time each collected point was last moved, valid until the next sample
+    return self.timestampsSec[:self.numberOfPoints]
+      
+  def readPointsFromMarkups(self):
+    numberOfFiducials = self.markupsFiducialNode.GetNumberOfFiducials()
+    self.pointsMm = numpy.zeros([max(self.initialPointCapacity, 2 * numberOfFiducials),3])
+    self.timestampsSec = numpy.zeros(self.pointsMm.shape[0])
+    pointMm = [0,0,0]
+    for pointIndex in xrange(numberOfFiducials):
+      self.markupsFiducialNode.GetNthFiducialPosition(pointIndex, pointMm)
+      self.pointsMm[pointIndex] = pointMm
+    self.numberOfPoints = numberOfFiducials
+    self.firstModifiedPointIndex = numberOfFiducials
+    for listener in self.pointListeners:
+      listener.onPointsReset(self.getPointsMm())
+    
+  def flushPointsToMarkups(self):
+    # Bring the markups node in line with the point buffer, touching only the points that changed.
+    # All the edits are made in a single modify block so observers see one ModifiedEvent.
+    numberOfFiducials = self.markupsFiducialNode.GetNumberOfFiducials()
+    if (self.firstModifiedPointIndex >= self.numberOfPoints and numberOfFiducials == self.numberOfPoints):
+      return
+    wasModifying = self.markupsFiducialNode.StartModify()
+    while (numberOfFiducials > self.numberOfPoints):
+      numberOfFiducials = numberOfFiducials - 1
+      self.markupsFiducialNode.RemoveMarkup(numberOfFiducials)
+    for pointIndex in xrange(self.firstModifiedPointIndex, numberOfFiducials):
+      self.markupsFiducialNode.SetMarkupPointFromArray(pointIndex,0,self.pointsMm[pointIndex].tolist())
+    for pointIndex in xrange(numberOfFiducials, self.numberOfPoints):
+      self.markupsFiducialNode.AddFiducialFromArray(self.pointsMm[pointIndex].tolist())
+    self.markupsFiducialNode.EndModify(wasModifying)
+    self.firstModifiedPointIndex = self.numberOfPoints
   
   def removeAllPoints(self):
+    self.numberOfPoints = 0
+    self.firstModifiedPointIndex = 0
+    for listener in self.pointListeners:
+      listener.onPointsReset(self.getPointsMm())
     if (self.markupsFiducialNode):
-      while (self.markupsFiducialNode.GetNumberOfFiducials() > 0):
-        indexOfLastPoint = self.markupsFiducialNode.GetNumberOfFiducials() - 1;
-        self.markupsFiducialNode.RemoveMarkup(indexOfLastPoint)
+      self.markupsFiducialNode.RemoveAllMarkups()
+        
+  def processSamplePerMarkup(self):
+    # Collection step working directly on the markups node, one round-trip per point access.
+    # This is how samples used to be processed, it is only kept for benchmarkPointCollection.
+    matrixSourceToTarget = vtk.vtkMatrix4x4()
+    self.transformSourceNode.GetMatrixTransformToNode(self.transformTargetNode,matrixSourceToTarget)
+    transformSourceToTarget = vtk.vtkTransform()
+    transformSourceToTarget.SetMatrix(matrixSourceToTarget)
+    currentPositionMm = [0,0,0]
+    transformSourceToTarget.GetPosition(currentPositionMm)
+    distanceFromPointMm = [0,0,0,0] # indexed by how far back the point is
+    for pointsBack in [2,3]:
+      if (self.markupsFiducialNode.GetNumberOfFiducials() >= pointsBack):
+        pointMm = [0,0,0]
+        self.markupsFiducialNode.GetNthFiducialPosition(self.markupsFiducialNode.GetNumberOfFiducials() - pointsBack, pointMm)
+        positionRelativeToPointMm = [0,0,0]
+        vtk.vtkMath.Subtract(currentPositionMm,pointMm,positionRelativeToPointMm)
+        distanceFromPointMm[pointsBack] = vtk.vtkMath.Norm(positionRelativeToPointMm)
+    numberOfFiducials = self.markupsFiducialNode.GetNumberOfFiducials()
+    if (numberOfFiducials < 2 or distanceFromPointMm[2] >= self.minimumAddDistanceMm):
+      self.markupsFiducialNode.AddFiducialFromArray(currentPositionMm)
+    elif (self.allowPointRemovals and numberOfFiducials >= 3 and distanceFromPointMm[3] < self.minimumAddDistanceMm):
+      self.markupsFiducialNode.RemoveMarkup(numberOfFiducials - 1)
+    if (self.markupsFiducialNode.GetNumberOfFiducials() >= 1):
+      self.markupsFiducialNode.SetMarkupPointFromArray(self.markupsFiducialNode.GetNumberOfFiducials() - 1,0,currentPositionMm)
+    
+  def benchmarkPointCollection(self, sampleRatesHz=[50,200], durationSec=10, tipSpeedMmPerSec=20, minimumAddDistanceMm=1):
+    """
+    Time the per-sample cost of point collection for a synthetic tracker that drags the tool tip along a helix.
+    Each rate is run through processSamplePerMarkup and through processSample on a scratch scene.
+    Returns one dictionary per sample rate.
+    """
+    logging.debug('benchmarkPointCollection')
+    savedState = (self.transformSourceNode, self.transformTargetNode, self.markupsFiducialNode, self.minimumAddDistanceMm, self.allowPointRemovals, self.forceConstantPointDistance, self.pointListeners)
+    self.pointListeners = [] # the synthetic points are not for them
+    results = []
+    for sampleRateHz in sampleRatesHz:
+      numberOfSamples = int(sampleRateHz * durationSec)
+      timestampsSec = numpy.arange(numberOfSamples) / float(sampleRateHz)
+      helixRadiusMm = 10.0
+      angularSpeedRadPerSec = tipSpeedMmPerSec / helixRadiusMm
+      result = { 'sampleRateHz' : sampleRateHz, 'numberOfSamples' : numberOfSamples }
+      for method in ['perMarkup', 'buffered']:
+        scene = slicer.vtkMRMLScene()
+        self.transformTargetNode = scene.AddNode(slicer.vtkMRMLLinearTransformNode())
+        self.transformSourceNode = scene.AddNode(slicer.vtkMRMLLinearTransformNode())
+        self.transformSourceNode.SetAndObserveTransformNodeID(self.transformTargetNode.GetID())
+        self.markupsFiducialNode = scene.AddNode(slicer.vtkMRMLMarkupsFiducialNode())
+        self.minimumAddDistanceMm = minimumAddDistanceMm
+        self.allowPointRemovals = True
+        self.forceConstantPointDistance = False
+        self.readPointsFromMarkups()
+        self.lastFlushTimeSec = 0
+        matrixSourceToTarget = vtk.vtkMatrix4x4()
+        elapsedSec = 0
+        for timestampSec in timestampsSec:
+          matrixSourceToTarget.SetElement(0,3,helixRadiusMm * math.cos(angularSpeedRadPerSec * timestampSec))
+          matrixSourceToTarget.SetElement(1,3,helixRadiusMm * math.sin(angularSpeedRadPerSec * timestampSec))
+          matrixSourceToTarget.SetElement(2,3,timestampSec)
+          self.transformSourceNode.SetMatrixTransformToParent(matrixSourceToTarget)
+          startTimeSec = time.time()
+          if (method == 'perMarkup'):
+            self.processSamplePerMarkup()
+          else:
+            self.processSample(timestampSec)
+          elapsedSec = elapsedSec + time.time() - startTimeSec
+        if (method == 'buffered'):
+          self.flushPointsToMarkups()
+        result[method + 'PerSampleSec'] = elapsedSec / max(numberOfSamples, 1)
+        result[method + 'NumberOfPoints'] = self.markupsFiducialNode.GetNumberOfFiducials()
+        self.transformGraph.clear() # drop the scratch nodes, the graph mirrors them again when next queried
+        scene.Clear(1)
+      result['speedup'] = (result['perMarkupPerSampleSec'] / result['bufferedPerSampleSec']) if (result['bufferedPerSampleSec'] > 0) else None
+      logging.info("Point collection benchmark: {sampleRateHz} Hz, per markup {perMarkupPerSampleSec} s/sample, buffered {bufferedPerSampleSec} s/sample".format(**result))
+      results.append(result)
+    (self.transformSourceNode, self.transformTargetNode, self.markupsFiducialNode, self.minimumAddDistanceMm, self.allowPointRemovals, self.forceConstantPointDistance, self.pointListeners) = savedState
+    self.numberOfPoints = 0
+    self.firstModifiedPointIndex = 0
+    for listener in self.pointListeners:
+      listener.onPointsReset(self.getPointsMm())
+    return results
@@ -1,5 +1,9 @@
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
+from vtk.util import numpy_support
+import logging
+import numpy
+import time
 
 #
 # InsertionGridPlanner
@@ -9,7 +13,7 @@ class InsertionGridPlanner(ScriptedLoadableModule):
   def __init__(self, parent):
     parent.title = "InsertionGridPlanner"
     parent.categories = ["IGT"]
-    parent.dependencies = []
+    parent.dependencies = ["TipToSurfaceDistance"]
     parent.contributors = ["Thomas Vaughan (Queen's)", "Gabor Fichtinger (Queen's)"]
     parent.helpText = """
     Plan a grid of needle insertions.
@@ -175,60 +179,115 @@ class InsertionGridPlannerLogic(ScriptedLoadableModuleLogic):
     self.gridSpacingHorizontalMm = 10
     self.gridSpacingVerticalMm = 10
     
+    # hole geometry
+    self.holeLengthMm = 80
+    self.holeRadiusMm = 1
+    
     # outputs
     self.outputModelNode = None
     self.outputDisplayNode = None
+    
+    # per-point hole labels, see setHoleLabels
+    self.holeLabelArrayName = "HoleLabel"
+    
+    # cached geometry of a single hole, see getHoleTemplate
+    self.holeTemplatePolyData = None
+    
+    # incremental updates keep the output model node and rewrite its polydata in place
+    self.incrementalUpdates = False
+    self.holeLatticeIndices = None # lattice index of every hole, in the order of the hole blocks in the polydata
+    self.holePointsMm = None # points of the output polydata, one block of template points per hole
+    self.holeGeometryKey = None # pattern and spacing the hole blocks were generated for
       
   def setTransformGridToTargetNode(self,node):
-    print "setTransformGridToTargetNode"
+    logging.debug("setTransformGridToTargetNode")
     self.transformGridToTargetNode = node
     
   def setGridPatternToRectangular(self):
-    print "setPatternToRectangular"
+    logging.debug("setPatternToRectangular")
     self.gridPattern = self.gridPatternRectangular
   
   def setGridPatternToTriangular(self):
-    print "setPatternToTriangular"
+    logging.debug("setPatternToTriangular")
     self.gridPattern = self.gridPatternTriangular
     
   def setGridSizeLeftMm(self,sizeMm):
-    print "setGridSizeLeftMm"
+    logging.debug("setGridSizeLeftMm")
     self.gridSizeLeftMm = sizeMm
       
   def setGridSizeRightMm(self,sizeMm):
-    print "setGridSizeRightMm"
+    logging.debug("setGridSizeRightMm")
     self.gridSizeRightMm = sizeMm
       
   def setGridSizeUpMm(self,sizeMm):
-    print "setGridSizeUpMm"
+    logging.debug("setGridSizeUpMm")
     self.gridSizeUpMm = sizeMm
       
   def setGridSizeDownMm(self,sizeMm):
-    print "setGridSizeDownMm"
+    logging.debug("setGridSizeDownMm")
     self.gridSizeDownMm = sizeMm
     
   def setGridSpacingHorizontalMm(self,spacingMm):
-    print "setGridSpacingHorizontalMm"
+    logging.debug("setGridSpacingHorizontalMm")
     self.gridSpacingHorizontalMm = spacingMm
     
   def setGridSpacingVerticalMm(self,spacingMm):
-    print "setGridSpacingVerticalMm"
+    logging.debug("setGridSpacingVerticalMm")
     self.gridSpacingVerticalMm = spacingMm
     
+  def setIncrementalUpdatesEnabled(self,enabled):
+    logging.debug("setIncrementalUpdatesEnabled")
+    self.incrementalUpdates = enabled
+    
   def createGrid(self):
-    print "createGrid"
+    logging.debug("createGrid")
+    if (self.incrementalUpdates and self.outputModelNode and self.outputModelNode.GetScene()):
+      self.updateGrid()
+      return
     self.deleteGrid()
     self.generateGridModel()
     
   def generateGridModel(self):
-    print "generateGridModel"
+    logging.debug("generateGridModel")
+    self.holeLatticeIndices = self.computeHoleLatticeIndices()
+    self.holeGeometryKey = self.getHoleGeometryKey()
+    self.holePointsMm = self.instanceHoleTemplatePointsMm(self.computeHoleCentersMm(self.holeLatticeIndices))
     polyData = vtk.vtkPolyData()
-    if (self.gridPattern == self.gridPatternRectangular):
-      polyData = self.generateGridPolyDataRectangular()
-    elif (self.gridPattern == self.gridPatternTriangular):
-      polyData = self.generateGridPolyDataTriangular()
+    self.setHolesInPolyData(polyData, self.holePointsMm)
     self.addPolyDataToScene(polyData,"Grid")
     
+  def getHoleGeometryKey(self):
+    return (self.gridPattern, self.gridSpacingHorizontalMm, self.gridSpacingVerticalMm)
+    
+  def updateGrid(self):
+    # Rewrite the polydata of the existing grid model node. If only the extents changed,
+    # the blocks of holes that remain are reused and only added holes are generated.
+    logging.debug("updateGrid")
+    latticeIndices = self.computeHoleLatticeIndices()
+    geometryKey = self.getHoleGeometryKey()
+    if (geometryKey != self.holeGeometryKey or self.holeLatticeIndices is None):
+      self.holeLatticeIndices = latticeIndices
+      self.holePointsMm = self.instanceHoleTemplatePointsMm(self.computeHoleCentersMm(latticeIndices))
+      self.holeGeometryKey = geometryKey
+    else:
+      currentKeys = self.encodeHoleLatticeIndices(self.holeLatticeIndices)
+      requestedKeys = self.encodeHoleLatticeIndices(latticeIndices)
+      keptHoles = numpy.in1d(currentKeys, requestedKeys)
+      addedHoles = ~numpy.in1d(requestedKeys, currentKeys)
+      if (keptHoles.all() and not addedHoles.any()):
+        return
+      addedLatticeIndices = latticeIndices[addedHoles]
+      addedPointsMm = self.instanceHoleTemplatePointsMm(self.computeHoleCentersMm(addedLatticeIndices))
+      self.holeLatticeIndices = numpy.concatenate((self.holeLatticeIndices[keptHoles], addedLatticeIndices))
+      self.holePointsMm = numpy.concatenate((self.holePointsMm[keptHoles], addedPointsMm))
+    if (self.transformGridToTargetNode and self.outputModelNode.GetTransformNodeID() != self.transformGridToTargetNode.GetID()):
+      self.outputModelNode.SetAndObserveTransformNodeID(self.transformGridToTargetNode.GetID())
+    self.setHolesInPolyData(self.outputModelNode.GetPolyData(), self.holePointsMm)
+    
+  def encodeHoleLatticeIndices(self, latticeIndices):
+    # one integer per (column,row) pair, so membership can be tested with numpy.in1d
+    return latticeIndices[:,0].astype(numpy.int64) * 1000003 + latticeIndices[:,1]
+    
   def evaluateLowerHorizontalBoundMm(self):
     return -(self.gridSizeLeftMm // self.gridSpacingHorizontalMm) * self.gridSpacingHorizontalMm
     
@@ -241,61 +300,151 @@ class InsertionGridPlannerLogic(ScriptedLoadableModuleLogic):
   def evaluateUpperVerticalBoundMm(self):
     return (self.gridSizeUpMm // self.gridSpacingVerticalMm) * self.gridSpacingVerticalMm
     
-  def generateGridPolyDataRectangular(self):
-    polyDataCombiner = vtk.vtkAppendPolyData()
+  def computeHoleLatticeIndices(self, gridPattern=None):
+    # Integer (column,row) index of every hole, rows outer and columns inner.
+    # Hole (column,row) sits at (column * horizontal spacing, row * vertical spacing),
+    # odd rows of the triangular pattern are shifted right by half a spacing.
+    lowerColumn = -int(self.gridSizeLeftMm // self.gridSpacingHorizontalMm)
+    upperColumn = int(self.gridSizeRightMm // self.gridSpacingHorizontalMm)
+    lowerRow = -int(self.gridSizeDownMm // self.gridSpacingVerticalMm)
+    upperRow = int(self.gridSizeUpMm // self.gridSpacingVerticalMm)
+    if gridPattern is None:
+      gridPattern = self.gridPattern
+    columns, rows = numpy.meshgrid(numpy.arange(lowerColumn, upperColumn + 1), numpy.arange(lowerRow, upperRow + 1))
+    latticeIndices = numpy.column_stack((columns.ravel(), rows.ravel()))
+    if (gridPattern == self.gridPatternTriangular):
+      # the shifted odd rows lose their last hole, it would fall outside the upper bound
+      oddRow = (latticeIndices[:,1] % 2 == 1)
+      latticeIndices = latticeIndices[~(oddRow & (latticeIndices[:,0] == upperColumn))]
+    return latticeIndices
+    
+  def computeHoleCentersMm(self, latticeIndices=None, gridPattern=None):
+    if gridPattern is None:
+      gridPattern = self.gridPattern
+    if latticeIndices is None:
+      latticeIndices = self.computeHoleLatticeIndices(gridPattern)
+    holeCentersMm = numpy.empty((latticeIndices.shape[0],2))
+    holeCentersMm[:,0] = latticeIndices[:,0] * self.gridSpacingHorizontalMm
+    holeCentersMm[:,1] = latticeIndices[:,1] * self.gridSpacingVerticalMm
+    if (gridPattern == self.gridPatternTriangular):
+      oddRow = (latticeIndices[:,1] % 2 == 1)
+      holeCentersMm[oddRow,0] += self.gridSpacingHorizontalMm / 2.0
+    return holeCentersMm
     
-    lowerHorizontalBoundMm = self.evaluateLowerHorizontalBoundMm()
-    upperHorizontalBoundMm = self.evaluateUpperHorizontalBoundMm()
+  def generateGridPolyDataRectangular(self):
+    return self.generateGridPolyDataFromHoleCenters(self.computeHoleCentersMm(gridPattern=self.gridPatternRectangular))
     
-    lowerVerticalBoundMm = self.evaluateLowerVerticalBoundMm()
-    upperVerticalBoundMm = self.evaluateUpperVerticalBoundMm()
-
-    # traditional 'for' loops would be very nice here... :-/
-    yMm = lowerVerticalBoundMm
-    while (yMm <= upperVerticalBoundMm):
-      xMm = lowerHorizontalBoundMm    
-      while (xMm <= upperHorizontalBoundMm):
-        cylinderPolyData = self.generateCylinderPolyData(xMm,yMm)
-        polyDataCombiner.AddInputData(cylinderPolyData)
-        xMm = xMm + self.gridSpacingHorizontalMm
-      yMm = yMm + self.gridSpacingVerticalMm
+  def generateGridPolyDataTriangular(self):
+    return self.generateGridPolyDataFromHoleCenters(self.computeHoleCentersMm(gridPattern=self.gridPatternTriangular))
+    
+  def getHoleTemplate(self):
+    # One cylinder at the grid origin, its points and cells are copied for every hole
+    if self.holeTemplatePolyData is None:
+      self.holeTemplatePolyData = self.generateCylinderPolyData(0,0)
+      self.holeTemplatePointsMm = numpy_support.vtk_to_numpy(self.holeTemplatePolyData.GetPoints().GetData()).astype(numpy.float32)
+      self.holeTemplateNormals = numpy_support.vtk_to_numpy(self.holeTemplatePolyData.GetPointData().GetNormals())
+      # legacy cell array layout: [n, id_0 ... id_n-1, n, id_0 ...], only the ids get offset per hole
+      self.holeTemplateCells = numpy_support.vtk_to_numpy(self.holeTemplatePolyData.GetPolys().GetData()).astype(numpy_support.ID_TYPE_CODE)
+      self.holeTemplateCellIdMask = numpy.ones(self.holeTemplateCells.shape[0], dtype=numpy_support.ID_TYPE_CODE)
+      cellStart = 0
+      while (cellStart < self.holeTemplateCells.shape[0]):
+        self.holeTemplateCellIdMask[cellStart] = 0
+        cellStart = cellStart + self.holeTemplateCells[cellStart] + 1
+    return self.holeTemplatePolyData
+    
+  def instanceHoleTemplatePointsMm(self, holeCentersMm):
+    # Template points translated to every hole center, shape (holes, template points, 3)
+    self.getHoleTemplate()
+    offsetsMm = numpy.zeros((holeCentersMm.shape[0],1,3), dtype=numpy.float32)
+    offsetsMm[:,0,0:2] = holeCentersMm
+    return self.holeTemplatePointsMm[numpy.newaxis,:,:] + offsetsMm
+    
+  def setHolesInPolyData(self, polyData, holePointsMm):
+    # Write the points of all hole blocks into polyData. Normals and cells only
+    # depend on the number of holes, so they are only rewritten when it changes.
+    numberOfHoles = holePointsMm.shape[0]
+    numberOfTemplatePoints = self.holeTemplatePointsMm.shape[0]
+    numberOfTemplateCells = self.holeTemplatePolyData.GetNumberOfPolys()
+    
+    if not polyData.GetPoints():
+      polyData.SetPoints(vtk.vtkPoints())
+    polyData.GetPoints().SetData(numpy_support.numpy_to_vtk(holePointsMm.reshape(-1,3), deep=1))
+    
+    if (polyData.GetNumberOfPolys() != numberOfHoles * numberOfTemplateCells):
+      polyData.GetPointData().RemoveArray(self.holeLabelArrayName)
+      normals = numpy_support.numpy_to_vtk(numpy.tile(self.holeTemplateNormals, (numberOfHoles,1)), deep=1)
+      normals.SetName("Normals")
+      polyData.GetPointData().SetNormals(normals)
       
-    polyDataCombiner.Update()
-    gridPolyData = polyDataCombiner.GetOutput()
+      pointIdOffsets = numpy.arange(numberOfHoles, dtype=numpy_support.ID_TYPE_CODE) * numberOfTemplatePoints
+      cells = (self.holeTemplateCells[numpy.newaxis,:] + pointIdOffsets[:,numpy.newaxis] * self.holeTemplateCellIdMask[numpy.newaxis,:]).ravel()
+      polys = vtk.vtkCellArray()
+      polys.SetCells(numberOfHoles * numberOfTemplateCells, numpy_support.numpy_to_vtkIdTypeArray(cells, deep=1))
+      polyData.SetPolys(polys)
+    polyData.Modified()
+    
+  def generateGridPolyDataFromHoleCenters(self, holeCentersMm):
+    # Instance the hole template at every center by writing the points and cells arrays directly
+    gridPolyData = vtk.vtkPolyData()
+    self.setHolesInPolyData(gridPolyData, self.instanceHoleTemplatePointsMm(holeCentersMm))
     return gridPolyData
     
-  def generateGridPolyDataTriangular(self):
+  def generateGridPolyDataPerHole(self, holeCentersMm):
+    # Reference implementation with one cylinder pipeline per hole, kept for benchmarking
     polyDataCombiner = vtk.vtkAppendPolyData()
-    
-    lowerHorizontalBoundMm = self.evaluateLowerHorizontalBoundMm()
-    upperHorizontalBoundMm = self.evaluateUpperHorizontalBoundMm()
-    
-    lowerVerticalBoundMm = self.evaluateLowerVerticalBoundMm()
-    upperVerticalBoundMm = self.evaluateUpperVerticalBoundMm()
-
-    # traditional 'for' loops would be very nice here... :-/
-    yMm = lowerVerticalBoundMm
-    while (yMm <= upperVerticalBoundMm):
-      # determine whether to offset in horizontal axis -
-      # this makes the triangular pattern if done on odd rows only
-      offsetMm = 0
-      oddRow = (round(yMm / self.gridSpacingVerticalMm) % 2 == 1)
-      if oddRow:
-        offsetMm = self.gridSpacingHorizontalMm / 2.0
-      xMm = lowerHorizontalBoundMm + offsetMm
-      while (xMm <= upperHorizontalBoundMm):
-        cylinderPolyData = self.generateCylinderPolyData(xMm,yMm)
-        polyDataCombiner.AddInputData(cylinderPolyData)
-        xMm = xMm + self.gridSpacingHorizontalMm
-      yMm = yMm + self.gridSpacingVerticalMm
-      
+    for holeIndex in xrange(holeCentersMm.shape[0]):
+      cylinderPolyData = self.generateCylinderPolyData(holeCentersMm[holeIndex,0],holeCentersMm[holeIndex,1])
+      polyDataCombiner.AddInputData(cylinderPolyData)
     polyDataCombiner.Update()
     gridPolyData = polyDataCombiner.GetOutput()
     return gridPolyData
     
+  def benchmarkGridGeneration(self, gridSizesMm=[5,10,20,40,80,150], gridSpacingMm=1, maximumPerHoleNumberOfHoles=10000):
+    """
+    Time the per-hole and the vectorized grid builders for square grids of the given extents (in every direction).
+    The per-hole builder is skipped (None) for grids with more than maximumPerHoleNumberOfHoles holes.
+    Returns one dictionary per pattern and grid size.
+    """
+    logging.debug('benchmarkGridGeneration')
+    savedParameters = (self.gridPattern, self.gridSizeLeftMm, self.gridSizeRightMm, self.gridSizeUpMm, self.gridSizeDownMm, self.gridSpacingHorizontalMm, self.gridSpacingVerticalMm)
+    results = []
+    for gridPattern in [self.gridPatternRectangular, self.gridPatternTriangular]:
+      for gridSizeMm in gridSizesMm:
+        self.gridPattern = gridPattern
+        self.gridSizeLeftMm = self.gridSizeRightMm = self.gridSizeUpMm = self.gridSizeDownMm = gridSizeMm
+        self.gridSpacingHorizontalMm = self.gridSpacingVerticalMm = gridSpacingMm
+        holeCentersMm = self.computeHoleCentersMm()
+        numberOfHoles = holeCentersMm.shape[0]
+        
+        startTimeSec = time.time()
+        self.generateGridPolyDataFromHoleCenters(self.computeHoleCentersMm())
+        vectorizedSec = time.time() - startTimeSec
+        
+        perHoleSec = None
+        if (numberOfHoles <= maximumPerHoleNumberOfHoles):
+          startTimeSec = time.time()
+          self.generateGridPolyDataPerHole(holeCentersMm)
+          perHoleSec = time.time() - startTimeSec
+          
+        result = { 'pattern' : 'rectangular' if (gridPattern == self.gridPatternRectangular) else 'triangular',
+                   'gridSizeMm' : gridSizeMm,
+                   'gridSpacingMm' : gridSpacingMm,
+                   'numberOfHoles' : numberOfHoles,
+                   'perHoleSec' : perHoleSec,
+                   'vectorizedSec' : vectorizedSec,
+                   'speedup' : (perHoleSec / vectorizedSec) if (perHoleSec and vectorizedSec > 0) else None }
+        logging.info("Grid benchmark: {pattern} {numberOfHoles} holes, per-hole {perHoleSec} s, vectorized {vectorizedSec} s".format(**result))
+        results.append(result)
+    (self.gridPattern, self.gridSizeLeftMm, self.gridSizeRightMm, self.gridSizeUpMm, self.gridSizeDownMm, self.gridSpacingHorizontalMm, self.gridSpacingVerticalMm) = savedParameters
+    return results
+    
+  def getHoleMaximumDepthMm(self):
+    # depth below the grid plane of the far end of the hole cylinders, see generateCylinderPolyData
+    return self.holeLengthMm * 1.5
+    
   def generateCylinderPolyData(self,x,y):
-    cylinderHeightMm = 80
-    cylinderRadiusMm = 1
+    cylinderHeightMm = self.holeLengthMm
+    cylinderRadiusMm = self.holeRadiusMm
     cylinderSource = vtk.vtkCylinderSource()
     cylinderSource.SetHeight(cylinderHeightMm)
     cylinderSource.SetRadius(cylinderRadiusMm)
@@ -310,8 +459,30 @@ class InsertionGridPlannerLogic(ScriptedLoadableModuleLogic):
     polyData = transformFilter.GetOutput()
     return polyData
     
+  def setHoleLabels(self, holeLabels, colorNode):
+    # Color every hole of the output model by its label (index into colorNode), None shows the plain grid color
+    if not self.outputModelNode or not self.outputDisplayNode:
+      return
+    polyData = self.outputModelNode.GetPolyData()
+    if holeLabels is None:
+      polyData.GetPointData().RemoveArray(self.holeLabelArrayName)
+      self.outputDisplayNode.SetScalarVisibility(False)
+      return
+    pointLabels = numpy_support.numpy_to_vtk(numpy.repeat(holeLabels.astype(numpy.float32), self.holeTemplatePointsMm.shape[0]), deep=1)
+    pointLabels.SetName(self.holeLabelArrayName)
+    polyData.GetPointData().AddArray(pointLabels)
+    polyData.Modified()
+    self.outputDisplayNode.SetActiveScalarName(self.holeLabelArrayName)
+    self.outputDisplayNode.SetAndObserveColorNodeID(colorNode.GetID())
+    if hasattr(self.outputDisplayNode, 'SetScalarRangeFlag'):
+      self.outputDisplayNode.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseManualScalarRange)
+    else:
+      self.outputDisplayNode.SetAutoScalarRange(False)
+    self.outputDisplayNode.SetScalarRange(0, colorNode.GetNumberOfColors() - 1)
+    self.outputDisplayNode.SetScalarVisibility(True)
+    
   def addPolyDataToScene(self,polyData,name):
-    print "addPolyDataToScene"
+    logging.debug("addPolyDataToScene")
     self.outputDisplayNode = slicer.vtkMRMLModelDisplayNode()
     self.outputDisplayNode.SetName(name+"Display")
     self.outputDisplayNode.SetColor(0,0,1.0)
@@ -326,10 +497,299 @@ class InsertionGridPlannerLogic(ScriptedLoadableModuleLogic):
     slicer.mrmlScene.AddNode(self.outputModelNode)
       
   def deleteGrid(self):
-    print "deleteGrid"
+    logging.debug("deleteGrid")
+    self.holeLatticeIndices = None
+    self.holePointsMm = None
+    self.holeGeometryKey = None
     if self.outputModelNode:
       slicer.mrmlScene.RemoveNode(self.outputModelNode)
       self.outputModelNode = None
     if self.outputDisplayNode:
       slicer.mrmlScene.RemoveNode(self.outputDisplayNode)
       self.outputDisplayNode = None
+
+#
+# InsertionGridAnatomyLogic
+#
+
+class InsertionGridAnatomyLogic(ScriptedLoadableModuleLogic):
+  """
+  Intersects the axis of every hole of an InsertionGridPlannerLogic grid with a target
+  (seroma) and an obstacle (chest wall) surface model. Each surface is indexed with a
+  SurfaceRayCaster that is only rebuilt when the model's polydata changes, so re-running the
+  analysis after the grid moves only costs one batch of ray casts per surface.
+  """
+  def __init__(self):
+    # constants - DO NOT CHANGE THESE
+    self.holeLabelUsable = 0
+    self.holeLabelUnsafe = 1
+    self.holeLabelMissesTarget = 2
+    
+    # inputs
+    self.targetModelNode = None
+    self.obstacleModelNode = None
+    
+    # cached surface ray casters, by model node ID: [polydata modified time, SurfaceRayCaster]
+    self.surfaceRayCasters = {}
+    self.holeLabelColorNode = None
+    
+  def setTargetModelNode(self,node):
+    self.targetModelNode = node
+    
+  def setObstacleModelNode(self,node):
+    self.obstacleModelNode = node
+    
+  def getSurfaceRayCaster(self, modelNode):
+    if not modelNode or not modelNode.GetPolyData() or modelNode.GetPolyData().GetNumberOfCells() == 0:
+      return None
+    polyData = modelNode.GetPolyData()
+    cachedRayCaster = self.surfaceRayCasters.get(modelNode.GetID())
+    if cachedRayCaster and cachedRayCaster[0] == polyData.GetMTime():
+      return cachedRayCaster[1]
+    logging.debug('Building surface ray caster for {0}'.format(modelNode.GetName()))
+    import TipToSurfaceDistance
+    rayCaster = TipToSurfaceDistance.SurfaceRayCaster(polyData)
+    self.surfaceRayCasters[modelNode.GetID()] = [polyData.GetMTime(), rayCaster]
+    return rayCaster
+    
+  def getMatrixGridToModel(self, gridTransformNode, modelNode):
+    matrixGridToModel = vtk.vtkMatrix4x4()
+    modelTransformNode = modelNode.GetParentTransformNode()
+    if gridTransformNode and modelTransformNode:
+      gridTransformNode.GetMatrixTransformToNode(modelTransformNode, matrixGridToModel)
+    elif gridTransformNode:
+      gridTransformNode.GetMatrixTransformToWorld(matrixGridToModel)
+    elif modelTransformNode:
+      modelTransformNode.GetMatrixTransformToWorld(matrixGridToModel)
+      matrixGridToModel.Invert()
+    return numpy.array([[matrixGridToModel.GetElement(row,column) for column in xrange(4)] for row in xrange(4)])
+    
+  def computeHoleIntersections(self, gridLogic):
+    """
+    Returns a dictionary of per-hole arrays, in the order of the holes in gridLogic's output model:
+    target entry and exit depths, first obstacle depth (NaN if there is no crossing) and hole labels.
+    Depths are measured in mm along the hole axis from the grid plane.
+    """
+    if gridLogic.holeLatticeIndices is None:
+      return None
+    holeCentersMm = gridLogic.computeHoleCentersMm(gridLogic.holeLatticeIndices)
+    numberOfHoles = holeCentersMm.shape[0]
+    holeStartsMm_Grid = numpy.zeros((numberOfHoles,4))
+    holeStartsMm_Grid[:,0:2] = holeCentersMm
+    holeStartsMm_Grid[:,3] = 1
+    holeEndsMm_Grid = holeStartsMm_Grid.copy()
+    holeEndsMm_Grid[:,2] = -gridLogic.getHoleMaximumDepthMm()
+    
+    results = { 'targetEntryDepthMm' : numpy.full(numberOfHoles, numpy.nan),
+                'targetExitDepthMm' : numpy.full(numberOfHoles, numpy.nan),
+                'obstacleDepthMm' : numpy.full(numberOfHoles, numpy.nan) }
+    for modelNode, isTarget in [(self.targetModelNode, True), (self.obstacleModelNode, False)]:
+      rayCaster = self.getSurfaceRayCaster(modelNode)
+      if not rayCaster:
+        continue
+      matrixGridToModel = self.getMatrixGridToModel(gridLogic.transformGridToTargetNode, modelNode)
+      holeStartsMm = holeStartsMm_Grid.dot(matrixGridToModel.T)[:,0:3]
+      holeEndsMm = holeEndsMm_Grid.dot(matrixGridToModel.T)[:,0:3]
+      (firstDepthsMm, lastDepthsMm) = rayCaster.castRays(holeStartsMm, holeEndsMm - holeStartsMm, numpy.linalg.norm(holeEndsMm - holeStartsMm, axis=1))
+      if isTarget:
+        results['targetEntryDepthMm'] = firstDepthsMm
+        results['targetExitDepthMm'] = lastDepthsMm
+      else:
+        results['obstacleDepthMm'] = firstDepthsMm
+          
+    holeLabels = numpy.full(numberOfHoles, self.holeLabelMissesTarget, dtype=numpy.int32)
+    holeLabels[~numpy.isnan(results['targetEntryDepthMm'])] = self.holeLabelUsable
+    holeLabels[~numpy.isnan(results['obstacleDepthMm'])] = self.holeLabelUnsafe
+    results['holeLabels'] = holeLabels
+    return results
+    
+  def getHoleLabelColorNode(self):
+    if not self.holeLabelColorNode or not self.holeLabelColorNode.GetScene():
+      self.holeLabelColorNode = slicer.vtkMRMLColorTableNode()
+      self.holeLabelColorNode.SetName("GridHoleLabelColors")
+      self.holeLabelColorNode.SetTypeToUser()
+      self.holeLabelColorNode.SetNumberOfColors(3)
+      self.holeLabelColorNode.SetColor(self.holeLabelUsable, "usable", 0.0, 1.0, 0.0, 1.0) # Green
+      self.holeLabelColorNode.SetColor(self.holeLabelUnsafe, "unsafe", 1.0, 0.0, 0.0, 1.0) # Red
+      self.holeLabelColorNode.SetColor(self.holeLabelMissesTarget, "misses target", 0.5, 0.5, 0.5, 1.0) # Grey
+      self.holeLabelColorNode.SetHideFromEditors(True)
+      slicer.mrmlScene.AddNode(self.holeLabelColorNode)
+    return self.holeLabelColorNode
+    
+  def updateGridHoleLabels(self, gridLogic):
+    # Analyze the grid and color its holes, returns the analysis results
+    results = self.computeHoleIntersections(gridLogic)
+    if results is None:
+      return None
+    gridLogic.setHoleLabels(results['holeLabels'], self.getHoleLabelColorNode())
+    return results
+
+#
+# InsertionGridPoseOptimizerLogic
+#
+
+def rasterizeSurfaceCrossings(trianglesMm, mapOriginMm, mapSpacingMm, mapShape, maximumDepthMm):
+  """
+  For every cell center of a 2D map in the grid plane, check whether a hole axis through it
+  (pointing along -z, depth = -z) crosses any of the triangles between depth 0 and maximumDepthMm.
+  trianglesMm is an array of shape (triangles, 3 vertices, 3).
+  """
+  crossingMap = numpy.zeros(mapShape, dtype=bool)
+  for triangleMm in trianglesMm:
+    lowerIndex = numpy.maximum(numpy.ceil((triangleMm[:,0:2].min(axis=0) - mapOriginMm) / mapSpacingMm - 0.5).astype(int), 0)
+    upperIndex = numpy.minimum(numpy.floor((triangleMm[:,0:2].max(axis=0) - mapOriginMm) / mapSpacingMm - 0.5).astype(int), numpy.array(mapShape) - 1)
+    if (lowerIndex > upperIndex).any():
+      continue
+    xMm = mapOriginMm[0] + (numpy.arange(lowerIndex[0], upperIndex[0] + 1) + 0.5) * mapSpacingMm
+    yMm = mapOriginMm[1] + (numpy.arange(lowerIndex[1], upperIndex[1] + 1) + 0.5) * mapSpacingMm
+    xMm, yMm = numpy.meshgrid(xMm, yMm, indexing='ij')
+    # barycentric coordinates of the cell centers in the projected triangle
+    (x0, y0), (x1, y1), (x2, y2) = triangleMm[:,0:2]
+    determinant = (y1 - y2) * (x0 - x2) + (x2 - x1) * (y0 - y2)
+    if determinant == 0:
+      continue
+    weight0 = ((y1 - y2) * (xMm - x2) + (x2 - x1) * (yMm - y2)) / determinant
+    weight1 = ((y2 - y0) * (xMm - x2) + (x0 - x2) * (yMm - y2)) / determinant
+    weight2 = 1.0 - weight0 - weight1
+    depthMm = -(weight0 * triangleMm[0,2] + weight1 * triangleMm[1,2] + weight2 * triangleMm[2,2])
+    crossing = (weight0 >= 0) & (weight1 >= 0) & (weight2 >= 0) & (depthMm >= 0) & (depthMm <= maximumDepthMm)
+    crossingMap[lowerIndex[0]:upperIndex[0] + 1, lowerIndex[1]:upperIndex[1] + 1] |= crossing
+  return crossingMap
+
+def evaluateGridPoseCandidates(arguments):
+  """
+  Score grid poses against precomputed target and obstacle crossing maps.
+  candidates is an array of (rotation deg, horizontal spacing mm, vertical spacing mm) rows.
+  Returns one row per candidate: usable holes, unsafe holes and total holes within the tightest
+  extents that keep all usable holes, followed by those extents in points (left, right, up, down).
+  """
+  (candidates, latticeIndices, triangularPattern, targetMap, obstacleMap, mapOriginMm, mapSpacingMm) = arguments
+  columns = latticeIndices[numpy.newaxis,:,0].astype(float)
+  rows = latticeIndices[numpy.newaxis,:,1].astype(float)
+  rotationsRad = numpy.radians(candidates[:,0])[:,numpy.newaxis]
+  xMm = columns * candidates[:,1,numpy.newaxis]
+  if triangularPattern:
+    xMm = xMm + (latticeIndices[numpy.newaxis,:,1] % 2 == 1) * candidates[:,1,numpy.newaxis] / 2.0
+  yMm = rows * candidates[:,2,numpy.newaxis]
+  xMm, yMm = (numpy.cos(rotationsRad) * xMm - numpy.sin(rotationsRad) * yMm, numpy.sin(rotationsRad) * xMm + numpy.cos(rotationsRad) * yMm)
+  
+  mapIndexX = numpy.floor((xMm - mapOriginMm[0]) / mapSpacingMm).astype(int)
+  mapIndexY = numpy.floor((yMm - mapOriginMm[1]) / mapSpacingMm).astype(int)
+  insideMap = (mapIndexX >= 0) & (mapIndexX < targetMap.shape[0]) & (mapIndexY >= 0) & (mapIndexY < targetMap.shape[1])
+  mapIndexX[~insideMap] = 0
+  mapIndexY[~insideMap] = 0
+  hitsTarget = insideMap & targetMap[mapIndexX, mapIndexY]
+  hitsObstacle = ~insideMap | obstacleMap[mapIndexX, mapIndexY] # nothing is known outside the map, so those holes are not safe
+  usable = hitsTarget & ~hitsObstacle
+  
+  # tightest extents around the usable holes, the grid always keeps the hole at the origin
+  largeIndex = 1000000
+  lastColumns = columns
+  if triangularPattern: # shifted rows lose their last hole, see InsertionGridPlannerLogic.computeHoleLatticeIndices
+    lastColumns = columns + (latticeIndices[numpy.newaxis,:,1] % 2 == 1)
+  lowerColumn = numpy.minimum(numpy.where(usable, columns, largeIndex).min(axis=1), 0)
+  upperColumn = numpy.maximum(numpy.where(usable, lastColumns, -largeIndex).max(axis=1), 0)
+  lowerRow = numpy.minimum(numpy.where(usable, rows, largeIndex).min(axis=1), 0)
+  upperRow = numpy.maximum(numpy.where(usable, rows, -largeIndex).max(axis=1), 0)
+  inExtents = ((columns >= lowerColumn[:,numpy.newaxis]) & (columns <= upperColumn[:,numpy.newaxis]) &
+               (rows >= lowerRow[:,numpy.newaxis]) & (rows <= upperRow[:,numpy.newaxis]))
+  if triangularPattern:
+    inExtents &= (lastColumns <= upperColumn[:,numpy.newaxis])
+  return numpy.column_stack((usable.sum(axis=1), (inExtents & hitsObstacle).sum(axis=1), inExtents.sum(axis=1),
+                             -lowerColumn, upperColumn, upperRow, -lowerRow))
+
+class InsertionGridPoseOptimizerLogic(InsertionGridAnatomyLogic):
+  """
+  Searches grid rotation and spacing for the poses with the most holes that pass through the
+  target without crossing the obstacle. For each rotation and spacing the extents are not
+  searched separately: the best extents are the tightest ones that keep every usable hole.
+  The target and obstacle are rasterized once into crossing maps in the grid plane, so
+  scoring a candidate is a lookup per hole. Candidates are scored in vectorized batches.
+  """
+  def __init__(self):
+    InsertionGridAnatomyLogic.__init__(self)
+    # search space
+    self.rotationsDeg = numpy.arange(-90, 90, 5) # the lattice is symmetric under a 180 degree rotation
+    self.spacingsHorizontalMm = numpy.arange(5, 16)
+    self.spacingsVerticalMm = numpy.arange(5, 16)
+    self.maximumExtentNumPoints = 10
+    self.crossingMapSpacingMm = 0.5
+    self.candidatesPerJob = 256
+    
+  def getTrianglesMm(self, modelNode, matrixModelToPlan):
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(modelNode.GetPolyData())
+    triangleFilter.PassLinesOff()
+    triangleFilter.PassVertsOff()
+    triangleFilter.Update()
+    polyData = triangleFilter.GetOutput()
+    if polyData.GetNumberOfPolys() == 0:
+      return numpy.zeros((0,3,3))
+    pointsMm = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(float)
+    pointsMm = pointsMm.dot(matrixModelToPlan[0:3,0:3].T) + matrixModelToPlan[0:3,3]
+    triangleIds = numpy_support.vtk_to_numpy(polyData.GetPolys().GetData()).reshape(-1,4)[:,1:]
+    return pointsMm[triangleIds]
+    
+  def computeCrossingMaps(self, gridLogic):
+    # Target and obstacle crossing maps in the plan (grid parent) coordinate system, None if there is no target
+    if not self.targetModelNode or not self.targetModelNode.GetPolyData() or self.targetModelNode.GetPolyData().GetNumberOfCells() == 0:
+      return None
+    planTransformNode = gridLogic.transformGridToTargetNode.GetParentTransformNode() if gridLogic.transformGridToTargetNode else None
+    targetTrianglesMm = self.getTrianglesMm(self.targetModelNode, numpy.linalg.inv(self.getMatrixGridToModel(planTransformNode, self.targetModelNode)))
+    # The map covers every hole of every candidate: the extents keep the hole at the origin, so they can reach
+    # maximumExtentNumPoints (plus the half spacing of shifted rows) at the largest spacing, in any rotation.
+    reachMm = numpy.sqrt(2) * (self.maximumExtentNumPoints + 1) * max(self.spacingsHorizontalMm.max(), self.spacingsVerticalMm.max())
+    mapOriginMm = numpy.array([-reachMm, -reachMm])
+    mapShape = (int(numpy.ceil(2 * reachMm / self.crossingMapSpacingMm)),) * 2
+    maximumDepthMm = gridLogic.getHoleMaximumDepthMm()
+    targetMap = rasterizeSurfaceCrossings(targetTrianglesMm, mapOriginMm, self.crossingMapSpacingMm, mapShape, maximumDepthMm)
+    obstacleMap = numpy.zeros(mapShape, dtype=bool)
+    if self.obstacleModelNode and self.obstacleModelNode.GetPolyData() and self.obstacleModelNode.GetPolyData().GetNumberOfCells() > 0:
+      obstacleTrianglesMm = self.getTrianglesMm(self.obstacleModelNode, numpy.linalg.inv(self.getMatrixGridToModel(planTransformNode, self.obstacleModelNode)))
+      mapUpperMm = mapOriginMm + numpy.array(mapShape) * self.crossingMapSpacingMm
+      overlapsMap = ((obstacleTrianglesMm[:,:,0:2].max(axis=1) >= mapOriginMm).all(axis=1) &
+                     (obstacleTrianglesMm[:,:,0:2].min(axis=1) <= mapUpperMm).all(axis=1))
+      obstacleMap = rasterizeSurfaceCrossings(obstacleTrianglesMm[overlapsMap], mapOriginMm, self.crossingMapSpacingMm, mapShape, maximumDepthMm)
+    return (targetMap, obstacleMap, mapOriginMm)
+    
+  def optimizeGridPose(self, gridLogic, numberOfPoses=5):
+    """
+    Returns the best numberOfPoses grid poses for gridLogic's pattern, best first. Each pose is a dictionary with
+    the rotation (deg), spacings (mm), extents (points left/right/up/down) and its usable/unsafe/total hole counts.
+    """
+    logging.debug('optimizeGridPose')
+    startTimeSec = time.time()
+    crossingMaps = self.computeCrossingMaps(gridLogic)
+    if crossingMaps is None:
+      logging.warning('No target model to optimize the grid pose for')
+      return []
+    (targetMap, obstacleMap, mapOriginMm) = crossingMaps
+    
+    rotationsDeg, spacingsHorizontalMm, spacingsVerticalMm = numpy.meshgrid(self.rotationsDeg, self.spacingsHorizontalMm, self.spacingsVerticalMm, indexing='ij')
+    candidates = numpy.column_stack((rotationsDeg.ravel(), spacingsHorizontalMm.ravel(), spacingsVerticalMm.ravel())).astype(float)
+    columns, rows = numpy.meshgrid(numpy.arange(-self.maximumExtentNumPoints, self.maximumExtentNumPoints + 1), numpy.arange(-self.maximumExtentNumPoints, self.maximumExtentNumPoints + 1))
+    latticeIndices = numpy.column_stack((columns.ravel(), rows.ravel()))
+    triangularPattern = (gridLogic.gridPattern == gridLogic.gridPatternTriangular)
+    if triangularPattern:
+      latticeIndices = latticeIndices[~((latticeIndices[:,1] % 2 == 1) & (latticeIndices[:,0] == self.maximumExtentNumPoints))]
+    jobs = [(candidates[jobStart:jobStart + self.candidatesPerJob], latticeIndices, triangularPattern, targetMap, obstacleMap, mapOriginMm, self.crossingMapSpacingMm)
+            for jobStart in xrange(0, candidates.shape[0], self.candidatesPerJob)]
+    # scored in this process, forking the application for a process pool is not safe with its Qt, VTK and BLAS threads
+    scores = numpy.concatenate(map(evaluateGridPoseCandidates, jobs))
+      
+    # most usable holes first, then fewest unsafe holes in the grid, then smallest grid
+    order = numpy.lexsort((scores[:,2], scores[:,1], -scores[:,0]))[0:numberOfPoses]
+    poses = []
+    for candidateIndex in order:
+      poses.append({ 'rotationDeg' : candidates[candidateIndex,0],
+                     'gridSpacingHorizontalMm' : candidates[candidateIndex,1],
+                     'gridSpacingVerticalMm' : candidates[candidateIndex,2],
+                     'gridSizeLeftNumPoints' : int(scores[candidateIndex,3]),
+                     'gridSizeRightNumPoints' : int(scores[candidateIndex,4]),
+                     'gridSizeUpNumPoints' : int(scores[candidateIndex,5]),
+                     'gridSizeDownNumPoints' : int(scores[candidateIndex,6]),
+                     'usableHoles' : int(scores[candidateIndex,0]),
+                     'unsafeHoles' : int(scores[candidateIndex,1]),
+                     'totalHoles' : int(scores[candidateIndex,2]) })
+    logging.info("Evaluated {0} grid poses in {1:.2f} s".format(candidates.shape[0], time.time() - startTimeSec))
+    return poses
@@ -0,0 +1,609 @@
+from __main__ import vtk, qt, ctk, slicer
+from slicer.ScriptedLoadableModule import *
+from vtk.util import numpy_support
+import logging
+import math
+import numpy
+
+#
+# TipToSurfaceDistance
+#
+
+class TipToSurfaceDistance(ScriptedLoadableModule):
+  def __init__(self, parent):
+    parent.title = "TipToSurfaceDistance"
+    parent.categories = ["IGT"]
+    parent.dependencies = ["CatheterReconstruction", "TransformGraph"]
+    parent.contributors = ["Thomas Vaughan (Queen's)", "Gabor Fichtinger (Queen's)"]
+    parent.helpText = """
+    Show the signed distance from a tracked tool tip to a closed surface model (e.g. seroma or chest wall), negative inside.
+    A signed distance field is computed in a background thread whenever the surface changes, so that each tracker frame
+    only needs a trilinear lookup. Close to the surface the distance is computed exactly.
+    """
+    parent.acknowledgementText = """
+	This work is funded as a project in the Laboratory for Percutaneous Surgery, Queen's University, Kingston, Ontario. Thomas Vaughan is funded by an NSERC Postgraduate award. Gabor Fichtinger is funded as a Cancer Care Ontario (CCO) Chair.
+	""" # replace with organization, grant and thanks.
+    self.parent = parent
+
+#
+# TipToSurfaceDistanceWidget
+#
+
+class TipToSurfaceDistanceWidget(ScriptedLoadableModuleWidget):
+
+  def setup(self):
+    ScriptedLoadableModuleWidget.setup(self)
+
+    self.logic = TipToSurfaceDistanceLogic()
+    self.monitor = TipToSurfaceDistanceMonitor(self.logic, 'Surface')
+    self.monitor.setDistanceCallback(self.onDistanceChanged)
+
+    # Collapsible buttons
+    self.parametersCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.parametersCollapsibleButton.text = "TipToSurfaceDistance"
+    self.layout.addWidget(self.parametersCollapsibleButton)
+
+    # Layout within the collapsible button
+    self.parametersFormLayout = qt.QFormLayout(self.parametersCollapsibleButton)
+
+    # Tip transform combobox
+    self.tipTransformLabel = qt.QLabel()
+    self.tipTransformLabel.setText("Tip transform: ")
+    self.tipTransformSelector = slicer.qMRMLNodeComboBox()
+    self.tipTransformSelector.nodeTypes = ( ("vtkMRMLLinearTransformNode"), "" )
+    self.tipTransformSelector.noneEnabled = True
+    self.tipTransformSelector.addEnabled = False
+    self.tipTransformSelector.removeEnabled = False
+    self.tipTransformSelector.setMRMLScene( slicer.mrmlScene )
+    self.tipTransformSelector.setToolTip("Pick the transform whose origin is the tool tip, e.g. NeedleTipToNeedle")
+    self.parametersFormLayout.addRow(self.tipTransformLabel, self.tipTransformSelector)
+
+    # Model combobox
+    self.modelLabel = qt.QLabel()
+    self.modelLabel.setText("Surface model: ")
+    self.modelSelector = slicer.qMRMLNodeComboBox()
+    self.modelSelector.nodeTypes = ( ("vtkMRMLModelNode"), "" )
+    self.modelSelector.noneEnabled = True
+    self.modelSelector.addEnabled = False
+    self.modelSelector.removeEnabled = False
+    self.modelSelector.setMRMLScene( slicer.mrmlScene )
+    self.modelSelector.setToolTip("Pick the closed surface to measure the distance to")
+    self.parametersFormLayout.addRow(self.modelLabel, self.modelSelector)
+
+    self.distanceLabel = qt.QLabel()
+    self.distanceLabel.setText("Distance (mm): ")
+    self.distanceValueLabel = qt.QLabel()
+    self.distanceValueLabel.setText("-")
+    self.parametersFormLayout.addRow(self.distanceLabel, self.distanceValueLabel)
+
+    self.tipTransformSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onNodesChanged)
+    self.modelSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onNodesChanged)
+
+    # Add vertical spacer
+    self.layout.addStretch(1)
+
+  def cleanup(self):
+    self.monitor.stop()
+
+  def onNodesChanged(self, node):
+    logging.debug('onNodesChanged')
+    self.monitor.setNodes(self.tipTransformSelector.currentNode(), self.modelSelector.currentNode())
+
+  def onDistanceChanged(self, distanceMm, closestPointRas):
+    if (distanceMm is None):
+      self.distanceValueLabel.setText("-")
+      return
+    self.distanceValueLabel.setText("{0:.1f}".format(distanceMm))
+
+#
+# TipToSurfaceDistanceLogic
+#
+
+class TipToSurfaceDistanceLogic(ScriptedLoadableModuleLogic):
+  """
+  computeSignedDistanceField works on VTK objects that are not in the scene, so it can run in a worker thread.
+  """
+  # constants - DO NOT CHANGE THESE
+  nearSurfaceDistanceInVoxelDiagonals = 1.0 # interpolation rounds off edges and corners by up to about one voxel
+  insideTestTolerance = 0.0001 # fraction of the bounds diagonal, at the default 0.001 rays grazing an edge are miscounted
+
+  def __init__(self):
+    self.trajectoryLengthMm = 200.0 # surfaces further along the trajectory are not reported
+    self.fieldMarginMm = 30.0 # beyond the margin every lookup is an exact query
+    self.maximumFieldDimension = 32 # samples along the longest side, computing the field is proportional to its cube
+    self.minimumFieldSpacingMm = 0.5
+    self.maximumFieldNumberOfTriangles = 1000 # the field is sampled from a decimated surface, exact queries use all triangles
+
+  def computeSignedDistanceField(self, surfacePolyData):
+    """
+    Sample the signed distance to surfacePolyData on a grid around it, in the surface's coordinates.
+    Returns a SignedDistanceField, or None if there is no surface. Does not touch the scene.
+    """
+    if (surfacePolyData.GetNumberOfPolys() == 0):
+      return None
+    bounds = surfacePolyData.GetBounds()
+    minimumMm = numpy.array(bounds[0::2]) - self.fieldMarginMm
+    maximumMm = numpy.array(bounds[1::2]) + self.fieldMarginMm
+    spacingMm = max(self.minimumFieldSpacingMm, numpy.max(maximumMm - minimumMm) / (self.maximumFieldDimension - 1))
+    dimensions = [int(dimension) for dimension in numpy.ceil((maximumMm - minimumMm) / spacingMm) + 1]
+    maximumMm = minimumMm + (numpy.array(dimensions) - 1) * spacingMm # whole voxels, so the spacing is the same along all axes
+
+    # Magnitude: the sign of vtkImplicitPolyDataDistance comes from the normal of the closest triangle,
+    # which is unreliable on the sliver triangles of a subdivided convex hull, so only the magnitude is used
+    fieldPolyData = surfacePolyData
+    if (surfacePolyData.GetNumberOfPolys() > self.maximumFieldNumberOfTriangles):
+      decimation = vtk.vtkQuadricDecimation()
+      decimation.SetInputData(surfacePolyData)
+      decimation.SetTargetReduction(1.0 - float(self.maximumFieldNumberOfTriangles) / surfacePolyData.GetNumberOfPolys())
+      decimation.Update()
+      fieldPolyData = decimation.GetOutput()
+    implicitDistance = vtk.vtkImplicitPolyDataDistance()
+    implicitDistance.SetInput(fieldPolyData)
+    sampleFunction = vtk.vtkSampleFunction()
+    sampleFunction.SetImplicitFunction(implicitDistance)
+    sampleFunction.SetModelBounds(minimumMm[0], maximumMm[0], minimumMm[1], maximumMm[1], minimumMm[2], maximumMm[2])
+    sampleFunction.SetSampleDimensions(dimensions)
+    sampleFunction.SetOutputScalarTypeToDouble()
+    sampleFunction.ComputeNormalsOff()
+    sampleFunction.CappingOff()
+    sampleFunction.Update()
+    distancesMm = numpy.abs(numpy_support.vtk_to_numpy(sampleFunction.GetOutput().GetPointData().GetScalars()))
+
+    # Sign: scan conversion of the closed surface onto the same grid does not depend on triangle orientation
+    stencil = vtk.vtkPolyDataToImageStencil()
+    stencil.SetInputData(surfacePolyData)
+    stencil.SetOutputOrigin(minimumMm[0], minimumMm[1], minimumMm[2])
+    stencil.SetOutputSpacing(spacingMm, spacingMm, spacingMm)
+    stencil.SetOutputWholeExtent(0, dimensions[0] - 1, 0, dimensions[1] - 1, 0, dimensions[2] - 1)
+    stencilToImage = vtk.vtkImageStencilToImage()
+    stencilToImage.SetInputConnection(stencil.GetOutputPort())
+    stencilToImage.SetInsideValue(1)
+    stencilToImage.SetOutsideValue(0)
+    stencilToImage.SetOutputScalarTypeToUnsignedChar()
+    stencilToImage.Update()
+    isInside = numpy_support.vtk_to_numpy(stencilToImage.GetOutput().GetPointData().GetScalars()) > 0
+    distancesMm[isInside] = -distancesMm[isInside]
+    distancesMm = distancesMm.reshape(dimensions[::-1]) # x varies fastest
+
+    cellLocator = vtk.vtkCellLocator()
+    cellLocator.SetDataSet(surfacePolyData)
+    cellLocator.BuildLocator()
+    # near the surface the scan converted sign is off by up to a voxel, there it comes from ray casting instead
+    enclosedPoints = vtk.vtkSelectEnclosedPoints()
+    enclosedPoints.CheckSurfaceOff()
+    enclosedPoints.SetTolerance(self.insideTestTolerance)
+    enclosedPoints.Initialize(surfacePolyData)
+    nearSurfaceDistanceMm = self.nearSurfaceDistanceInVoxelDiagonals * math.sqrt(3.0) * spacingMm
+    return SignedDistanceField(distancesMm, minimumMm, [spacingMm] * 3, cellLocator, enclosedPoints, nearSurfaceDistanceMm)
+
+#
+# SignedDistanceField
+#
+
+class SignedDistanceField(object):
+  """
+  Signed distance to a closed surface sampled on a regular grid, negative inside. A lookup interpolates the eight
+  surrounding samples, and the closest surface point is found by stepping along the interpolated gradient.
+  Within nearSurfaceDistanceMm of the surface and inside it, where interpolation smooths over edges and the ridges
+  of the distance along the medial axis, and outside the grid, the surface is queried exactly instead.
+  Within nearSurfaceDistanceMm of the surface the sign is also queried exactly, since the sampled sign is only
+  right to about a voxel. The grid extends well beyond the surface, so outside the grid is outside the surface.
+  """
+
+  def __init__(self, distancesMm, originMm, spacingMm, cellLocator, enclosedPoints, nearSurfaceDistanceMm):
+    self.distancesMm = distancesMm # indexed [k, j, i]
+    self.originMm = [float(value) for value in originMm]
+    self.spacingMm = [float(value) for value in spacingMm]
+    self.maximumIndices = [distancesMm.shape[2] - 1, distancesMm.shape[1] - 1, distancesMm.shape[0] - 1]
+    self.cellLocator = cellLocator # exact closest point on the full surface
+    self.enclosedPoints = enclosedPoints # exact inside test, initialized with the full surface
+    self.nearSurfaceDistanceMm = nearSurfaceDistanceMm
+    self.closestCellId = vtk.mutable(0)
+    self.closestSubId = vtk.mutable(0)
+    self.closestDistance2 = vtk.mutable(0.0)
+    self.numberOfInterpolatedLookups = 0
+    self.numberOfExactQueries = 0
+
+  def getDistanceMm(self, pointMm):
+    # returns (signed distance, closest surface point), both in the surface's coordinates
+    x = (pointMm[0] - self.originMm[0]) / self.spacingMm[0]
+    y = (pointMm[1] - self.originMm[1]) / self.spacingMm[1]
+    z = (pointMm[2] - self.originMm[2]) / self.spacingMm[2]
+    if (not (0.0 <= x < self.maximumIndices[0] and 0.0 <= y < self.maximumIndices[1] and 0.0 <= z < self.maximumIndices[2])):
+      return self.getExactDistanceMm(pointMm, False)
+    i = int(x)
+    j = int(y)
+    k = int(z)
+    tx = x - i
+    ty = y - j
+    tz = z - k
+    cube = self.distancesMm[k:k+2, j:j+2, i:i+2].tolist() # cube[dz][dy][dx]
+    d00 = cube[0][0][0] + (cube[0][0][1] - cube[0][0][0]) * tx
+    d10 = cube[0][1][0] + (cube[0][1][1] - cube[0][1][0]) * tx
+    d01 = cube[1][0][0] + (cube[1][0][1] - cube[1][0][0]) * tx
+    d11 = cube[1][1][0] + (cube[1][1][1] - cube[1][1][0]) * tx
+    d0 = d00 + (d10 - d00) * ty
+    d1 = d01 + (d11 - d01) * ty
+    distanceMm = d0 + (d1 - d0) * tz
+    if (distanceMm <= self.nearSurfaceDistanceMm):
+      return self.getExactDistanceMm(pointMm, self.getFieldIsInside(distanceMm))
+    gradientX = (((cube[0][0][1] - cube[0][0][0]) * (1.0 - ty) + (cube[0][1][1] - cube[0][1][0]) * ty) * (1.0 - tz)
+                 + ((cube[1][0][1] - cube[1][0][0]) * (1.0 - ty) + (cube[1][1][1] - cube[1][1][0]) * ty) * tz) / self.spacingMm[0]
+    gradientY = ((d10 - d00) * (1.0 - tz) + (d11 - d01) * tz) / self.spacingMm[1]
+    gradientZ = (d1 - d0) / self.spacingMm[2]
+    gradientNorm = math.sqrt(gradientX * gradientX + gradientY * gradientY + gradientZ * gradientZ)
+    if (gradientNorm == 0.0):
+      return self.getExactDistanceMm(pointMm, self.getFieldIsInside(distanceMm))
+    self.numberOfInterpolatedLookups = self.numberOfInterpolatedLookups + 1
+    step = distanceMm / gradientNorm
+    closestPointMm = [pointMm[0] - step * gradientX, pointMm[1] - step * gradientY, pointMm[2] - step * gradientZ]
+    return (distanceMm, closestPointMm)
+
+  def getFieldIsInside(self, distanceMm):
+    # the sign of the sampled distance, None close to the surface where it cannot be trusted
+    if (distanceMm < -self.nearSurfaceDistanceMm):
+      return True
+    if (distanceMm > self.nearSurfaceDistanceMm):
+      return False
+    return None
+
+  def getExactDistanceMm(self, pointMm, isInside=None):
+    # the locator gives the unsigned distance, the sign is taken from isInside, or queried exactly if it is None
+    self.numberOfExactQueries = self.numberOfExactQueries + 1
+    closestPointMm = [0.0, 0.0, 0.0]
+    self.cellLocator.FindClosestPoint(pointMm, closestPointMm, self.closestCellId, self.closestSubId, self.closestDistance2)
+    distanceMm = math.sqrt(float(self.closestDistance2))
+    if (isInside is None):
+      isInside = (self.enclosedPoints.IsInsideSurface(pointMm[0], pointMm[1], pointMm[2]) != 0)
+    if (isInside):
+      distanceMm = -distanceMm
+    return (distanceMm, closestPointMm)
+
+#
+# SurfaceRayCaster
+#
+
+class SurfaceRayCaster(object):
+  """
+  First and last crossings of a batch of rays (e.g. every hole axis of a grid, or the needle axis) with a triangle
+  surface. The triangles are sorted into a balanced bounding volume hierarchy once per surface, by splitting every
+  node at the median triangle along its longest axis. The rays walk down the hierarchy one level at a time,
+  so each level is a single vectorized box test of all (ray, node) pairs and the leaves a single triangle test.
+  Does not touch the scene, so it can be built in a worker thread.
+  """
+  # constants - DO NOT CHANGE THESE
+  maximumTrianglesPerLeaf = 8
+
+  def __init__(self, surfacePolyData):
+    trianglesMm = self.getTrianglesMm(surfacePolyData)
+    self.numberOfTriangles = trianglesMm.shape[0]
+    self.depth = 0 # leaves are at this level, the root is level 0
+    if (self.numberOfTriangles > self.maximumTrianglesPerLeaf):
+      self.depth = int(math.ceil(math.log(float(self.numberOfTriangles) / self.maximumTrianglesPerLeaf, 2)))
+
+    # sort the triangles level by level, each node's triangles are a contiguous range split in half for its children
+    centroidsMm = trianglesMm.mean(axis=1)
+    triangleOrder = numpy.arange(self.numberOfTriangles)
+    for level in xrange(self.depth):
+      nodeStarts = self.getNodeStarts(level)
+      nodeOfTriangle = numpy.repeat(numpy.arange(len(nodeStarts)), numpy.diff(numpy.append(nodeStarts, self.numberOfTriangles)))
+      sortedCentroidsMm = centroidsMm[triangleOrder]
+      nodeExtentsMm = numpy.maximum.reduceat(sortedCentroidsMm, nodeStarts, axis=0) - numpy.minimum.reduceat(sortedCentroidsMm, nodeStarts, axis=0)
+      splitKeys = sortedCentroidsMm[numpy.arange(self.numberOfTriangles), numpy.argmax(nodeExtentsMm, axis=1)[nodeOfTriangle]]
+      triangleOrder = triangleOrder[numpy.lexsort((splitKeys, nodeOfTriangle))]
+    trianglesMm = trianglesMm[triangleOrder]
+    # one contiguous array per coordinate, gathering from them is much faster than from N x 3 arrays
+    (self.vertex0XMm, self.vertex0YMm, self.vertex0ZMm) = trianglesMm[:,0].T.copy()
+    (self.edge1XMm, self.edge1YMm, self.edge1ZMm) = (trianglesMm[:,1] - trianglesMm[:,0]).T.copy()
+    (self.edge2XMm, self.edge2YMm, self.edge2ZMm) = (trianglesMm[:,2] - trianglesMm[:,0]).T.copy()
+    self.leafStarts = self.getNodeStarts(self.depth)
+    self.leafEnds = numpy.append(self.leafStarts[1:], self.numberOfTriangles)
+
+    # node boxes, stored level after level: node i of a level is at index 2^level - 1 + i, its children are 2i and 2i+1
+    numberOfNodes = 2 ** (self.depth + 1) - 1
+    nodeLowerMm = numpy.zeros([numberOfNodes, 3])
+    nodeUpperMm = numpy.zeros([numberOfNodes, 3])
+    if (self.numberOfTriangles > 0):
+      leafOffset = 2 ** self.depth - 1
+      nodeLowerMm[leafOffset:] = numpy.minimum.reduceat(trianglesMm.min(axis=1), self.leafStarts, axis=0)
+      nodeUpperMm[leafOffset:] = numpy.maximum.reduceat(trianglesMm.max(axis=1), self.leafStarts, axis=0)
+    for level in xrange(self.depth - 1, -1, -1):
+      levelNodes = slice(2 ** level - 1, 2 ** (level + 1) - 1)
+      firstChildren = slice(2 ** (level + 1) - 1, 2 ** (level + 2) - 1, 2)
+      secondChildren = slice(2 ** (level + 1), 2 ** (level + 2) - 1, 2)
+      nodeLowerMm[levelNodes] = numpy.minimum(nodeLowerMm[firstChildren], nodeLowerMm[secondChildren])
+      nodeUpperMm[levelNodes] = numpy.maximum(nodeUpperMm[firstChildren], nodeUpperMm[secondChildren])
+    self.nodeLowerMm = nodeLowerMm.T.copy() # 3 x nodes
+    self.nodeUpperMm = nodeUpperMm.T.copy()
+
+  def getTrianglesMm(self, surfacePolyData):
+    # array of shape (triangles, 3 vertices, 3)
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(surfacePolyData)
+    triangleFilter.PassLinesOff()
+    triangleFilter.PassVertsOff()
+    triangleFilter.Update()
+    polyData = triangleFilter.GetOutput()
+    if (polyData.GetNumberOfPolys() == 0):
+      return numpy.zeros([0,3,3])
+    pointsMm = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(numpy.float64)
+    triangleIds = numpy_support.vtk_to_numpy(polyData.GetPolys().GetData()).reshape(-1,4)[:,1:]
+    return pointsMm[triangleIds]
+
+  def getNodeStarts(self, level):
+    # first sorted triangle of each node of the level, the halves of a node differ in size by at most one
+    return (numpy.arange(2 ** level) * self.numberOfTriangles) // (2 ** level)
+
+  def castRays(self, originsMm, directions, maximumDistancesMm):
+    """
+    originsMm and directions are N x 3 arrays, directions need not be normalized.
+    maximumDistancesMm is one length for all rays or one per ray.
+    Returns the distances in mm from the origins to the first and to the last crossing within the maximum distance,
+    NaN for rays that do not cross the surface.
+    """
+    originsMm = numpy.asarray(originsMm, dtype=numpy.float64).reshape(-1,3)
+    directions = numpy.asarray(directions, dtype=numpy.float64).reshape(-1,3)
+    directions = directions / numpy.linalg.norm(directions, axis=1)[:,numpy.newaxis]
+    numberOfRays = originsMm.shape[0]
+    maximumDistancesMm = numpy.ones(numberOfRays) * maximumDistancesMm
+    firstDistancesMm = numpy.full(numberOfRays, numpy.inf)
+    lastDistancesMm = numpy.full(numberOfRays, -numpy.inf)
+    if (self.numberOfTriangles == 0 or numberOfRays == 0):
+      return (numpy.full(numberOfRays, numpy.nan), numpy.full(numberOfRays, numpy.nan))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      (originsXMm, originsYMm, originsZMm) = originsMm.T.copy()
+      (directionsX, directionsY, directionsZ) = directions.T.copy()
+      (inverseDirectionsX, inverseDirectionsY, inverseDirectionsZ) = (1.0 / directions).T.copy()
+
+      # walk down the hierarchy with every (ray, node) pair whose box the ray passes through
+      rayIndices = numpy.arange(numberOfRays)
+      boxIndices = numpy.zeros(numberOfRays, dtype=numpy.int64)
+      for level in xrange(self.depth + 1):
+        entryDistancesMm = None
+        for (nodeLowerMm, nodeUpperMm, rayOriginsMm, rayInverseDirections) in [(self.nodeLowerMm[0], self.nodeUpperMm[0], originsXMm, inverseDirectionsX),
+                                                                               (self.nodeLowerMm[1], self.nodeUpperMm[1], originsYMm, inverseDirectionsY),
+                                                                               (self.nodeLowerMm[2], self.nodeUpperMm[2], originsZMm, inverseDirectionsZ)]:
+          pairOriginsMm = rayOriginsMm[rayIndices]
+          pairInverseDirections = rayInverseDirections[rayIndices]
+          distancesToLowerMm = (nodeLowerMm[boxIndices] - pairOriginsMm) * pairInverseDirections
+          distancesToUpperMm = (nodeUpperMm[boxIndices] - pairOriginsMm) * pairInverseDirections
+          # fmin and fmax skip the NaN of a ray that lies in a box face, the other axes decide
+          if (entryDistancesMm is None):
+            entryDistancesMm = numpy.fmin(distancesToLowerMm, distancesToUpperMm)
+            exitDistancesMm = numpy.fmax(distancesToLowerMm, distancesToUpperMm)
+          else:
+            entryDistancesMm = numpy.fmax(entryDistancesMm, numpy.fmin(distancesToLowerMm, distancesToUpperMm))
+            exitDistancesMm = numpy.fmin(exitDistancesMm, numpy.fmax(distancesToLowerMm, distancesToUpperMm))
+        isBoxCrossed = (entryDistancesMm <= exitDistancesMm) & (exitDistancesMm >= 0) & (entryDistancesMm <= maximumDistancesMm[rayIndices])
+        rayIndices = rayIndices[isBoxCrossed]
+        boxIndices = boxIndices[isBoxCrossed]
+        if (level < self.depth):
+          # children of the node at index n are at 2n+1 and 2n+2
+          rayIndices = numpy.repeat(rayIndices, 2)
+          boxIndices = numpy.repeat(2 * boxIndices + 1, 2)
+          boxIndices[1::2] += 1
+
+      # every triangle of every reached leaf
+      leafIndices = boxIndices - (2 ** self.depth - 1)
+      maximumLeafSize = int((self.leafEnds - self.leafStarts).max())
+      triangleIndices = self.leafStarts[leafIndices][:,numpy.newaxis] + numpy.arange(maximumLeafSize)
+      isInLeaf = (triangleIndices < self.leafEnds[leafIndices][:,numpy.newaxis]).ravel()
+      triangleIndices = triangleIndices.ravel()[isInLeaf]
+      rayIndices = numpy.repeat(rayIndices, maximumLeafSize)[isInLeaf]
+
+      # Moller-Trumbore, written out per coordinate
+      dx = directionsX[rayIndices]
+      dy = directionsY[rayIndices]
+      dz = directionsZ[rayIndices]
+      e1x = self.edge1XMm[triangleIndices]
+      e1y = self.edge1YMm[triangleIndices]
+      e1z = self.edge1ZMm[triangleIndices]
+      e2x = self.edge2XMm[triangleIndices]
+      e2y = self.edge2YMm[triangleIndices]
+      e2z = self.edge2ZMm[triangleIndices]
+      px = dy * e2z - dz * e2y
+      py = dz * e2x - dx * e2z
+      pz = dx * e2y - dy * e2x
+      determinants = e1x * px + e1y * py + e1z * pz
+      inverseDeterminants = 1.0 / determinants
+      sx = originsXMm[rayIndices] - self.vertex0XMm[triangleIndices]
+      sy = originsYMm[rayIndices] - self.vertex0YMm[triangleIndices]
+      sz = originsZMm[rayIndices] - self.vertex0ZMm[triangleIndices]
+      u = (sx * px + sy * py + sz * pz) * inverseDeterminants
+      qx = sy * e1z - sz * e1y
+      qy = sz * e1x - sx * e1z
+      qz = sx * e1y - sy * e1x
+      v = (dx * qx + dy * qy + dz * qz) * inverseDeterminants
+      distancesMm = (e2x * qx + e2y * qy + e2z * qz) * inverseDeterminants
+      isCrossing = ((numpy.abs(determinants) > 1e-12) & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0)
+                    & (distancesMm >= 0.0) & (distancesMm <= maximumDistancesMm[rayIndices]))
+    numpy.minimum.at(firstDistancesMm, rayIndices[isCrossing], distancesMm[isCrossing])
+    numpy.maximum.at(lastDistancesMm, rayIndices[isCrossing], distancesMm[isCrossing])
+    firstDistancesMm[numpy.isinf(firstDistancesMm)] = numpy.nan
+    lastDistancesMm[numpy.isinf(lastDistancesMm)] = numpy.nan
+    return (firstDistancesMm, lastDistancesMm)
+
+#
+# TipToSurfaceDistanceMonitor
+#
+
+class TipToSurfaceDistanceMonitor(object):
+  """
+  Keeps the distance from one tool tip to one surface model up to date, and optionally the distance along the tool's
+  trajectory. The model's signed distance field and ray caster are recomputed in a worker thread whenever its polydata
+  changes, the previous ones are used until the new ones arrive. The transform events of one tracker frame are
+  coalesced into a single lookup and ray cast.
+  """
+
+  def __init__(self, distanceLogic, surfaceName):
+    import CatheterReconstruction
+    import TransformGraph
+    self.distanceLogic = distanceLogic
+    self.surfaceName = surfaceName
+    self.tipTransformNode = None
+    self.modelNode = None
+    self.nodeObserverTags = []
+    self.trajectoryTransformNode = None
+    self.trajectoryDirection = None # in trajectoryTransformNode coordinates
+    self.distanceCallback = None # called as distanceCallback(distanceMm, closestPointRas), both None if unknown
+    self.trajectoryCallback = None # called as trajectoryCallback(distanceMm, hitPointRas), both None if the trajectory misses
+    self.distanceField = None
+    self.rayCaster = None
+    self.distanceMm = None
+    self.closestPointRas = None
+    self.trajectoryDistanceMm = None
+    self.trajectoryHitPointRas = None
+    self.updatePending = False
+    self.numberOfTransformEvents = 0
+    self.numberOfUpdates = 0
+    self.numberOfFieldComputations = 0
+    self.transformGraph = TransformGraph.CachedTransformGraph() # see setTransformGraph
+    self.worker = CatheterReconstruction.CatheterReconstructionWorker(self.computeSurfaceQueries, self.onSurfaceQueriesComputed,
+                                                                      surfaceName + ' distance field')
+
+  def setDistanceCallback(self, distanceCallback):
+    self.distanceCallback = distanceCallback
+
+  def setTransformGraph(self, transformGraph):
+    # share the matrix cache of the application, the monitor has its own until then
+    self.transformGraph.clear()
+    self.transformGraph = transformGraph
+
+  def setTrajectoryCallback(self, trajectoryCallback):
+    self.trajectoryCallback = trajectoryCallback
+
+  def setTrajectory(self, trajectoryTransformNode, trajectoryDirection):
+    """
+    The trajectory starts at the tip and points along trajectoryDirection, given in trajectoryTransformNode coordinates,
+    e.g. the needle axis in needle model coordinates. None for either stops the trajectory updates.
+    """
+    self.removeObservers()
+    self.trajectoryTransformNode = trajectoryTransformNode
+    self.trajectoryDirection = trajectoryDirection
+    if (not self.trajectoryTransformNode or self.trajectoryDirection is None):
+      self.setTrajectoryDistance(None, None)
+    if (self.tipTransformNode and self.modelNode):
+      self.addObservers()
+      self.scheduleUpdate()
+
+  def setNodes(self, tipTransformNode, modelNode):
+    # measure from the origin of tipTransformNode to modelNode, None for either stops the monitor
+    self.removeObservers()
+    self.worker.cancel()
+    self.distanceField = None
+    self.rayCaster = None
+    self.tipTransformNode = tipTransformNode
+    self.modelNode = modelNode
+    if (not self.tipTransformNode or not self.modelNode):
+      self.setDistance(None, None)
+      self.setTrajectoryDistance(None, None)
+      return
+    self.addObservers()
+    self.onModelPolyDataModified(self.modelNode, None) # the model may already hold a surface
+
+  def addObservers(self):
+    # transformable nodes pass on the TransformModifiedEvents of their parents
+    transformModifiedEvent = slicer.vtkMRMLTransformableNode.TransformModifiedEvent
+    transformNodes = [self.tipTransformNode, self.modelNode]
+    if (self.trajectoryTransformNode):
+      transformNodes.append(self.trajectoryTransformNode)
+    for transformNode in transformNodes:
+      self.nodeObserverTags.append([transformNode, transformNode.AddObserver(transformModifiedEvent, self.onTransformModified)])
+    self.nodeObserverTags.append([self.modelNode, self.modelNode.AddObserver(slicer.vtkMRMLModelNode.PolyDataModifiedEvent, self.onModelPolyDataModified)])
+
+  def removeObservers(self):
+    for [node, observerTag] in self.nodeObserverTags:
+      node.RemoveObserver(observerTag)
+    self.nodeObserverTags = []
+
+  def stop(self):
+    self.removeObservers()
+    self.worker.stop()
+    self.tipTransformNode = None
+    self.modelNode = None
+
+  def onModelPolyDataModified(self, observer, eventid):
+    polyData = self.modelNode.GetPolyData()
+    if (not polyData or polyData.GetNumberOfPolys() == 0):
+      self.worker.cancel()
+      self.distanceField = None
+      self.rayCaster = None
+      self.scheduleUpdate()
+      return
+    self.worker.submit(polyData)
+
+  def computeSurfaceQueries(self, surfacePolyData):
+    # runs in the worker thread
+    distanceField = self.distanceLogic.computeSignedDistanceField(surfacePolyData)
+    if (not distanceField):
+      return None
+    return (distanceField, SurfaceRayCaster(surfacePolyData))
+
+  def onSurfaceQueriesComputed(self, surfaceQueries, jobTag):
+    self.numberOfFieldComputations = self.numberOfFieldComputations + 1
+    (self.distanceField, self.rayCaster) = surfaceQueries
+    self.scheduleUpdate()
+
+  def onTransformModified(self, observer, eventid):
+    # no logging here, it is called for every tracker frame
+    self.numberOfTransformEvents = self.numberOfTransformEvents + 1
+    self.scheduleUpdate()
+
+  def scheduleUpdate(self):
+    if (self.updatePending == False):
+      self.updatePending = True
+      qt.QTimer.singleShot(0, self.onUpdate) # runs once the tracker frame has been processed
+
+  def onUpdate(self):
+    self.updatePending = False
+    if (not self.distanceField or not self.tipTransformNode or not self.modelNode):
+      self.setDistance(None, None)
+      self.setTrajectoryDistance(None, None)
+      return
+    self.numberOfUpdates = self.numberOfUpdates + 1
+    modelTransformNode = self.modelNode.GetParentTransformNode()
+    # all the matrices of the frame in one query, None is the world
+    nodePairs = [(self.tipTransformNode, modelTransformNode), (modelTransformNode, None)]
+    if (self.trajectoryTransformNode and self.trajectoryDirection is not None):
+      nodePairs.append((self.trajectoryTransformNode, modelTransformNode))
+    matrices = self.transformGraph.getMatrices(nodePairs)
+    matrixModelToWorld = matrices[1]
+    tipMm = matrices[0,0:3,3].tolist()
+    (distanceMm, closestPointMm) = self.distanceField.getDistanceMm(tipMm)
+    closestPointRas = (matrixModelToWorld[0:3,0:3].dot(closestPointMm) + matrixModelToWorld[0:3,3]).tolist()
+    self.setDistance(distanceMm, closestPointRas)
+    if (len(nodePairs) == 3):
+      self.updateTrajectoryDistance(matrices[2], matrixModelToWorld, tipMm)
+
+  def updateTrajectoryDistance(self, matrixTrajectoryToModel, matrixModelToWorld, tipMm):
+    directionMm = matrixTrajectoryToModel[0:3,0:3].dot(self.trajectoryDirection).tolist()
+    (firstDistancesMm, lastDistancesMm) = self.rayCaster.castRays([tipMm], [directionMm], self.distanceLogic.trajectoryLengthMm)
+    if (numpy.isnan(firstDistancesMm[0])):
+      self.setTrajectoryDistance(None, None)
+      return
+    trajectoryDistanceMm = float(firstDistancesMm[0])
+    directionNormMm = math.sqrt(directionMm[0] ** 2 + directionMm[1] ** 2 + directionMm[2] ** 2)
+    hitPointMm = [tipMm[axis] + directionMm[axis] / directionNormMm * trajectoryDistanceMm for axis in xrange(3)]
+    hitPointRas = (matrixModelToWorld[0:3,0:3].dot(hitPointMm) + matrixModelToWorld[0:3,3]).tolist()
+    self.setTrajectoryDistance(trajectoryDistanceMm, hitPointRas)
+
+  def setDistance(self, distanceMm, closestPointRas):
+    self.distanceMm = distanceMm
+    self.closestPointRas = closestPointRas
+    if (self.distanceCallback):
+      self.distanceCallback(distanceMm, closestPointRas)
+
+  def setTrajectoryDistance(self, distanceMm, hitPointRas):
+    self.trajectoryDistanceMm = distanceMm
+    self.trajectoryHitPointRas = hitPointRas
+    if (self.trajectoryCallback):
+      self.trajectoryCallback(distanceMm, hitPointRas)
+
+  def getCounters(self):
+    counters = { 'numberOfTransformEvents' : self.numberOfTransformEvents,
+                 'numberOfUpdates' : self.numberOfUpdates,
+                 'numberOfFieldComputations' : self.numberOfFieldComputations }
+    if (self.distanceField):
+      counters['numberOfInterpolatedLookups'] = self.distanceField.numberOfInterpolatedLookups
+      counters['numberOfExactQueries'] = self.distanceField.numberOfExactQueries
+    return counters
@@ -0,0 +1,343 @@
+from __main__ import vtk, qt, ctk, slicer
+from slicer.ScriptedLoadableModule import *
+import logging
+import math
+import numpy
+
+#
+# ToolCalibration
+#
+
+class ToolCalibration(ScriptedLoadableModule):
+  def __init__(self, parent):
+    parent.title = "ToolCalibration"
+    parent.categories = ["IGT"]
+    parent.dependencies = []
+    parent.contributors = ["Thomas Vaughan (Queen's)", "Gabor Fichtinger (Queen's)"]
+    parent.helpText = """
+    Tool calibrations computed from tracker samples as they arrive. The fixed point calibration keeps the samples in
+    arrays with a running mean and error, so the error is known while calibrating, and rejects outlying samples
+    (e.g. electromagnetic tracking glitches) before the final estimate. The pivot calibration keeps the normal equations
+    of the least-squares pivot problem up to date, so the tip and error can be shown while calibrating and the
+    calibration can stop as soon as the tip estimate has settled.
+    The calibrations are run from the CathNav calibration panel.
+    """
+    parent.acknowledgementText = """
+	This work is funded as a project in the Laboratory for Percutaneous Surgery, Queen's University, Kingston, Ontario. Thomas Vaughan is funded by an NSERC Postgraduate award. Gabor Fichtinger is funded as a Cancer Care Ontario (CCO) Chair.
+	""" # replace with organization, grant and thanks.
+    self.parent = parent
+
+#
+# ToolCalibrationWidget
+#
+
+class ToolCalibrationWidget(ScriptedLoadableModuleWidget):
+
+  def setup(self):
+    ScriptedLoadableModuleWidget.setup(self)
+
+    # Collapsible buttons
+    self.parametersCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.parametersCollapsibleButton.text = "ToolCalibration"
+    self.layout.addWidget(self.parametersCollapsibleButton)
+
+    # Layout within the collapsible button
+    self.parametersFormLayout = qt.QFormLayout(self.parametersCollapsibleButton)
+
+    # the tools are owned by CathNav, so there is nothing to set up here
+    self.usageLabel = qt.QLabel()
+    self.usageLabel.setText("Tools are calibrated from the CathNav calibration panel.")
+    self.usageLabel.setWordWrap(True)
+    self.parametersFormLayout.addRow(self.usageLabel)
+
+    # Add vertical spacer
+    self.layout.addStretch(1)
+
+#
+# ToolCalibrationLogic
+#
+
+class ToolCalibrationLogic(ScriptedLoadableModuleLogic):
+  # constants - DO NOT CHANGE THESE
+  robustSigmaPerMedianAbsoluteDeviation = 1.4826 # scales the median absolute deviation of normal data to its sigma
+
+  def __init__(self):
+    self.outlierThresholdSigmas = 3.0 # samples this many robust sigmas beyond the median distance are outliers
+    self.minimumOutlierThresholdMm = 0.5 # nothing closer than this to the estimate is an outlier, for very still tools
+    self.minimumInlierFraction = 0.5 # with fewer inliers there is no majority to trust, and nothing is rejected
+    self.maximumNumberOfTrimmingIterations = 5
+
+  def computeRobustFixedPoint(self, pointsMm):
+    """
+    Estimate the fixed point from samples of it (one per row of pointsMm) with outliers trimmed away.
+    Starting from the per-axis median, samples whose distance to the estimate is more than outlierThresholdSigmas robust
+    sigmas above the median distance are rejected and the estimate becomes the mean of the rest, until the inliers
+    stop changing. Returns a dictionary with the estimate ('pointMm'), the RMS distance of the inliers to it ('rmseMm'),
+    the inlier mask ('inliers'), 'numberOfInliers' and 'numberOfSamples', or None if there are no samples.
+    """
+    pointsMm = numpy.asarray(pointsMm, dtype=float)
+    numberOfSamples = pointsMm.shape[0]
+    if (numberOfSamples == 0):
+      return None
+    inliers = numpy.ones(numberOfSamples, dtype=bool)
+    pointMm = numpy.median(pointsMm, axis=0)
+    for iteration in xrange(self.maximumNumberOfTrimmingIterations):
+      distancesMm = numpy.sqrt(((pointsMm - pointMm) ** 2).sum(axis=1))
+      medianDistanceMm = numpy.median(distancesMm)
+      robustSigmaMm = self.robustSigmaPerMedianAbsoluteDeviation * numpy.median(numpy.abs(distancesMm - medianDistanceMm))
+      thresholdMm = max(medianDistanceMm + self.outlierThresholdSigmas * robustSigmaMm, self.minimumOutlierThresholdMm)
+      newInliers = distancesMm <= thresholdMm
+      if (newInliers.sum() < self.minimumInlierFraction * numberOfSamples):
+        newInliers[:] = True
+      pointMm = pointsMm[newInliers].mean(axis=0)
+      if (numpy.array_equal(newInliers, inliers) and iteration > 0):
+        break
+      inliers = newInliers
+    numberOfInliers = int(inliers.sum())
+    inlierOffsetsMm = pointsMm[inliers] - pointMm
+    rmseMm = math.sqrt((inlierOffsetsMm ** 2).sum() / numberOfInliers)
+    return { 'pointMm' : pointMm,
+             'rmseMm' : rmseMm,
+             'inliers' : inliers,
+             'numberOfInliers' : numberOfInliers,
+             'numberOfSamples' : numberOfSamples }
+
+#
+# TrackedCalibration
+#
+
+class TrackedCalibration(object):
+  """
+  Base of the calibrations that sample tracked transforms. The transform events of one tracker frame are coalesced into
+  a single call of sampleTransforms, which the subclasses implement along with reset and getObservedTransformNodes.
+  """
+
+  def __init__(self):
+    self.nodeObserverTags = []
+    self.samplePending = False
+
+  def start(self):
+    self.removeObservers()
+    self.reset()
+    observedTransformNodes = self.getObservedTransformNodes()
+    if (None in observedTransformNodes):
+      logging.error("A transform node for {0} is missing. No samples will be collected.".format(self.__class__.__name__))
+      return
+    self.addObservers(observedTransformNodes)
+
+  def stop(self):
+    self.removeObservers()
+
+  def addObservers(self, transformNodes):
+    # transformable nodes pass on the TransformModifiedEvents of their parents
+    transformModifiedEvent = slicer.vtkMRMLTransformableNode.TransformModifiedEvent
+    for transformNode in transformNodes:
+      self.nodeObserverTags.append([transformNode, transformNode.AddObserver(transformModifiedEvent, self.onTransformModified)])
+
+  def removeObservers(self):
+    for [node, observerTag] in self.nodeObserverTags:
+      node.RemoveObserver(observerTag)
+    self.nodeObserverTags = []
+
+  def onTransformModified(self, observer, eventid):
+    # no logging here, it is called for every tracker frame
+    if (self.samplePending == False):
+      self.samplePending = True
+      qt.QTimer.singleShot(0, self.onSample) # runs once the tracker frame has been processed
+
+  def onSample(self):
+    self.samplePending = False
+    if (not self.nodeObserverTags): # stopped since the frame arrived
+      return
+    self.sampleTransforms()
+
+#
+# FixedPointCalibration
+#
+
+class FixedPointCalibration(TrackedCalibration):
+  """
+  Collects the position of a pointer tip in the coordinates of a tool sensor while the pointer is held on a fixed point
+  of the tool. Samples go straight into an array, with a running (Welford) mean and sum of squared deviations so the
+  estimate and its RMSE are available at any time without a pass over the samples. The final calibration is computed
+  with outliers trimmed, see ToolCalibrationLogic.computeRobustFixedPoint.
+  """
+  # constants - DO NOT CHANGE THESE
+  initialSampleCapacity = 1024
+
+  def __init__(self, calibrationLogic):
+    TrackedCalibration.__init__(self)
+    self.calibrationLogic = calibrationLogic
+    self.pointTransformNode = None
+    self.referenceTransformNode = None
+    self.matrixPointToReference = vtk.vtkMatrix4x4() # reused for every sample
+    self.samplesMm = numpy.zeros([self.initialSampleCapacity,3])
+    self.reset()
+
+  def reset(self):
+    self.numberOfSamples = 0
+    self.meanMm = numpy.zeros(3)
+    self.sumOfSquaredDeviationsMm2 = 0.0
+
+  def setTransformNodes(self, pointTransformNode, referenceTransformNode):
+    # samples are the origin of pointTransformNode in referenceTransformNode coordinates
+    self.removeObservers()
+    self.pointTransformNode = pointTransformNode
+    self.referenceTransformNode = referenceTransformNode
+
+  def getObservedTransformNodes(self):
+    return [self.pointTransformNode, self.referenceTransformNode]
+
+  def sampleTransforms(self):
+    self.pointTransformNode.GetMatrixTransformToNode(self.referenceTransformNode, self.matrixPointToReference)
+    self.addSample([self.matrixPointToReference.GetElement(0,3), self.matrixPointToReference.GetElement(1,3), self.matrixPointToReference.GetElement(2,3)])
+
+  def addSample(self, pointMm):
+    if (self.numberOfSamples == self.samplesMm.shape[0]): # grow geometrically so appends stay O(1) amortized
+      self.samplesMm = numpy.concatenate([self.samplesMm, numpy.zeros(self.samplesMm.shape)])
+    self.samplesMm[self.numberOfSamples] = pointMm
+    self.numberOfSamples = self.numberOfSamples + 1
+    # Welford's update, stable however far the point is from the origin
+    deviationFromOldMeanMm = self.samplesMm[self.numberOfSamples - 1] - self.meanMm
+    self.meanMm = self.meanMm + deviationFromOldMeanMm / self.numberOfSamples
+    self.sumOfSquaredDeviationsMm2 = self.sumOfSquaredDeviationsMm2 + deviationFromOldMeanMm.dot(self.samplesMm[self.numberOfSamples - 1] - self.meanMm)
+
+  def getNumberOfSamples(self):
+    return self.numberOfSamples
+
+  def getSamplesMm(self):
+    # view of the collected samples, valid until the next sample
+    return self.samplesMm[:self.numberOfSamples]
+
+  def getMeanMm(self):
+    # mean of all the samples so far, None if there are none
+    if (self.numberOfSamples == 0):
+      return None
+    return self.meanMm.copy()
+
+  def getRMSEMm(self):
+    # RMS distance of all the samples so far to their mean, None if there are none
+    if (self.numberOfSamples == 0):
+      return None
+    return math.sqrt(self.sumOfSquaredDeviationsMm2 / self.numberOfSamples)
+
+  def computeCalibration(self):
+    # outlier-trimmed estimate of the samples so far, see ToolCalibrationLogic.computeRobustFixedPoint
+    return self.calibrationLogic.computeRobustFixedPoint(self.getSamplesMm())
+
+#
+# PivotCalibration
+#
+
+class PivotCalibration(TrackedCalibration):
+  """
+  Finds the tip of a tool swivelled about a fixed pivot, from the poses of the tool in a reference frame.
+  Every pose R, t gives three equations R * tip + t = pivot, linear in the tip and pivot. Only the sums that make up
+  the normal equations of the least-squares problem are kept, so a sample costs the same however many came before,
+  and the estimate and its RMSE can be solved for at any time. updateEstimate is meant to be called periodically,
+  and reports when the estimate has stopped moving (see isConverged).
+  """
+  # constants - DO NOT CHANGE THESE
+  numberOfUnknowns = 6 # tip in tool coordinates, pivot in reference coordinates
+
+  def __init__(self):
+    TrackedCalibration.__init__(self)
+    self.toolToReferenceTransformNode = None
+    self.minimumNumberOfSamples = 30
+    self.minimumRotationSpread = 0.01 # of the normal matrix over the samples, small if the tool was hardly swivelled
+    self.convergenceToleranceMm = 0.2 # largest tip movement between updates for the estimate to count as converged
+    self.numberOfStableUpdatesForConvergence = 3
+    self.matrixToolToReference = vtk.vtkMatrix4x4() # reused for every sample
+    self.reset()
+
+  def reset(self):
+    self.numberOfSamples = 0
+    self.originMm = None # translations are taken relative to the first one, which keeps the sums small
+    self.sumOfRotations = numpy.zeros([3,3])
+    self.sumOfRotatedTranslationsMm = numpy.zeros(3) # sum of R^T t
+    self.sumOfTranslationsMm = numpy.zeros(3)
+    self.sumOfSquaredTranslationsMm2 = 0.0
+    self.tipMm = None
+    self.pivotMm = None
+    self.rmseMm = None
+    self.numberOfStableUpdates = 0
+
+  def setTransformNode(self, toolToReferenceTransformNode):
+    # samples are the transforms of toolToReferenceTransformNode to its parent
+    self.removeObservers()
+    self.toolToReferenceTransformNode = toolToReferenceTransformNode
+
+  def getObservedTransformNodes(self):
+    return [self.toolToReferenceTransformNode]
+
+  def sampleTransforms(self):
+    self.toolToReferenceTransformNode.GetMatrixTransformToParent(self.matrixToolToReference)
+    matrix = self.matrixToolToReference
+    self.addSample([[matrix.GetElement(row,column) for column in xrange(3)] for row in xrange(3)],
+                   [matrix.GetElement(0,3), matrix.GetElement(1,3), matrix.GetElement(2,3)])
+
+  def addSample(self, rotation, translationMm):
+    rotation = numpy.asarray(rotation, dtype=float)
+    translationMm = numpy.asarray(translationMm, dtype=float)
+    if (self.originMm is None):
+      self.originMm = translationMm
+    translationMm = translationMm - self.originMm
+    self.numberOfSamples = self.numberOfSamples + 1
+    self.sumOfRotations += rotation
+    self.sumOfRotatedTranslationsMm += rotation.T.dot(translationMm)
+    self.sumOfTranslationsMm += translationMm
+    self.sumOfSquaredTranslationsMm2 += translationMm.dot(translationMm)
+
+  def getNumberOfSamples(self):
+    return self.numberOfSamples
+
+  def getNormalEquations(self):
+    # A^T A and A^T b of the stacked equations [R -I] [tip; pivot] = -t
+    normalMatrix = numpy.empty([self.numberOfUnknowns, self.numberOfUnknowns])
+    normalMatrix[0:3,0:3] = self.numberOfSamples * numpy.eye(3)
+    normalMatrix[0:3,3:6] = -self.sumOfRotations.T
+    normalMatrix[3:6,0:3] = -self.sumOfRotations
+    normalMatrix[3:6,3:6] = self.numberOfSamples * numpy.eye(3)
+    normalVector = numpy.concatenate([-self.sumOfRotatedTranslationsMm, self.sumOfTranslationsMm])
+    return normalMatrix, normalVector
+
+  def getRotationSpread(self):
+    # smallest eigenvalue of the normal matrix per sample: 0 if the tool never rotated, so the tip is undetermined
+    if (self.numberOfSamples == 0):
+      return 0.0
+    normalMatrix, normalVector = self.getNormalEquations()
+    return numpy.linalg.eigvalsh(normalMatrix / self.numberOfSamples)[0]
+
+  def updateEstimate(self):
+    """
+    Solve for the tip and pivot from the samples so far. Returns False, leaving the estimate None, if there are too few
+    samples or the tool has not been swivelled enough to determine the tip.
+    """
+    if (self.numberOfSamples < self.minimumNumberOfSamples or self.getRotationSpread() < self.minimumRotationSpread):
+      self.tipMm = None
+      self.pivotMm = None
+      self.rmseMm = None
+      self.numberOfStableUpdates = 0
+      return False
+    normalMatrix, normalVector = self.getNormalEquations()
+    solution = numpy.linalg.solve(normalMatrix, normalVector)
+    # sum of squared residuals |A x - b|^2 = x^T A^T A x - 2 x^T A^T b + b^T b
+    sumOfSquaredResidualsMm2 = solution.dot(normalMatrix).dot(solution) - 2 * solution.dot(normalVector) + self.sumOfSquaredTranslationsMm2
+    if (self.tipMm is not None and numpy.linalg.norm(solution[0:3] - self.tipMm) < self.convergenceToleranceMm):
+      self.numberOfStableUpdates = self.numberOfStableUpdates + 1
+    else:
+      self.numberOfStableUpdates = 0
+    self.tipMm = solution[0:3]
+    self.pivotMm = solution[3:6] + self.originMm
+    self.rmseMm = math.sqrt(max(sumOfSquaredResidualsMm2, 0.0) / self.numberOfSamples)
+    return True
+
+  def isConverged(self):
+    # the tip estimate moved less than convergenceToleranceMm over the last numberOfStableUpdatesForConvergence updates
+    return (self.tipMm is not None and self.numberOfStableUpdates >= self.numberOfStableUpdatesForConvergence)
+
+  def getToolTipToToolMatrix(self, toolTipToToolMatrix):
+    # translation to the tip, rotation left as identity
+    toolTipToToolMatrix.Identity()
+    for axis in xrange(3):
+      toolTipToToolMatrix.SetElement(axis, 3, self.tipMm[axis])
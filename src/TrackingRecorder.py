@@ -0,0 +1,503 @@
+from __main__ import vtk, qt, ctk, slicer
+from slicer.ScriptedLoadableModule import *
+import logging
+import numpy
+import os
+import Queue
+import threading
+import time
+
+#
+# TrackingRecorder
+#
+
+class TrackingRecorder(ScriptedLoadableModule):
+  def __init__(self, parent):
+    parent.title = "TrackingRecorder"
+    parent.categories = ["IGT"]
+    parent.dependencies = []
+    parent.contributors = ["Thomas Vaughan (Queen's)", "Gabor Fichtinger (Queen's)"]
+    parent.helpText = """
+    Record every update of the observed transforms, with a timestamp, to a memory-mapped binary file.
+    Recordings can be replayed into the transform nodes with the same names, in real time, faster, or as fast as possible.
+    """
+    parent.acknowledgementText = """
+	This work is funded as a project in the Laboratory for Percutaneous Surgery, Queen's University, Kingston, Ontario. Thomas Vaughan is funded by an NSERC Postgraduate award. Gabor Fichtinger is funded as a Cancer Care Ontario (CCO) Chair.
+	""" # replace with organization, grant and thanks.
+    self.parent = parent
+
+#
+# TrackingRecorderWidget
+#
+
+class TrackingRecorderWidget(ScriptedLoadableModuleWidget):
+
+  def setup(self):
+    ScriptedLoadableModuleWidget.setup(self)
+
+    self.logic = TrackingRecorderLogic()
+
+    # Collapsible buttons
+    self.parametersCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.parametersCollapsibleButton.text = "TrackingRecorder"
+    self.layout.addWidget(self.parametersCollapsibleButton)
+
+    # Layout within the collapsible button
+    self.parametersFormLayout = qt.QFormLayout(self.parametersCollapsibleButton)
+
+    # Transforms to record
+    self.transformNodesLabel = qt.QLabel()
+    self.transformNodesLabel.setText("Transform nodes: ")
+    self.transformNodesSelector = slicer.qMRMLCheckableNodeComboBox()
+    self.transformNodesSelector.nodeTypes = ( ("vtkMRMLLinearTransformNode"), "" )
+    self.transformNodesSelector.setMRMLScene( slicer.mrmlScene )
+    self.transformNodesSelector.setToolTip("Pick the transforms to record")
+    self.parametersFormLayout.addRow(self.transformNodesLabel, self.transformNodesSelector)
+
+    # Output file
+    self.filePathLabel = qt.QLabel()
+    self.filePathLabel.setText("Recording file: ")
+    self.filePathEdit = ctk.ctkPathLineEdit()
+    self.filePathEdit.filters = ctk.ctkPathLineEdit.Files | ctk.ctkPathLineEdit.Writable
+    self.filePathEdit.nameFilters = ["Tracking recording (*" + TrackingRecorderLogic.recordingFileExtension + ")"]
+    self.parametersFormLayout.addRow(self.filePathLabel, self.filePathEdit)
+
+    self.recordButton = qt.QPushButton()
+    self.recordButton.text = "Start Recording"
+    self.recordButton.setCheckable(True)
+    self.parametersFormLayout.addRow(self.recordButton)
+
+    # Replay
+    self.replayCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.replayCollapsibleButton.text = "Replay"
+    self.layout.addWidget(self.replayCollapsibleButton)
+    self.replayFormLayout = qt.QFormLayout(self.replayCollapsibleButton)
+
+    self.replayFilePathLabel = qt.QLabel()
+    self.replayFilePathLabel.setText("Recording file: ")
+    self.replayFilePathEdit = ctk.ctkPathLineEdit()
+    self.replayFilePathEdit.filters = ctk.ctkPathLineEdit.Files | ctk.ctkPathLineEdit.Readable
+    self.replayFilePathEdit.nameFilters = ["Tracking recording (*" + TrackingRecorderLogic.recordingFileExtension + ")"]
+    self.replayFormLayout.addRow(self.replayFilePathLabel, self.replayFilePathEdit)
+
+    self.replaySpeedLabel = qt.QLabel()
+    self.replaySpeedLabel.setText("Speed: ")
+    self.replaySpeedSpinBox = qt.QDoubleSpinBox()
+    self.replaySpeedSpinBox.minimum = 0
+    self.replaySpeedSpinBox.maximum = 100
+    self.replaySpeedSpinBox.value = 1
+    self.replaySpeedSpinBox.suffix = "x"
+    self.replaySpeedSpinBox.specialValueText = "As fast as possible" # shown for 0
+    self.replayFormLayout.addRow(self.replaySpeedLabel, self.replaySpeedSpinBox)
+
+    self.replayButton = qt.QPushButton()
+    self.replayButton.text = "Start Replay"
+    self.replayButton.setCheckable(True)
+    self.replayFormLayout.addRow(self.replayButton)
+
+    self.replayLatencyLabel = qt.QLabel()
+    self.replayFormLayout.addRow(self.replayLatencyLabel)
+
+    self.replayLogic = TrackingReplayLogic()
+    self.replayLogic.setReplayFinishedCallback(self.onReplayFinished)
+
+    self.recordButton.connect('clicked(bool)', self.recordButtonClicked)
+    self.replayButton.connect('clicked(bool)', self.replayButtonClicked)
+
+    # Add vertical spacer
+    self.layout.addStretch(1)
+
+  def recordButtonClicked(self, checked):
+    logging.debug('recordButtonClicked')
+    if (checked):
+      self.logic.startRecording(self.filePathEdit.currentPath, self.transformNodesSelector.checkedNodes())
+      self.recordButton.text = "Stop Recording"
+    else:
+      if (not self.logic.stopRecording()):
+        slicer.util.errorDisplay("The tracking recording could not be written completely: {0}".format(self.logic.writerError))
+      self.recordButton.text = "Start Recording"
+
+  def replayButtonClicked(self, checked):
+    logging.debug('replayButtonClicked')
+    if (checked):
+      self.replayLogic.setRecording(TrackingRecording(self.replayFilePathEdit.currentPath))
+      self.replayLogic.setReplaySpeed(self.replaySpeedSpinBox.value)
+      self.replayLogic.startReplay()
+      self.replayButton.text = "Stop Replay"
+    else:
+      self.replayLogic.stopReplay()
+
+  def onReplayFinished(self):
+    self.replayButton.checked = False
+    self.replayButton.text = "Start Replay"
+    latencyStatistics = self.replayLogic.getLatencyStatistics()
+    self.replayLatencyLabel.setText("{numberOfFrames} frames, latency median {medianSec:.4f} s, 95th percentile {percentile95Sec:.4f} s, max {maximumSec:.4f} s".format(**latencyStatistics))
+
+#
+# TrackingRecorderLogic
+#
+
+class TrackingRecorderLogic(ScriptedLoadableModuleLogic):
+  """
+  Records the ToParent matrix of each observed transform node every time it is modified.
+  The observer only timestamps the matrix and queues it, a writer thread copies the queued samples
+  into the memory-mapped file, so the Qt thread never waits for the disk.
+  """
+  # constants - DO NOT CHANGE THESE
+  recordingFileExtension = '.trk'
+  fileMagic = 'CNTRKREC'
+  fileVersion = 1
+  headerSizeBytes = 4096
+  # 'streamNames' pads the header to headerSizeBytes, the names are separated by newlines
+  headerDtype = numpy.dtype([('magic', 'S8'), ('version', '<u4'), ('headerSizeBytes', '<u4'),
+                             ('recordCapacity', '<u8'), ('numberOfRecords', '<u8'), ('streamNames', 'S4064')])
+  recordDtype = numpy.dtype([('timestampSec', '<f8'), ('streamIndex', '<i4'), ('reserved', '<i4'), ('matrix', '<f8', (4,4))])
+  transformModifiedEvent = 15000
+
+  def __init__(self):
+    self.filePath = None
+    self.transformNodes = []
+    self.streamIndexByNodeID = {}
+    self.transformNodeObserverTags = []
+    self.currentlyRecording = False
+    self.matrixToParent = vtk.vtkMatrix4x4() # reused for every sample
+    self.sampleQueue = None
+    self.writerThread = None
+    self.headerMap = None
+    self.recordsMap = None
+    self.numberOfRecords = 0
+    self.fileFlushIntervalSec = 1.0
+    self.writerFailed = False # set by the writer thread if the file could not be written, see writeSamples
+    self.writerError = None
+
+  def startRecording(self, filePath, transformNodes, expectedDurationSec=60, expectedRateHz=50, observeTransformNodes=True):
+    """
+    Start recording the given transform nodes to filePath. The file is preallocated for the expected duration
+    and update rate of every stream, and doubles in the writer thread whenever the recording runs longer.
+    If observeTransformNodes is False, samples are only recorded by calling recordSample.
+    """
+    logging.debug('startRecording')
+    if (self.currentlyRecording):
+      self.stopRecording()
+    if (not filePath or len(transformNodes) == 0):
+      logging.warning("A recording file and at least one transform node are needed. Nothing will be recorded.")
+      return False
+    self.filePath = filePath
+    self.transformNodes = list(transformNodes)
+    self.streamIndexByNodeID = {}
+    for streamIndex, transformNode in enumerate(self.transformNodes):
+      self.streamIndexByNodeID[transformNode.GetID()] = streamIndex
+
+    recordCapacity = max(1, int(len(self.transformNodes) * expectedRateHz * expectedDurationSec))
+    self.headerMap = numpy.memmap(self.filePath, dtype=self.headerDtype, mode='w+', shape=(1,))
+    self.headerMap['magic'] = self.fileMagic
+    self.headerMap['version'] = self.fileVersion
+    self.headerMap['headerSizeBytes'] = self.headerSizeBytes
+    self.headerMap['streamNames'] = '\n'.join([transformNode.GetName() for transformNode in self.transformNodes])
+    self.numberOfRecords = 0
+    self.resizeRecords(recordCapacity)
+
+    self.sampleQueue = Queue.Queue()
+    self.writerFailed = False
+    self.writerError = None
+    self.writerThread = threading.Thread(target=self.writeSamples)
+    self.writerThread.daemon = True
+    self.writerThread.start()
+    self.currentlyRecording = True
+    if (not observeTransformNodes):
+      return True
+    for transformNode in self.transformNodes:
+      self.transformNodeObserverTags.append([transformNode, transformNode.AddObserver(self.transformModifiedEvent, self.onTransformModified)])
+    return True
+
+  def stopRecording(self):
+    """
+    Stop recording and finish the file. Returns False if the file could not be written completely.
+    """
+    logging.debug('stopRecording')
+    if (not self.currentlyRecording):
+      return True
+    self.removeObservers()
+    self.currentlyRecording = False
+    self.sampleQueue.put(None) # the writer thread stops after writing everything queued before this
+    self.writerThread.join()
+    self.writerThread = None
+    self.sampleQueue = None # drops the samples a failed writer left behind
+    if (not self.writerFailed):
+      try:
+        self.resizeRecords(self.numberOfRecords) # drop the unused preallocated space
+        self.headerMap.flush()
+      except EnvironmentError as error:
+        self.writerFailed = True
+        self.writerError = error
+    elif (self.headerMap is not None):
+      self.headerMap['numberOfRecords'] = self.numberOfRecords # keep what was written before the failure readable
+    try:
+      self.closeMap(self.recordsMap)
+      self.closeMap(self.headerMap)
+    except EnvironmentError:
+      pass # the failure, if any, is reported below
+    self.recordsMap = None
+    self.headerMap = None
+    if (self.writerFailed):
+      logging.error("Recording to {0} failed, the file holds at most {1} transform samples: {2}".format(self.filePath, self.numberOfRecords, self.writerError))
+      return False
+    logging.info("Recorded {0} transform samples to {1}".format(self.numberOfRecords, self.filePath))
+    return True
+
+  def removeObservers(self):
+    for nodeTagPair in self.transformNodeObserverTags:
+      nodeTagPair[0].RemoveObserver(nodeTagPair[1])
+    self.transformNodeObserverTags = []
+
+  def onTransformModified(self, caller, eventid):
+    # no logging here, this runs for every tracker update
+    self.recordSample(caller, time.time())
+
+  def recordSample(self, transformNode, timestampSec):
+    if (self.writerFailed):
+      # nothing would reach the file, stop queueing samples until stopRecording reports the failure
+      self.removeObservers()
+      return
+    transformNode.GetMatrixTransformToParent(self.matrixToParent)
+    elements = [self.matrixToParent.GetElement(row, column) for row in xrange(4) for column in xrange(4)]
+    self.sampleQueue.put((timestampSec, self.streamIndexByNodeID[transformNode.GetID()], elements))
+
+  def writeSamples(self):
+    try:
+      self.writeQueuedSamples()
+    except Exception as error: # e.g. a full disk, the thread would otherwise end silently
+      logging.error("Writing the tracking recording {0} failed: {1}".format(self.filePath, error))
+      self.writerError = error
+      self.writerFailed = True
+
+  def writeQueuedSamples(self):
+    lastFlushTimeSec = time.time()
+    stopping = False
+    while (not stopping):
+      samples = [self.sampleQueue.get()] # wait for the first sample, then take everything else that is queued
+      try:
+        while True:
+          samples.append(self.sampleQueue.get_nowait())
+      except Queue.Empty:
+        pass
+      if (None in samples):
+        stopping = True
+        samples = samples[:samples.index(None)]
+      if (len(samples) > 0):
+        self.appendRecords(samples)
+      if (stopping or time.time() - lastFlushTimeSec >= self.fileFlushIntervalSec):
+        self.recordsMap.flush()
+        self.headerMap['numberOfRecords'] = self.numberOfRecords # only counts records that are on disk
+        self.headerMap.flush()
+        lastFlushTimeSec = time.time()
+
+  def appendRecords(self, samples):
+    numberOfSamples = len(samples)
+    if (self.numberOfRecords + numberOfSamples > self.recordsMap.shape[0]):
+      self.resizeRecords(max(2 * self.recordsMap.shape[0], self.numberOfRecords + numberOfSamples))
+    records = self.recordsMap[self.numberOfRecords:self.numberOfRecords + numberOfSamples]
+    records['timestampSec'] = [sample[0] for sample in samples]
+    records['streamIndex'] = [sample[1] for sample in samples]
+    records['matrix'] = numpy.array([sample[2] for sample in samples]).reshape(numberOfSamples, 4, 4)
+    self.numberOfRecords = self.numberOfRecords + numberOfSamples
+
+  def resizeRecords(self, recordCapacity):
+    # Windows cannot resize a file while any part of it is mapped, so both maps are closed first and mapped again after
+    self.closeMap(self.recordsMap)
+    self.recordsMap = None
+    self.closeMap(self.headerMap)
+    self.headerMap = None
+    recordCapacity = max(recordCapacity, 1) # numpy cannot map an empty region
+    with open(self.filePath, 'r+b') as recordingFile:
+      recordingFile.truncate(self.headerSizeBytes + recordCapacity * self.recordDtype.itemsize)
+    self.headerMap = numpy.memmap(self.filePath, dtype=self.headerDtype, mode='r+', shape=(1,))
+    self.recordsMap = numpy.memmap(self.filePath, dtype=self.recordDtype, mode='r+', offset=self.headerSizeBytes, shape=(recordCapacity,))
+    self.headerMap['recordCapacity'] = recordCapacity
+
+  def closeMap(self, memoryMap):
+    # numpy only unmaps the file when the array is garbage collected, which may be later than the resize
+    if (memoryMap is None):
+      return
+    memoryMap.flush()
+    if (memoryMap._mmap is not None):
+      memoryMap._mmap.close()
+
+  def getDefaultRecordingFilePath(self, directory, filenamePrefix):
+    if (not os.path.exists(directory)):
+      os.makedirs(directory)
+    return os.path.join(directory, filenamePrefix + time.strftime("%Y%m%d-%H%M%S") + self.recordingFileExtension)
+
+#
+# TrackingRecording
+#
+
+class TrackingRecording(object):
+  """
+  Read access to a file written by TrackingRecorderLogic. The records are memory-mapped,
+  so opening is instant and only the parts that are used are read from disk.
+  """
+
+  def __init__(self, filePath):
+    self.filePath = filePath
+    header = numpy.fromfile(filePath, dtype=TrackingRecorderLogic.headerDtype, count=1)
+    if (len(header) == 0 or header['magic'][0] != TrackingRecorderLogic.fileMagic):
+      raise ValueError("{0} is not a tracking recording".format(filePath))
+    if (header['version'][0] > TrackingRecorderLogic.fileVersion):
+      raise ValueError("{0} was written by a newer version of TrackingRecorder".format(filePath))
+    self.streamNames = header['streamNames'][0].split('\n')
+    self.numberOfRecords = int(header['numberOfRecords'][0])
+    self.records = numpy.memmap(filePath, dtype=TrackingRecorderLogic.recordDtype, mode='r',
+                                offset=int(header['headerSizeBytes'][0]), shape=(max(self.numberOfRecords, 1),))[:self.numberOfRecords]
+    self.recordIndicesByStream = {}
+
+  def getStreamNames(self):
+    return self.streamNames
+
+  def getNumberOfRecords(self):
+    return self.numberOfRecords
+
+  def getDurationSec(self):
+    if (self.numberOfRecords == 0):
+      return 0
+    return self.records['timestampSec'][-1] - self.records['timestampSec'][0]
+
+  def getStreamRecordIndices(self, streamName):
+    # indices into self.records, in recording order
+    streamIndex = self.streamNames.index(streamName)
+    if (streamIndex not in self.recordIndicesByStream):
+      self.recordIndicesByStream[streamIndex] = numpy.flatnonzero(self.records['streamIndex'] == streamIndex)
+    return self.recordIndicesByStream[streamIndex]
+
+  def getStreamTimestampsSec(self, streamName):
+    return self.records['timestampSec'][self.getStreamRecordIndices(streamName)]
+
+  def getStreamMatrices(self, streamName):
+    return self.records['matrix'][self.getStreamRecordIndices(streamName)]
+
+#
+# TrackingReplayLogic
+#
+
+class TrackingReplayLogic(ScriptedLoadableModuleLogic):
+  """
+  Plays a TrackingRecording back into transform nodes, standing in for the tracker's OpenIGTLink server.
+  Records closer together than frameGroupingToleranceSec form one tracker frame and are applied together.
+  The latency of a frame is the time from applying its first transform until every observer, including
+  work deferred to the event loop with a zero timer, has run.
+  """
+  # constants - DO NOT CHANGE THESE
+  replaySpeedAsFastAsPossible = 0
+  frameGroupingToleranceSec = 0.005
+
+  def __init__(self):
+    self.recording = None
+    self.replaySpeed = 1.0
+    self.transformNodes = [] # indexed by stream index
+    self.frameStartRecordIndices = numpy.zeros(1, dtype=numpy.int64) # one extra entry, the end of the last frame
+    self.currentFrameIndex = 0
+    self.currentlyReplaying = False
+    self.replayStartTimeSec = 0
+    self.frameStartTimeSec = 0
+    self.frameLatenciesSec = numpy.zeros(0)
+    self.matrixToParent = vtk.vtkMatrix4x4() # reused for every sample
+    self.replayFinishedCallback = None
+
+  def setRecording(self, recording):
+    logging.debug('setRecording')
+    self.recording = recording
+    timestampsSec = recording.records['timestampSec']
+    frameBreaks = numpy.flatnonzero(numpy.diff(timestampsSec) > self.frameGroupingToleranceSec) + 1
+    self.frameStartRecordIndices = numpy.concatenate([[0], frameBreaks, [recording.getNumberOfRecords()]]).astype(numpy.int64)
+    if (recording.getNumberOfRecords() == 0):
+      self.frameStartRecordIndices = numpy.zeros(1, dtype=numpy.int64)
+
+  def setReplaySpeed(self, replaySpeed):
+    # 1 is real time, 0 (replaySpeedAsFastAsPossible) replays the next frame as soon as the previous one is processed
+    logging.debug('setReplaySpeed')
+    self.replaySpeed = replaySpeed
+
+  def setReplayFinishedCallback(self, callback):
+    self.replayFinishedCallback = callback
+
+  def getNumberOfFrames(self):
+    return len(self.frameStartRecordIndices) - 1
+
+  def startReplay(self, nodeByStreamName=None):
+    """
+    Replay the recording into the transform nodes named like the recorded streams, or into the nodes
+    given in nodeByStreamName. Missing nodes are created, so replay also works in an empty scene.
+    """
+    logging.debug('startReplay')
+    if (self.recording is None or self.getNumberOfFrames() == 0):
+      logging.warning("There is no recording to replay")
+      return False
+    self.transformNodes = []
+    for streamName in self.recording.getStreamNames():
+      transformNode = nodeByStreamName.get(streamName) if nodeByStreamName else None
+      if (not transformNode):
+        transformNode = slicer.mrmlScene.GetFirstNodeByName(streamName)
+      if (not transformNode):
+        transformNode = slicer.vtkMRMLLinearTransformNode()
+        transformNode.SetName(streamName)
+        slicer.mrmlScene.AddNode(transformNode)
+      self.transformNodes.append(transformNode)
+    self.frameLatenciesSec = numpy.zeros(self.getNumberOfFrames())
+    self.currentFrameIndex = 0
+    self.currentlyReplaying = True
+    self.replayStartTimeSec = time.time()
+    self.replayFrame()
+    return True
+
+  def stopReplay(self):
+    logging.debug('stopReplay')
+    if (not self.currentlyReplaying):
+      return
+    self.currentlyReplaying = False
+    self.frameLatenciesSec = self.frameLatenciesSec[:self.currentFrameIndex]
+    if (self.replayFinishedCallback):
+      self.replayFinishedCallback()
+
+  def replayFrame(self):
+    if (not self.currentlyReplaying):
+      return
+    self.frameStartTimeSec = time.time()
+    records = self.recording.records[self.frameStartRecordIndices[self.currentFrameIndex]:self.frameStartRecordIndices[self.currentFrameIndex + 1]]
+    for streamIndex, matrix in zip(records['streamIndex'], records['matrix']):
+      self.matrixToParent.DeepCopy(matrix.ravel().tolist())
+      self.transformNodes[streamIndex].SetMatrixTransformToParent(self.matrixToParent)
+    qt.QTimer.singleShot(0, self.onFrameProcessed) # runs after the zero timers the observers started
+
+  def onFrameProcessed(self):
+    if (not self.currentlyReplaying):
+      return
+    self.frameLatenciesSec[self.currentFrameIndex] = time.time() - self.frameStartTimeSec
+    self.currentFrameIndex = self.currentFrameIndex + 1
+    if (self.currentFrameIndex >= self.getNumberOfFrames()):
+      self.stopReplay()
+      return
+    delayMs = 0
+    if (self.replaySpeed != self.replaySpeedAsFastAsPossible):
+      timestampsSec = self.recording.records['timestampSec']
+      frameOffsetSec = (timestampsSec[self.frameStartRecordIndices[self.currentFrameIndex]] - timestampsSec[0]) / self.replaySpeed
+      delayMs = max(0, int(1000 * (self.replayStartTimeSec + frameOffsetSec - time.time())))
+    qt.QTimer.singleShot(delayMs, self.replayFrame)
+
+  def waitForReplay(self, timeoutSec=None):
+    # for scripts and tests without a running event loop
+    stopTimeSec = (time.time() + timeoutSec) if timeoutSec else None
+    while (self.currentlyReplaying):
+      if (stopTimeSec and time.time() > stopTimeSec):
+        self.stopReplay()
+        break
+      slicer.app.processEvents()
+
+  def getLatencyStatistics(self):
+    latenciesSec = self.frameLatenciesSec[:self.currentFrameIndex] if self.currentlyReplaying else self.frameLatenciesSec
+    if (len(latenciesSec) == 0):
+      return { 'numberOfFrames' : 0, 'meanSec' : 0, 'medianSec' : 0, 'percentile95Sec' : 0, 'maximumSec' : 0 }
+    return { 'numberOfFrames' : len(latenciesSec),
+             'meanSec' : float(numpy.mean(latenciesSec)),
+             'medianSec' : float(numpy.median(latenciesSec)),
+             'percentile95Sec' : float(numpy.percentile(latenciesSec, 95)),
+             'maximumSec' : float(numpy.max(latenciesSec)) }
@@ -0,0 +1,201 @@
+from __main__ import vtk, qt, ctk, slicer
+from slicer.ScriptedLoadableModule import *
+import logging
+import numpy
+
+#
+# TransformGraph
+#
+
+class TransformGraph(ScriptedLoadableModule):
+  def __init__(self, parent):
+    parent.title = "TransformGraph"
+    parent.categories = ["IGT"]
+    parent.dependencies = []
+    parent.contributors = ["Thomas Vaughan (Queen's)", "Gabor Fichtinger (Queen's)"]
+    parent.helpText = """
+    Matrices between any two linear transform nodes, cached. The graph mirrors the part of the transform hierarchy it
+    is asked about and keeps a version number per node. A query for a pair whose chains have not changed is a dictionary
+    lookup, and a tracker update only invalidates the nodes below the transform that changed.
+    It is used by CathNav, CollectFiducialsSupplement and TipToSurfaceDistance for their per-frame queries.
+    """
+    parent.acknowledgementText = """
+	This work is funded as a project in the Laboratory for Percutaneous Surgery, Queen's University, Kingston, Ontario. Thomas Vaughan is funded by an NSERC Postgraduate award. Gabor Fichtinger is funded as a Cancer Care Ontario (CCO) Chair.
+	""" # replace with organization, grant and thanks.
+    self.parent = parent
+
+#
+# TransformGraphWidget
+#
+
+class TransformGraphWidget(ScriptedLoadableModuleWidget):
+
+  def setup(self):
+    ScriptedLoadableModuleWidget.setup(self)
+
+    # Collapsible buttons
+    self.parametersCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.parametersCollapsibleButton.text = "TransformGraph"
+    self.layout.addWidget(self.parametersCollapsibleButton)
+
+    # Layout within the collapsible button
+    self.parametersFormLayout = qt.QFormLayout(self.parametersCollapsibleButton)
+
+    # the graph is built by the modules that query it, so there is nothing to set up here
+    self.usageLabel = qt.QLabel()
+    self.usageLabel.setText("The transform graph is used by other modules, it has no settings of its own.")
+    self.usageLabel.setWordWrap(True)
+    self.parametersFormLayout.addRow(self.usageLabel)
+
+    # Add vertical spacer
+    self.layout.addStretch(1)
+
+#
+# CachedTransformGraph
+#
+
+class CachedTransformGraph(object):
+  """
+  Answers GetMatrixTransformToNode-style queries between linear transform nodes from cached numpy matrices.
+  Nodes are added with their parents the first time they are queried, and observed from then on. An event only marks
+  its node as modified; before the next query the modified nodes whose own matrix or parent really changed (events are
+  also passed down to the children of a changed node) bump the version of their subtree. The to-world matrix of a node
+  and the matrix of a pair are recomputed only if the versions they were computed from are out of date.
+  Returned matrices are shared with the cache and must not be modified. None stands for the world (RAS) coordinates.
+  Queries see the events that have been handled, so make them after the tracker frame, not from a transform observer.
+  """
+  # constants - DO NOT CHANGE THESE
+  worldNodeID = None
+
+  def __init__(self):
+    self.nodeObserverTags = []
+    self.clear()
+
+  def clear(self):
+    # forget every node, e.g. when the scene is closed
+    self.removeObservers()
+    self.nodes = {} # by node ID
+    self.nodeParentIDs = { self.worldNodeID : None }
+    self.nodeChildIDs = { self.worldNodeID : [] }
+    self.nodeVersions = { self.worldNodeID : 0 } # bumped whenever the node or one of its parents changes
+    self.nodeMatricesToParent = {}
+    self.nodeMatricesToWorld = { self.worldNodeID : (0, numpy.eye(4)) } # (version, matrix)
+    self.nodeMatricesFromWorld = { self.worldNodeID : (0, numpy.eye(4)) } # (version, inverse matrix)
+    self.pairMatrices = {} # by (source ID, target ID): (source version, target version, matrix)
+    self.modifiedNodeIDs = set()
+    self.matrixToParent = vtk.vtkMatrix4x4() # reused for every read
+    self.numberOfQueries = 0
+    self.numberOfCacheHits = 0
+
+  def addTransformNode(self, transformNode):
+    # mirror transformNode and its parents, it is not needed before querying
+    if (transformNode is None):
+      return self.worldNodeID
+    nodeID = transformNode.GetID()
+    if (nodeID in self.nodes):
+      return nodeID
+    parentID = self.addTransformNode(transformNode.GetParentTransformNode())
+    self.nodes[nodeID] = transformNode
+    self.nodeParentIDs[nodeID] = parentID
+    self.nodeChildIDs[nodeID] = []
+    self.nodeChildIDs[parentID].append(nodeID)
+    self.nodeVersions[nodeID] = 0
+    self.nodeMatricesToParent[nodeID] = self.readMatrixToParent(transformNode)
+    # transformable nodes pass on the TransformModifiedEvents of their parents
+    transformModifiedEvent = slicer.vtkMRMLTransformableNode.TransformModifiedEvent
+    self.nodeObserverTags.append([transformNode, transformNode.AddObserver(transformModifiedEvent, self.onTransformModified)])
+    return nodeID
+
+  def removeObservers(self):
+    for [node, observerTag] in self.nodeObserverTags:
+      node.RemoveObserver(observerTag)
+    self.nodeObserverTags = []
+
+  def onTransformModified(self, observer, eventid):
+    # no logging here, it is called for every tracker frame
+    self.modifiedNodeIDs.add(observer.GetID())
+
+  def readMatrixToParent(self, transformNode):
+    transformNode.GetMatrixTransformToParent(self.matrixToParent)
+    return numpy.array([[self.matrixToParent.GetElement(row,column) for column in xrange(4)] for row in xrange(4)])
+
+  def updateModifiedNodes(self):
+    if (not self.modifiedNodeIDs):
+      return
+    modifiedNodeIDs = self.modifiedNodeIDs
+    self.modifiedNodeIDs = set()
+    for nodeID in modifiedNodeIDs:
+      transformNode = self.nodes[nodeID]
+      parentID = self.addTransformNode(transformNode.GetParentTransformNode())
+      matrixToParent = self.readMatrixToParent(transformNode)
+      if (parentID != self.nodeParentIDs[nodeID]):
+        self.nodeChildIDs[self.nodeParentIDs[nodeID]].remove(nodeID)
+        self.nodeChildIDs[parentID].append(nodeID)
+        self.nodeParentIDs[nodeID] = parentID
+      elif (numpy.array_equal(matrixToParent, self.nodeMatricesToParent[nodeID])):
+        continue # only passed on from a parent, which bumps this subtree itself
+      self.nodeMatricesToParent[nodeID] = matrixToParent
+      self.invalidateSubtree(nodeID)
+
+  def invalidateSubtree(self, nodeID):
+    nodeIDs = [nodeID]
+    while nodeIDs:
+      nodeID = nodeIDs.pop()
+      self.nodeVersions[nodeID] = self.nodeVersions[nodeID] + 1
+      nodeIDs.extend(self.nodeChildIDs[nodeID])
+
+  def getMatrixToWorldByID(self, nodeID):
+    version = self.nodeVersions[nodeID]
+    (cachedVersion, matrixToWorld) = self.nodeMatricesToWorld.get(nodeID, (None, None))
+    if (cachedVersion != version):
+      matrixToWorld = self.getMatrixToWorldByID(self.nodeParentIDs[nodeID]).dot(self.nodeMatricesToParent[nodeID])
+      self.nodeMatricesToWorld[nodeID] = (version, matrixToWorld)
+    return matrixToWorld
+
+  def getMatrixFromWorldByID(self, nodeID):
+    version = self.nodeVersions[nodeID]
+    (cachedVersion, matrixFromWorld) = self.nodeMatricesFromWorld.get(nodeID, (None, None))
+    if (cachedVersion != version):
+      matrixFromWorld = numpy.linalg.inv(self.getMatrixToWorldByID(nodeID))
+      self.nodeMatricesFromWorld[nodeID] = (version, matrixFromWorld)
+    return matrixFromWorld
+
+  def getMatrixByID(self, sourceNodeID, targetNodeID):
+    self.numberOfQueries = self.numberOfQueries + 1
+    sourceVersion = self.nodeVersions[sourceNodeID]
+    targetVersion = self.nodeVersions[targetNodeID]
+    cachedPair = self.pairMatrices.get((sourceNodeID, targetNodeID))
+    if (cachedPair and cachedPair[0] == sourceVersion and cachedPair[1] == targetVersion):
+      self.numberOfCacheHits = self.numberOfCacheHits + 1
+      return cachedPair[2]
+    matrix = self.getMatrixFromWorldByID(targetNodeID).dot(self.getMatrixToWorldByID(sourceNodeID))
+    self.pairMatrices[(sourceNodeID, targetNodeID)] = (sourceVersion, targetVersion, matrix)
+    return matrix
+
+  def getMatrix(self, sourceNode, targetNode=None):
+    # 4x4 numpy matrix from sourceNode to targetNode coordinates, to world coordinates if targetNode is None
+    sourceNodeID = self.addTransformNode(sourceNode)
+    targetNodeID = self.addTransformNode(targetNode)
+    self.updateModifiedNodes()
+    return self.getMatrixByID(sourceNodeID, targetNodeID)
+
+  def getMatrices(self, nodePairs):
+    # getMatrix for every (sourceNode, targetNode) of nodePairs, as a k x 4 x 4 array
+    nodeIDPairs = [(self.addTransformNode(sourceNode), self.addTransformNode(targetNode)) for (sourceNode, targetNode) in nodePairs]
+    self.updateModifiedNodes()
+    matrices = numpy.empty([len(nodeIDPairs),4,4])
+    for pairIndex, (sourceNodeID, targetNodeID) in enumerate(nodeIDPairs):
+      matrices[pairIndex] = self.getMatrixByID(sourceNodeID, targetNodeID)
+    return matrices
+
+  def getMatrixTransformToNode(self, sourceNode, targetNode, matrix):
+    # same as sourceNode.GetMatrixTransformToNode(targetNode, matrix) for a vtkMatrix4x4 matrix
+    cachedMatrix = self.getMatrix(sourceNode, targetNode)
+    for row in xrange(4):
+      for column in xrange(4):
+        matrix.SetElement(row, column, cachedMatrix[row,column])
+
+  def getCounters(self):
+    return { 'numberOfNodes' : len(self.nodes),
+             'numberOfQueries' : self.numberOfQueries,
+             'numberOfCacheHits' : self.numberOfCacheHits }
@@ -6,7 +6,6 @@ from Guidelet import Guidelet
 import logging
 import time
 import numpy
-import threading
 
 #
 # CathNav ###
@@ -86,8 +85,119 @@ class CathNavLogic(GuideletLogic):
                    'RecordingFilenamePrefix' : 'CathNavRecording-',
                    'SavedScenesDirectory': defaultSavePathOfCathNav,#overwrites the default setting param of base
                    'LiveUltrasoundNodeName': 'Image_Chest',
+                   'PlanningGridPreviewIntervalMs' : '50',
+                   'PointCollectionDisplayUpdateRateHz' : '30',
+                   'SurfaceRebuildIntervalMs' : '33',
                    }
     self.updateSettings(settingList, 'Default')
+
+  def getToolModelCacheDirectoryPath(self):
+    return os.path.join(slicer.app.temporaryPath, 'CathNavToolModels')
+
+  def getFileHash(self, filePath):
+    import hashlib
+    with open(filePath, 'rb') as file:
+      return hashlib.sha1(file.read()).hexdigest()
+
+  def getCreateModelsHash(self, functionName, *parameters):
+    # CreateModels geometry only changes with its parameters and with the Slicer version
+    import hashlib
+    return hashlib.sha1(repr((functionName, parameters, slicer.app.applicationVersion))).hexdigest()
+
+  def getCachedToolPolyData(self, cacheKey, createPolyData):
+    # tool geometry from the cache directory, createPolyData() is only called (and its result stored) on a miss
+    cacheFilePath = os.path.join(self.getToolModelCacheDirectoryPath(), cacheKey + '.vtp')
+    if (os.path.isfile(cacheFilePath)):
+      reader = vtk.vtkXMLPolyDataReader()
+      reader.SetFileName(cacheFilePath)
+      reader.Update()
+      polyData = reader.GetOutput()
+      if (polyData.GetNumberOfPoints() > 0):
+        logging.debug("Tool model read from cache " + cacheFilePath)
+        return polyData
+      logging.warning("Tool model cache file " + cacheFilePath + " could not be read, it is rebuilt")
+    polyData = createPolyData()
+    try:
+      if (not os.path.isdir(self.getToolModelCacheDirectoryPath())):
+        os.makedirs(self.getToolModelCacheDirectoryPath())
+      # written under a temporary name and renamed, so a partly written file is never read
+      temporaryFilePath = cacheFilePath + '.' + str(os.getpid()) + '.tmp'
+      writer = vtk.vtkXMLPolyDataWriter()
+      writer.SetFileName(temporaryFilePath)
+      writer.SetInputData(polyData)
+      writer.SetDataModeToBinary()
+      writer.SetCompressorTypeToNone() # the files are small, reading them uncompressed is faster
+      if (not writer.Write()):
+        logging.warning("Tool model cache file " + cacheFilePath + " could not be written")
+        return polyData
+      if (os.path.isfile(cacheFilePath)):
+        os.remove(cacheFilePath)
+      os.rename(temporaryFilePath, cacheFilePath)
+    except (IOError, OSError) as error:
+      logging.warning("Tool model cache file " + cacheFilePath + " could not be written: " + str(error))
+    return polyData
+
+  def readStlPolyData(self, filePath):
+    reader = vtk.vtkSTLReader()
+    reader.SetFileName(filePath)
+    reader.Update()
+    polyData = vtk.vtkPolyData()
+    polyData.DeepCopy(reader.GetOutput())
+    return polyData
+
+  def createModelsPolyData(self, modelNodeName, createModel):
+    # createModel() adds a CreateModels model named modelNodeName to the scene, its geometry is kept and the nodes removed
+    createModel()
+    modelNode = slicer.util.getNode(pattern=modelNodeName)
+    polyData = vtk.vtkPolyData()
+    polyData.DeepCopy(modelNode.GetPolyData())
+    if (modelNode.GetDisplayNode()):
+      slicer.mrmlScene.RemoveNode(modelNode.GetDisplayNode())
+    slicer.mrmlScene.RemoveNode(modelNode)
+    return polyData
+    
+  def computeAverageOfMarkups(self, markupsFiducialNode):
+    logging.debug('computeAverageOfMarkups')
+    numberOfMarkups = markupsFiducialNode.GetNumberOfFiducials()
+    logging.debug(numberOfMarkups)
+    if (numberOfMarkups == 0):
+      logging.error("Number of markups for fixed point calibration is 0. Returning [0,0,0]")
+      pointMm = [0.0,0.0,0.0]
+      return pointMm
+    currentIndex = 0
+    sumOfPointsMm = [0.0,0.0,0.0]
+    while currentIndex < numberOfMarkups:
+      pointMm = [0.0,0.0,0.0]
+      markupsFiducialNode.GetNthFiducialPosition(currentIndex,pointMm)
+      sumOfPointsMm[0] = sumOfPointsMm[0] + pointMm[0]
+      sumOfPointsMm[1] = sumOfPointsMm[1] + pointMm[1]
+      sumOfPointsMm[2] = sumOfPointsMm[2] + pointMm[2]
+      currentIndex = currentIndex + 1
+    avgOfPointsMm = sumOfPointsMm
+    avgOfPointsMm[0] = float(avgOfPointsMm[0]) / float(numberOfMarkups)
+    avgOfPointsMm[1] = float(avgOfPointsMm[1]) / float(numberOfMarkups)
+    avgOfPointsMm[2] = float(avgOfPointsMm[2]) / float(numberOfMarkups)
+    return avgOfPointsMm
+    
+  def computeRMSEOfPointToMarkups(self, toolPointMm, markupsFiducialNode):
+    logging.debug('computeRMSEOfPointToMarkups')
+    numberOfMarkups = markupsFiducialNode.GetNumberOfFiducials()
+    if (numberOfMarkups == 0):
+      logging.error("Number of markups for fixed point calibration is 0. Returning 1000 mm error.")
+      errorMm = 1000.0
+      return errorMm;
+    currentIndex = 0
+    sumSqDifferencesMm = 0.0
+    while currentIndex < numberOfMarkups:
+      markupPointMm = [0.0,0.0,0.0]
+      markupsFiducialNode.GetNthFiducialPosition(currentIndex,markupPointMm)
+      sqDifferenceMm = (toolPointMm[0] - markupPointMm[0])**2 + (toolPointMm[1] - markupPointMm[1])**2 + (toolPointMm[2] - markupPointMm[2])**2
+      sumSqDifferencesMm = sumSqDifferencesMm + sqDifferenceMm
+      currentIndex = currentIndex + 1
+    meanSqDifferenceMm = float(sumSqDifferencesMm) / float(numberOfMarkups)
+    rootMeanSqDifferenceMm = meanSqDifferenceMm ** (0.5)
+    return rootMeanSqDifferenceMm
+
 #
 # CathNavTest ###
 #
@@ -131,17 +241,20 @@ class CathNavGuidelet(Guidelet):
   gridSizeDownNumPoints = 2
   gridSpacingHorizontalMm = 10
   gridSpacingVerticalMm = 10
+  gridPreviewFrameBudgetSec = 1.0 / 60.0 # one display frame
   
   # Calibration
   currentCalibration = 0
   currentCalibration_PIVOT = 0
   currentCalibration_FIXED_POINT = 1
-  fixedPointCalibrationMarkups = None
   fixedPointCalibrationTargetTransformNode = None
   fixedPointCalibrationTargetTransformName = None
 
   def __init__(self, parent, logic, configurationName='Default'):
     logging.debug('CathNavGuidelet.__init__')
+    self.startupStartTimeSec = time.time()
+    self.startupPhaseStartTimeSec = self.startupStartTimeSec
+    self.startupPhaseDurationsSec = [] # (phase name, duration) in the order the phases ran, see markStartupPhase
     Guidelet.__init__(self, parent, logic, configurationName)
     moduleDirectoryPath = slicer.modules.cathnav.path.replace('CathNav.py', '')
 
@@ -151,16 +264,15 @@ class CathNavGuidelet(Guidelet):
     self.mainWindow.setWindowTitle('HDR Catheter navigation')
     self.mainWindow.windowIcon = qt.QIcon(moduleDirectoryPath + '/Resources/Icons/CathNav.png')
     
-    self.tumorMarkups_NeedleObserver = None
-    self.chestwallMarkups_ChestObserver = None
     self.wirePoints_NeedleObserver = None
     self.pathCount = 0
-    self.reconstructionThread = None
 
     self.setupScene()
 
     # Setting button open on startup.
     self.calibrationCollapsibleButton.setProperty('collapsed', False)
+    self.markStartupPhase('Open calibration panel')
+    self.logStartupTimes()
 
   def __del__(self):#common
     self.cleanup()
@@ -169,10 +281,13 @@ class CathNavGuidelet(Guidelet):
   def cleanup(self):#common
     Guidelet.cleanup(self)
     logging.debug('cleanup')
-    if self.tumorMarkups_NeedleObserver:
-      self.tumorMarkups_Needle.RemoveObserver(self.tumorMarkups_NeedleObserver)
-    if self.chestwallMarkups_Chest:
-      self.chestwallMarkups_Chest.RemoveObserver(self.chestwallMarkups_ChestObserver)
+    self.seromaSurfacePipeline.stop()
+    self.chestWallSurfacePipeline.stop()
+    self.seromaDistanceMonitor.stop()
+    self.chestWallDistanceMonitor.stop()
+    self.transformGraph.clear()
+    self.trackingRecorderLogic.stopRecording()
+    self.catheterReconstructionWorker.stop()
     
   def setupScene(self): #applet specific
     logging.debug('setupScene')
@@ -183,71 +298,70 @@ class CathNavGuidelet(Guidelet):
     view.SetAxisLabelsVisible(False)
     
     logging.debug('Setup Transforms')
-    self.guideTipToGuide = self.initializeLinearTransform('GuideTipToGuide')
+    self.markStartupPhase('Guidelet')
+    [self.guideTipToGuide, self.needleTipToNeedle, self.guideModelToGuideTip, self.guideCameraToGuideModel,
+     self.needleModelToNeedleTip, self.referenceToRas, self.needleToGuide, self.planToNeedle, self.gridToPlan,
+     self.gridCameraToGrid, self.guideToNeedle, self.guideToChest, self.wireToChest,
+     self.needleToChest] = self.initializeLinearTransforms(['GuideTipToGuide', 'NeedleTipToNeedle', 'GuideModelToGuideTip', 'GuideCameraToGuideModel',
+                                                            'NeedleModelToNeedleTip', 'ChestToRas', 'NeedleToGuide', 'PlanToNeedle', 'GridToPlan',
+                                                            'GridCameraToGrid', 'GuideToNeedle', 'GuideToChest', 'WireToChest',
+                                                            'NeedleToChest'])
     self.loadLinearTransformFromSettings(self.guideTipToGuide)
-    self.needleTipToNeedle = self.initializeLinearTransform('NeedleTipToNeedle')
     self.loadLinearTransformFromSettings(self.needleTipToNeedle)
-    self.guideModelToGuideTip = self.initializeLinearTransform('GuideModelToGuideTip')
     guideModelToGuideTipMatrix = [ 0, 1, 0, 0,
                                    0, 0, 1, 0,
                                    1, 0, 0, 0,
                                    0, 0, 0, 1 ]
     self.setLinearTransform(self.guideModelToGuideTip, guideModelToGuideTipMatrix)
-    self.guideCameraToGuideModel = self.initializeLinearTransform('GuideCameraToGuideModel')
     guideCameraToGuideModelMatrix = [ 0, 1, 0, 0,
                                       1, 0, 0, 0,
                                       0, 0,-1, 0,
                                       0, 0, 0, 1 ]
     self.setLinearTransform(self.guideCameraToGuideModel, guideCameraToGuideModelMatrix)      
-    self.needleModelToNeedleTip = self.initializeLinearTransform('NeedleModelToNeedleTip')
     needleModelToNeedleTipMatrix = [ 0, 1, 0, 0,
                                      0, 0, 1, 0,
                                      1, 0, 0, 0,
                                      0, 0, 0, 1 ]
     self.setLinearTransform(self.needleModelToNeedleTip, needleModelToNeedleTipMatrix)
-    self.referenceToRas = self.initializeLinearTransform('ChestToRas')
-    self.needleToGuide = self.initializeLinearTransform('NeedleToGuide')
-    self.planToNeedle = self.initializeLinearTransform('PlanToNeedle')
-    self.gridToPlan = self.initializeLinearTransform('GridToPlan')
-    self.gridCameraToGrid = self.initializeLinearTransform('GridCameraToGrid')
-    self.guideToNeedle = self.initializeLinearTransform('GuideToNeedle')
-    self.needleToGuide = self.initializeLinearTransform('NeedleToGuide')
-    self.guideToChest = self.initializeLinearTransform('GuideToChest')
-    self.wireToChest = self.initializeLinearTransform('WireToChest')
-    self.needleToChest = self.initializeLinearTransform('NeedleToChest')
+    self.markStartupPhase('Transforms')
 
     logging.debug('Setup Models')
+    # the tool geometry is built once and then read from the model cache, see CathNavLogic.getCachedToolPolyData
     self.guideModel_GuideTip = slicer.util.getNode('GuideModel')
     if not self.guideModel_GuideTip:
       moduleDirectoryPath = slicer.modules.cathnav.path.replace('CathNav.py', '')
-      slicer.util.loadModel(qt.QDir.toNativeSeparators(moduleDirectoryPath + 'models/catheterGuide.stl'))
-      self.guideModel_GuideTip=slicer.util.getNode(pattern="catheterGuide")
+      guideModelFilePath = qt.QDir.toNativeSeparators(moduleDirectoryPath + 'models/catheterGuide.stl')
+      guideModelCacheKey = 'GuideModel-' + self.logic.getFileHash(guideModelFilePath)
+      guidePolyData = self.logic.getCachedToolPolyData(guideModelCacheKey, lambda: self.logic.readStlPolyData(guideModelFilePath))
+      self.guideModel_GuideTip = self.createToolModel("GuideModel", guidePolyData)
       self.guideModel_GuideTip.GetDisplayNode().SetColor(1.0, 1.0, 0)
-      self.guideModel_GuideTip.SetName("GuideModel")
     self.needleModel_NeedleTip = slicer.util.getNode('NeedleModel')
     if not self.needleModel_NeedleTip:
-      slicer.modules.createmodels.logic().CreateNeedle(80,0.5,0,0)
-      self.needleModel_NeedleTip=slicer.util.getNode(pattern="NeedleModel")
+      needleModelCacheKey = 'NeedleModel-' + self.logic.getCreateModelsHash('CreateNeedle', 80, 0.5, 0, 0)
+      needlePolyData = self.logic.getCachedToolPolyData(needleModelCacheKey, lambda: self.logic.createModelsPolyData('NeedleModel', lambda: slicer.modules.createmodels.logic().CreateNeedle(80,0.5,0,0)))
+      self.needleModel_NeedleTip = self.createToolModel("NeedleModel", needlePolyData)
       self.needleModel_NeedleTip.GetDisplayNode().SetColor(0.333333, 1.0, 1.0)
-      self.needleModel_NeedleTip.SetName("NeedleModel")
       self.needleModel_NeedleTip.GetDisplayNode().SliceIntersectionVisibilityOn()
     self.wireModel_Wire = slicer.util.getNode('WireModel')
     if not self.wireModel_Wire:
-      slicer.modules.createmodels.logic().CreateSphere(0.75)
-      self.wireModel_Wire=slicer.util.getNode(pattern="SphereModel")
+      wireModelCacheKey = 'WireModel-' + self.logic.getCreateModelsHash('CreateSphere', 0.75)
+      wirePolyData = self.logic.getCachedToolPolyData(wireModelCacheKey, lambda: self.logic.createModelsPolyData('SphereModel', lambda: slicer.modules.createmodels.logic().CreateSphere(0.75)))
+      self.wireModel_Wire = self.createToolModel("WireModel", wirePolyData)
       self.wireModel_Wire.GetDisplayNode().SetColor(1.0, 0.5, 0.25)
-      self.wireModel_Wire.SetName("WireModel")
       self.wireModel_Wire.GetDisplayNode().SliceIntersectionVisibilityOn()
+    self.markStartupPhase('Models')
     
     logging.debug('Setup Guidelet')
     Guidelet.setupScene(self)
+    self.markStartupPhase('Guidelet scene')
     
-    logging.debug('Setup Calibration')
-    self.needleTipMarkups_Guide = self.initializeFiducialList('NeedleTipMarkups_Guide')
+    logging.debug('Setup Fiducial Lists')
+    [self.tumorMarkups_Needle, self.chestwallMarkups_Chest, self.wirePoints_Needle,
+     self.tipToSurfaceClosestPoints_Ras] = self.initializeFiducialLists(['SeromaMarkups_Needle', 'ChestwallMarkups_Chest', 'WirePoints_Needle',
+                                                                         'TipToSurfaceClosestPoints_Ras'])
+    self.markStartupPhase('Fiducial lists')
 
     logging.debug('Setup Model Making - Seroma')
-    self.tumorMarkups_Needle = self.initializeFiducialList('SeromaMarkups_Needle')
-    self.tumorMarkups_NeedleObserver = self.setAndObserveNode(self.tumorMarkups_Needle, self.tumorMarkups_NeedleObserver, self.onTumorMarkupsNodeModified)
     self.tumorModel_Needle = slicer.util.getNode('SeromaModel')
     if not self.tumorModel_Needle:
       self.tumorModel_Needle = slicer.vtkMRMLModelNode()
@@ -262,8 +376,6 @@ class CathNavGuidelet(Guidelet):
       slicer.mrmlScene.AddNode(modelDisplayNode)
       self.tumorModel_Needle.SetAndObserveDisplayNodeID(modelDisplayNode.GetID())
     logging.debug('Setup Model Making - Chestwall')
-    self.chestwallMarkups_Chest = self.initializeFiducialList('ChestwallMarkups_Chest')
-    self.chestwallMarkups_ChestObserver = self.setAndObserveNode(self.chestwallMarkups_Chest, self.chestwallMarkups_ChestObserver, self.onChestwallMarkupsNodeModified)
     self.chestwallModel_Chest = slicer.util.getNode('ChestWallModel')
     if not self.chestwallModel_Chest:
       self.chestwallModel_Chest = slicer.vtkMRMLModelNode()
@@ -277,10 +389,14 @@ class CathNavGuidelet(Guidelet):
       modelDisplayNode.SetOpacity(0.3)
       slicer.mrmlScene.AddNode(modelDisplayNode)
       self.chestwallModel_Chest.SetAndObserveDisplayNodeID(modelDisplayNode.GetID())
+    self.seromaSurfacePipeline.setNodes(self.tumorMarkups_Needle, self.tumorModel_Needle)
+    self.chestWallSurfacePipeline.setNodes(self.chestwallMarkups_Chest, self.chestwallModel_Chest)
+    self.markStartupPhase('Surface models')
     
     logging.debug('Setup Catheter Path Reconstruction')
-    self.wirePoints_Needle = self.initializeFiducialList('WirePoints_Needle')
     self.pathCount = 0
+    self.loadCatheterPaths(self.parameterNode.GetParameter('CatheterPathsFilePath'))
+    self.markStartupPhase('Catheter paths')
 
     logging.debug('Setup Transform Tree')
     # Guidelet assumes that the top transform in the hierarchy is called referenceToRas.
@@ -304,15 +420,57 @@ class CathNavGuidelet(Guidelet):
     self.tumorMarkups_Needle.SetAndObserveTransformNodeID(self.needleToChest.GetID())
     self.chestwallModel_Chest.SetAndObserveTransformNodeID(self.referenceToRas.GetID())
     self.chestwallMarkups_Chest.SetAndObserveTransformNodeID(self.referenceToRas.GetID())
+    self.markStartupPhase('Transform tree')
+
+    logging.debug('Setup Tip To Surface Distance')
+    # one closest point and one trajectory hit point per surface, in RAS, hidden while the distance is unknown
+    self.tipToSurfaceClosestPoints_Ras.RemoveAllMarkups()
+    for closestPointLabel in ['Seroma', 'Chest wall', 'Seroma trajectory', 'Chest wall trajectory']:
+      closestPointIndex = self.tipToSurfaceClosestPoints_Ras.AddFiducial(0, 0, 0)
+      self.tipToSurfaceClosestPoints_Ras.SetNthFiducialLabel(closestPointIndex, closestPointLabel)
+      self.tipToSurfaceClosestPoints_Ras.SetNthFiducialVisibility(closestPointIndex, False)
+    self.tipToSurfaceClosestPoints_Ras.SetLocked(True)
+    self.tipToSurfaceClosestPoints_Ras.GetDisplayNode().SetGlyphType(slicer.vtkMRMLMarkupsDisplayNode.Cross2D)
+    self.tipToSurfaceClosestPoints_Ras.SetDisplayVisibility(self.tipToSurfaceDistanceCrossHairVisible or self.tipToSurfaceDistanceTrajectoryVisible)
+    self.seromaDistanceMonitor.setNodes(self.needleTipToNeedle, self.tumorModel_Needle)
+    self.chestWallDistanceMonitor.setNodes(self.needleTipToNeedle, self.chestwallModel_Chest)
+    if (self.tipToSurfaceDistanceTrajectoryVisible):
+      # the needle models made by CreateModels point along -z in model coordinates
+      self.seromaDistanceMonitor.setTrajectory(self.needleModelToNeedleTip, [0, 0, -1])
+      self.chestWallDistanceMonitor.setTrajectory(self.needleModelToNeedleTip, [0, 0, -1])
+
+    self.markStartupPhase('Tip to surface distance')
 
     # Hide slice view annotations (patient name, scale, color bar, etc.) as they
-    # decrease reslicing performance by 20%-100%
-    logging.debug('Setup - Hide slice view annotations')
+    # decrease reslicing performance by 20%-100%. DataProbe is only imported once the slicelet is up.
+    qt.QTimer.singleShot(0, self.hideSliceViewAnnotations)
+
+  def hideSliceViewAnnotations(self):
+    logging.debug('hideSliceViewAnnotations')
     import DataProbe
     dataProbeUtil=DataProbe.DataProbeLib.DataProbeUtil()
     dataProbeParameterNode=dataProbeUtil.getParameterNode()
     dataProbeParameterNode.SetParameter('showSliceViewAnnotations', '0')
 
+  def markStartupPhase(self, phaseName):
+    # the time since the previous mark is booked to phaseName
+    currentTimeSec = time.time()
+    self.startupPhaseDurationsSec.append((phaseName, currentTimeSec - self.startupPhaseStartTimeSec))
+    self.startupPhaseStartTimeSec = currentTimeSec
+
+  def logStartupTimes(self):
+    # phases that ran more than once (e.g. parts of the Guidelet base class) are added up
+    phaseNames = []
+    phaseDurationsSec = {}
+    for (phaseName, durationSec) in self.startupPhaseDurationsSec:
+      if (phaseName not in phaseDurationsSec):
+        phaseNames.append(phaseName)
+        phaseDurationsSec[phaseName] = 0.0
+      phaseDurationsSec[phaseName] = phaseDurationsSec[phaseName] + durationSec
+    logging.info("CathNav startup took {0:.2f} s".format(time.time() - self.startupStartTimeSec))
+    for phaseName in phaseNames:
+      logging.info("  {0}: {1:.3f} s".format(phaseName, phaseDurationsSec[phaseName]))
+
   def initializeLinearTransform(self,name):
     logging.debug('initializeLinearTransform')
     transform = slicer.util.getNode(name)
@@ -322,6 +480,25 @@ class CathNavGuidelet(Guidelet):
       slicer.mrmlScene.AddNode(transform)
     return transform
     
+  def initializeLinearTransforms(self,names):
+    # initializeLinearTransform for each name, with the new nodes added in one batch
+    return self.initializeNodes(names, 'vtkMRMLLinearTransformNode', self.initializeLinearTransform)
+    
+  def initializeNodes(self,names,className,initializeNode):
+    # existing nodes are found with a single pass over the scene, missing ones are made by initializeNode(name)
+    existingNodes = slicer.mrmlScene.GetNodesByClass(className)
+    nodesByName = {}
+    for nodeIndex in xrange(existingNodes.GetNumberOfItems()):
+      node = existingNodes.GetItemAsObject(nodeIndex)
+      if (node.GetName() not in nodesByName):
+        nodesByName[node.GetName()] = node
+    slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    try:
+      nodes = [nodesByName[name] if (name in nodesByName) else initializeNode(name) for name in names]
+    finally:
+      slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+    return nodes
+    
   def setLinearTransform(self,node,values):
     logging.debug('setLinearTransform')
     # array indexing is as follows (row major):
@@ -375,6 +552,21 @@ class CathNavGuidelet(Guidelet):
       fiducialList.SetDisplayVisibility(0)
     return fiducialList
     
+  def initializeFiducialLists(self,names):
+    # initializeFiducialList for each name, with the new nodes added in one batch
+    return self.initializeNodes(names, 'vtkMRMLMarkupsFiducialNode', self.initializeFiducialList)
+    
+  def createToolModel(self,name,polyData):
+    logging.debug('createToolModel')
+    modelNode = slicer.vtkMRMLModelNode()
+    modelNode.SetName(name)
+    modelNode.SetAndObservePolyData(polyData)
+    slicer.mrmlScene.AddNode(modelNode)
+    modelDisplayNode = slicer.vtkMRMLModelDisplayNode()
+    slicer.mrmlScene.AddNode(modelDisplayNode)
+    modelNode.SetAndObserveDisplayNodeID(modelDisplayNode.GetID())
+    return modelNode
+    
   def copyFiducialsFromListToList(self,sourceList,targetList):
     targetList.RemoveAllMarkups()
     numSourceFiducials = sourceList.GetNumberOfFiducials()
@@ -385,6 +577,7 @@ class CathNavGuidelet(Guidelet):
   
   def createFeaturePanels(self):
     # Create GUI panels.
+    self.markStartupPhase('Guidelet')
 
     self.setupCalibrationPanel()
     featurePanelList = Guidelet.createFeaturePanels(self) # for ultrasound
@@ -396,7 +589,35 @@ class CathNavGuidelet(Guidelet):
 
     featurePanelList[len(featurePanelList):] = [self.calibrationCollapsibleButton, self.guidewireCollapsibleButton, self.planningCollapsibleButton, self.navigationCollapsibleButton, self.reconstructionCollapsibleButton]
 
+    # Only the panel headers are created here. The contents of a panel, its connections and its logic
+    # are created when the panel is first expanded, see createFeaturePanelContents.
+    self.featurePanelContentsFunctions = { 'calibration' : [self.createCalibrationPanelContents, self.setupCalibrationPanelConnections],
+                                           'ultrasound' : [self.createUltrasoundPanelContents, self.setupUltrasoundPanelConnections],
+                                           'guidewire' : [self.createGuidewirePanelContents, self.setupGuidewirePanelConnections],
+                                           'planning' : [self.createPlanningPanelContents, self.setupPlanningPanelConnections],
+                                           'navigation' : [self.createNavigationPanelContents, self.setupNavigationPanelConnections],
+                                           'reconstruction' : [self.createReconstructionPanelContents, self.setupReconstructionPanelConnections] }
+    self.common3DPanelButtons = { 'guidewire' : self.guidewireCollapsibleButton,
+                                  'planning' : self.planningCollapsibleButton,
+                                  'navigation' : self.navigationCollapsibleButton,
+                                  'reconstruction' : self.reconstructionCollapsibleButton }
+    self.createdFeaturePanelNames = []
+
+    self.markStartupPhase('Feature panels')
     return featurePanelList
+
+  def createFeaturePanelContents(self, panelName):
+    if (panelName in self.createdFeaturePanelNames):
+      return
+    logging.debug('createFeaturePanelContents ' + panelName)
+    startTimeSec = time.time()
+    self.createdFeaturePanelNames.append(panelName)
+    for contentsFunction in self.featurePanelContentsFunctions[panelName]:
+      contentsFunction()
+    logging.info("CathNav {0} panel created in {1:.0f} ms".format(panelName, 1000 * (time.time() - startTimeSec)))
+
+  def isFeaturePanelCreated(self, panelName):
+    return (panelName in self.createdFeaturePanelNames)
       
   def setupCalibrationPanel(self):
     logging.debug('setupCalibrationPanel')
@@ -411,6 +632,9 @@ class CathNavGuidelet(Guidelet):
     self.calibrationLayout.setContentsMargins(12, 4, 4, 4)
     self.calibrationLayout.setSpacing(4)
 
+  def createCalibrationPanelContents(self):
+    logging.debug('createCalibrationPanelContents')
+
     self.calibrationNeedleButton = qt.QPushButton('Start needle calibration')
     self.calibrationLayout.addRow(self.calibrationNeedleButton)
 
@@ -429,6 +653,9 @@ class CathNavGuidelet(Guidelet):
 
     self.ultrasoundCollapsibleButton.text = "Segmentation"
 
+  def createUltrasoundPanelContents(self):
+    logging.debug('createUltrasoundPanelContents')
+
     self.tumorMarkupsPlaceButton = qt.QPushButton("Mark tumor")
     self.tumorMarkupsPlaceButton.setCheckable(True)
     self.tumorMarkupsPlaceButton.setIcon(qt.QIcon(":/Icons/MarkupsMouseModePlace.png"))
@@ -478,6 +705,9 @@ class CathNavGuidelet(Guidelet):
     self.guidewireCollapsibleLayout.setContentsMargins(12, 4, 4, 4)
     self.guidewireCollapsibleLayout.setSpacing(4)
     
+  def createGuidewirePanelContents(self):
+    logging.debug('createGuidewirePanelContents')
+
     self.guidewireCameraButton = qt.QPushButton("Guidewire Camera")
     self.guidewireCameraButton.setCheckable(True)
     self.guidewireCollapsibleLayout.addRow(self.guidewireCameraButton)
@@ -562,6 +792,9 @@ class CathNavGuidelet(Guidelet):
     self.planningCollapsibleLayout.setContentsMargins(12, 4, 4, 4)
     self.planningCollapsibleLayout.setSpacing(4)
     
+  def createPlanningPanelContents(self):
+    logging.debug('createPlanningPanelContents')
+
     # Load icons
     logging.debug('Loading grid icons')
     iconDirectoryPath = slicer.modules.cathnav.path.replace('CathNav.py', '/Resources/Icons/')
@@ -583,6 +816,38 @@ class CathNavGuidelet(Guidelet):
     self.planningCreateGridButton = qt.QPushButton(iconGridBuild,"Create grid")
     self.planningCollapsibleLayout.addRow(self.planningCreateGridButton)
     
+    # Live preview: grid parameter changes are applied to the created grid right away
+    self.planningLivePreviewCheckBox = qt.QCheckBox("Live preview")
+    self.planningLivePreviewCheckBox.setToolTip("Update the created grid whenever a grid parameter changes")
+    self.planningCollapsibleLayout.addRow(self.planningLivePreviewCheckBox)
+    
+    self.planningGridUpdateLatencyLabel = qt.QLabel()
+    self.planningCollapsibleLayout.addRow(self.planningGridUpdateLatencyLabel)
+    
+    # Anatomy check: color holes by whether they reach the seroma and avoid the chest wall
+    self.planningAnatomyCheckBox = qt.QCheckBox("Check holes against anatomy")
+    self.planningAnatomyCheckBox.setToolTip("Color holes green (usable), red (crosses the chest wall) or grey (misses the seroma)")
+    self.planningCollapsibleLayout.addRow(self.planningAnatomyCheckBox)
+    
+    self.planningAnatomyLabel = qt.QLabel()
+    self.planningCollapsibleLayout.addRow(self.planningAnatomyLabel)
+    
+    # Pose optimization: search rotation, spacing and extents for the best seroma coverage
+    self.planningOptimizeButton = qt.QPushButton("Optimize grid")
+    self.planningOptimizeButton.setToolTip("Find the grid poses with the most holes through the seroma that avoid the chest wall")
+    self.planningOptimizedPosesComboBox = qt.QComboBox()
+    self.planningOptimizedPosesComboBox.setToolTip("Apply one of the best grid poses")
+    self.planningOptimizedPosesComboBox.setEnabled(False)
+    self.planningOptimizeHBox = qt.QHBoxLayout()
+    self.planningOptimizeHBox.addWidget(self.planningOptimizeButton)
+    self.planningOptimizeHBox.addWidget(self.planningOptimizedPosesComboBox)
+    self.planningCollapsibleLayout.addRow(self.planningOptimizeHBox)
+    self.planningOptimizedPoses = []
+    
+    self.planningGridUpdateTimer = qt.QTimer()
+    self.planningGridUpdateTimer.setSingleShot(True)
+    self.planningGridUpdateMaxLatencySec = 0
+    
     # "Grid Parameters" Collapsible
     self.planningGridCollapsibleButton = ctk.ctkCollapsibleGroupBox()
     self.planningGridCollapsibleButton.collapsed=False
@@ -670,10 +935,43 @@ class CathNavGuidelet(Guidelet):
     self.navigationCollapsibleLayout = qt.QFormLayout(self.navigationCollapsibleButton)
     self.navigationCollapsibleLayout.setContentsMargins(12, 4, 4, 4)
     self.navigationCollapsibleLayout.setSpacing(4)
+
+    # the tip to surface distances are shown in these labels once the panel contents exist
+    self.navigationSeromaDistanceValueLabel = None
+    self.navigationChestWallDistanceValueLabel = None
+    self.navigationSeromaTrajectoryValueLabel = None
+    self.navigationChestWallTrajectoryValueLabel = None
     
+  def createNavigationPanelContents(self):
+    logging.debug('createNavigationPanelContents')
+
     self.navigationCameraButton = qt.QPushButton("Navigation Camera")
     self.navigationCameraButton.setCheckable(True)
     self.navigationCollapsibleLayout.addRow(self.navigationCameraButton)
+
+    self.navigationSeromaDistanceLabel = qt.QLabel()
+    self.navigationSeromaDistanceLabel.setText("Tip to seroma (mm): ")
+    self.navigationSeromaDistanceValueLabel = qt.QLabel()
+    self.navigationSeromaDistanceValueLabel.setText("-")
+    self.navigationCollapsibleLayout.addRow(self.navigationSeromaDistanceLabel, self.navigationSeromaDistanceValueLabel)
+
+    self.navigationChestWallDistanceLabel = qt.QLabel()
+    self.navigationChestWallDistanceLabel.setText("Tip to chest wall (mm): ")
+    self.navigationChestWallDistanceValueLabel = qt.QLabel()
+    self.navigationChestWallDistanceValueLabel.setText("-")
+    self.navigationCollapsibleLayout.addRow(self.navigationChestWallDistanceLabel, self.navigationChestWallDistanceValueLabel)
+
+    self.navigationSeromaTrajectoryLabel = qt.QLabel()
+    self.navigationSeromaTrajectoryLabel.setText("Trajectory to seroma (mm): ")
+    self.navigationSeromaTrajectoryValueLabel = qt.QLabel()
+    self.navigationSeromaTrajectoryValueLabel.setText("-")
+    self.navigationCollapsibleLayout.addRow(self.navigationSeromaTrajectoryLabel, self.navigationSeromaTrajectoryValueLabel)
+
+    self.navigationChestWallTrajectoryLabel = qt.QLabel()
+    self.navigationChestWallTrajectoryLabel.setText("Trajectory to chest wall (mm): ")
+    self.navigationChestWallTrajectoryValueLabel = qt.QLabel()
+    self.navigationChestWallTrajectoryValueLabel.setText("-")
+    self.navigationCollapsibleLayout.addRow(self.navigationChestWallTrajectoryLabel, self.navigationChestWallTrajectoryValueLabel)
     
     # "Camera Control" Collapsible
     self.navigationCameraTranslationCollapsibleButton = ctk.ctkCollapsibleGroupBox()
@@ -754,6 +1052,9 @@ class CathNavGuidelet(Guidelet):
     self.reconstructionCollapsibleLayout.setContentsMargins(12, 4, 4, 4)
     self.reconstructionCollapsibleLayout.setSpacing(4)
     
+  def createReconstructionPanelContents(self):
+    logging.debug('createReconstructionPanelContents')
+
     self.reconstructionCollectPointsButton = qt.QPushButton("Collect Points")
     self.reconstructionCollectPointsButton.setCheckable(True)
     self.reconstructionCollapsibleLayout.addRow(self.reconstructionCollectPointsButton)
@@ -766,28 +1067,111 @@ class CathNavGuidelet(Guidelet):
     self.reconstructionCameraButton.setCheckable(True)
     self.reconstructionCollapsibleLayout.addRow(self.reconstructionCameraButton)
     
+    self.reconstructionRecordTrackingCheckBox = qt.QCheckBox("Record raw tracking")
+    self.reconstructionRecordTrackingCheckBox.setToolTip("Save every guide, needle and wire transform update while points are collected")
+    self.reconstructionRecordTrackingCheckBox.setChecked(True)
+    self.reconstructionCollapsibleLayout.addRow(self.reconstructionRecordTrackingCheckBox)
+    
+    self.reconstructionDeviationLabel = qt.QLabel()
+    self.reconstructionDeviationLabel.setText("Deviation from plan: ")
+    self.reconstructionDeviationValueLabel = qt.QLabel()
+    self.reconstructionDeviationValueLabel.setText("-")
+    self.reconstructionCollapsibleLayout.addRow(self.reconstructionDeviationLabel, self.reconstructionDeviationValueLabel)
+    
+    self.reconstructionReferencePathsLabel = qt.QLabel()
+    self.reconstructionReferencePathsLabel.setText("Reference paths: ")
+    self.reconstructionReferencePathsEdit = ctk.ctkPathLineEdit()
+    self.reconstructionReferencePathsEdit.filters = ctk.ctkPathLineEdit.Files | ctk.ctkPathLineEdit.Readable
+    self.reconstructionReferencePathsEdit.nameFilters = ["Catheter paths (*.npz)"]
+    self.reconstructionReferencePathsEdit.setToolTip("Paths or dwell positions (one path per channel) in needle coordinates, saved like the catheter paths")
+    self.reconstructionCollapsibleLayout.addRow(self.reconstructionReferencePathsLabel, self.reconstructionReferencePathsEdit)
+    
+    self.reconstructionReferenceComparisonLabel = qt.QLabel()
+    self.reconstructionReferenceComparisonLabel.setText("Distance to reference: ")
+    self.reconstructionReferenceComparisonValueLabel = qt.QLabel()
+    self.reconstructionReferenceComparisonValueLabel.setText("-")
+    self.reconstructionCollapsibleLayout.addRow(self.reconstructionReferenceComparisonLabel, self.reconstructionReferenceComparisonValueLabel)
+    
   def setupConnections(self):
     logging.debug('CathNav.setupConnections()')
+    self.markStartupPhase('Guidelet')
     Guidelet.setupConnections(self)
 
+    # matrices between the transforms of the scene, shared by everything that queries them on every tracker frame
+    import TransformGraph
+    self.transformGraph = TransformGraph.CachedTransformGraph()
+
+    # the connections of the panel contents are made when they are created, see setupCalibrationPanelConnections etc.
     self.calibrationCollapsibleButton.connect('toggled(bool)', self.onCalibrationPanelToggled)
     self.guidewireCollapsibleButton.connect('toggled(bool)', self.onCommon3DPanelToggled)
     self.planningCollapsibleButton.connect('toggled(bool)', self.onCommon3DPanelToggled)
     self.navigationCollapsibleButton.connect('toggled(bool)', self.onCommon3DPanelToggled)
     self.reconstructionCollapsibleButton.connect('toggled(bool)', self.onCommon3DPanelToggled)
 
-    # calibration panel
-    self.pivotCalibrationLogic=slicer.modules.pivotcalibration.logic()
-    
+    self.collectFiducialsSupplementLogic = None # created on first use, see getCollectFiducialsSupplementLogic
+    
+    import TrackingRecorder
+    self.trackingRecorderLogic = TrackingRecorder.TrackingRecorderLogic()
+
+    self.viewpointLogic = None # created on first use, see getViewpointLogic
+    self.planningLogic = None # created with the planning panel, see setupPlanningPanelConnections
+
+    # tip to surface distances, the nodes are set in setupScene
+    import TipToSurfaceDistance
+    self.tipToSurfaceDistanceLogic = TipToSurfaceDistance.TipToSurfaceDistanceLogic()
+    self.seromaDistanceMonitor = TipToSurfaceDistance.TipToSurfaceDistanceMonitor(self.tipToSurfaceDistanceLogic, 'Seroma')
+    self.seromaDistanceMonitor.setTransformGraph(self.transformGraph)
+    self.seromaDistanceMonitor.setDistanceCallback(self.onSeromaDistanceChanged)
+    self.chestWallDistanceMonitor = TipToSurfaceDistance.TipToSurfaceDistanceMonitor(self.tipToSurfaceDistanceLogic, 'Chest wall')
+    self.chestWallDistanceMonitor.setTransformGraph(self.transformGraph)
+    self.chestWallDistanceMonitor.setDistanceCallback(self.onChestWallDistanceChanged)
+    self.seromaDistanceMonitor.setTrajectoryCallback(self.onSeromaTrajectoryDistanceChanged)
+    self.chestWallDistanceMonitor.setTrajectoryCallback(self.onChestWallTrajectoryDistanceChanged)
+    self.tipToSurfaceDistanceTextVisible = (self.parameterNode.GetParameter('TipToSurfaceDistanceText') == 'True')
+    self.tipToSurfaceDistanceCrossHairVisible = (self.parameterNode.GetParameter('TipToSurfaceDistanceCrossHair') == 'True')
+    self.tipToSurfaceDistanceTrajectoryVisible = (self.parameterNode.GetParameter('TipToSurfaceDistanceTrajectory') == 'True')
+
+    # seroma and chest wall each have their own pipeline, the nodes are set in setupScene
+    import ClosedSurfaceModeling
+    self.closedSurfaceModelingLogic = ClosedSurfaceModeling.ClosedSurfaceModelingLogic()
+    self.seromaSurfacePipeline = ClosedSurfaceModeling.ClosedSurfacePipeline(self.closedSurfaceModelingLogic, 'Seroma')
+    self.seromaSurfacePipeline.setIncrementalConvexHull(True) # seroma points are added one at a time while sweeping the probe
+    self.chestWallSurfacePipeline = ClosedSurfaceModeling.ClosedSurfacePipeline(self.closedSurfaceModelingLogic, 'Chest wall')
+    for surfacePipeline in [self.seromaSurfacePipeline, self.chestWallSurfacePipeline]:
+      surfacePipeline.setRebuildIntervalMs(int(self.parameterNode.GetParameter('SurfaceRebuildIntervalMs')))
+    
+    # catheter paths, the stored paths are loaded in setupScene
+    import CatheterReconstruction
+    self.catheterReconstructionLogic = CatheterReconstruction.CatheterReconstructionLogic()
+    self.catheterCurveFit = CatheterReconstruction.IncrementalCatheterCurveFit(self.catheterReconstructionLogic)
+    self.catheterPathStore = CatheterReconstruction.CatheterPathStore(self.catheterReconstructionLogic.polynomialOrder)
+    self.catheterPolyDataByPathNumber = {} # final tubes of the stored paths, kept out of the scene
+    liveProfileName = CatheterReconstruction.CatheterReconstructionLogic.liveProfileName
+    self.catheterReconstructionWorker = CatheterReconstruction.CatheterReconstructionWorker(lambda curvePointsMm: self.catheterReconstructionLogic.createTubePolyData(curvePointsMm, liveProfileName),
+                                                                                              self.onLiveCatheterReconstructed)
+    import CatheterAnalysis
+    self.catheterAnalysisLogic = CatheterAnalysis.CatheterAnalysisLogic()
+    self.catheterDeviations = None # per-catheter deviations from the plan, see updateCatheterDeviations
+    self.catheterReferencePathStore = None
+    self.catheterPathComparison = None # index over the stored paths, built on the first comparison after they change
+    self.catheterReferenceComparison = None # per-catheter distances to the reference paths, see updateCatheterReferenceComparison
+    
+    self.markStartupPhase('Connections')
+
+  def setupCalibrationPanelConnections(self):
+    logging.debug('setupCalibrationPanelConnections')
     self.calibrationGuideButton.connect('clicked()', self.onCalibrationGuideClicked)
     self.calibrationNeedleButton.connect('clicked()', self.onCalibrationNeedleClicked)
     
     self.calibrationSamplingTimer.connect('timeout()',self.onCalibrationSamplingTimeout)
     
-    import CollectFiducialsSupplement
-    self.collectFiducialsSupplementLogic = CollectFiducialsSupplement.CollectFiducialsSupplementLogic()
+    import ToolCalibration
+    self.toolCalibrationLogic = ToolCalibration.ToolCalibrationLogic()
+    self.fixedPointCalibration = ToolCalibration.FixedPointCalibration(self.toolCalibrationLogic)
+    self.pivotCalibration = ToolCalibration.PivotCalibration()
 
-    # ultrasound panel
+  def setupUltrasoundPanelConnections(self):
+    logging.debug('setupUltrasoundPanelConnections')
     self.tumorMarkupsPlaceButton.connect('clicked(bool)', self.onTumorMarkupsPlaceClicked)
     self.tumorMarkupsDeleteLastButton.connect('clicked()', self.onTumorMarkupsDeleteLastClicked)
     self.tumorMarkupsDeleteAllButton.connect('clicked()', self.onTumorMarkupsDeleteAllClicked)
@@ -796,9 +1180,8 @@ class CathNavGuidelet(Guidelet):
     self.chestwallMarkupsDeleteLastButton.connect('clicked()', self.onChestwallMarkupsDeleteLastClicked)
     self.chestwallMarkupsDeleteAllButton.connect('clicked()', self.onChestwallMarkupsDeleteAllClicked)
 
-    # guidewire panel
-    import Viewpoint
-    self.viewpointLogic = Viewpoint.ViewpointLogic()
+  def setupGuidewirePanelConnections(self):
+    logging.debug('setupGuidewirePanelConnections')
     self.guidewireCameraZoomButtonIncrease.connect('clicked()', self.cameraZoomIncrease)
     self.guidewireCameraZoomButtonDecrease.connect('clicked()', self.cameraZoomDecrease)
     self.guidewireCameraTranslationXIncreaseButton.connect('clicked()', self.cameraTranslationXIncrease)
@@ -808,10 +1191,14 @@ class CathNavGuidelet(Guidelet):
     self.guidewireCameraTranslationZIncreaseButton.connect('clicked()', self.cameraTranslationZIncrease)
     self.guidewireCameraTranslationZDecreaseButton.connect('clicked()', self.cameraTranslationZDecrease)
     self.guidewireCameraButton.connect('clicked()', self.onGuidewireCameraButtonClicked)
-    
-    # planning panel
+
+  def setupPlanningPanelConnections(self):
+    logging.debug('setupPlanningPanelConnections')
     import InsertionGridPlanner
     self.planningLogic = InsertionGridPlanner.InsertionGridPlannerLogic()
+    self.planningLogic.setIncrementalUpdatesEnabled(True)
+    self.planningAnatomyLogic = InsertionGridPlanner.InsertionGridAnatomyLogic()
+    self.planningPoseOptimizerLogic = InsertionGridPlanner.InsertionGridPoseOptimizerLogic()
     self.planningCreateGridButton.connect('clicked()', self.onCreatePlanButtonClicked)
     self.planningGridSizeLeftIncrease.connect('clicked()', self.gridSizeLeftIncrease)
     self.planningGridSizeLeftDecrease.connect('clicked()', self.gridSizeLeftDecrease)
@@ -826,8 +1213,15 @@ class CathNavGuidelet(Guidelet):
     self.planningGridSpacingVerticalIncrease.connect('clicked()', self.gridSpacingVerticalIncrease)
     self.planningGridSpacingVerticalDecrease.connect('clicked()', self.gridSpacingVerticalDecrease)
     self.gridRotationSlider.connect('valueChanged(double)', self.rotateGrid)
-    
-    # navigation
+    self.planningLivePreviewCheckBox.connect('toggled(bool)', self.onPlanningLivePreviewToggled)
+    self.planningAnatomyCheckBox.connect('toggled(bool)', self.onPlanningAnatomyToggled)
+    self.planningOptimizeButton.connect('clicked()', self.onPlanningOptimizeClicked)
+    self.planningOptimizedPosesComboBox.connect('activated(int)', self.onPlanningOptimizedPoseActivated)
+    self.planningGridUpdateTimer.setInterval(int(self.parameterNode.GetParameter('PlanningGridPreviewIntervalMs')))
+    self.planningGridUpdateTimer.connect('timeout()', self.onPlanningGridUpdateTimeout)
+
+  def setupNavigationPanelConnections(self):
+    logging.debug('setupNavigationPanelConnections')
     self.navigationCameraZoomButtonIncrease.connect('clicked()', self.cameraZoomIncrease)
     self.navigationCameraZoomButtonDecrease.connect('clicked()', self.cameraZoomDecrease)
     self.navigationCameraTranslationXIncreaseButton.connect('clicked()', self.cameraTranslationXIncrease)
@@ -836,108 +1230,110 @@ class CathNavGuidelet(Guidelet):
     self.navigationCameraTranslationYDecreaseButton.connect('clicked()', self.cameraTranslationYDecrease)
     self.navigationCameraTranslationZIncreaseButton.connect('clicked()', self.cameraTranslationZIncrease)
     self.navigationCameraButton.connect('clicked()', self.onNavigationCameraButtonClicked)
-    
-    # reconstruction panel
-    self.MarkupsToModelClosedSurfaceNode = slicer.vtkMRMLMarkupsToModelNode()
-    self.MarkupsToModelClosedSurfaceNode.SetModelType(self.MarkupsToModelClosedSurfaceNode.ClosedSurface)
-    self.MarkupsToModelClosedSurfaceNode.SetCleanMarkups(True)
-    self.MarkupsToModelClosedSurfaceNode.SetButterflySubdivision(True)
-    self.MarkupsToModelClosedSurfaceNode.SetConvexHull(True)
-    self.MarkupsToModelClosedSurfaceNode.SetDelaunayAlpha(0.0)
-    self.MarkupsToModelClosedSurfaceNode.SetAutoUpdateOutput(False)
-    self.MarkupsToModelClosedSurfaceNode.SetName('MarkupsToModel_ClosedSurfaces')
-    slicer.mrmlScene.AddNode(self.MarkupsToModelClosedSurfaceNode)
-    
-    self.MarkupsToModelCurveNode = slicer.vtkMRMLMarkupsToModelNode()
-    self.MarkupsToModelCurveNode.SetModelType(self.MarkupsToModelCurveNode.Curve)
-    self.MarkupsToModelCurveNode.SetTubeRadius(1.0)
-    self.MarkupsToModelCurveNode.SetTubeNumberOfSides(8)
-    self.MarkupsToModelCurveNode.SetTubeSamplingFrequency(5)
-    self.MarkupsToModelCurveNode.SetCleanMarkups(True)
-    self.MarkupsToModelCurveNode.SetInterpolationType(self.MarkupsToModelCurveNode.Polynomial)
-    self.MarkupsToModelCurveNode.SetPointParameterType(self.MarkupsToModelCurveNode.MinimumSpanningTree)
-    self.MarkupsToModelCurveNode.SetPolynomialOrder(9)
-    self.MarkupsToModelCurveNode.SetAutoUpdateOutput(False)
-    self.MarkupsToModelCurveNode.SetName('MarkupsToModel_CatheterPaths')
-    slicer.mrmlScene.AddNode(self.MarkupsToModelCurveNode)
-    
-    self.MarkupsToModelLogic = slicer.modules.markupstomodel.logic()
-    
+    for distanceLabel in [self.navigationSeromaDistanceLabel, self.navigationSeromaDistanceValueLabel,
+                          self.navigationChestWallDistanceLabel, self.navigationChestWallDistanceValueLabel]:
+      distanceLabel.setVisible(self.tipToSurfaceDistanceTextVisible)
+    for trajectoryLabel in [self.navigationSeromaTrajectoryLabel, self.navigationSeromaTrajectoryValueLabel,
+                            self.navigationChestWallTrajectoryLabel, self.navigationChestWallTrajectoryValueLabel]:
+      trajectoryLabel.setVisible(self.tipToSurfaceDistanceTextVisible and self.tipToSurfaceDistanceTrajectoryVisible)
+
+  def setupReconstructionPanelConnections(self):
+    logging.debug('setupReconstructionPanelConnections')
     self.reconstructionCameraButton.connect('clicked()', self.onReconstructionCameraButtonClicked)
     self.reconstructionCollectPointsButton.connect('clicked()', self.onReconstructionCollectPointsButtonClicked)
     self.reconstructionDeleteLastButton.connect('clicked()', self.onReconstructionDeleteLastButtonClicked)
+    self.reconstructionReferencePathsEdit.connect('currentPathChanged(QString)', self.onReconstructionReferencePathsChanged)
+    # the catheter analysis is shown in this panel, it is skipped until the panel exists
+    self.updateCatheterAnalysis()
+    self.reconstructionReferencePathsEdit.currentPath = self.parameterNode.GetParameter('CatheterReferencePathsFilePath')
     
-
   def disconnect(self):
     logging.debug('CathNav.disconnect()')
     Guidelet.disconnect(self)
       
-    # Remove observer to old parameter node
-    if self.tumorMarkups_Needle and self.tumorMarkups_NeedleObserver:
-      self.tumorMarkups_Needle.RemoveObserver(self.tumorMarkups_NeedleObserver)
-      self.tumorMarkups_NeedleObserver = None
-
-    if self.chestwallMarkups_Chest and self.chestwallMarkups_ChestObserver:
-      self.chestwallMarkups_Chest.RemoveObserver(self.chestwallMarkups_ChestObserver)
-      self.chestwallMarkups_ChestObserver = None
+    self.seromaSurfacePipeline.stop()
+    self.chestWallSurfacePipeline.stop()
+    self.seromaDistanceMonitor.stop()
+    self.chestWallDistanceMonitor.stop()
+    self.transformGraph.clear()
 
     self.calibrationCollapsibleButton.disconnect('toggled(bool)', self.onCalibrationPanelToggled)
-    self.navigationCollapsibleButton.disconnect('toggled(bool)', self.onNavigationPanelToggled)
+    self.guidewireCollapsibleButton.disconnect('toggled(bool)', self.onCommon3DPanelToggled)
+    self.planningCollapsibleButton.disconnect('toggled(bool)', self.onCommon3DPanelToggled)
+    self.navigationCollapsibleButton.disconnect('toggled(bool)', self.onCommon3DPanelToggled)
+    self.reconstructionCollapsibleButton.disconnect('toggled(bool)', self.onCommon3DPanelToggled)
 
     # calibration panel
-    self.calibrationGuideButton.disconnect('clicked()', self.onCalibrationGuideClicked)
-    self.calibrationNeedleButton.disconnect('clicked()', self.onCalibrationNeedleClicked)
+    if (self.isFeaturePanelCreated('calibration')):
+      self.calibrationGuideButton.disconnect('clicked()', self.onCalibrationGuideClicked)
+      self.calibrationNeedleButton.disconnect('clicked()', self.onCalibrationNeedleClicked)
+
+      self.calibrationSamplingTimer.disconnect('timeout()',self.onCalibrationSamplingTimeout)
+      self.fixedPointCalibration.stop()
+      self.pivotCalibration.stop()
 
-    self.calibrationSamplingTimer.disconnect('timeout()',self.onCalibrationSamplingTimeout)
-    
     # ultrasound panel
-    self.tumorMarkupsDeleteLastButton.disconnect('clicked()', self.onTumorMarkupsDeleteLastClicked)
-    self.tumorMarkupsDeleteAllButton.disconnect('clicked()', self.onTumorMarkupsDeleteAllClicked)
-    self.tumorMarkupsPlaceButton.disconnect('clicked(bool)', self.onTumorMarkupsPlaceClicked)
+    if (self.isFeaturePanelCreated('ultrasound')):
+      self.tumorMarkupsDeleteLastButton.disconnect('clicked()', self.onTumorMarkupsDeleteLastClicked)
+      self.tumorMarkupsDeleteAllButton.disconnect('clicked()', self.onTumorMarkupsDeleteAllClicked)
+      self.tumorMarkupsPlaceButton.disconnect('clicked(bool)', self.onTumorMarkupsPlaceClicked)
 
-    self.chestwallMarkupsPlaceButton.disconnect('clicked(bool)', self.onChestwallMarkupsPlaceClicked)
-    self.chestwallMarkupsDeleteLastButton.disconnect('clicked()', self.onChestwallMarkupsDeleteLastClicked)
-    self.chestwallMarkupsDeleteAllButton.disconnect('clicked()', self.onChestwallMarkupsDeleteAllClicked)
+      self.chestwallMarkupsPlaceButton.disconnect('clicked(bool)', self.onChestwallMarkupsPlaceClicked)
+      self.chestwallMarkupsDeleteLastButton.disconnect('clicked()', self.onChestwallMarkupsDeleteLastClicked)
+      self.chestwallMarkupsDeleteAllButton.disconnect('clicked()', self.onChestwallMarkupsDeleteAllClicked)
 
     # guidewire panel
-    self.guidewireCameraZoomButtonIncrease.disconnect('clicked()', self.cameraZoomIncrease)
-    self.guidewireCameraZoomButtonDecrease.disconnect('clicked()', self.cameraZoomDecrease)
-    self.guidewireCameraTranslationXIncreaseButton.disconnect('clicked()', self.cameraTranslationXIncrease)
-    self.guidewireCameraTranslationXDecreaseButton.disconnect('clicked()', self.cameraTranslationXDecrease)
-    self.guidewireCameraTranslationYIncreaseButton.disconnect('clicked()', self.cameraTranslationYIncrease)
-    self.guidewireCameraTranslationYDecreaseButton.disconnect('clicked()', self.cameraTranslationYDecrease)
-    self.guidewireCameraTranslationZIncreaseButton.disconnect('clicked()', self.cameraTranslationZIncrease)
-    self.guidewireCameraTranslationZDecreaseButton.disconnect('clicked()', self.cameraTranslationZDecrease)
-    self.guidewireCameraButton.disconnect('clicked()', self.onGuidewireCameraButtonClicked)
-    
+    if (self.isFeaturePanelCreated('guidewire')):
+      self.guidewireCameraZoomButtonIncrease.disconnect('clicked()', self.cameraZoomIncrease)
+      self.guidewireCameraZoomButtonDecrease.disconnect('clicked()', self.cameraZoomDecrease)
+      self.guidewireCameraTranslationXIncreaseButton.disconnect('clicked()', self.cameraTranslationXIncrease)
+      self.guidewireCameraTranslationXDecreaseButton.disconnect('clicked()', self.cameraTranslationXDecrease)
+      self.guidewireCameraTranslationYIncreaseButton.disconnect('clicked()', self.cameraTranslationYIncrease)
+      self.guidewireCameraTranslationYDecreaseButton.disconnect('clicked()', self.cameraTranslationYDecrease)
+      self.guidewireCameraTranslationZIncreaseButton.disconnect('clicked()', self.cameraTranslationZIncrease)
+      self.guidewireCameraTranslationZDecreaseButton.disconnect('clicked()', self.cameraTranslationZDecrease)
+      self.guidewireCameraButton.disconnect('clicked()', self.onGuidewireCameraButtonClicked)
+
     # planning panel
-    self.planningCreateGridButton.disconnect('clicked()', self.onCreatePlanButtonClicked)
-    self.gridRotationSlider.disconnect('valueChanged(double)', self.rotateGrid)
-    
+    if (self.isFeaturePanelCreated('planning')):
+      self.planningCreateGridButton.disconnect('clicked()', self.onCreatePlanButtonClicked)
+      self.gridRotationSlider.disconnect('valueChanged(double)', self.rotateGrid)
+      self.planningLivePreviewCheckBox.disconnect('toggled(bool)', self.onPlanningLivePreviewToggled)
+      self.planningAnatomyCheckBox.disconnect('toggled(bool)', self.onPlanningAnatomyToggled)
+      self.planningOptimizeButton.disconnect('clicked()', self.onPlanningOptimizeClicked)
+      self.planningOptimizedPosesComboBox.disconnect('activated(int)', self.onPlanningOptimizedPoseActivated)
+      self.planningGridUpdateTimer.disconnect('timeout()', self.onPlanningGridUpdateTimeout)
+
     # navigation panel
-    self.navigationCameraZoomButtonIncrease.disconnect('clicked()', self.cameraZoomIncrease)
-    self.navigationCameraZoomButtonDecrease.disconnect('clicked()', self.cameraZoomDecrease)
-    self.navigationCameraTranslationXIncreaseButton.disconnect('clicked()', self.cameraTranslationXIncrease)
-    self.navigationCameraTranslationXDecreaseButton.disconnect('clicked()', self.cameraTranslationXDecrease)
-    self.navigationCameraTranslationYIncreaseButton.disconnect('clicked()', self.cameraTranslationYIncrease)
-    self.navigationCameraTranslationYDecreaseButton.disconnect('clicked()', self.cameraTranslationYDecrease)
-    self.navigationCameraTranslationZIncreaseButton.disconnect('clicked()', self.cameraTranslationZIncrease)
-    self.navigationCameraTranslationZDecreaseButton.disconnect('clicked()', self.cameraTranslationZDecrease)
-    self.navigationCameraButton.disconnect('clicked()', self.onNavigationCameraButtonClicked)
-    
+    if (self.isFeaturePanelCreated('navigation')):
+      self.navigationCameraZoomButtonIncrease.disconnect('clicked()', self.cameraZoomIncrease)
+      self.navigationCameraZoomButtonDecrease.disconnect('clicked()', self.cameraZoomDecrease)
+      self.navigationCameraTranslationXIncreaseButton.disconnect('clicked()', self.cameraTranslationXIncrease)
+      self.navigationCameraTranslationXDecreaseButton.disconnect('clicked()', self.cameraTranslationXDecrease)
+      self.navigationCameraTranslationYIncreaseButton.disconnect('clicked()', self.cameraTranslationYIncrease)
+      self.navigationCameraTranslationYDecreaseButton.disconnect('clicked()', self.cameraTranslationYDecrease)
+      self.navigationCameraTranslationZIncreaseButton.disconnect('clicked()', self.cameraTranslationZIncrease)
+      self.navigationCameraTranslationZDecreaseButton.disconnect('clicked()', self.cameraTranslationZDecrease)
+      self.navigationCameraButton.disconnect('clicked()', self.onNavigationCameraButtonClicked)
+
     # reconstruction panel
-    self.reconstructionCameraButton.disconnect('clicked()', self.onReconstructionCameraButtonClicked)
-    self.reconstructionCollectPointsButton.disconnect('clicked()', self.onReconstructionCollectPointsButtonClicked)
-    self.reconstructionDeleteLastButton.disconnect('clicked()', self.onReconstructionDeleteLastButtonClicked)
+    if (self.isFeaturePanelCreated('reconstruction')):
+      self.reconstructionCameraButton.disconnect('clicked()', self.onReconstructionCameraButtonClicked)
+      self.reconstructionCollectPointsButton.disconnect('clicked()', self.onReconstructionCollectPointsButtonClicked)
+      self.reconstructionDeleteLastButton.disconnect('clicked()', self.onReconstructionDeleteLastButtonClicked)
+      self.reconstructionReferencePathsEdit.disconnect('currentPathChanged(QString)', self.onReconstructionReferencePathsChanged)
 
   def onCalibrationPanelToggled(self, toggled):
     if toggled == False:
       return
     logging.debug('onCalibrationPanelToggled')
+    self.createFeaturePanelContents('calibration')
     self.onPanelToggledCommonTasks()
     self.selectView(self.VIEW_ULTRASOUND_3D) 
 
   def onUltrasoundPanelToggled(self, toggled):
+    if toggled:
+      self.createFeaturePanelContents('ultrasound')
     Guidelet.onUltrasoundPanelToggled(self, toggled)
     self.onPanelToggledCommonTasks()
     # The user may want to freeze the image (disconnect) to make contouring easier.
@@ -949,6 +1345,10 @@ class CathNavGuidelet(Guidelet):
     if toggled == False:
       return
     logging.debug('onCommon3DPanelToggled')
+    # the signal does not tell which panel was expanded, but it is the only one that is not collapsed
+    for panelName in self.common3DPanelButtons:
+      if (self.common3DPanelButtons[panelName].collapsed == False):
+        self.createFeaturePanelContents(panelName)
     self.onPanelToggledCommonTasks()
     self.selectView(self.VIEW_3D)
     
@@ -973,7 +1373,7 @@ class CathNavGuidelet(Guidelet):
     
   def onCalibrationGuideClicked(self):
     logging.debug('onCalibrationGuideClicked')
-    self.startFixedPointCalibration('GuideTipToGuide', self.needleTipToNeedle, self.guideToChest, self.needleTipMarkups_Guide, self.guideTipToGuide)
+    self.startFixedPointCalibration('GuideTipToGuide', self.needleTipToNeedle, self.guideToChest, self.guideTipToGuide)
     
   def startPivotCalibration(self, toolToReferenceTransformName, toolToReferenceTransformNode, toolTipToToolTransformNode):
     logging.debug('startPivotCalibration')
@@ -981,34 +1381,37 @@ class CathNavGuidelet(Guidelet):
     self.calibrationGuideButton.setEnabled(False)
     self.pivotCalibrationResultTargetNode =  toolTipToToolTransformNode
     self.pivotCalibrationResultTargetName = toolToReferenceTransformName
-    self.pivotCalibrationLogic.SetAndObserveTransformNode( toolToReferenceTransformNode );
+    self.pivotCalibration.setTransformNode(toolToReferenceTransformNode)
+    self.pivotCalibration.start()
     self.calibrationStopTime=time.time()+float(self.parameterNode.GetParameter('PivotCalibrationDurationSec'))
-    self.pivotCalibrationLogic.SetRecordingState(True)
-    self.onCalibrationSamplingTimeout()
     self.currentCalibration = self.currentCalibration_PIVOT
+    self.onCalibrationSamplingTimeout()
     
-  def startFixedPointCalibration(self, toolPointToToolSensorTransformName, pointerTipTransformNode, toolSensorTransformNode, pointerTipMarkups_toolSensorNode, toolPointToToolSensorTransformNode):
+  def startFixedPointCalibration(self, toolPointToToolSensorTransformName, pointerTipTransformNode, toolSensorTransformNode, toolPointToToolSensorTransformNode):
     logging.debug('startFixedPointCalibration')
     self.calibrationNeedleButton.setEnabled(False)
     self.calibrationGuideButton.setEnabled(False)
-    pointerTipMarkups_toolSensorNode.RemoveAllMarkups()
-    self.collectFiducialsSupplementLogic.setMinimumAddDistanceMm(0)
-    self.collectFiducialsSupplementLogic.setTransformSourceNode(pointerTipTransformNode)
-    self.collectFiducialsSupplementLogic.setTransformTargetNode(toolSensorTransformNode)
-    self.collectFiducialsSupplementLogic.setMarkupsFiducialNode(pointerTipMarkups_toolSensorNode)
-    self.collectFiducialsSupplementLogic.setAllowPointRemovalsFalse()
-    self.collectFiducialsSupplementLogic.setForceConstantPointDistanceFalse()
-    self.collectFiducialsSupplementLogic.startCollection()
+    self.fixedPointCalibration.setTransformNodes(pointerTipTransformNode, toolSensorTransformNode)
+    self.fixedPointCalibration.start()
     self.calibrationStopTime=time.time()+float(self.parameterNode.GetParameter('FixedPointCalibrationDurationSec'))
     self.currentCalibration = self.currentCalibration_FIXED_POINT
-    self.fixedPointCalibrationMarkups = pointerTipMarkups_toolSensorNode
     self.fixedPointCalibrationTargetTransformNode = toolPointToToolSensorTransformNode
     self.fixedPointCalibrationTargetTransformName = toolPointToToolSensorTransformName
     self.onCalibrationSamplingTimeout()
     
   def onCalibrationSamplingTimeout(self):
-    self.countdownLabel.setText("Calibrating for {0:.0f} more seconds".format(self.calibrationStopTime-time.time())) 
-    if(time.time()<self.calibrationStopTime):
+    countdownText = "Calibrating for {0:.0f} more seconds".format(self.calibrationStopTime-time.time())
+    if (self.currentCalibration == self.currentCalibration_FIXED_POINT and self.fixedPointCalibration.getNumberOfSamples() > 0):
+      countdownText = countdownText + ", error = {0:.2f} mm".format(self.fixedPointCalibration.getRMSEMm())
+    pivotCalibrationConverged = False
+    if (self.currentCalibration == self.currentCalibration_PIVOT):
+      if (self.pivotCalibration.updateEstimate() == True):
+        countdownText = countdownText + ", error = {0:.2f} mm, tip = ({1:.1f}, {2:.1f}, {3:.1f}) mm".format(self.pivotCalibration.rmseMm, *self.pivotCalibration.tipMm)
+        pivotCalibrationConverged = self.pivotCalibration.isConverged()
+      else:
+        countdownText = countdownText + ", keep swivelling the tool"
+    self.countdownLabel.setText(countdownText)
+    if(time.time()<self.calibrationStopTime and pivotCalibrationConverged == False):
       # continue
       self.calibrationSamplingTimer.start()
     else:
@@ -1022,30 +1425,36 @@ class CathNavGuidelet(Guidelet):
         self.countdownLabel.setText("An internal error occurred. No calibration performed")        
 
   def onStopPivotCalibration(self):
+    # called when the estimate has converged, whether the error is small enough or not, or when the time is up
     logging.debug('onStopPivotCalibration')
-    self.pivotCalibrationLogic.SetRecordingState(False)
+    self.pivotCalibration.stop()
     self.calibrationNeedleButton.setEnabled(True)
     self.calibrationGuideButton.setEnabled(True)
-    self.pivotCalibrationLogic.ComputePivotCalibration()
-    if(self.pivotCalibrationLogic.GetPivotRMSE() >= float(self.parameterNode.GetParameter('PivotCalibrationErrorThresholdMm'))):
-      self.countdownLabel.setText("Calibration failed, error = %f mm, please calibrate again!"  % self.pivotCalibrationLogic.GetPivotRMSE())
-      self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
+    if (self.pivotCalibration.updateEstimate() == False):
+      self.countdownLabel.setText("Calibration failed, the tool was not swivelled enough, please calibrate again!")
+      return
+    if(self.pivotCalibration.rmseMm >= float(self.parameterNode.GetParameter('PivotCalibrationErrorThresholdMm'))):
+      self.countdownLabel.setText("Calibration failed, error = %f mm, please calibrate again!"  % self.pivotCalibration.rmseMm)
       return
     tooltipToToolMatrix = vtk.vtkMatrix4x4()
-    self.pivotCalibrationLogic.GetToolTipToToolMatrix(tooltipToToolMatrix)
-    self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
+    self.pivotCalibration.getToolTipToToolMatrix(tooltipToToolMatrix)
     self.pivotCalibrationResultTargetNode.SetMatrixTransformToParent(tooltipToToolMatrix)
     self.logic.writeTransformToSettings(self.pivotCalibrationResultTargetName, tooltipToToolMatrix, self.configurationName)
-    self.countdownLabel.setText("Calibration completed, error = %f mm" % self.pivotCalibrationLogic.GetPivotRMSE())
-    logging.debug("Pivot calibration completed. Tool: {0}. RMSE = {1} mm".format(self.pivotCalibrationResultTargetNode.GetName(), self.pivotCalibrationLogic.GetPivotRMSE()))
+    self.countdownLabel.setText("Calibration completed, error = %f mm" % self.pivotCalibration.rmseMm)
+    logging.debug("Pivot calibration completed. Tool: {0}. RMSE = {1} mm. Samples: {2}".format(self.pivotCalibrationResultTargetNode.GetName(), self.pivotCalibration.rmseMm, self.pivotCalibration.getNumberOfSamples()))
     
   def onStopFixedPointCalibration(self):
     logging.debug('onStopFixedPointCalibration')
-    self.collectFiducialsSupplementLogic.stopCollection()
+    self.fixedPointCalibration.stop()
     self.calibrationNeedleButton.setEnabled(True)
     self.calibrationGuideButton.setEnabled(True)
-    vectorToolPointToToolSensorMm = self.computeAverageOfMarkups(self.fixedPointCalibrationMarkups)
-    rmseToolSensorToToolPointMm = self.computeRMSEOfPointToMarkups(vectorToolPointToToolSensorMm,self.fixedPointCalibrationMarkups)
+    calibration = self.fixedPointCalibration.computeCalibration()
+    if (calibration is None):
+      self.countdownLabel.setText("Calibration failed, no tracking data was received, please calibrate again!")
+      return
+    vectorToolPointToToolSensorMm = calibration['pointMm']
+    rmseToolSensorToToolPointMm = calibration['rmseMm']
+    numberOfOutliers = calibration['numberOfSamples'] - calibration['numberOfInliers']
     if (rmseToolSensorToToolPointMm >= float(self.parameterNode.GetParameter('FixedPointCalibrationErrorThresholdMm'))):
       self.countdownLabel.setText("Calibration failed, error = %f mm, please calibrate again!"  % rmseToolSensorToToolPointMm)
       return
@@ -1055,50 +1464,8 @@ class CathNavGuidelet(Guidelet):
     toolPointToToolSensorMatrix.SetElement( 2, 3, vectorToolPointToToolSensorMm[2] )
     self.logic.writeTransformToSettings(self.fixedPointCalibrationTargetTransformName, toolPointToToolSensorMatrix, self.configurationName)
     self.fixedPointCalibrationTargetTransformNode.SetMatrixTransformToParent(toolPointToToolSensorMatrix)
-    self.countdownLabel.setText("Calibration completed, error = %f mm" % rmseToolSensorToToolPointMm)
-    logging.debug("Fixed point calibration completed. Tool: {0}. RMSE = {1} mm".format(self.fixedPointCalibrationTargetTransformNode.GetName(), rmseToolSensorToToolPointMm))
-    
-  def computeAverageOfMarkups(self, markupsFiducialNode):
-    logging.debug('computeAverageOfMarkups')
-    numberOfMarkups = markupsFiducialNode.GetNumberOfFiducials()
-    logging.debug(numberOfMarkups)
-    if (numberOfMarkups == 0):
-      logging.error("Number of markups for fixed point calibration is 0. Returning [0,0,0]")
-      pointMm = [0.0,0.0,0.0]
-      return pointMm
-    currentIndex = 0
-    sumOfPointsMm = [0.0,0.0,0.0]
-    while currentIndex < numberOfMarkups:
-      pointMm = [0.0,0.0,0.0]
-      markupsFiducialNode.GetNthFiducialPosition(currentIndex,pointMm)
-      sumOfPointsMm[0] = sumOfPointsMm[0] + pointMm[0]
-      sumOfPointsMm[1] = sumOfPointsMm[1] + pointMm[1]
-      sumOfPointsMm[2] = sumOfPointsMm[2] + pointMm[2]
-      currentIndex = currentIndex + 1
-    avgOfPointsMm = sumOfPointsMm
-    avgOfPointsMm[0] = float(avgOfPointsMm[0]) / float(numberOfMarkups)
-    avgOfPointsMm[1] = float(avgOfPointsMm[1]) / float(numberOfMarkups)
-    avgOfPointsMm[2] = float(avgOfPointsMm[2]) / float(numberOfMarkups)
-    return avgOfPointsMm
-    
-  def computeRMSEOfPointToMarkups(self, toolPointMm, markupsFiducialNode):
-    logging.debug('computeRMSEOfPointToMarkups')
-    numberOfMarkups = markupsFiducialNode.GetNumberOfFiducials()
-    if (numberOfMarkups == 0):
-      logging.error("Number of markups for fixed point calibration is 0. Returning 1000 mm error.")
-      errorMm = 1000.0
-      return errorMm;
-    currentIndex = 0
-    sumSqDifferencesMm = 0.0
-    while currentIndex < numberOfMarkups:
-      markupPointMm = [0.0,0.0,0.0]
-      markupsFiducialNode.GetNthFiducialPosition(currentIndex,markupPointMm)
-      sqDifferenceMm = (toolPointMm[0] - markupPointMm[0])**2 + (toolPointMm[1] - markupPointMm[1])**2 + (toolPointMm[2] - markupPointMm[2])**2
-      sumSqDifferencesMm = sumSqDifferencesMm + sqDifferenceMm
-      currentIndex = currentIndex + 1
-    meanSqDifferenceMm = float(sumSqDifferencesMm) / float(numberOfMarkups)
-    rootMeanSqDifferenceMm = meanSqDifferenceMm ** (0.5)
-    return rootMeanSqDifferenceMm
+    self.countdownLabel.setText("Calibration completed, error = %f mm (%d of %d samples rejected)" % (rmseToolSensorToToolPointMm, numberOfOutliers, calibration['numberOfSamples']))
+    logging.debug("Fixed point calibration completed. Tool: {0}. RMSE = {1} mm. Outliers: {2} of {3} samples".format(self.fixedPointCalibrationTargetTransformNode.GetName(), rmseToolSensorToToolPointMm, numberOfOutliers, calibration['numberOfSamples']))
     
   # ========== ULTRASOUND PANEL FUNCTIONS ===========
 
@@ -1172,18 +1539,6 @@ class CathNavGuidelet(Guidelet):
     newMarkupsObserver = node.AddObserver(vtk.vtkCommand.ModifiedEvent, method)
     return newMarkupsObserver
 
-  def onTumorMarkupsNodeModified(self, observer, eventid):
-    logging.debug('onTumorMarkupsNodeModified')
-    self.MarkupsToModelClosedSurfaceNode.SetAndObserveMarkupsNodeID(self.tumorMarkups_Needle.GetID())
-    self.MarkupsToModelClosedSurfaceNode.SetAndObserveModelNodeID(self.tumorModel_Needle.GetID())
-    self.MarkupsToModelLogic.UpdateOutputModel(self.MarkupsToModelClosedSurfaceNode)
-
-  def onChestwallMarkupsNodeModified(self, observer, eventid):
-    logging.debug('onChestwallMarkupsNodeModified')
-    self.MarkupsToModelClosedSurfaceNode.SetAndObserveMarkupsNodeID(self.chestwallMarkups_Chest.GetID())
-    self.MarkupsToModelClosedSurfaceNode.SetAndObserveModelNodeID(self.chestwallModel_Chest.GetID())
-    self.MarkupsToModelLogic.UpdateOutputModel(self.MarkupsToModelClosedSurfaceNode)
-
 
   # ========== GUIDE WIRE PANEL FUNCTIONS ===========
   
@@ -1192,7 +1547,7 @@ class CathNavGuidelet(Guidelet):
     matrixPlanToNeedle = vtk.vtkMatrix4x4()
     needleTransformNode = self.needleToChest
     gridTransformNode = self.guideCameraToGuideModel # we take a snapshot of the guide's position
-    gridTransformNode.GetMatrixTransformToNode(needleTransformNode,matrixPlanToNeedle)
+    self.transformGraph.getMatrixTransformToNode(gridTransformNode,needleTransformNode,matrixPlanToNeedle)
     self.planToNeedle.SetMatrixTransformToParent(matrixPlanToNeedle)
     # =========== PLANNING PANEL FUNCTIONS ============
     
@@ -1201,76 +1556,92 @@ class CathNavGuidelet(Guidelet):
     gridSpacingHorizontalMaxMm = 20
     if self.gridSpacingHorizontalMm < gridSpacingHorizontalMaxMm:
       self.gridSpacingHorizontalMm = self.gridSpacingHorizontalMm + 1
+    self.schedulePlanningGridUpdate()
   
   def gridSpacingHorizontalDecrease(self):
     logging.debug('gridSpacingHorizontalDecrease')
     gridSpacingHorizontalMinMm = 1
     if self.gridSpacingHorizontalMm > gridSpacingHorizontalMinMm:
       self.gridSpacingHorizontalMm = self.gridSpacingHorizontalMm - 1
+    self.schedulePlanningGridUpdate()
   
   def gridSpacingVerticalIncrease(self):
     logging.debug('gridSpacingVerticalIncrease')
     gridSpacingVerticalMaxMm = 20
     if self.gridSpacingVerticalMm < gridSpacingVerticalMaxMm:
       self.gridSpacingVerticalMm = self.gridSpacingVerticalMm + 1
+    self.schedulePlanningGridUpdate()
   
   def gridSpacingVerticalDecrease(self):
     logging.debug('gridSpacingVerticalDecrease')
     gridSpacingVerticalMinMm = 1
     if self.gridSpacingVerticalMm > gridSpacingVerticalMinMm:
       self.gridSpacingVerticalMm = self.gridSpacingVerticalMm - 1
+    self.schedulePlanningGridUpdate()
     
   def gridSizeLeftIncrease(self):
     logging.debug('gridSizeLeftIncrease')
     gridSizeLeftMaxNumPoints = 10
     if self.gridSizeLeftNumPoints < gridSizeLeftMaxNumPoints:
       self.gridSizeLeftNumPoints = self.gridSizeLeftNumPoints + 1
+    self.schedulePlanningGridUpdate()
     
   def gridSizeLeftDecrease(self):
     logging.debug('gridSizeLeftDecrease')
     gridSizeLeftMinNumPoints = 0
     if self.gridSizeLeftNumPoints > gridSizeLeftMinNumPoints:
       self.gridSizeLeftNumPoints = self.gridSizeLeftNumPoints - 1
+    self.schedulePlanningGridUpdate()
     
   def gridSizeRightIncrease(self):
     logging.debug('gridSizeRightIncrease')
     gridSizeRightMaxNumPoints = 10
     if self.gridSizeRightNumPoints < gridSizeRightMaxNumPoints:
       self.gridSizeRightNumPoints = self.gridSizeRightNumPoints + 1
+    self.schedulePlanningGridUpdate()
     
   def gridSizeRightDecrease(self):
     logging.debug('gridSizeRightDecrease')
     gridSizeRightMinNumPoints = 0
     if self.gridSizeRightNumPoints > gridSizeRightMinNumPoints:
       self.gridSizeRightNumPoints = self.gridSizeRightNumPoints - 1
+    self.schedulePlanningGridUpdate()
     
   def gridSizeUpIncrease(self):
     logging.debug('gridSizeUpIncrease')
     gridSizeUpMaxNumPoints = 10
     if self.gridSizeUpNumPoints < gridSizeUpMaxNumPoints:
       self.gridSizeUpNumPoints = self.gridSizeUpNumPoints + 1
+    self.schedulePlanningGridUpdate()
     
   def gridSizeUpDecrease(self):
     logging.debug('gridSizeUpDecrease')
     gridSizeUpMinNumPoints = 0
     if self.gridSizeUpNumPoints > gridSizeUpMinNumPoints:
       self.gridSizeUpNumPoints = self.gridSizeUpNumPoints - 1
+    self.schedulePlanningGridUpdate()
     
   def gridSizeDownIncrease(self):
     logging.debug('gridSizeDownIncrease')
     gridSizeDownMaxNumPoints = 10
     if self.gridSizeDownNumPoints < gridSizeDownMaxNumPoints:
       self.gridSizeDownNumPoints = self.gridSizeDownNumPoints + 1
+    self.schedulePlanningGridUpdate()
     
   def gridSizeDownDecrease(self):
     logging.debug('gridSizeDownDecrease')
     gridSizeDownMinNumPoints = 0
     if self.gridSizeDownNumPoints > gridSizeDownMinNumPoints:
       self.gridSizeDownNumPoints = self.gridSizeDownNumPoints - 1
+    self.schedulePlanningGridUpdate()
        
   def onCreatePlanButtonClicked(self):
     logging.debug("onCreatePlanButtonClicked")
     self.recordGuidePosition() #TODO: Move this function elsewhere?
+    self.updatePlanningGrid()
+    
+  def updatePlanningGrid(self):
+    logging.debug("updatePlanningGrid")
     # update grid parameters
     gridSizeLeftMm = self.gridSizeLeftNumPoints * self.gridSpacingHorizontalMm
     gridSizeRightMm = self.gridSizeRightNumPoints * self.gridSpacingHorizontalMm
@@ -1284,8 +1655,85 @@ class CathNavGuidelet(Guidelet):
     self.planningLogic.setGridSizeUpMm(gridSizeUpMm)
     self.planningLogic.setGridSizeDownMm(gridSizeDownMm)
     self.planningLogic.setTransformGridToTargetNode(self.gridToPlan)
-    # update/create the grid
+    # update/create the grid, the existing grid model is updated in place
     self.planningLogic.createGrid()
+    self.updatePlanningGridAnatomy()
+    
+  def onPlanningAnatomyToggled(self, toggled):
+    logging.debug('onPlanningAnatomyToggled')
+    if not toggled:
+      self.planningLogic.setHoleLabels(None, None)
+      self.planningAnatomyLabel.setText("")
+      return
+    self.updatePlanningGridAnatomy()
+    
+  def updatePlanningGridAnatomy(self):
+    if not self.planningAnatomyCheckBox.checked:
+      return
+    self.planningAnatomyLogic.setTargetModelNode(self.tumorModel_Needle)
+    self.planningAnatomyLogic.setObstacleModelNode(self.chestwallModel_Chest)
+    results = self.planningAnatomyLogic.updateGridHoleLabels(self.planningLogic)
+    if results is None:
+      return
+    holeLabels = results['holeLabels']
+    self.planningAnatomyLabel.setText("Usable: {0}, unsafe: {1}, missing seroma: {2}".format(
+      numpy.count_nonzero(holeLabels == self.planningAnatomyLogic.holeLabelUsable),
+      numpy.count_nonzero(holeLabels == self.planningAnatomyLogic.holeLabelUnsafe),
+      numpy.count_nonzero(holeLabels == self.planningAnatomyLogic.holeLabelMissesTarget)))
+    
+  def onPlanningLivePreviewToggled(self, toggled):
+    logging.debug('onPlanningLivePreviewToggled')
+    self.planningGridUpdateMaxLatencySec = 0
+    self.schedulePlanningGridUpdate()
+    
+  def schedulePlanningGridUpdate(self):
+    # A burst of parameter changes within one timer interval results in a single grid update
+    if not self.planningLivePreviewCheckBox.checked:
+      return
+    if not self.planningGridUpdateTimer.isActive():
+      self.planningGridUpdateTimer.start()
+      
+  def onPlanningGridUpdateTimeout(self):
+    if not self.planningLogic.outputModelNode: # nothing to preview until the grid is created
+      return
+    startTimeSec = time.time()
+    self.updatePlanningGrid()
+    latencySec = time.time() - startTimeSec
+    self.planningGridUpdateMaxLatencySec = max(self.planningGridUpdateMaxLatencySec, latencySec)
+    self.planningGridUpdateLatencyLabel.setText("Grid update: {0:.1f} ms (max {1:.1f} ms)".format(latencySec * 1000, self.planningGridUpdateMaxLatencySec * 1000))
+    if latencySec > self.gridPreviewFrameBudgetSec:
+      logging.warning("Grid update took {0:.1f} ms, longer than one display frame".format(latencySec * 1000))
+    
+  def onPlanningOptimizeClicked(self):
+    logging.debug('onPlanningOptimizeClicked')
+    if not self.planningLogic.outputModelNode: # the search is done in the coordinate system of the recorded guide position
+      self.planningAnatomyLabel.setText("Create the grid before optimizing it")
+      return
+    self.planningLogic.setGridPatternToTriangular()
+    self.planningLogic.setTransformGridToTargetNode(self.gridToPlan)
+    self.planningPoseOptimizerLogic.setTargetModelNode(self.tumorModel_Needle)
+    self.planningPoseOptimizerLogic.setObstacleModelNode(self.chestwallModel_Chest)
+    self.planningOptimizedPoses = self.planningPoseOptimizerLogic.optimizeGridPose(self.planningLogic)
+    self.planningOptimizedPosesComboBox.clear()
+    for pose in self.planningOptimizedPoses:
+      self.planningOptimizedPosesComboBox.addItem("{0} usable / {1} holes, {2:.0f} deg".format(pose['usableHoles'], pose['totalHoles'], pose['rotationDeg']))
+    self.planningOptimizedPosesComboBox.setEnabled(len(self.planningOptimizedPoses) > 0)
+    if self.planningOptimizedPoses:
+      self.onPlanningOptimizedPoseActivated(0)
+    
+  def onPlanningOptimizedPoseActivated(self, poseIndex):
+    logging.debug('onPlanningOptimizedPoseActivated')
+    if poseIndex < 0 or poseIndex >= len(self.planningOptimizedPoses):
+      return
+    pose = self.planningOptimizedPoses[poseIndex]
+    self.gridSpacingHorizontalMm = pose['gridSpacingHorizontalMm']
+    self.gridSpacingVerticalMm = pose['gridSpacingVerticalMm']
+    self.gridSizeLeftNumPoints = pose['gridSizeLeftNumPoints']
+    self.gridSizeRightNumPoints = pose['gridSizeRightNumPoints']
+    self.gridSizeUpNumPoints = pose['gridSizeUpNumPoints']
+    self.gridSizeDownNumPoints = pose['gridSizeDownNumPoints']
+    self.updatePlanningGrid()
+    self.gridRotationSlider.value = pose['rotationDeg'] # rotates the grid through rotateGrid
     
   def rotateGrid(self, value):
     logging.debug('rotateGrid')
@@ -1293,6 +1741,7 @@ class CathNavGuidelet(Guidelet):
     transformGridToPlan.RotateZ(value)
     matrixGridToPlan = transformGridToPlan.GetMatrix()
     self.gridToPlan.SetMatrixTransformToParent(matrixGridToPlan)
+    self.updatePlanningGridAnatomy()
  
   # ========== NAVIGATION PANEL FUNCTIONS ===========
   
@@ -1354,6 +1803,8 @@ class CathNavGuidelet(Guidelet):
 
   def setEnableGuidewireCameraControls(self, enable):
     logging.debug('setEnableGuidewireCameraControls')
+    if (not self.isFeaturePanelCreated('guidewire')):
+      return
     self.guidewireCameraZoomButtonIncrease.setEnabled(enable)
     self.guidewireCameraZoomButtonDecrease.setEnabled(enable)
     self.guidewireCameraTranslationXIncreaseButton.setEnabled(enable)
@@ -1365,6 +1816,8 @@ class CathNavGuidelet(Guidelet):
 
   def setEnableNavigationCameraControls(self, enable):
     logging.debug('setEnableNavigationCameraControls')
+    if (not self.isFeaturePanelCreated('navigation')):
+      return
     self.navigationCameraZoomButtonIncrease.setEnabled(enable)
     self.navigationCameraZoomButtonDecrease.setEnabled(enable)
     self.navigationCameraTranslationXIncreaseButton.setEnabled(enable)
@@ -1391,11 +1844,41 @@ class CathNavGuidelet(Guidelet):
     else:
       self.setEnableNavigationCameraControls(False)
       self.disableViewpoint()
-      
+
+  def onSeromaDistanceChanged(self, distanceMm, closestPointRas):
+    self.updateTipToSurfaceDistanceDisplay(self.navigationSeromaDistanceValueLabel, 0, self.tipToSurfaceDistanceCrossHairVisible,
+                                           distanceMm, closestPointRas)
+
+  def onChestWallDistanceChanged(self, distanceMm, closestPointRas):
+    self.updateTipToSurfaceDistanceDisplay(self.navigationChestWallDistanceValueLabel, 1, self.tipToSurfaceDistanceCrossHairVisible,
+                                           distanceMm, closestPointRas)
+
+  def onSeromaTrajectoryDistanceChanged(self, distanceMm, hitPointRas):
+    self.updateTipToSurfaceDistanceDisplay(self.navigationSeromaTrajectoryValueLabel, 2, self.tipToSurfaceDistanceTrajectoryVisible,
+                                           distanceMm, hitPointRas)
+
+  def onChestWallTrajectoryDistanceChanged(self, distanceMm, hitPointRas):
+    self.updateTipToSurfaceDistanceDisplay(self.navigationChestWallTrajectoryValueLabel, 3, self.tipToSurfaceDistanceTrajectoryVisible,
+                                           distanceMm, hitPointRas)
+
+  def updateTipToSurfaceDistanceDisplay(self, distanceValueLabel, pointIndex, pointVisible, distanceMm, pointRas):
+    # no logging here, it is called for every tracker frame
+    if (self.tipToSurfaceDistanceTextVisible and distanceValueLabel is not None):
+      if (distanceMm is None):
+        distanceValueLabel.setText("-")
+      else:
+        distanceValueLabel.setText("{0:.1f}".format(distanceMm))
+    if (pointVisible):
+      if (distanceMm is None):
+        self.tipToSurfaceClosestPoints_Ras.SetNthFiducialVisibility(pointIndex, False)
+        return
+      self.tipToSurfaceClosestPoints_Ras.SetNthFiducialPositionFromArray(pointIndex, pointRas)
+      self.tipToSurfaceClosestPoints_Ras.SetNthFiducialVisibility(pointIndex, True)
+
   def updateViewpointCameraParameters(self):
     logging.debug('updateViewpointCameraParameters')
     viewNode = self.getViewNode('View1')
-    viewpointInstance = self.viewpointLogic.getViewpointForViewNode(viewNode)
+    viewpointInstance = self.getViewpointLogic().getViewpointForViewNode(viewNode)
     viewpointInstance.bullseyeSetCameraXPosMm(self.cameraTranslationXMm)
     viewpointInstance.bullseyeSetCameraYPosMm(self.cameraTranslationYMm)
     viewpointInstance.bullseyeSetCameraZPosMm(self.cameraTranslationZMm)
@@ -1405,7 +1888,7 @@ class CathNavGuidelet(Guidelet):
   def enableViewpoint(self, cameraToTargetNode):
     logging.debug('enableViewpoint')
     viewNode = self.getViewNode('View1')
-    viewpointInstance = self.viewpointLogic.getViewpointForViewNode(viewNode)
+    viewpointInstance = self.getViewpointLogic().getViewpointForViewNode(viewNode)
     viewpointInstance.setViewNode(viewNode)
     viewpointInstance.bullseyeSetTransformNode(cameraToTargetNode)
     viewpointInstance.bullseyeSetCameraParallelProjection(True)
@@ -1414,11 +1897,27 @@ class CathNavGuidelet(Guidelet):
     
   def disableViewpoint(self):
     logging.debug('disableViewpoint')
+    if (self.viewpointLogic is None):
+      return # never enabled
     viewNode = self.getViewNode('View1')
     viewpointInstance = self.viewpointLogic.getViewpointForViewNode(viewNode)
     if (viewpointInstance.isCurrentModeBullseye()):
       viewpointInstance.bullseyeStop()
 
+  def getViewpointLogic(self):
+    if (self.viewpointLogic is None):
+      import Viewpoint
+      self.viewpointLogic = Viewpoint.ViewpointLogic()
+    return self.viewpointLogic
+
+  def getCollectFiducialsSupplementLogic(self):
+    if (self.collectFiducialsSupplementLogic is None):
+      import CollectFiducialsSupplement
+      self.collectFiducialsSupplementLogic = CollectFiducialsSupplement.CollectFiducialsSupplementLogic()
+      self.collectFiducialsSupplementLogic.setTransformGraph(self.transformGraph)
+      self.collectFiducialsSupplementLogic.setDisplayUpdateRateHz(float(self.parameterNode.GetParameter('PointCollectionDisplayUpdateRateHz')))
+    return self.collectFiducialsSupplementLogic
+
   def getViewNode(self, viewName):
     """
     Get the view node for the selected 3D view
@@ -1434,78 +1933,240 @@ class CathNavGuidelet(Guidelet):
   
   def startPointCollection(self):
     logging.debug('startPointCollection')
-    self.collectFiducialsSupplementLogic.setMinimumAddDistanceMm(1) # collect points every 0.1 mm
-    self.collectFiducialsSupplementLogic.setTransformSourceNode(self.wireToChest)
-    self.collectFiducialsSupplementLogic.setTransformTargetNode(self.needleToChest)
-    self.collectFiducialsSupplementLogic.setMarkupsFiducialNode(self.wirePoints_Needle)
-    self.collectFiducialsSupplementLogic.setAllowPointRemovalsTrue()
-    self.collectFiducialsSupplementLogic.setForceConstantPointDistanceFalse()
-    self.collectFiducialsSupplementLogic.startCollection()
-    self.wirePoints_Needle.RemoveAllMarkups()
+    collectFiducialsSupplementLogic = self.getCollectFiducialsSupplementLogic()
+    collectFiducialsSupplementLogic.setMinimumAddDistanceMm(1) # collect points every 0.1 mm
+    collectFiducialsSupplementLogic.setTransformSourceNode(self.wireToChest)
+    collectFiducialsSupplementLogic.setTransformTargetNode(self.needleToChest)
+    collectFiducialsSupplementLogic.setMarkupsFiducialNode(self.wirePoints_Needle)
+    collectFiducialsSupplementLogic.setAllowPointRemovalsTrue()
+    collectFiducialsSupplementLogic.setForceConstantPointDistanceFalse()
+    self.wirePoints_Needle.RemoveAllMarkups() # before starting, the collector picks up the points already in the list
+    collectFiducialsSupplementLogic.startCollection()
+    collectFiducialsSupplementLogic.addPointListener(self.catheterCurveFit) # live curve, updated on every sample
+    self.catheterReconstructionLogic.resetRebuildStatistics()
     self.wirePoints_NeedleObserver = self.setAndObserveNode(self.wirePoints_Needle, self.wirePoints_NeedleObserver, self.onWireMarkupsNodeModified)
     self.pathCount = self.pathCount + 1
+    if self.reconstructionRecordTrackingCheckBox.checked:
+      self.startTrackingRecording()
     logging.debug('startPointCollection end')
     
+  def startTrackingRecording(self):
+    logging.debug('startTrackingRecording')
+    recordingFilePath = self.trackingRecorderLogic.getDefaultRecordingFilePath(self.parameterNode.GetParameter('SavedScenesDirectory'),
+                                                                               self.parameterNode.GetParameter('RecordingFilenamePrefix'))
+    self.trackingRecorderLogic.startRecording(recordingFilePath, [self.guideToChest, self.needleToChest, self.wireToChest])
+    
   def stopPointCollection(self):
     # Stop collection
-    self.collectFiducialsSupplementLogic.stopCollection()
+    collectFiducialsSupplementLogic = self.getCollectFiducialsSupplementLogic()
+    collectFiducialsSupplementLogic.stopCollection()
+    collectFiducialsSupplementLogic.removePointListener(self.catheterCurveFit)
+    self.trackingRecorderLogic.stopRecording()
     if self.wirePoints_Needle and self.wirePoints_NeedleObserver:
       self.wirePoints_Needle.RemoveObserver(self.wirePoints_NeedleObserver)
       self.wirePoints_NeedleObserver = None
     
-    # Create a copy of the list for data storage purposes
-    if self.reconstructionThread:
-      while self.reconstructionThread.isAlive():
-        pass # wait until the thread terminates? TODO: Ask Andras if there is a safer way
-    # Do one final reconstruction
-    markupsNode = self.wirePoints_Needle
-    self.MarkupsToModelCurveNode.SetAndObserveMarkupsNodeID(markupsNode.GetID())
-    modelNode = self.getCatheterModelForPathNumber(self.pathCount)
-    self.MarkupsToModelCurveNode.SetAndObserveModelNodeID(modelNode.GetID())
-    self.MarkupsToModelLogic.UpdateOutputModel(self.MarkupsToModelCurveNode)
-    
-    # create a copy of the markups for analysis purposes
-    storeRawFiducialsListName = 'WirePoints_Needle_RawPath' + str(self.pathCount)
-    storeRawFiducialsList = self.initializeFiducialList(storeRawFiducialsListName)
-    self.copyFiducialsFromListToList(self.wirePoints_Needle,storeRawFiducialsList)
+    # The in-flight live reconstruction is out of date, discard it and do one final high resolution reconstruction here,
+    # reparameterizing all the points rather than relying on the incremental fit.
+    # The raw points are kept in the path store for analysis purposes.
+    self.catheterReconstructionWorker.cancel()
+    wirePointsMm = collectFiducialsSupplementLogic.getPointsMm().copy()
+    wireTimestampsSec = collectFiducialsSupplementLogic.getTimestampsSec().copy()
+    curveCoefficients, numberOfFittedPoints = self.catheterReconstructionLogic.fitCatheterCurve(wirePointsMm)
+    self.catheterPathStore.addPath(self.pathCount, wirePointsMm, wireTimestampsSec, curveCoefficients, numberOfFittedPoints)
+    self.updateCatheterModel()
+    self.updateCatheterAnalysis()
+    self.getCatheterLivePreviewModel().SetAndObservePolyData(vtk.vtkPolyData())
+    self.logCatheterRebuildStatistics()
     self.wirePoints_Needle.RemoveAllMarkups()
     self.pathCount = self.pathCount + 1
   
   def onWireMarkupsNodeModified(self, observer, eventid):
-    if self.reconstructionThread:
-      if self.reconstructionThread.isAlive():
-        return
-    markupsNode = self.wirePoints_Needle
-    if markupsNode.GetNumberOfFiducials() <= 10:
+    numberOfPoints = self.catheterCurveFit.getNumberOfPoints()
+    if numberOfPoints <= 10:
+      return
+    # the fit is already up to date, only the low resolution live tube is built in the worker
+    # the worker copies the points and only keeps the latest job, so this can be called for every flush
+    liveProfileName = self.catheterReconstructionLogic.liveProfileName
+    curvePointsMm = self.catheterCurveFit.getCurvePointsMm(self.catheterReconstructionLogic.getNumberOfCurveSamples(liveProfileName, numberOfPoints))
+    self.catheterReconstructionWorker.submit(curvePointsMm, self.pathCount)
+    
+  def onLiveCatheterReconstructed(self, polyData, pathNumber):
+    modelNode = self.getCatheterLivePreviewModel()
+    modelNode.SetAndObservePolyData(polyData)
+    modelNode.SetAndObserveTransformNodeID(self.wirePoints_Needle.GetTransformNodeID())
+    
+  def updateCatheterModel(self):
+    # All the visible paths share one model node, so the scene does not grow with the number of catheters.
+    # Tubes are only built for paths that have none yet, the rest are appended from the cache.
+    appendFilter = vtk.vtkAppendPolyData()
+    for pathNumber in self.catheterPathStore.getVisiblePathNumbers():
+      pathNumber = int(pathNumber)
+      if pathNumber not in self.catheterPolyDataByPathNumber:
+        curveCoefficients, numberOfFittedPoints = self.catheterPathStore.getPathCurve(pathNumber)
+        self.catheterPolyDataByPathNumber[pathNumber] = self.catheterReconstructionLogic.createCurvePolyData(curveCoefficients, numberOfFittedPoints)
+      appendFilter.AddInputData(self.catheterPolyDataByPathNumber[pathNumber])
+    catheterPolyData = vtk.vtkPolyData()
+    if appendFilter.GetNumberOfInputConnections(0) > 0:
+      appendFilter.Update()
+      catheterPolyData = appendFilter.GetOutput()
+    modelNode = self.getCatheterModel()
+    modelNode.SetAndObservePolyData(catheterPolyData)
+    modelNode.SetAndObserveTransformNodeID(self.wirePoints_Needle.GetTransformNodeID())
+    
+  def setCatheterPathVisible(self, pathNumber, visible):
+    self.catheterPathStore.setPathVisible(pathNumber, visible)
+    self.updateCatheterModel()
+    
+  def saveCatheterPaths(self, filePath):
+    logging.info('Saving catheter paths to {0}'.format(filePath))
+    self.catheterPathStore.save(filePath)
+    self.parameterNode.SetParameter('CatheterPathsFilePath', filePath)
+    
+  def loadCatheterPaths(self, filePath):
+    if not filePath or not os.path.isfile(filePath):
+      return
+    logging.info('Loading catheter paths from {0}'.format(filePath))
+    self.catheterPathStore.load(filePath)
+    self.catheterPolyDataByPathNumber = {}
+    if self.catheterPathStore.getNumberOfPaths() > 0:
+      self.pathCount = int(self.catheterPathStore.getPathNumbers().max()) + 1
+    self.updateCatheterModel()
+    self.updateCatheterAnalysis()
+    
+  def updateCatheterAnalysis(self):
+    # the stored paths changed
+    self.catheterPathComparison = None
+    if (not self.isFeaturePanelCreated('reconstruction')):
+      return # done when the panel is created
+    self.updateCatheterDeviations()
+    self.updateCatheterReferenceComparison()
+    
+  def updateCatheterDeviations(self):
+    # compares all the stored paths with the current plan, cheap enough to run after every collected catheter
+    startTimeSec = time.time()
+    self.catheterDeviations = None
+    pathsTransformNode = self.wirePoints_Needle.GetParentTransformNode()
+    holeAxesMm = None
+    if pathsTransformNode and self.planningLogic: # no plan before the planning panel is opened
+      matrixGridToPaths = vtk.vtkMatrix4x4()
+      self.gridToPlan.GetMatrixTransformToNode(pathsTransformNode, matrixGridToPaths)
+      holeAxesMm = self.catheterAnalysisLogic.computeHoleAxesMm(self.planningLogic, matrixGridToPaths)
+    if holeAxesMm is not None:
+      # the plan is for the catheters to pass through the seroma, so their tips are expected where the holes leave it
+      self.planningAnatomyLogic.setTargetModelNode(self.tumorModel_Needle)
+      self.planningAnatomyLogic.setObstacleModelNode(self.chestwallModel_Chest)
+      holeIntersections = self.planningAnatomyLogic.computeHoleIntersections(self.planningLogic)
+      holeStartsMm, holeDirections = holeAxesMm
+      self.catheterDeviations = self.catheterAnalysisLogic.computeDeviations(self.catheterPathStore, self.planningLogic.holeLatticeIndices,
+                                                                             holeStartsMm, holeDirections, holeIntersections['targetExitDepthMm'])
+    if self.catheterDeviations is None:
+      self.getCatheterAnalysisTable('CatheterDeviations').SetAndObserveTable(vtk.vtkTable())
+      self.reconstructionDeviationValueLabel.setText("-")
+      return
+    self.catheterAnalysisLogic.updateTableNode(self.catheterDeviations, self.getCatheterAnalysisTable('CatheterDeviations'))
+    self.reconstructionDeviationValueLabel.setText("{0} catheters, up to {1:.1f} mm, {2:.1f} deg".format(
+      len(self.catheterDeviations['pathNumber']), self.catheterDeviations['maximumLateralDeviationMm'].max(),
+      self.catheterDeviations['angularDeviationDeg'].max()))
+    logging.debug('Catheter deviations computed in {0:.1f} ms'.format(1000 * (time.time() - startTimeSec)))
+    
+  def updateCatheterReferenceComparison(self):
+    # the index over the stored paths is only rebuilt after they change, switching references only indexes the new reference
+    startTimeSec = time.time()
+    self.catheterReferenceComparison = None
+    if self.catheterReferencePathStore and self.catheterPathStore.getNumberOfPaths() > 0:
+      if self.catheterPathComparison is None:
+        import CatheterAnalysis
+        self.catheterPathComparison = CatheterAnalysis.CatheterPathComparison(self.catheterPathStore)
+      referencePointsMm, referencePathIndices = self.catheterReferencePathStore.getAllPathPointsMm()
+      referencePathNumbers = self.catheterReferencePathStore.getPathNumbers()[referencePathIndices]
+      self.catheterReferenceComparison = self.catheterPathComparison.compare(referencePointsMm, referencePathNumbers)
+    tableNode = self.getCatheterAnalysisTable('CatheterReferenceComparison')
+    if self.catheterReferenceComparison is None:
+      tableNode.SetAndObserveTable(vtk.vtkTable())
+      self.reconstructionReferenceComparisonValueLabel.setText("-")
       return
-    self.MarkupsToModelCurveNode.SetAndObserveMarkupsNodeID(markupsNode.GetID())
-    modelNode = self.getCatheterModelForPathNumber(self.pathCount)
-    self.MarkupsToModelCurveNode.SetAndObserveModelNodeID(modelNode.GetID())
-    self.reconstructionThread = ReconstructionThread(self.MarkupsToModelCurveNode)
-    self.reconstructionThread.start()
-    logging.debug('onWireMarkupsNodeModified - end')
-    
-  def getCatheterModelForPathNumber(self, pathNumber):
-    nodeName = self.getCatheterModelNameForPathNumber(pathNumber)
+    self.catheterAnalysisLogic.updateTableNode(self.catheterReferenceComparison, tableNode, self.catheterAnalysisLogic.comparisonColumns)
+    self.reconstructionReferenceComparisonValueLabel.setText("{0} catheters, Hausdorff up to {1:.1f} mm".format(
+      len(self.catheterReferenceComparison['pathNumber']), numpy.nanmax(self.catheterReferenceComparison['hausdorffDistanceMm'])))
+    logging.debug('Catheter reference comparison computed in {0:.1f} ms'.format(1000 * (time.time() - startTimeSec)))
+    
+  def loadCatheterReferencePaths(self, filePath):
+    self.catheterReferencePathStore = None
+    if filePath and os.path.isfile(filePath):
+      logging.info('Loading catheter reference paths from {0}'.format(filePath))
+      import CatheterReconstruction
+      self.catheterReferencePathStore = CatheterReconstruction.CatheterPathStore(self.catheterReconstructionLogic.polynomialOrder)
+      self.catheterReferencePathStore.load(filePath)
+    self.parameterNode.SetParameter('CatheterReferencePathsFilePath', filePath)
+    self.updateCatheterReferenceComparison()
+    
+  def onReconstructionReferencePathsChanged(self, filePath):
+    logging.debug('onReconstructionReferencePathsChanged')
+    self.loadCatheterReferencePaths(filePath)
+    
+  def getCatheterAnalysisTable(self, nodeName):
+    tableNode = slicer.util.getNode(nodeName)
+    if not tableNode:
+      tableNode = slicer.vtkMRMLTableNode()
+      tableNode.SetName(nodeName)
+      slicer.mrmlScene.AddNode(tableNode)
+    return tableNode
+    
+  def onSaveSceneClicked(self):
+    # the paths and their deviations go in files next to the scene, the scene only keeps the paths file name
+    timeStamp = time.strftime("%Y%m%d-%H%M%S")
+    savedScenesDirectory = self.parameterNode.GetParameter('SavedScenesDirectory')
+    self.saveCatheterPaths(os.path.join(savedScenesDirectory, 'CathNavCatheterPaths-' + timeStamp + '.npz'))
+    if self.catheterDeviations is not None:
+      self.catheterAnalysisLogic.writeCsv(self.catheterDeviations, os.path.join(savedScenesDirectory, 'CathNavCatheterDeviations-' + timeStamp + '.csv'))
+    if self.catheterReferenceComparison is not None:
+      self.catheterAnalysisLogic.writeCsv(self.catheterReferenceComparison, os.path.join(savedScenesDirectory, 'CathNavCatheterReferenceComparison-' + timeStamp + '.csv'),
+                                          self.catheterAnalysisLogic.comparisonColumns)
+    Guidelet.onSaveSceneClicked(self)
+    
+  def logCatheterRebuildStatistics(self):
+    trackerFramePeriodSec = 1.0 / 50
+    for profileName in [self.catheterReconstructionLogic.liveProfileName, self.catheterReconstructionLogic.finalProfileName]:
+      statistics = self.catheterReconstructionLogic.getRebuildStatistics(profileName)
+      if not statistics:
+        continue
+      logging.info('{0} catheter model: {1} rebuilds, mean {2:.1f} ms, max {3:.1f} ms (tracker frame {4:.0f} ms), up to {5} triangles'.format(
+        profileName, statistics['numberOfRebuilds'], 1000 * statistics['meanDurationSec'], 1000 * statistics['maximumDurationSec'],
+        1000 * trackerFramePeriodSec, statistics['maximumNumberOfTriangles']))
+    
+  def getCatheterModel(self):
+    nodeName = 'Catheters'
     modelNode = slicer.util.getNode(nodeName)
     if not modelNode:
-      modelNode = slicer.vtkMRMLModelNode()
-      modelNode.SetName(nodeName)
-      slicer.mrmlScene.AddNode(modelNode)
-      # Add display node
-      displayNode = slicer.vtkMRMLModelDisplayNode()
-      displayNode.SetColor(0,1,0) # Green
-      displayNode.BackfaceCullingOff()
-      displayNode.SliceIntersectionVisibilityOn()
-      displayNode.SetSliceIntersectionThickness(2)
-      displayNode.SetOpacity(0.3) # Between 0-1, 1 being opaque
-      slicer.mrmlScene.AddNode(displayNode)
-      modelNode.SetAndObserveDisplayNodeID(displayNode.GetID())
+      modelNode = self.createCatheterModel(nodeName)
+    return modelNode
+  
+  def getCatheterLivePreviewModel(self):
+    # shows the catheter while its points are collected, it is added to the catheters model when collection stops
+    nodeName = 'CatheterLivePreview'
+    modelNode = slicer.util.getNode(nodeName)
+    if not modelNode:
+      modelNode = self.createCatheterModel(nodeName)
+      modelNode.SetSaveWithScene(False)
+      modelNode.GetDisplayNode().SetSaveWithScene(False)
+    return modelNode
+  
+  def createCatheterModel(self, nodeName):
+    modelNode = slicer.vtkMRMLModelNode()
+    modelNode.SetName(nodeName)
+    slicer.mrmlScene.AddNode(modelNode)
+    # Add display node
+    displayNode = slicer.vtkMRMLModelDisplayNode()
+    displayNode.SetColor(0,1,0) # Green
+    displayNode.BackfaceCullingOff()
+    displayNode.SliceIntersectionVisibilityOn()
+    displayNode.SetSliceIntersectionThickness(2)
+    displayNode.SetOpacity(0.3) # Between 0-1, 1 being opaque
+    slicer.mrmlScene.AddNode(displayNode)
+    modelNode.SetAndObserveDisplayNodeID(displayNode.GetID())
     return modelNode
   
-  def getCatheterModelNameForPathNumber(self, pathNumber):
-    return ('Catheter' + str(pathNumber))
-
   def onReconstructionCollectPointsButtonClicked(self):
     logging.debug('onReconstructionCollectPointsButtonClicked')
     if (self.reconstructionCollectPointsButton.checked):
@@ -1515,14 +2176,9 @@ class CathNavGuidelet(Guidelet):
   
   def onReconstructionDeleteLastButtonClicked(self):
     logging.debug('onReconstructionDeleteLastButtonClicked')
-    
-class ReconstructionThread (threading.Thread):
-  def __init__(self, markupsToModelNode):
-    threading.Thread.__init__(self)
-    self.markupsToModelNode = markupsToModelNode
-    self.MarkupsToModelLogic = slicer.modules.markupstomodel.logic()
-    
-  def run(self):
-    logging.debug("ReconstructionThread.run()")
-    self.MarkupsToModelLogic.UpdateOutputModel(self.markupsToModelNode)
-  
\ No newline at end of file
+    pathNumber = self.catheterPathStore.removeLastPath()
+    if pathNumber is None:
+      return
+    self.catheterPolyDataByPathNumber.pop(pathNumber, None)
+    self.updateCatheterModel()
+    self.updateCatheterAnalysis()